@@ -324,6 +324,7 @@ async def parallel_save_chat_logs(
 
 
 # レート制限用のセマフォ（OpenAI API同時呼び出し数制限）
+# 同時実行数の上限のみ。RPM/TPMは各LLMクライアント内の共有ペーサー（module.rate_pacer）で管理
 OPENAI_SEMAPHORE = asyncio.Semaphore(10)  # 最大10並列まで
 
 async def rate_limited_openai_call(func, *args, **kwargs):
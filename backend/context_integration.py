@@ -10,6 +10,7 @@ import asyncio
 
 from context_manager import ContextManager, ContextMetrics
 from embedding_utils import EmbeddingClient, SemanticSearch
+from vector_index import get_vector_index
 
 logger = logging.getLogger(__name__)
 
@@ -183,6 +184,17 @@ async def save_message_with_embedding(
                         .execute()
                     )
                     
+                    # 検索はプロセス内のベクトルインデックスで行う
+                    if message_data.get("conversation_id"):
+                        await asyncio.to_thread(
+                            get_vector_index().add,
+                            message_data["conversation_id"],
+                            [message_id],
+                            [message_text],
+                            [embedding],
+                            [{"sender": message_data.get("sender"), "created_at": result.data[0].get("created_at")}]
+                        )
+                    
                     logger.info(f"✅ 埋め込みを生成・保存: メッセージID={message_id}")
                     
             except Exception as e:
@@ -253,7 +265,8 @@ async def update_conversation_summary(
         updated = await context_manager.rotate_summary_if_needed(
             conversation_id=conversation_id,
             turn_count=turn_count,
-            force=force
+            force=force,
+            conversation_history=conversation_history
         )
         
         if updated:
@@ -1,17 +1,38 @@
 """
 対話コンテキスト管理モジュール
 トークン予算内で最適なプロンプトを構築し、長期的な文脈を維持
+
+- メッセージごとのトークン数はメッセージIDをキーにキャッシュし、会話が続いても数え直さない
+- 直近会話は新しい順の累積和（プレフィックス和）で予算に収まる件数を求める（履歴の長さに対して線形）
+- セクションの配分比率（SYSTEM 10% / SUMMARY 20% / RECENT 60% / RETRIEVED 10%）のうち使われない枠は、
+  優先度順に他のセクションへ再配分する（選んだ配分は ContextMetrics.allocation）
+- 長期要約は会話ごとの累積要約（chat_conversations.metadata の rolling_summary）。直近会話より古い未要約の発話が
+  SUMMARY_ROTATE_EVERY 件、または SUMMARY_PRESSURE_TOKENS トークンを超えたら、小さいモデルで要約に取り込む
+  （応答を待たせないよう別タスクで実行し、次のターンから使う。リクエストのコンテキストは引き継がず、
+  トークン使用量はリクエストに合算せず、スケジューラでは endpoint="background" として扱う）。
+  累積要約がない会話はキーワードで抽出した簡易要約
+- ENABLE_ROLLING_SUMMARY=false で累積要約を無効化
+- 埋め込みクライアントがある場合、RETRIEVED は会話ごとのプロセス内ベクトルインデックス（vector_index）から
+  直近会話を除いた類似発話の上位 K_RETRIEVE 件（類似度 RETRIEVAL_MIN_SIMILARITY 以上）。
+  インデックスにない履歴の埋め込みは別タスクで生成して追加する
 """
 import os
 import json
 import logging
 import asyncio
+import contextvars
+from bisect import bisect_right
+from itertools import accumulate
 from typing import List, Dict, Optional, Any, Tuple
 from datetime import datetime, timezone, timedelta
 from dataclasses import dataclass, field
 import hashlib
 import numpy as np
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+
+from module.llm_context import llm_context
+from prompt.prompt import ROLLING_SUMMARY_PROMPT
+from vector_index import VectorIndex, get_vector_index
 
 logger = logging.getLogger(__name__)
 
@@ -26,7 +47,12 @@ class ContextSection:
     
 @dataclass
 class ContextMetrics:
-    """コンテキスト管理のメトリクス"""
+    """
+    コンテキスト管理のメトリクス
+    
+    build_context は呼び出しごとに新しいインスタンスを返す（同時に構築する会話どうしで上書きしない）。
+    summary_updates など構築をまたいで数える項目は ContextManager.metrics に累積し、返す時点の値を写す
+    """
     total_tokens: int = 0
     system_tokens: int = 0
     summary_tokens: int = 0
@@ -36,6 +62,39 @@ class ContextMetrics:
     retrieval_hits: int = 0
     topic_switches: int = 0
     last_summary_update: Optional[datetime] = None
+    allocation: Dict[str, int] = field(default_factory=dict)  # セクションごとに割り当てたトークン数
+    reallocated_tokens: int = 0  # 使われない枠から他のセクションに回したトークン数
+    token_cache_hits: int = 0  # この構築でキャッシュから得たメッセージのトークン数の件数
+    recent_messages: int = 0  # 直近会話に含めたメッセージ数
+    summary_updates: int = 0  # 累積要約を更新した回数
+    summary_failures: int = 0  # 累積要約の更新に失敗した回数
+
+@dataclass
+class ConversationSummary:
+    """会話ごとの累積要約（chat_conversations.metadata の rolling_summary に保存）"""
+    text: str = ""
+    summarized_until: Optional[Any] = None  # 要約に取り込んだ最後のメッセージID
+    summarized_messages: int = 0  # 要約に取り込んだメッセージ数
+    updated_at: Optional[str] = None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "text": self.text,
+            "summarized_until": self.summarized_until,
+            "summarized_messages": self.summarized_messages,
+            "updated_at": self.updated_at,
+        }
+    
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "ConversationSummary":
+        if not isinstance(data, dict):
+            return cls()
+        return cls(
+            text=data.get("text") or "",
+            summarized_until=data.get("summarized_until"),
+            summarized_messages=int(data.get("summarized_messages") or 0),
+            updated_at=data.get("updated_at")
+        )
     
 class ContextManager:
     """
@@ -47,11 +106,15 @@ class ContextManager:
         self,
         supabase_client=None,
         embedding_client=None,
-        token_counter=None
+        token_counter=None,
+        llm_client=None,
+        vector_index: Optional[VectorIndex] = None
     ):
         # クライアント
         self.supabase = supabase_client
         self.embedding_client = embedding_client
+        self.llm_client = llm_client  # 累積要約の生成用（generate_response_async を持つ非同期クライアント）
+        self._vector_index = vector_index
         self.token_counter = token_counter or self._simple_token_counter
         
         # 設定値（環境変数から取得）
@@ -61,17 +124,34 @@ class ContextManager:
         self.summary_max_tokens = int(os.environ.get("SUMMARY_MAXTOKENS", "500"))
         self.mmr_lambda = float(os.environ.get("MMR_LAMBDA", "0.7"))
         self.topic_tau = float(os.environ.get("TOPIC_TAU", "0.78"))
+        self.retrieval_min_similarity = float(os.environ.get("RETRIEVAL_MIN_SIMILARITY", "0.5"))
         self.summary_rotate_every = int(os.environ.get("SUMMARY_ROTATE_EVERY", "20"))
+        self.rolling_summary_enabled = os.environ.get("ENABLE_ROLLING_SUMMARY", "true").lower() == "true"
+        self.summary_pressure_tokens = int(os.environ.get("SUMMARY_PRESSURE_TOKENS", "1500"))
+        self.summary_fold_max_messages = int(os.environ.get("SUMMARY_FOLD_MAX_MESSAGES", "40"))
+        self.summary_cache_size = int(os.environ.get("SUMMARY_CACHE_SIZE", "1000"))
+        
+        self.token_cache_size = int(os.environ.get("CONTEXT_TOKEN_CACHE_SIZE", "10000"))
         
         # トークン配分比率
         self.system_ratio = 0.10
         self.summary_ratio = 0.20
         self.recent_ratio = 0.60
         self.retrieved_ratio = 0.10
+        # ユーザーメッセージ以外に確保する余裕
+        self.reserve_tokens = 100
         
-        # 内部状態
+        # 内部状態（構築をまたいで数えるメトリクス。構築ごとの値は build_context の戻り値）
         self.metrics = ContextMetrics()
         self.last_embeddings_cache = {}
+        # メッセージID（IDがなければ内容のハッシュ）→ 整形済みの行のトークン数（LRU）
+        self._message_token_cache: "OrderedDict[Any, int]" = OrderedDict()
+        # 会話ID → 累積要約（LRU、DBから読んだ要約がない会話も空の要約として持つ）
+        self._summaries: "OrderedDict[str, ConversationSummary]" = OrderedDict()
+        # 会話ID → 実行中の要約更新タスク（同じ会話で重複して更新しない）
+        self._summary_tasks: Dict[str, asyncio.Task] = {}
+        # 会話ID → 実行中の埋め込み追加タスク
+        self._index_tasks: Dict[str, asyncio.Task] = {}
         
         logger.info(f"📋 ContextManager初期化完了")
         logger.info(f"   トークン予算: {self.token_budget}")
@@ -96,68 +176,108 @@ class ContextManager:
         トークン予算内で最適なコンテキストを構築
         
         Returns:
-            (messages, metrics)のタプル
+            (messages, metrics)のタプル（metrics はこの呼び出しのメトリクス）
         """
         logger.info(f"🔄 コンテキスト構築開始 (会話ID: {conversation_id[:8]}...)")
+        # 要約の読み込み・埋め込みの生成で中断する間に他の会話の構築が進むため、メトリクスは呼び出しごとに持つ
+        metrics = ContextMetrics()
         
-        sections = []
+        # ユーザーメッセージ分と余裕を除いた予算をセクションに配分
+        available = max(0, self.token_budget - self.token_counter(user_message) - self.reserve_tokens)
+        ratios = self._section_ratios()
         
-        # 1. システムプロンプト（10%）
-        system_budget = int(self.token_budget * self.system_ratio)
+        # 1. システムプロンプト（圧縮しない）
+        system_content = self._build_system_prompt(system_prompt)
         system_section = ContextSection(
             name="SYSTEM",
-            content=self._build_system_prompt(system_prompt),
-            tokens=self.token_counter(system_prompt),
+            content=system_content,
+            tokens=self.token_counter(system_content),
             priority=1,
             can_compress=False
         )
-        sections.append(system_section)
         
-        # 2. 長期要約（20%） - Phase 1では簡易版
-        summary_budget = int(self.token_budget * self.summary_ratio)
+        # 2. 長期要約 - Phase 1では簡易版
         summary_section = await self._get_or_create_summary(
             conversation_id, 
             conversation_history,
-            summary_budget
+            int(available * ratios["SUMMARY"])
         )
-        if summary_section:
-            sections.append(summary_section)
         
-        # 3. 直近会話（60%）
-        recent_budget = int(self.token_budget * self.recent_ratio)
-        recent_section = self._build_recent_context(
-            conversation_history,
-            recent_budget,
-            self.n_recent
-        )
-        sections.append(recent_section)
+        # 3. 直近会話（この時点では予算を決めず、各メッセージのトークン数だけ求める）
+        recent_tokens = self._recent_message_tokens(conversation_history, self.n_recent, metrics)
         
-        # 4. 検索結果（10%） - Phase 2で実装
+        # 4. 検索結果 - Phase 2で実装
+        retrieved_section = None
         if self.embedding_client and self.k_retrieve > 0:
-            retrieved_budget = int(self.token_budget * self.retrieved_ratio)
             retrieved_section = await self._retrieve_relevant_context(
                 user_message,
                 conversation_id,
-                retrieved_budget,
-                self.k_retrieve
+                int(available * ratios["RETRIEVED"]),
+                self.k_retrieve,
+                conversation_history,
+                metrics
             )
-            if retrieved_section:
-                sections.append(retrieved_section)
         
-        # 5. トークン調整（パッキング）
+        # 5. 各セクションが必要とするトークン数から配分を決め、配分に合わせて各セクションを詰める
+        demands = {
+            "SYSTEM": system_section.tokens,
+            "SUMMARY": summary_section.tokens if summary_section else 0,
+            "RECENT": sum(recent_tokens),
+            "RETRIEVED": retrieved_section.tokens if retrieved_section else 0,
+        }
+        allocation = self._allocate_budget(demands, available)
+        
+        sections = [system_section]
+        for section in (summary_section, retrieved_section):
+            if section:
+                sections.append(self._fit_section(section, allocation[section.name]))
+        sections.append(self._build_recent_context(
+            conversation_history, allocation["RECENT"], self.n_recent, recent_tokens, metrics
+        ))
+        
         messages = self._pack_into_budget(sections, user_message)
         
         # メトリクス更新
-        self._update_metrics(sections)
+        self._update_metrics(metrics, sections, allocation, available)
         
         logger.info(f"✅ コンテキスト構築完了")
-        logger.info(f"   総トークン: {self.metrics.total_tokens}/{self.token_budget}")
-        logger.info(f"   セクション: SYSTEM={self.metrics.system_tokens}, "
-                   f"SUMMARY={self.metrics.summary_tokens}, "
-                   f"RECENT={self.metrics.recent_tokens}, "
-                   f"RETRIEVED={self.metrics.retrieved_tokens}")
+        logger.info(f"   総トークン: {metrics.total_tokens}/{self.token_budget}")
+        logger.info(f"   セクション: SYSTEM={metrics.system_tokens}, "
+                   f"SUMMARY={metrics.summary_tokens}, "
+                   f"RECENT={metrics.recent_tokens}, "
+                   f"RETRIEVED={metrics.retrieved_tokens}")
         
-        return messages, self.metrics
+        return messages, metrics
+    
+    def _section_ratios(self) -> Dict[str, float]:
+        return {
+            "SYSTEM": self.system_ratio,
+            "SUMMARY": self.summary_ratio,
+            "RECENT": self.recent_ratio,
+            "RETRIEVED": self.retrieved_ratio,
+        }
+    
+    def _allocate_budget(self, demands: Dict[str, int], available: int) -> Dict[str, int]:
+        """
+        セクションごとのトークン配分を決める
+        
+        システムプロンプトは必要な分をすべて確保し、他のセクションには配分比率の枠（必要な分が少なければその分）を
+        優先度順に割り当てる。余った枠は優先度順（SUMMARY → RECENT → RETRIEVED）に、まだ必要な分が残るセクションへ回す
+        """
+        ratios = self._section_ratios()
+        order = ["SUMMARY", "RECENT", "RETRIEVED"]
+        
+        allocation = {"SYSTEM": demands.get("SYSTEM", 0)}
+        remaining = max(0, available - allocation["SYSTEM"])
+        for name in order:
+            allocation[name] = min(demands.get(name, 0), int(available * ratios[name]), remaining)
+            remaining -= allocation[name]
+        for name in order:
+            extra = min(demands.get(name, 0) - allocation[name], remaining)
+            if extra > 0:
+                allocation[name] += extra
+                remaining -= extra
+        return allocation
     
     def _build_system_prompt(self, base_prompt: str) -> str:
         """システムプロンプトを構築"""
@@ -178,12 +298,29 @@ class ContextManager:
         history: Optional[List[Dict[str, Any]]],
         budget: int
     ) -> Optional[ContextSection]:
-        """長期要約を取得または生成（Phase 1では簡易版）"""
-        # Phase 1: 最近の重要発話から簡易要約を作成
+        """長期要約を取得（累積要約があればそれを使い、必要なら別タスクで更新を始める）"""
+        summary = None
+        if self._rolling_summary_available(conversation_id):
+            summary = await self._load_summary(conversation_id)
+            if history:
+                self._schedule_summary_update(conversation_id, history, summary)
+        
+        if summary is not None and summary.text:
+            summary_text = "## これまでの会話の要約\n" + summary.text
+            return ContextSection(
+                name="SUMMARY",
+                content=summary_text,
+                tokens=self.token_counter(summary_text),
+                priority=2,
+                can_compress=True
+            )
+        return self._keyword_summary(history)
+    
+    def _keyword_summary(self, history: Optional[List[Dict[str, Any]]]) -> Optional[ContextSection]:
+        """累積要約がない場合の簡易要約（直近の重要発話をキーワードで抽出）"""
         if not history or len(history) < 5:
             return None
         
-        # 簡易的な要約（後でLLMベースに置換）
         important_messages = []
         for msg in history[-20:]:  # 直近20件から抽出
             content = msg.get("message", "")
@@ -204,13 +341,206 @@ class ContextManager:
             can_compress=True
         )
     
+    # ---------------------------------
+    # 累積要約
+    # ---------------------------------
+    
+    def _rolling_summary_available(self, conversation_id: str) -> bool:
+        return self.rolling_summary_enabled and self.llm_client is not None and bool(conversation_id)
+    
+    async def _load_summary(self, conversation_id: str) -> ConversationSummary:
+        """累積要約を取得（キャッシュになければ chat_conversations.metadata から読む）"""
+        summary = self._summaries.get(conversation_id)
+        if summary is not None:
+            self._summaries.move_to_end(conversation_id)
+            return summary
+        
+        summary = ConversationSummary()
+        if self.supabase is not None:
+            try:
+                metadata = await asyncio.to_thread(self._read_metadata, conversation_id)
+                summary = ConversationSummary.from_dict(metadata.get("rolling_summary"))
+            except Exception as e:
+                logger.warning(f"⚠️ 累積要約の読み込みエラー（要約なしで継続）: {e}")
+        self._cache_summary(conversation_id, summary)
+        return summary
+    
+    def _cache_summary(self, conversation_id: str, summary: ConversationSummary):
+        self._summaries[conversation_id] = summary
+        self._summaries.move_to_end(conversation_id)
+        if len(self._summaries) > self.summary_cache_size:
+            self._summaries.popitem(last=False)
+    
+    def _read_metadata(self, conversation_id: str) -> Dict[str, Any]:
+        result = self.supabase.table("chat_conversations").select("metadata").eq("id", conversation_id).execute()
+        if not result.data:
+            return {}
+        metadata = result.data[0].get("metadata") or {}
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata) if metadata else {}
+        return metadata if isinstance(metadata, dict) else {}
+    
+    def _save_summary(self, conversation_id: str, summary: ConversationSummary):
+        """累積要約を chat_conversations.metadata に保存（他のキーは残す）"""
+        result = self.supabase.table("chat_conversations").select("metadata").eq("id", conversation_id).execute()
+        stored = result.data[0].get("metadata") if result.data else None
+        metadata = json.loads(stored) if isinstance(stored, str) and stored else (stored or {})
+        metadata["rolling_summary"] = summary.to_dict()
+        # 文字列で保存されている場合は文字列のまま書き戻す（conversation_api と同じ形式）
+        value = json.dumps(metadata, ensure_ascii=False) if isinstance(stored, str) else metadata
+        self.supabase.table("chat_conversations").update({"metadata": value}).eq("id", conversation_id).execute()
+    
+    def _unsummarized_messages(
+        self,
+        history: List[Dict[str, Any]],
+        summary: Optional[ConversationSummary]
+    ) -> List[Dict[str, Any]]:
+        """直近会話より古く、まだ要約に取り込んでいない発話（古い順、IDのない発話は位置を記録できないため含めない）"""
+        older = [msg for msg in history[:max(0, len(history) - self.n_recent)] if msg.get("id") is not None]
+        until = summary.summarized_until if summary is not None else None
+        if until is None:
+            return older
+        for index, msg in enumerate(older):
+            if msg["id"] == until:
+                return older[index + 1:]
+        # 取り込んだ位置が取得した範囲にない場合はIDの大小で判断
+        try:
+            return [msg for msg in older if msg["id"] > until]
+        except TypeError:
+            return older
+    
+    def _needs_summary_update(self, pending: List[Dict[str, Any]]) -> bool:
+        """未要約の発話が件数またはトークン数のしきい値を超えたか"""
+        if not pending:
+            return False
+        if len(pending) >= self.summary_rotate_every:
+            return True
+        pending_tokens = sum(self._lookup_message_tokens(msg)[0] for msg in pending)
+        return pending_tokens >= self.summary_pressure_tokens
+    
+    def _schedule_summary_update(
+        self,
+        conversation_id: str,
+        history: List[Dict[str, Any]],
+        summary: Optional[ConversationSummary]
+    ) -> Optional[asyncio.Task]:
+        """しきい値を超えていれば累積要約の更新を別タスクで開始（応答は待たせない）"""
+        if conversation_id in self._summary_tasks:
+            return None
+        pending = self._unsummarized_messages(history, summary)
+        if not self._needs_summary_update(pending):
+            return None
+        
+        # リクエストのコンテキスト（collect_usage・ユーザーキー）を引き継がない新しいコンテキストで実行
+        task = asyncio.create_task(
+            self._update_summary_in_background(conversation_id, pending),
+            context=contextvars.Context()
+        )
+        self._summary_tasks[conversation_id] = task
+        task.add_done_callback(lambda _: self._summary_tasks.pop(conversation_id, None))
+        return task
+    
+    async def _update_summary_in_background(self, conversation_id: str, pending: List[Dict[str, Any]]) -> bool:
+        with llm_context(endpoint="background"):
+            return await self._update_summary(conversation_id, pending)
+    
+    async def _update_summary(self, conversation_id: str, pending: List[Dict[str, Any]]) -> bool:
+        """古い方から最大 summary_fold_max_messages 件を累積要約に取り込んで保存"""
+        span = pending[:self.summary_fold_max_messages]
+        try:
+            previous = await self._load_summary(conversation_id)
+            prompt = ROLLING_SUMMARY_PROMPT.format(
+                previous_summary=previous.text or "（なし）",
+                new_messages="\n".join(self._format_message(msg) for msg in span),
+                max_chars=self.summary_max_tokens
+            )
+            with llm_context(step="rolling_summary"):
+                text = await self.llm_client.generate_response_async([{"role": "user", "content": prompt}])
+            text = (text or "").strip()
+            if not text:
+                raise ValueError("要約が空です")
+            if self.token_counter(text) > self.summary_max_tokens:
+                text = self._compress_section(
+                    ContextSection(name="SUMMARY", content=text), self.summary_max_tokens
+                )
+            
+            summary = ConversationSummary(
+                text=text,
+                summarized_until=span[-1]["id"],
+                summarized_messages=previous.summarized_messages + len(span),
+                updated_at=datetime.now(timezone.utc).isoformat()
+            )
+            self._cache_summary(conversation_id, summary)
+            if self.supabase is not None:
+                await asyncio.to_thread(self._save_summary, conversation_id, summary)
+            
+            self.metrics.summary_updates += 1
+            self.metrics.last_summary_update = datetime.now(timezone.utc)
+            logger.info(
+                f"📝 累積要約を更新 (会話ID: {conversation_id[:8]}...): "
+                f"{len(span)}件を取り込み（計{summary.summarized_messages}件）, {self.token_counter(text)}トークン"
+            )
+            return True
+        except Exception as e:
+            self.metrics.summary_failures += 1
+            logger.warning(f"⚠️ 累積要約の更新エラー（次のターンで再試行）: {e}")
+            return False
+    
+    def _format_message(self, msg: Dict[str, Any]) -> str:
+        return f"{msg.get('sender', 'user')}: {msg.get('message', '')}"
+    
+    def _message_tokens(self, msg: Dict[str, Any], metrics: Optional[ContextMetrics] = None) -> int:
+        """
+        整形済みの1行（"sender: message"）のトークン数（区切りの改行分として1を加える）
+        
+        メッセージIDをキーにキャッシュする（IDがなければ内容のハッシュ）。キャッシュにあれば metrics の token_cache_hits に数える
+        """
+        tokens, hit = self._lookup_message_tokens(msg)
+        if hit and metrics is not None:
+            metrics.token_cache_hits += 1
+        return tokens
+    
+    def _lookup_message_tokens(self, msg: Dict[str, Any]) -> Tuple[int, bool]:
+        """_message_tokens の本体（メトリクスを変更しない）。(トークン数, キャッシュにあったか) を返す"""
+        line = self._format_message(msg)
+        msg_id = msg.get("id")
+        if msg_id is not None:
+            key = (msg_id, len(line))
+        else:
+            key = hashlib.sha1(line.encode("utf-8")).hexdigest()
+        
+        cache = self._message_token_cache
+        tokens = cache.get(key)
+        if tokens is not None:
+            cache.move_to_end(key)
+            return tokens, True
+        
+        tokens = self.token_counter(line) + 1
+        cache[key] = tokens
+        if len(cache) > self.token_cache_size:
+            cache.popitem(last=False)
+        return tokens, False
+    
+    def _recent_message_tokens(
+        self,
+        history: Optional[List[Dict[str, Any]]],
+        n_recent: int,
+        metrics: Optional[ContextMetrics] = None
+    ) -> List[int]:
+        """直近N件の各メッセージのトークン数（古い順）"""
+        if not history:
+            return []
+        return [self._message_tokens(msg, metrics) for msg in history[-n_recent:]]
+    
     def _build_recent_context(
         self,
         history: Optional[List[Dict[str, Any]]],
         budget: int,
-        n_recent: int
+        n_recent: int,
+        message_tokens: Optional[List[int]] = None,
+        metrics: Optional[ContextMetrics] = None
     ) -> ContextSection:
-        """直近の会話コンテキストを構築"""
+        """直近の会話コンテキストを構築（予算を超える場合は古い方から削る、message_tokens は求め済みの各メッセージのトークン数）"""
         if not history:
             return ContextSection(
                 name="RECENT",
@@ -220,118 +550,200 @@ class ContextManager:
             )
         
         # 直近N件を取得
-        recent_messages = history[-n_recent:] if len(history) > n_recent else history
-        
-        # メッセージを整形
-        formatted_messages = []
-        for msg in recent_messages:
-            role = msg.get("sender", "user")
-            content = msg.get("message", "")
-            formatted_messages.append(f"{role}: {content}")
+        recent_messages = history[-n_recent:]
         
-        recent_text = "\n".join(formatted_messages)
-        
-        # トークン数が予算を超える場合は古い方から削る
-        while self.token_counter(recent_text) > budget and formatted_messages:
-            formatted_messages.pop(0)
-            recent_text = "\n".join(formatted_messages)
+        # 新しい順の累積トークン数から、予算に収まる件数を二分探索で求める
+        if message_tokens is None:
+            message_tokens = self._recent_message_tokens(history, n_recent, metrics)
+        newest_first = list(accumulate(reversed(message_tokens)))
+        count = bisect_right(newest_first, budget)
+        kept = recent_messages[len(recent_messages) - count:] if count else []
+        if metrics is not None:
+            metrics.recent_messages = count
         
         return ContextSection(
             name="RECENT",
-            content=recent_text,
-            tokens=self.token_counter(recent_text),
+            content="\n".join(self._format_message(msg) for msg in kept),
+            tokens=newest_first[count - 1] if count else 0,
             priority=3,
             can_compress=False
         )
     
+    @property
+    def vector_index(self) -> VectorIndex:
+        if self._vector_index is None:
+            self._vector_index = get_vector_index()
+        return self._vector_index
+    
     async def _retrieve_relevant_context(
         self,
         query: str,
         conversation_id: str,
         budget: int,
-        k: int
+        k: int,
+        history: Optional[List[Dict[str, Any]]] = None,
+        metrics: Optional[ContextMetrics] = None
     ) -> Optional[ContextSection]:
-        """関連する過去の文脈を検索（Phase 2で実装）"""
-        # Phase 2で埋め込みベースの検索を実装
-        # 現在はスタブ
-        return None
+        """関連する過去の発話をベクトルインデックスから検索（直近会話に含まれる発話は除く。件数は metrics の retrieval_hits）"""
+        if not conversation_id:
+            return None
+        if history:
+            self._schedule_indexing(conversation_id, history)
+        
+        try:
+            query_embedding = await self.embedding_client.generate_embedding(query)
+            recent_ids = [msg["id"] for msg in (history or [])[-self.n_recent:] if msg.get("id") is not None]
+            hits = self.vector_index.search(
+                conversation_id,
+                query_embedding,
+                k=k + 1,  # 保存済みの今回の発話が含まれる場合の分
+                min_similarity=self.retrieval_min_similarity,
+                exclude_ids=recent_ids
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ 関連発話の検索エラー（検索なしで継続）: {e}")
+            return None
+        
+        hits = [hit for hit in hits if hit.text != query][:k]
+        if not hits:
+            return None
+        if metrics is not None:
+            metrics.retrieval_hits = len(hits)
+        
+        lines = [f"- {hit.metadata.get('sender') or 'user'}: {hit.text}" for hit in hits]
+        content = "## 関連する過去の会話\n" + "\n".join(lines)
+        return ContextSection(
+            name="RETRIEVED",
+            content=content,
+            tokens=self.token_counter(content),
+            priority=4,
+            can_compress=True
+        )
+    
+    def _schedule_indexing(self, conversation_id: str, history: List[Dict[str, Any]]) -> Optional[asyncio.Task]:
+        """インデックスにない履歴の埋め込みを別タスクで生成して追加（応答は待たせない）"""
+        if conversation_id in self._index_tasks:
+            return None
+        pending = {msg["id"]: msg for msg in history if msg.get("id") is not None and msg.get("message")}
+        missing = self.vector_index.missing_ids(conversation_id, pending)
+        if not missing:
+            return None
+        
+        task = asyncio.create_task(self._index_messages(conversation_id, [pending[msg_id] for msg_id in missing]))
+        self._index_tasks[conversation_id] = task
+        task.add_done_callback(lambda _: self._index_tasks.pop(conversation_id, None))
+        return task
+    
+    async def _index_messages(self, conversation_id: str, messages: List[Dict[str, Any]]) -> int:
+        try:
+            texts = [msg["message"] for msg in messages]
+            embeddings = await self.embedding_client.generate_batch_embeddings(texts)
+            added = await asyncio.to_thread(
+                self.vector_index.add,
+                conversation_id,
+                [msg["id"] for msg in messages],
+                texts,
+                embeddings,
+                [{"sender": msg.get("sender"), "created_at": msg.get("created_at")} for msg in messages]
+            )
+            logger.info(f"🧭 ベクトルインデックスに追加 (会話ID: {conversation_id[:8]}...): {added}件")
+            return added
+        except Exception as e:
+            logger.warning(f"⚠️ 埋め込みの追加エラー（次のターンで再試行）: {e}")
+            return 0
+    
+    def _fit_section(self, section: ContextSection, budget: int) -> ContextSection:
+        """配分を超える圧縮可能なセクションを配分まで圧縮"""
+        if section.tokens <= budget:
+            return section
+        content = self._compress_section(section, budget) if section.can_compress else ""
+        return ContextSection(
+            name=section.name,
+            content=content,
+            tokens=self.token_counter(content) if content else 0,
+            priority=section.priority,
+            can_compress=section.can_compress
+        )
     
     def _pack_into_budget(
         self,
         sections: List[ContextSection],
         user_message: str
     ) -> List[Dict[str, str]]:
-        """セクションをトークン予算内にパッキング"""
-        messages = []
-        total_tokens = 0
-        user_tokens = self.token_counter(user_message)
-        
-        # ユーザーメッセージ分を確保
-        available_budget = self.token_budget - user_tokens - 100  # 余裕を持たせる
-        
+        """配分に合わせて詰めたセクションをメッセージにまとめる"""
         # 優先度順にソート
         sections.sort(key=lambda x: x.priority)
         
-        # システムプロンプトを構築
         system_parts = []
         context_parts = []
-        
         for section in sections:
-            if total_tokens + section.tokens <= available_budget:
-                if section.name == "SYSTEM":
-                    system_parts.append(section.content)
-                else:
-                    if section.content:  # 空でない場合のみ追加
-                        context_parts.append(f"[{section.name}]\n{section.content}")
-                total_tokens += section.tokens
-            elif section.can_compress and section.tokens > 0:
-                # 圧縮可能なセクションは部分的に含める
-                remaining_budget = available_budget - total_tokens
-                if remaining_budget > 100:  # 最低100トークンは欲しい
-                    compressed = self._compress_section(section, remaining_budget)
-                    context_parts.append(f"[{section.name}]\n{compressed}")
-                    total_tokens += self.token_counter(compressed)
+            if section.name == "SYSTEM":
+                system_parts.append(section.content)
+            elif section.content:  # 空でない場合のみ追加
+                context_parts.append(f"[{section.name}]\n{section.content}")
         
         # メッセージリストを構築
         system_content = "\n".join(system_parts)
         if context_parts:
             system_content += "\n\n" + "\n\n".join(context_parts)
         
-        messages.append({"role": "system", "content": system_content})
-        messages.append({"role": "user", "content": user_message})
-        
-        return messages
+        return [
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": user_message}
+        ]
     
     def _compress_section(self, section: ContextSection, target_tokens: int) -> str:
-        """セクションを目標トークン数に圧縮"""
-        # 簡易的な圧縮: 文字数で切り詰める
-        # 後でより高度な圧縮アルゴリズムに置換
-        content = section.content
-        
-        # 概算: 1トークン ≈ 2.5文字（日本語の場合）
-        target_chars = int(target_tokens * 2.5)
-        
-        if len(content) > target_chars:
-            return content[:target_chars] + "..."
-        
-        return content
+        """セクションを目標トークン数に圧縮（先頭から行単位で収まる分だけ残す）"""
+        lines = section.content.split("\n")
+        prefix = list(accumulate(self.token_counter(line) + 1 for line in lines))
+        count = bisect_right(prefix, target_tokens)
+        if count:
+            return "\n".join(lines[:count])
+        
+        # 1行目も収まらない場合は文字数を二分探索して切り詰める
+        first = lines[0]
+        low, high = 0, len(first)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.token_counter(first[:middle] + "...") <= target_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return first[:low] + "..." if low else ""
     
-    def _update_metrics(self, sections: List[ContextSection]):
-        """メトリクスを更新"""
-        self.metrics.total_tokens = sum(s.tokens for s in sections)
+    def _update_metrics(
+        self,
+        metrics: ContextMetrics,
+        sections: List[ContextSection],
+        allocation: Dict[str, int],
+        available: int
+    ):
+        """この構築のメトリクスを更新（構築をまたいで数える項目は現在の累計を写す）"""
+        metrics.total_tokens = sum(s.tokens for s in sections)
         
         for section in sections:
             if section.name == "SYSTEM":
-                self.metrics.system_tokens = section.tokens
+                metrics.system_tokens = section.tokens
             elif section.name == "SUMMARY":
-                self.metrics.summary_tokens = section.tokens
+                metrics.summary_tokens = section.tokens
             elif section.name == "RECENT":
-                self.metrics.recent_tokens = section.tokens
+                metrics.recent_tokens = section.tokens
             elif section.name == "RETRIEVED":
-                self.metrics.retrieved_tokens = section.tokens
+                metrics.retrieved_tokens = section.tokens
+        
+        ratios = self._section_ratios()
+        metrics.allocation = dict(allocation)
+        metrics.reallocated_tokens = sum(
+            max(0, tokens - int(available * ratios[name])) for name, tokens in allocation.items() if name != "SYSTEM"
+        )
+        
+        if metrics.total_tokens > 0:
+            metrics.compression_ratio = metrics.total_tokens / self.token_budget
         
-        if self.metrics.total_tokens > 0:
-            self.metrics.compression_ratio = self.metrics.total_tokens / self.token_budget
+        metrics.topic_switches = self.metrics.topic_switches
+        metrics.last_summary_update = self.metrics.last_summary_update
+        metrics.summary_updates = self.metrics.summary_updates
+        metrics.summary_failures = self.metrics.summary_failures
     
     async def detect_topic_switch(
         self,
@@ -347,12 +759,26 @@ class ContextManager:
         self,
         conversation_id: str,
         turn_count: int,
-        force: bool = False
+        force: bool = False,
+        conversation_history: Optional[List[Dict[str, Any]]] = None
     ) -> bool:
-        """必要に応じて要約を更新"""
-        if force or (turn_count % self.summary_rotate_every == 0):
-            logger.info(f"📝 要約更新開始 (会話ID: {conversation_id[:8]}...)")
-            # Phase 2でLLMベースの要約生成を実装
-            self.metrics.last_summary_update = datetime.now(timezone.utc)
-            return True
-        return False
\ No newline at end of file
+        """
+        必要に応じて累積要約を更新（完了まで待つ）
+        
+        SUMMARY_ROTATE_EVERY ターンごと、または force の場合に、直近会話より古い未要約の発話を要約に取り込む
+        """
+        if not (force or (turn_count % self.summary_rotate_every == 0)):
+            return False
+        if not conversation_history or not self._rolling_summary_available(conversation_id):
+            return False
+        
+        running = self._summary_tasks.get(conversation_id)
+        if running is not None:
+            return await running
+        
+        logger.info(f"📝 要約更新開始 (会話ID: {conversation_id[:8]}...)")
+        summary = await self._load_summary(conversation_id)
+        pending = self._unsummarized_messages(conversation_history, summary)
+        if not pending:
+            return False
+        return await self._update_summary(conversation_id, pending)
@@ -0,0 +1,324 @@
+"""
+チャットのプロンプト構築方式（コンテキスト戦略）
+/chat と /conversation-agent/chat で会話履歴からプロンプトを作る方式を切り替え、方式ごとのプロンプトの
+トークン数と構築時間を記録して比較できるようにします。
+
+- raw: 取得した履歴をそのまま並べる（従来の方式）
+- budgeted: ContextManager でトークン予算内に詰める（要約・直近会話をシステムプロンプトにまとめる）
+- memory: MemoryManager.optimize_context_window で重要度の高い発話を優先して予算内に選ぶ
+- どの方式でも履歴は HistoryNormalizer で正規化してから使う（フォローアップ候補・[要約]・[理由タグ]の除去と長さの上限）
+- 会話ごとに方式を固定で割り当てる（会話IDのハッシュを CHAT_CONTEXT_STRATEGY_WEIGHTS の重みで振り分け）
+- budgeted / memory の予算は TOKEN_BUDGET_IN（ContextManager と共通）
+- budgeted の長期要約は ContextManager の累積要約、関連発話はプロセス内ベクトルインデックス
+  （起動時に configure で Supabase・非同期LLMクライアント・埋め込みクライアント（ENABLE_EMBEDDINGS 時）を設定）
+- 方式ごとのターン数・プロンプトのトークン数・構築時間を集計
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from context_manager import ContextManager
+from history_normalizer import HistoryNormalizer, get_history_normalizer
+from memory_manager import MemoryManager, TokenManager
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_STRATEGY_RAW = "raw"
+CONTEXT_STRATEGY_BUDGETED = "budgeted"
+CONTEXT_STRATEGY_MEMORY = "memory"
+CONTEXT_STRATEGIES = (CONTEXT_STRATEGY_RAW, CONTEXT_STRATEGY_BUDGETED, CONTEXT_STRATEGY_MEMORY)
+
+
+def _parse_strategy_weights(raw: str) -> Dict[str, int]:
+    """"raw:1,budgeted:1" 形式の重みをパース（不明な方式・0以下の重みは無視）"""
+    weights = {}
+    for item in raw.split(","):
+        name, _, weight = item.strip().partition(":")
+        name = name.strip()
+        if name not in CONTEXT_STRATEGIES:
+            continue
+        try:
+            value = int(weight) if weight.strip() else 1
+        except ValueError:
+            continue
+        if value > 0:
+            weights[name] = value
+    return weights
+
+
+def build_raw_messages(
+    system_prompt: str,
+    conversation_history: List[Dict[str, Any]],
+    user_message: str
+) -> List[Dict[str, str]]:
+    """取得した履歴をそのまま並べたメッセージリスト"""
+    messages = [{"role": "system", "content": system_prompt}]
+
+    if conversation_history:
+        for history_msg in conversation_history:
+            role = "user" if history_msg["sender"] == "user" else "assistant"
+            messages.append({"role": role, "content": history_msg["message"]})
+
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+@dataclass
+class BuiltContext:
+    """構築したプロンプト"""
+    strategy: str
+    messages: List[Dict[str, str]]
+    history: List[Dict[str, Any]]     # プロンプトに含めた履歴（対話エージェントに渡す）
+    prompt_tokens: int
+    build_ms: float
+    history_total: int                # 取得した履歴の件数
+
+    def to_metrics(self) -> Dict[str, Any]:
+        """レスポンスの performance_metrics に含める値"""
+        return {
+            "context_strategy": self.strategy,
+            "prompt_tokens": self.prompt_tokens,
+            "context_build_ms": self.build_ms,
+            "history_messages": len(self.history),
+            "history_total": self.history_total,
+        }
+
+
+@dataclass
+class StrategyStats:
+    """方式ごとの集計"""
+    turns: int = 0
+    total_prompt_tokens: int = 0
+    total_build_ms: float = 0.0
+    errors: int = 0
+    recent_prompt_tokens: Deque[int] = field(default_factory=lambda: deque(maxlen=500))
+    recent_build_ms: Deque[float] = field(default_factory=lambda: deque(maxlen=500))
+
+    def to_dict(self) -> Dict[str, Any]:
+        tokens = sorted(self.recent_prompt_tokens)
+        build_ms = sorted(self.recent_build_ms)
+        return {
+            "turns": self.turns,
+            "errors": self.errors,
+            "average_prompt_tokens": self.total_prompt_tokens / self.turns if self.turns else 0,
+            "p50_prompt_tokens": tokens[len(tokens) // 2] if tokens else 0,
+            "p90_prompt_tokens": tokens[int(len(tokens) * 0.9)] if tokens else 0,
+            "average_build_ms": self.total_build_ms / self.turns if self.turns else 0,
+            "p90_build_ms": build_ms[int(len(build_ms) * 0.9)] if build_ms else 0,
+        }
+
+
+class ContextStrategySelector:
+    """会話ごとにプロンプトの構築方式を割り当てて構築・計測する"""
+
+    def __init__(
+        self,
+        weights: Optional[Dict[str, int]] = None,
+        token_budget: Optional[int] = None,
+        model: str = "gpt-4",
+        context_manager: Optional[ContextManager] = None,
+        memory_manager: Optional[MemoryManager] = None,
+        normalizer: Optional[HistoryNormalizer] = None
+    ):
+        if weights is None:
+            weights = _parse_strategy_weights(os.environ.get("CHAT_CONTEXT_STRATEGY_WEIGHTS", "raw:1"))
+        if token_budget is None:
+            token_budget = int(os.environ.get("TOKEN_BUDGET_IN", "4000"))
+        if not weights:
+            logger.warning(f"⚠️ 有効なコンテキスト戦略がありません（{CONTEXT_STRATEGY_RAW}を使用）")
+            weights = {CONTEXT_STRATEGY_RAW: 1}
+
+        self.weights = weights
+        self.token_budget = token_budget
+        self.token_manager = TokenManager(model)
+        self._context_manager = context_manager
+        self._memory_manager = memory_manager
+        self.normalizer = normalizer or get_history_normalizer()
+        # budgeted の累積要約の保存先と生成に使うクライアント、関連発話の検索に使う埋め込みクライアント（configure で設定）
+        self._supabase_client = None
+        self._llm_client = None
+        self._embedding_client = None
+
+        self._lock = threading.Lock()
+        self._stats: Dict[str, StrategyStats] = {}
+
+    @property
+    def context_manager(self) -> ContextManager:
+        if self._context_manager is None:
+            self._context_manager = ContextManager(
+                supabase_client=self._supabase_client,
+                embedding_client=self._embedding_client,
+                token_counter=self.token_manager.count_tokens,
+                llm_client=self._llm_client
+            )
+            self._context_manager.token_budget = self.token_budget
+        return self._context_manager
+
+    def configure(self, supabase_client=None, llm_client=None, embedding_client=None) -> None:
+        """起動時に累積要約の保存先（Supabase）と生成用の非同期LLMクライアント、埋め込みクライアントを設定"""
+        self._supabase_client = supabase_client
+        self._llm_client = llm_client
+        self._embedding_client = embedding_client
+        if self._context_manager is not None:
+            self._context_manager.supabase = supabase_client
+            self._context_manager.llm_client = llm_client
+            self._context_manager.embedding_client = embedding_client
+
+    @property
+    def memory_manager(self) -> MemoryManager:
+        if self._memory_manager is None:
+            self._memory_manager = MemoryManager(model=self.token_manager.model)
+        return self._memory_manager
+
+    def assign(self, conversation_id: Optional[str]) -> str:
+        """会話IDから方式を決める（同じ会話には常に同じ方式、プロセスをまたいでも同じ）"""
+        names = sorted(self.weights)
+        if not conversation_id:
+            return max(names, key=lambda name: self.weights[name])
+        total = sum(self.weights[name] for name in names)
+        bucket = int(hashlib.sha1(str(conversation_id).encode("utf-8")).hexdigest(), 16) % total
+        for name in names:
+            bucket -= self.weights[name]
+            if bucket < 0:
+                return name
+        return names[-1]
+
+    async def build(
+        self,
+        conversation_id: Optional[str],
+        system_prompt: str,
+        conversation_history: List[Dict[str, Any]],
+        user_message: str,
+        strategy: Optional[str] = None
+    ) -> BuiltContext:
+        """
+        割り当てた方式でプロンプトを構築
+
+        budgeted / memory の構築に失敗した場合は raw で構築する（失敗は方式ごとの errors に記録）
+        """
+        strategy = strategy or self.assign(conversation_id)
+        start = time.perf_counter()
+        history = self.normalizer.normalize(conversation_history or [])
+        try:
+            if strategy == CONTEXT_STRATEGY_BUDGETED:
+                messages, selected = await self._build_budgeted(conversation_id, system_prompt, history, user_message)
+            elif strategy == CONTEXT_STRATEGY_MEMORY:
+                messages, selected = self._build_memory(system_prompt, history, user_message)
+            else:
+                messages, selected = build_raw_messages(system_prompt, history, user_message), history
+        except Exception as e:
+            logger.error(f"❌ コンテキスト構築エラー（{strategy}）、rawで構築: {e}")
+            with self._lock:
+                self._stats.setdefault(strategy, StrategyStats()).errors += 1
+            strategy = CONTEXT_STRATEGY_RAW
+            messages, selected = build_raw_messages(system_prompt, history, user_message), history
+        build_ms = round((time.perf_counter() - start) * 1000, 1)
+
+        context = BuiltContext(
+            strategy=strategy,
+            messages=messages,
+            history=selected,
+            prompt_tokens=self.token_manager.count_messages_tokens(messages),
+            build_ms=build_ms,
+            history_total=len(history)
+        )
+        self._record(context)
+        logger.info(
+            f"📐 コンテキスト構築（{strategy}）: {context.prompt_tokens}トークン, "
+            f"履歴{len(selected)}/{len(history)}件, {build_ms:.1f}ms"
+        )
+        return context
+
+    async def _build_budgeted(
+        self,
+        conversation_id: Optional[str],
+        system_prompt: str,
+        history: List[Dict[str, Any]],
+        user_message: str
+    ) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+        manager = self.context_manager
+        messages, metrics = await manager.build_context(
+            user_message=user_message,
+            conversation_id=conversation_id or "",
+            system_prompt=system_prompt,
+            conversation_history=history
+        )
+        # 直近会話に含めた件数は build_context がこの呼び出しのメトリクスとして返す（他の会話の構築とは共有しない）
+        selected = history[len(history) - metrics.recent_messages:] if metrics.recent_messages else []
+        return messages, selected
+
+    def _build_memory(
+        self,
+        system_prompt: str,
+        history: List[Dict[str, Any]],
+        user_message: str
+    ) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+        system_message = {"role": "system", "content": system_prompt}
+        user = {"role": "user", "content": user_message}
+        fixed_tokens = self.token_manager.count_messages_tokens([system_message, user])
+        optimized = self.memory_manager.optimize_context_window(
+            history, target_tokens=max(0, self.token_budget - fixed_tokens)
+        )
+
+        # 要約で置き換えた発話もあるため、対話エージェントには選ばれた発話の内容で渡す
+        by_id = {msg.get("id"): msg for msg in history if msg.get("id") is not None}
+        messages = [system_message]
+        selected = []
+        for item in optimized:
+            metadata = item.pop("_metadata", {})
+            messages.append(item)
+            original = by_id.get(metadata.get("id"), {})
+            selected.append({
+                **original,
+                "sender": "user" if item["role"] == "user" else "assistant",
+                "message": item["content"],
+            })
+        messages.append(user)
+        return messages, selected
+
+    def _record(self, context: BuiltContext) -> None:
+        with self._lock:
+            stats = self._stats.get(context.strategy)
+            if stats is None:
+                stats = self._stats[context.strategy] = StrategyStats()
+            stats.turns += 1
+            stats.total_prompt_tokens += context.prompt_tokens
+            stats.total_build_ms += context.build_ms
+            stats.recent_prompt_tokens.append(context.prompt_tokens)
+            stats.recent_build_ms.append(context.build_ms)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """方式ごとのプロンプトのトークン数と構築時間"""
+        with self._lock:
+            return {
+                "weights": dict(self.weights),
+                "token_budget": self.token_budget,
+                "strategies": {name: stats.to_dict() for name, stats in self._stats.items()},
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+
+# シングルトンインスタンスを管理
+_selector_instance: Optional[ContextStrategySelector] = None
+_selector_lock = threading.Lock()
+
+
+def get_context_strategy_selector() -> ContextStrategySelector:
+    """プロセス共通のコンテキスト戦略を取得"""
+    global _selector_instance
+
+    if _selector_instance is None:
+        with _selector_lock:
+            if _selector_instance is None:
+                _selector_instance = ContextStrategySelector()
+
+    return _selector_instance
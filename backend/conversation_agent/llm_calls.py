@@ -0,0 +1,24 @@
+"""
+対話エージェントの各コンポーネントから使うLLM呼び出しヘルパー
+非同期パイプライン（process_turn_async）用に、非同期クライアントと同期クライアントの違いを吸収する
+"""
+
+import asyncio
+from typing import Any, Dict, List
+
+
+# <summary>LLMを非同期で呼び出し、応答テキストを返します。</summary>
+# <arg name="llm_client">同期LLMクライアント（module.llm_api）。</arg>
+# <arg name="messages">LLMに渡すメッセージ。</arg>
+# <arg name="async_llm_client">非同期LLMクライアント（module.async_llm_api、任意）。</arg>
+# <returns>LLMの応答テキスト。</returns>
+async def generate_response_async(
+    llm_client,
+    messages: List[Dict[str, Any]],
+    async_llm_client=None
+) -> str:
+    client = async_llm_client or llm_client
+    if hasattr(client, "generate_response_async"):
+        return await client.generate_response_async(messages)
+    # 非同期クライアントがない場合は同期クライアントをスレッドで実行（イベントループを塞がない）
+    return await asyncio.to_thread(client.generate_response, messages)
@@ -18,6 +18,8 @@ from async_helpers import (
     parallel_fetch_context_and_history,
     parallel_save_chat_logs
 )
+from context_strategy import get_context_strategy_selector
+from prompt.prompt import system_prompt
 
 logger = logging.getLogger(__name__)
 
@@ -47,7 +49,8 @@ async def optimized_chat_with_conversation_agent(
     llm_client,
     conversation_orchestrator,
     CONVERSATION_AGENT_AVAILABLE: bool,
-    ENABLE_CONVERSATION_AGENT: bool
+    ENABLE_CONVERSATION_AGENT: bool,
+    async_llm_client=None
 ):
     """
     最適化版 conversation agent エンドポイント
@@ -61,6 +64,7 @@ async def optimized_chat_with_conversation_agent(
         conversation_orchestrator: 対話オーケストレーター
         CONVERSATION_AGENT_AVAILABLE: エージェントモジュール利用可能フラグ
         ENABLE_CONVERSATION_AGENT: エージェント有効化フラグ
+        async_llm_client: 非同期LLMクライアント（一時オーケストレーターで使用）
         
     Returns:
         OptimizedConversationAgentResponse
@@ -99,7 +103,8 @@ async def optimized_chat_with_conversation_agent(
                 from conversation_agent import ConversationOrchestrator
                 temp_orchestrator = ConversationOrchestrator(
                     llm_client=llm_client,
-                    use_mock=request.mock_mode
+                    use_mock=request.mock_mode,
+                    async_llm_client=async_llm_client
                 )
                 logger.info(f"✅ 対話エージェント一時初期化完了（mock={request.mock_mode}）")
             except Exception as e:
@@ -184,6 +189,12 @@ async def optimized_chat_with_conversation_agent(
         metrics["db_fetch_time"] = time.time() - db_fetch_start
         logger.info(f"📊 DB取得時間: {metrics['db_fetch_time']:.2f}秒")
         
+        # 会話ごとに割り当てたコンテキスト戦略で、エージェントに渡す履歴を選ぶ（/chat と共通の計測）
+        context = await get_context_strategy_selector().build(
+            conversation_id, system_prompt, conversation_history, request.message
+        )
+        metrics.update(context.to_metrics())
+        
         # ====================
         # Step 2: エージェント処理
         # ====================
@@ -192,20 +203,21 @@ async def optimized_chat_with_conversation_agent(
         try:
             # 履歴フォーマット変換
             agent_history = []
-            for msg in conversation_history:
+            for msg in context.history:
                 agent_history.append({
+                    "id": msg.get("id"),  # 状態ストアの差分抽出で使用
                     "sender": msg["sender"],
                     "message": msg["message"]
                 })
             
-            # エージェント処理（非同期ラップ）
-            agent_result = await asyncio.to_thread(
-                temp_orchestrator.process_turn,
+            # エージェント処理（非同期パイプライン）
+            agent_result = await temp_orchestrator.process_turn_async(
                 user_message=request.message,
                 conversation_history=agent_history,
                 project_context=project_context,
                 user_id=current_user,
-                conversation_id=conversation_id
+                conversation_id=conversation_id,
+                mode=request.orchestrator_mode
             )
             
             metrics["agent_processing_time"] = time.time() - agent_start
@@ -3,10 +3,12 @@
 すべてのコンポーネントを統合して対話フローを制御
 """
 import json
+import time
+import asyncio
 import logging
 import sys
 import os
-from typing import List, Dict, Optional, Any, Tuple
+from typing import List, Dict, Optional, Any, Tuple, Union
 from datetime import datetime
 from .schema import (
     StateSnapshot,
@@ -21,36 +23,76 @@ from .state_extractor import StateExtractor
 from .support_typer import SupportTyper
 from .policies import PolicyEngine
 from .project_planner import ProjectPlanner
+from .state_store import ConversationStateStore, get_state_store
+from .session_store import ConversationSession, ConversationSessionStore, get_session_store
+from .state_memo import MaterialChangeRule, get_material_change_rule
 
 # prompt.pyへのパスを追加
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
-from prompt.prompt import generate_response_prompt
+from prompt.prompt import generate_response_prompt, generate_followups_prompt, FUSED_TURN_PROMPT
+from module.llm_context import llm_context
+from .llm_calls import generate_response_async
 
 logger = logging.getLogger(__name__)
 
+# 対話処理のモード
+ORCHESTRATOR_MODE_MULTI = "multi"   # ステップごとにLLMを呼び出す（状態抽出・支援タイプ判定・応答生成）
+ORCHESTRATOR_MODE_FUSED = "fused"   # 1回の構造化出力で状態・支援タイプ・アクト・応答をまとめて生成
+ORCHESTRATOR_MODES = (ORCHESTRATOR_MODE_MULTI, ORCHESTRATOR_MODE_FUSED)
+
 class ConversationOrchestrator:
     """対話フロー全体を統合制御"""
     
     # <summary>対話オーケストレーターを初期化します。</summary>
     # <arg name="llm_client">LLMクライアント（既存のmodule.llm_apiを使用）。</arg>
     # <arg name="use_mock">モックモードで動作するか（Phase 1ではTrue）。</arg>
-    def __init__(self, llm_client=None, use_mock: bool = False):
+    # <arg name="async_llm_client">非同期LLMクライアント（module.async_llm_api、process_turn_asyncで使用）。</arg>
+    # <arg name="enable_planning">計画思考フェーズを実行するか（未指定時は環境変数 CONVERSATION_AGENT_ENABLE_PLAN）。</arg>
+    # <arg name="default_mode">リクエストで指定がない場合の処理モード（未指定時は環境変数 CONVERSATION_AGENT_ORCHESTRATOR_MODE）。</arg>
+    # <arg name="state_store">会話ごとの状態ストア（未指定時は ENABLE_CONVERSATION_STATE_STORE が有効ならプロセス共通のストア）。</arg>
+    # <arg name="session_store">会話ごとの履歴・メトリクスを保持するセッションストア（未指定時はプロセス共通のストア）。</arg>
+    # <arg name="memo_rule">支援タイプ・計画を再利用する「実質的な変化」の基準（ルール名またはMaterialChangeRule、未指定時は環境変数 CONVERSATION_AGENT_MEMO_RULE）。</arg>
+    def __init__(
+        self,
+        llm_client=None,
+        use_mock: bool = False,
+        async_llm_client=None,
+        enable_planning: Optional[bool] = None,
+        default_mode: Optional[str] = None,
+        state_store: Optional[ConversationStateStore] = None,
+        session_store: Optional[ConversationSessionStore] = None,
+        memo_rule: Union[str, MaterialChangeRule, None] = None
+    ):
         self.llm_client = llm_client
+        self.async_llm_client = async_llm_client
         self.use_mock = use_mock
+        if enable_planning is None:
+            enable_planning = os.environ.get("CONVERSATION_AGENT_ENABLE_PLAN", "false").lower() == "true"
+        self.enable_planning = enable_planning
+        if default_mode is None:
+            default_mode = os.environ.get("CONVERSATION_AGENT_ORCHESTRATOR_MODE", ORCHESTRATOR_MODE_MULTI).lower()
+        if default_mode not in ORCHESTRATOR_MODES:
+            logger.warning(f"⚠️ 不明な処理モード: {default_mode}（{ORCHESTRATOR_MODE_MULTI}を使用）")
+            default_mode = ORCHESTRATOR_MODE_MULTI
+        self.default_mode = default_mode
+        
+        if state_store is None and os.environ.get("ENABLE_CONVERSATION_STATE_STORE", "true").lower() == "true":
+            state_store = get_state_store()
+        self.state_store = state_store
         
         # 各コンポーネントの初期化
-        self.state_extractor = StateExtractor(llm_client)
-        self.project_planner = ProjectPlanner(llm_client)
-        self.support_typer = SupportTyper(llm_client)
+        self.state_extractor = StateExtractor(llm_client, async_llm_client, state_store)
+        self.project_planner = ProjectPlanner(llm_client, async_llm_client)
+        self.support_typer = SupportTyper(llm_client, async_llm_client)
         self.policy_engine = PolicyEngine()
         
-        # メトリクス追跡
-        self.metrics = ConversationMetrics()
+        # 会話ごとの履歴・メトリクスはセッションストアに保持（オーケストレーター自体は状態を持たない）
+        self.session_store = session_store or get_session_store()
         
-        # 会話履歴（簡易版）
-        self.conversation_history: List[Dict[str, Any]] = []
-        self.support_type_history: List[str] = []
-        self.act_history: List[List[str]] = []
+        # 状態が実質的に変わっていない間は支援タイプ・計画を再利用（Noneならメモ化しない）
+        if memo_rule is None or isinstance(memo_rule, str):
+            memo_rule = get_material_change_rule(memo_rule)
+        self.memo_rule = memo_rule
     
     # <summary>1ターンの対話処理を実行します（メインエントリポイント）。</summary>
     # <arg name="user_message">ユーザーの入力メッセージ。</arg>
@@ -73,15 +115,23 @@ class ConversationOrchestrator:
         logger.info(f"   - プロジェクトコンテキスト: {bool(project_context)}")
         logger.info(f"   - 履歴件数: {len(conversation_history)}")
         
+        turn_start = time.perf_counter()
+        step_timings: Dict[str, float] = {}
+        session = self.session_store.get(conversation_id)
+        
         try:
             # 1. 状態抽出(理解)
             logger.info("📊 Step 1: 状態抽出開始")
+            step_start = time.perf_counter()
             state = self._extract_state(conversation_history, project_context, user_id, conversation_id)
+            step_timings["state_extract"] = _elapsed_ms(step_start)
             logger.info(f"✅ Step 1完了: 目標={state.goal or '未設定'}, 目的={state.purpose or '未設定'}")
             
             # 2. 計画思考フェーズ（思考）
             logger.info("🎯 Step 2: 計画思考フェーズ開始")
-            project_plan = self._generate_project_plan(state, conversation_history)
+            step_start = time.perf_counter()
+            project_plan = self._generate_project_plan(state, conversation_history, session)
+            step_timings["plan"] = _elapsed_ms(step_start)
             if project_plan:
                 logger.info(f"✅ Step 2完了: 北極星={project_plan.north_star[:50]}...")
             else:
@@ -89,43 +139,32 @@ class ConversationOrchestrator:
             
             # 3. 支援タイプ判定
             logger.info("🔍 Step 3: 支援タイプ判定開始")
-            support_type, support_reason, confidence = self._determine_support_type(state)
+            step_start = time.perf_counter()
+            support_type, support_reason, confidence = self._determine_support_type(state, session)
+            step_timings["support_type"] = _elapsed_ms(step_start)
             logger.info(f"✅ Step 3完了: 支援タイプ={support_type}, 確信度={confidence}")
             
             # 4. 発話アクト選択
             logger.info("💬 Step 4: 発話アクト選択開始")
-            selected_acts, act_reason = self._select_acts(state, support_type)
+            step_start = time.perf_counter()
+            selected_acts, act_reason = self._select_acts(state, support_type, session)
+            step_timings["select_acts"] = _elapsed_ms(step_start)
             logger.info(f"✅ Step 4完了: アクト={selected_acts}")
             
             # 5. 応答生成
             logger.info("📝 Step 5: 応答生成開始")
+            step_start = time.perf_counter()
             response_package = self._generate_llm_response(
                 state, support_type, selected_acts, user_message
             )
+            step_timings["reply"] = _elapsed_ms(step_start)
             logger.info(f"✅ Step 5完了: 応答文字数={len(response_package.natural_reply)}")
             
-            # 6. メトリクス更新
-            self._update_metrics(state, support_type, selected_acts)
-            
-            # 7. 履歴更新
-            self._update_history(support_type, selected_acts, response_package)
-            
-            # 結果をパッケージング
-            result = {
-                "response": response_package.natural_reply,
-                "followups": response_package.followups,
-                "support_type": support_type,
-                "selected_acts": selected_acts,
-                "state_snapshot": state.dict(exclude={'user_id', 'conversation_id', 'turn_index'}),
-                "project_plan": project_plan.dict() if project_plan else None,  # NEW!
-                "decision_metadata": {
-                    "support_reason": support_reason,
-                    "support_confidence": confidence,
-                    "act_reason": act_reason,
-                    "timestamp": datetime.now().isoformat()
-                },
-                "metrics": self.metrics.dict()
-            }
+            step_timings["total"] = _elapsed_ms(turn_start)
+            result = self._complete_turn(
+                state, project_plan, support_type, support_reason, confidence,
+                selected_acts, act_reason, response_package, step_timings, session, pipeline="sync"
+            )
             
             logger.info("🎉 対話エージェント処理完了")
             return result
@@ -135,7 +174,358 @@ class ConversationOrchestrator:
             logger.error(f"❌ 対話処理エラー: {e}")
             logger.error(f"❌ トレースバック:\n{traceback.format_exc()}")
             # エラー時のフォールバック応答
-            return self._generate_fallback_response(str(e))
+            return self._generate_fallback_response(str(e), session)
+    
+    # <summary>1ターンの対話処理を非同期で実行します（process_turn と同じ結果形式）。</summary>
+    # <arg name="user_message">ユーザーの入力メッセージ。</arg>
+    # <arg name="conversation_history">会話履歴。</arg>
+    # <arg name="project_context">プロジェクト情報（任意）。</arg>
+    # <arg name="user_id">ユーザーID（任意）。</arg>
+    # <arg name="conversation_id">会話ID（任意）。</arg>
+    # <arg name="mode">処理モード（multi / fused、未指定時は default_mode）。</arg>
+    # <arg name="speculative_followups">フォローアップ候補を応答生成と並行して別の呼び出しで生成するか（multiモードのみ）。</arg>
+    # <returns>応答パッケージ（metrics.step_timings に各ステップの所要時間ms）。speculative_followups の場合、followups は空で followups_task にフォローアップ候補を返すタスクを含む。</returns>
+    async def process_turn_async(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        project_context: Optional[Dict[str, Any]] = None,
+        user_id: Optional[int] = None,
+        conversation_id: Optional[str] = None,
+        mode: Optional[str] = None,
+        speculative_followups: bool = False
+    ) -> Dict[str, Any]:
+        
+        if self._resolve_mode(mode) == ORCHESTRATOR_MODE_FUSED:
+            return await self._process_turn_fused_async(
+                user_message, conversation_history, project_context, user_id, conversation_id
+            )
+        
+        logger.info("🚀 対話エージェント処理開始（非同期）")
+        logger.info(f"   - ユーザーメッセージ: {user_message[:100]}...")
+        logger.info(f"   - プロジェクトコンテキスト: {bool(project_context)}")
+        logger.info(f"   - 履歴件数: {len(conversation_history)}")
+        
+        turn_start = time.perf_counter()
+        step_timings: Dict[str, float] = {}
+        session = self.session_store.get(conversation_id)
+        plan_task: Optional[asyncio.Task] = None
+        followups_task: Optional[asyncio.Task] = None
+        
+        try:
+            # 1. 状態抽出（以降の全ステップが依存するため先に完了させる）
+            state = await _timed(
+                step_timings, "state_extract",
+                self._extract_state_async(conversation_history, project_context, user_id, conversation_id)
+            )
+            logger.info(f"✅ Step 1完了: 目標={state.goal or '未設定'}, 目的={state.purpose or '未設定'}")
+            
+            # 2. 計画思考は応答に使わないため、支援タイプ判定・応答生成と並行して実行
+            plan_task = asyncio.create_task(_timed(
+                step_timings, "plan",
+                self._generate_project_plan_async(state, conversation_history, session)
+            ))
+            
+            # 3. 支援タイプ判定 → 4. 発話アクト選択 → 5. 応答生成（クリティカルパス）
+            support_type, support_reason, confidence = await _timed(
+                step_timings, "support_type", self._determine_support_type_async(state, session)
+            )
+            logger.info(f"✅ Step 3完了: 支援タイプ={support_type}, 確信度={confidence}")
+            
+            step_start = time.perf_counter()
+            selected_acts, act_reason = self._select_acts(state, support_type, session)
+            step_timings["select_acts"] = _elapsed_ms(step_start)
+            logger.info(f"✅ Step 4完了: アクト={selected_acts}")
+            
+            # フォローアップ候補は状態とアクトだけで生成できるため、応答生成と並行して実行（応答は待たせない）
+            if speculative_followups:
+                followups_task = asyncio.create_task(_timed(
+                    step_timings, "followups",
+                    self._generate_followups_async(state, support_type, selected_acts, user_message)
+                ))
+            
+            response_package = await _timed(
+                step_timings, "reply",
+                self._generate_llm_response_async(
+                    state, support_type, selected_acts, user_message,
+                    include_followups=followups_task is None
+                )
+            )
+            logger.info(f"✅ Step 5完了: 応答文字数={len(response_package.natural_reply)}")
+            
+            step_timings["critical_path"] = _elapsed_ms(turn_start)
+            project_plan = await plan_task
+            step_timings["total"] = _elapsed_ms(turn_start)
+            
+            result = self._complete_turn(
+                state, project_plan, support_type, support_reason, confidence,
+                selected_acts, act_reason, response_package, step_timings, session, pipeline="async"
+            )
+            if followups_task is not None:
+                # 完了を待つかどうかは呼び出し側が決める
+                result["followups_task"] = followups_task
+                followups_task = None
+            
+            logger.info(
+                f"🎉 対話エージェント処理完了: 合計={step_timings['total']:.0f}ms, "
+                f"クリティカルパス={step_timings['critical_path']:.0f}ms"
+            )
+            return result
+            
+        except Exception as e:
+            import traceback
+            logger.error(f"❌ 対話処理エラー: {e}")
+            logger.error(f"❌ トレースバック:\n{traceback.format_exc()}")
+            return self._generate_fallback_response(str(e), session)
+        
+        finally:
+            if plan_task is not None and not plan_task.done():
+                plan_task.cancel()
+            if followups_task is not None and not followups_task.done():
+                followups_task.cancel()
+    
+    # <summary>リクエストで指定された処理モードを解決します。</summary>
+    # <arg name="mode">リクエストで指定された処理モード（任意）。</arg>
+    # <returns>実際に使用する処理モード。</returns>
+    def _resolve_mode(self, mode: Optional[str]) -> str:
+        
+        mode = (mode or self.default_mode).lower()
+        if mode not in ORCHESTRATOR_MODES:
+            logger.warning(f"⚠️ 不明な処理モード: {mode}（{self.default_mode}を使用）")
+            mode = self.default_mode
+        
+        if mode == ORCHESTRATOR_MODE_FUSED and self.llm_client is None and self.async_llm_client is None:
+            # 1回の呼び出しにまとめる対象がないため、通常のパイプライン（ルールベース）で処理
+            return ORCHESTRATOR_MODE_MULTI
+        
+        return mode
+    
+    # <summary>1回のLLM呼び出しで状態・支援タイプ・アクト・応答をまとめて生成します（fusedモード）。</summary>
+    # <arg name="user_message">ユーザーの入力メッセージ。</arg>
+    # <arg name="conversation_history">会話履歴。</arg>
+    # <arg name="project_context">プロジェクト情報（任意）。</arg>
+    # <arg name="user_id">ユーザーID（任意）。</arg>
+    # <arg name="conversation_id">会話ID（任意）。</arg>
+    # <returns>応答パッケージ（process_turn_async と同じ形式）。</returns>
+    async def _process_turn_fused_async(
+        self,
+        user_message: str,
+        conversation_history: List[Dict[str, str]],
+        project_context: Optional[Dict[str, Any]],
+        user_id: Optional[int],
+        conversation_id: Optional[str]
+    ) -> Dict[str, Any]:
+        
+        logger.info("🚀 対話エージェント処理開始（fused）")
+        logger.info(f"   - ユーザーメッセージ: {user_message[:100]}...")
+        logger.info(f"   - 履歴件数: {len(conversation_history)}")
+        
+        turn_start = time.perf_counter()
+        step_timings: Dict[str, float] = {}
+        session = self.session_store.get(conversation_id)
+        
+        try:
+            response: Optional[str] = None
+            try:
+                messages = self._build_fused_messages(conversation_history, user_message)
+                with llm_context(step="fused_turn"):
+                    response = await _timed(
+                        step_timings, "fused_turn",
+                        generate_response_async(self.llm_client, messages, self.async_llm_client)
+                    )
+            except Exception as e:
+                logger.error(f"fused応答生成エラー、ルールベース処理を使用: {e}")
+            
+            step_start = time.perf_counter()
+            (state, support_type, support_reason, confidence,
+             selected_acts, act_reason, response_package, fallbacks) = self._resolve_fused_turn(
+                response, conversation_history, user_id, conversation_id, session
+            )
+            step_timings["resolve"] = _elapsed_ms(step_start)
+            
+            # 計画思考は確定した状態に依存するため、fusedの呼び出し後に実行
+            project_plan = await _timed(
+                step_timings, "plan",
+                self._generate_project_plan_async(state, conversation_history, session)
+            )
+            step_timings["total"] = _elapsed_ms(turn_start)
+            
+            result = self._complete_turn(
+                state, project_plan, support_type, support_reason, confidence,
+                selected_acts, act_reason, response_package, step_timings, session,
+                pipeline="async", mode=ORCHESTRATOR_MODE_FUSED, fallbacks=fallbacks
+            )
+            
+            logger.info(
+                f"🎉 対話エージェント処理完了（fused）: 合計={step_timings['total']:.0f}ms, "
+                f"フォールバック={fallbacks or 'なし'}"
+            )
+            return result
+            
+        except Exception as e:
+            import traceback
+            logger.error(f"❌ 対話処理エラー: {e}")
+            logger.error(f"❌ トレースバック:\n{traceback.format_exc()}")
+            return self._generate_fallback_response(str(e), session)
+    
+    # <summary>fusedモード用のLLMメッセージを構築します。</summary>
+    # <arg name="conversation_history">会話履歴。</arg>
+    # <arg name="user_message">ユーザーの入力メッセージ。</arg>
+    # <returns>LLMに渡すメッセージリスト。</returns>
+    def _build_fused_messages(
+        self,
+        conversation_history: List[Dict[str, str]],
+        user_message: str
+    ) -> List[Dict[str, str]]:
+        
+        # 状態抽出と同じく最新20メッセージのみを使用（プロジェクト情報は渡さない）
+        prompt = FUSED_TURN_PROMPT.format(
+            support_types=" / ".join(SupportType.ALL_TYPES),
+            speech_acts=" / ".join(SpeechAct.ALL_ACTS),
+            conversation=self.state_extractor._format_conversation(conversation_history[-20:]),
+            user_message=user_message
+        )
+        
+        return [
+            {"role": "system", "content": "あなたは学習支援の専門家です。"},
+            {"role": "user", "content": prompt}
+        ]
+    
+    # <summary>fusedモードの応答をスキーマで検証し、不正な部分だけルールベースのコンポーネントで補います。</summary>
+    # <arg name="response">LLMの応答テキスト（呼び出しに失敗した場合はNone）。</arg>
+    # <arg name="conversation_history">会話履歴。</arg>
+    # <arg name="user_id">ユーザーID（任意）。</arg>
+    # <arg name="conversation_id">会話ID（任意）。</arg>
+    # <arg name="session">この会話のセッション。</arg>
+    # <returns>(state, support_type, support_reason, confidence, selected_acts, act_reason, response_package, fallbacks)。</returns>
+    def _resolve_fused_turn(
+        self,
+        response: Optional[str],
+        conversation_history: List[Dict[str, str]],
+        user_id: Optional[int],
+        conversation_id: Optional[str],
+        session: ConversationSession
+    ) -> Tuple[StateSnapshot, str, str, float, List[str], str, TurnPackage, List[str]]:
+        
+        fallbacks: List[str] = []
+        
+        data: Dict[str, Any] = {}
+        if response is None:
+            fallbacks.append("llm_call")
+        else:
+            try:
+                data = json.loads(response)
+                if not isinstance(data, dict):
+                    raise ValueError("JSONオブジェクトではありません")
+            except (json.JSONDecodeError, ValueError) as e:
+                logger.warning(f"fused応答のJSON解析エラー: {e}")
+                data = {}
+                fallbacks.append("json")
+        
+        # 状態（StateSnapshot として検証）
+        try:
+            state_dict = data["state"]
+            state_dict.pop("project_context", None)
+            state = StateSnapshot(**state_dict)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            if data:
+                logger.warning(f"fused応答の状態が不正: {e}")
+            state = self.state_extractor._extract_heuristic(conversation_history, None)
+            fallbacks.append("state")
+        state = self._finalize_state(state, conversation_history, user_id, conversation_id)
+        
+        # 支援タイプ
+        support_type = data.get("support_type")
+        if support_type in SupportType.ALL_TYPES:
+            support_reason = str(data.get("support_reason") or "状態分析に基づく判定")
+            try:
+                confidence = min(1.0, max(0.0, float(data.get("confidence", 0.7))))
+            except (TypeError, ValueError):
+                confidence = 0.7
+        else:
+            support_type, support_reason, confidence = self.support_typer._determine_rule_based(state)
+            fallbacks.append("support_type")
+        support_type, support_reason, confidence = self._adjust_support_type(support_type, support_reason, confidence, session)
+        
+        # 発話アクト（候補にないものは除外し、最大2個）
+        raw_acts = data.get("selected_acts")
+        selected_acts = [act for act in raw_acts if act in SpeechAct.ALL_ACTS][:2] if isinstance(raw_acts, list) else []
+        if selected_acts:
+            act_reason = str(data.get("act_reason") or "fusedモードで選択")
+        else:
+            selected_acts, act_reason = self._select_acts(state, support_type, session)
+            fallbacks.append("selected_acts")
+        
+        # 応答（TurnPackage として検証）
+        try:
+            followups = data.get("followups") or []
+            response_package = TurnPackage(
+                natural_reply=data["natural_reply"],
+                followups=[str(f) for f in followups][:3] if isinstance(followups, list) else [],
+                metadata={"support_type": support_type, "mode": ORCHESTRATOR_MODE_FUSED}
+            )
+            if not response_package.natural_reply.strip():
+                raise ValueError("natural_reply が空です")
+        except (KeyError, TypeError, ValueError) as e:
+            if data:
+                logger.warning(f"fused応答の応答文が不正: {e}")
+            response_package = self._generate_mock_response(state, support_type, selected_acts)
+            fallbacks.append("reply")
+        
+        return state, support_type, support_reason, confidence, selected_acts, act_reason, response_package, fallbacks
+    
+    # <summary>ターン処理の結果をまとめ、メトリクスと履歴を更新します。</summary>
+    # <returns>応答パッケージ辞書。</returns>
+    def _complete_turn(
+        self,
+        state: StateSnapshot,
+        project_plan: Optional[ProjectPlan],
+        support_type: str,
+        support_reason: str,
+        confidence: float,
+        selected_acts: List[str],
+        act_reason: str,
+        response_package: TurnPackage,
+        step_timings: Dict[str, float],
+        session: ConversationSession,
+        pipeline: str,
+        mode: str = ORCHESTRATOR_MODE_MULTI,
+        fallbacks: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
+        
+        # メトリクス更新
+        self._update_metrics(session, state, support_type, selected_acts)
+        
+        # 履歴更新
+        self._update_history(session, support_type, selected_acts, response_package)
+        
+        metrics = session.metrics.dict()
+        metrics["pipeline"] = pipeline
+        metrics["orchestrator_mode"] = mode
+        metrics["step_timings"] = step_timings
+        metrics["memo_hit_rates"] = session.metrics.memo_hit_rates()
+        
+        decision_metadata = {
+            "support_reason": support_reason,
+            "support_confidence": confidence,
+            "act_reason": act_reason,
+            "orchestrator_mode": mode,
+            "timestamp": datetime.now().isoformat()
+        }
+        if fallbacks:
+            decision_metadata["fallbacks"] = fallbacks
+        
+        # 結果をパッケージング
+        return {
+            "response": response_package.natural_reply,
+            "followups": response_package.followups,
+            "support_type": support_type,
+            "selected_acts": selected_acts,
+            "state_snapshot": state.dict(exclude={'user_id', 'conversation_id', 'turn_index'}),
+            "project_plan": project_plan.dict() if project_plan else None,
+            "decision_metadata": decision_metadata,
+            "metrics": metrics
+        }
     
     # <summary>会話履歴から現在の状態を抽出します。</summary>
     # <arg name="conversation_history">会話履歴。</arg>
@@ -162,10 +552,43 @@ class ConversationOrchestrator:
             conversation_history,
             None,  # プロジェクト情報は渡さない
             use_llm=use_llm,
-            minimal_mode=True,  # 必須フィールドに限定
-            mock_mode=True  # 必須フィールドに限定（ゴール、目的、ProjectContext、会話履歴）
+            mock_mode=self.use_mock,  # モックモードでは必須フィールドに限定（ゴール、目的、ProjectContext、会話履歴）
+            conversation_id=conversation_id  # 状態ストアで前回の状態からの差分のみ抽出
+        )
+        
+        return self._finalize_state(state, conversation_history, user_id, conversation_id)
+    
+    # <summary>_extract_state の非同期版です。</summary>
+    async def _extract_state_async(
+        self,
+        conversation_history: List[Dict[str, str]],
+        project_context: Optional[Dict[str, Any]],
+        user_id: Optional[int],
+        conversation_id: Optional[str]
+    ) -> StateSnapshot:
+        
+        use_llm = not self.use_mock and (self.llm_client is not None or self.async_llm_client is not None)
+        
+        state = await self.state_extractor.extract_from_history_async(
+            conversation_history,
+            None,  # プロジェクト情報は渡さない
+            use_llm=use_llm,
+            mock_mode=self.use_mock,  # モックモードでは必須フィールドに限定（ゴール、目的、ProjectContext、会話履歴）
+            conversation_id=conversation_id  # 状態ストアで前回の状態からの差分のみ抽出
         )
         
+        return self._finalize_state(state, conversation_history, user_id, conversation_id)
+    
+    # <summary>抽出した状態にシステム情報と暫定的な目標を補います。</summary>
+    # <returns>補完済みの状態スナップショット。</returns>
+    def _finalize_state(
+        self,
+        state: StateSnapshot,
+        conversation_history: List[Dict[str, str]],
+        user_id: Optional[int],
+        conversation_id: Optional[str]
+    ) -> StateSnapshot:
+        
         # システム情報を追加
         state.user_id = user_id
         state.conversation_id = conversation_id
@@ -190,12 +613,18 @@ class ConversationOrchestrator:
     def _generate_project_plan(
         self,
         state: StateSnapshot,
-        conversation_history: List[Dict[str, str]]
+        conversation_history: List[Dict[str, str]],
+        session: ConversationSession
     ) -> Optional[ProjectPlan]:
         
         # 会話履歴ベースモードでは計画思考をスキップ
-        logger.info("会話履歴ベースモードのため、計画思考フェーズをスキップ")
-        return None
+        if not self.enable_planning:
+            logger.info("会話履歴ベースモードのため、計画思考フェーズをスキップ")
+            return None
+        
+        fingerprint, cached_plan = self._memo_lookup(session, "plan", state)
+        if cached_plan is not None:
+            return cached_plan
         
         # モックモードの場合はルールベース処理を使用
         use_llm = not self.use_mock and self.llm_client is not None
@@ -210,31 +639,127 @@ class ConversationOrchestrator:
             logger.info(f"プロジェクト計画生成完了: 北極星={project_plan.north_star[:50]}...")
             logger.info(f"次の行動数: {len(project_plan.next_actions)}, マイルストーン数: {len(project_plan.milestones)}")
             
+            self._memo_store(session, "plan", fingerprint, project_plan)
             return project_plan
             
         except Exception as e:
             logger.error(f"プロジェクト計画生成エラー: {e}")
             return None
     
+    # <summary>_generate_project_plan の非同期版です。</summary>
+    async def _generate_project_plan_async(
+        self,
+        state: StateSnapshot,
+        conversation_history: List[Dict[str, str]],
+        session: ConversationSession
+    ) -> Optional[ProjectPlan]:
+        
+        if not self.enable_planning:
+            return None
+        
+        fingerprint, cached_plan = self._memo_lookup(session, "plan", state)
+        if cached_plan is not None:
+            return cached_plan
+        
+        use_llm = not self.use_mock and (self.llm_client is not None or self.async_llm_client is not None)
+        
+        try:
+            project_plan = await self.project_planner.generate_project_plan_async(
+                state,
+                conversation_history,
+                use_llm=use_llm
+            )
+            self._memo_store(session, "plan", fingerprint, project_plan)
+            return project_plan
+        except Exception as e:
+            logger.error(f"プロジェクト計画生成エラー: {e}")
+            return None
+    
     # <summary>状態から支援タイプを判定します。</summary>
     # <arg name="state">現在の状態スナップショット。</arg>
+    # <arg name="session">この会話のセッション。</arg>
     # <returns>(support_type, reason, confidence)。支援タイプ、理由、確信度。</returns>
-    def _determine_support_type(self, state: StateSnapshot) -> Tuple[str, str, float]:
+    def _determine_support_type(self, state: StateSnapshot, session: ConversationSession) -> Tuple[str, str, float]:
         
-        # モックモードの場合はルールベース処理を使用
-        use_llm = not self.use_mock and self.llm_client is not None
+        fingerprint, cached = self._memo_lookup(session, "support_type", state)
+        if cached is not None:
+            support_type, reason, confidence = cached
+        else:
+            # モックモードの場合はルールベース処理を使用
+            use_llm = not self.use_mock and self.llm_client is not None
+            
+            support_type, reason, confidence = self.support_typer.determine_support_type(
+                state,
+                use_llm=use_llm
+            )
+            self._memo_store(session, "support_type", fingerprint, (support_type, reason, confidence))
         
-        support_type, reason, confidence = self.support_typer.determine_support_type(
-            state,
-            use_llm=use_llm
-        )
+        # 履歴に基づく調整はメモ化せず毎ターン行う
+        return self._adjust_support_type(support_type, reason, confidence, session)
+    
+    # <summary>_determine_support_type の非同期版です。</summary>
+    async def _determine_support_type_async(self, state: StateSnapshot, session: ConversationSession) -> Tuple[str, str, float]:
+        
+        fingerprint, cached = self._memo_lookup(session, "support_type", state)
+        if cached is not None:
+            support_type, reason, confidence = cached
+        else:
+            use_llm = not self.use_mock and (self.llm_client is not None or self.async_llm_client is not None)
+            
+            support_type, reason, confidence = await self.support_typer.determine_support_type_async(
+                state,
+                use_llm=use_llm
+            )
+            self._memo_store(session, "support_type", fingerprint, (support_type, reason, confidence))
         
-        # 文脈に基づく調整
-        if self.support_type_history:
+        return self._adjust_support_type(support_type, reason, confidence, session)
+    
+    # <summary>状態が前回から実質的に変わっていなければ、そのステップの前回の結果を返します。</summary>
+    # <arg name="session">この会話のセッション。</arg>
+    # <arg name="step">ステップ名（support_type / plan）。</arg>
+    # <arg name="state">現在の状態スナップショット。</arg>
+    # <returns>(fingerprint, cached)。メモ化しない場合はfingerprintがNone、再計算が必要な場合はcachedがNone。</returns>
+    def _memo_lookup(
+        self,
+        session: ConversationSession,
+        step: str,
+        state: StateSnapshot
+    ) -> Tuple[Optional[str], Any]:
+        
+        if self.memo_rule is None:
+            return None, None
+        
+        fingerprint = self.memo_rule.fingerprint(state)
+        entry = session.memo.get(step)
+        if entry is not None and entry[0] == fingerprint:
+            session.metrics.memo_hits[step] = session.metrics.memo_hits.get(step, 0) + 1
+            logger.info(f"♻️ {step}: 状態に実質的な変化がないため前回の結果を再利用")
+            return fingerprint, entry[1]
+        
+        session.metrics.memo_misses[step] = session.metrics.memo_misses.get(step, 0) + 1
+        return fingerprint, None
+    
+    # <summary>ステップの結果を状態のフィンガープリントとともに保存します。</summary>
+    def _memo_store(self, session: ConversationSession, step: str, fingerprint: Optional[str], value: Any):
+        if fingerprint is not None and value is not None:
+            session.memo[step] = (fingerprint, value)
+    
+    # <summary>直近の支援タイプ履歴に基づいて判定結果を調整します。</summary>
+    # <returns>(support_type, reason, confidence)。</returns>
+    def _adjust_support_type(
+        self,
+        support_type: str,
+        reason: str,
+        confidence: float,
+        session: ConversationSession
+    ) -> Tuple[str, str, float]:
+        
+        # 文脈に基づく調整（この会話の直近の支援タイプのみを参照）
+        if session.support_type_history:
             effectiveness_scores = {}  # Phase 2で実装
             support_type = self.support_typer.adjust_for_context(
                 support_type,
-                self.support_type_history[-5:],
+                list(session.support_type_history)[-5:],
                 effectiveness_scores
             )
         
@@ -245,13 +770,20 @@ class ConversationOrchestrator:
     # <summary>支援タイプに基づいて発話アクトを選択します。</summary>
     # <arg name="state">現在の状態スナップショット。</arg>
     # <arg name="support_type">選択された支援タイプ。</arg>
+    # <arg name="session">この会話のセッション。</arg>
     # <returns>(selected_acts, reason)。選択された発話アクトリストと理由。</returns>
-    def _select_acts(self, state: StateSnapshot, support_type: str) -> Tuple[List[str], str]:
+    def _select_acts(
+        self,
+        state: StateSnapshot,
+        support_type: str,
+        session: ConversationSession
+    ) -> Tuple[List[str], str]:
         
         selected_acts, reason = self.policy_engine.select_acts(
             state,
             support_type,
-            max_acts=2
+            max_acts=2,
+            act_history=session.recent_acts
         )
         
         # Socratic優先順位で並び替え
@@ -340,77 +872,161 @@ class ConversationOrchestrator:
         user_message: str
     ) -> TurnPackage:
         
+        try:
+            messages = self._build_reply_messages(state, support_type, selected_acts, user_message)
+            
+            # 支援タイプはモデル振り分けのシグナルにもなる
+            with llm_context(step="reply", support_type=support_type):
+                response = self.llm_client.generate_response(messages)
+            return self._parse_reply(response, support_type)
+            
+        except Exception as e:
+            logger.error(f"LLM応答生成エラー: {e}")
+            return self._generate_mock_response(state, support_type, selected_acts)
+    
+    # <summary>_generate_llm_response の非同期版です。</summary>
+    # <arg name="include_followups">応答と同じ呼び出しでフォローアップ候補を生成するか（別途生成する場合はFalse）。</arg>
+    async def _generate_llm_response_async(
+        self,
+        state: StateSnapshot,
+        support_type: str,
+        selected_acts: List[str],
+        user_message: str,
+        include_followups: bool = True
+    ) -> TurnPackage:
+        
+        if self.llm_client is None and self.async_llm_client is None:
+            return self._generate_mock_response(state, support_type, selected_acts)
+        
+        try:
+            messages = self._build_reply_messages(state, support_type, selected_acts, user_message, include_followups)
+            
+            with llm_context(step="reply", support_type=support_type):
+                response = await generate_response_async(self.llm_client, messages, self.async_llm_client)
+            return self._parse_reply(response, support_type)
+            
+        except Exception as e:
+            logger.error(f"LLM応答生成エラー: {e}")
+            return self._generate_mock_response(state, support_type, selected_acts)
+    
+    # <summary>応答生成用のLLMメッセージを構築します。</summary>
+    # <returns>LLMに渡すメッセージリスト。</returns>
+    def _build_reply_messages(
+        self,
+        state: StateSnapshot,
+        support_type: str,
+        selected_acts: List[str],
+        user_message: str,
+        include_followups: bool = True
+    ) -> List[Dict[str, str]]:
+        
         # プロンプト構築（prompt.pyから生成）
-        prompt = generate_response_prompt(selected_acts, support_type, state, user_message)
+        prompt = generate_response_prompt(selected_acts, support_type, state, user_message, include_followups)
+        
+        return [
+            {"role": "system", "content": "あなたは学習支援の専門家です。"},
+            {"role": "user", "content": prompt}
+        ]
+    
+    # <summary>状態と発話アクトからフォローアップ候補を生成します（応答生成と並行して実行）。</summary>
+    # <arg name="state">現在の状態スナップショット。</arg>
+    # <arg name="support_type">選択された支援タイプ。</arg>
+    # <arg name="selected_acts">選択された発話アクトリスト。</arg>
+    # <arg name="user_message">ユーザーの入力メッセージ。</arg>
+    # <returns>フォローアップ候補（最大3個、失敗時は空）。</returns>
+    async def _generate_followups_async(
+        self,
+        state: StateSnapshot,
+        support_type: str,
+        selected_acts: List[str],
+        user_message: str
+    ) -> List[str]:
+        
+        if self.llm_client is None and self.async_llm_client is None:
+            return self._generate_mock_response(state, support_type, selected_acts).followups
         
         try:
             messages = [
                 {"role": "system", "content": "あなたは学習支援の専門家です。"},
-                {"role": "user", "content": prompt}
+                {"role": "user", "content": generate_followups_prompt(selected_acts, support_type, state, user_message)}
             ]
             
-            response = self.llm_client.generate_response(messages)
-            result = json.loads(response)
-            
-            return TurnPackage(
-                natural_reply=result.get("natural_reply", "どのようなお手伝いができますか？"),
-                followups=result.get("followups", [])[:3],
-                metadata={"support_type": support_type}
-            )
+            # 短い候補のため支援タイプは渡さず、発話の重要度・長さでモデルを振り分ける
+            with llm_context(step="followups"):
+                response = await generate_response_async(self.llm_client, messages, self.async_llm_client)
+            followups = json.loads(response).get("followups") or []
+            return [str(f) for f in followups][:3] if isinstance(followups, list) else []
             
         except Exception as e:
-            logger.error(f"LLM応答生成エラー: {e}")
-            return self._generate_mock_response(state, support_type, selected_acts)
+            logger.warning(f"⚠️ フォローアップ候補の生成に失敗: {e}")
+            return []
+    
+    # <summary>LLMの応答（JSON）を応答パッケージに変換します。</summary>
+    # <returns>LLM生成応答パッケージ。</returns>
+    def _parse_reply(self, response: str, support_type: str) -> TurnPackage:
+        
+        result = json.loads(response)
+        
+        return TurnPackage(
+            natural_reply=result.get("natural_reply", "どのようなお手伝いができますか？"),
+            followups=result.get("followups", [])[:3],
+            metadata={"support_type": support_type}
+        )
     
     # <summary>会話メトリクスを更新します。</summary>
+    # <arg name="session">この会話のセッション。</arg>
     # <arg name="state">現在の状態スナップショット。</arg>
     # <arg name="support_type">選択された支援タイプ。</arg>
     # <arg name="selected_acts">選択された発話アクトリスト。</arg>
     def _update_metrics(
         self,
+        session: ConversationSession,
         state: StateSnapshot,
         support_type: str,
         selected_acts: List[str]
     ):
         
         # ターン数をインクリメント
-        self.metrics.turns_count += 1
+        session.metrics.turns_count += 1
         
         # 前進感の推定（簡易版）
         if state.progress_signal.actions_in_last_7_days > 3:
-            self.metrics.momentum_delta = 0.5
+            session.metrics.momentum_delta = 0.5
         elif state.progress_signal.looping_signals:
-            self.metrics.momentum_delta = -0.2
+            session.metrics.momentum_delta = -0.2
         else:
-            self.metrics.momentum_delta = 0.1
+            session.metrics.momentum_delta = 0.1
     
-    # <summary>会話履歴を更新します。</summary>
+    # <summary>会話履歴を更新します（件数の上限はセッションのdequeで制限）。</summary>
+    # <arg name="session">この会話のセッション。</arg>
     # <arg name="support_type">選択された支援タイプ。</arg>
     # <arg name="selected_acts">選択された発話アクトリスト。</arg>
     # <arg name="response_package">応答パッケージ。</arg>
     def _update_history(
         self,
+        session: ConversationSession,
         support_type: str,
         selected_acts: List[str],
         response_package: TurnPackage
     ):
         
-        self.support_type_history.append(support_type)
-        self.act_history.append(selected_acts)
-        
-        # 最大履歴数を制限
-        if len(self.support_type_history) > 20:
-            self.support_type_history = self.support_type_history[-20:]
-        if len(self.act_history) > 20:
-            self.act_history = self.act_history[-20:]
+        session.support_type_history.append(support_type)
+        session.act_history.append(list(selected_acts))
     
     # <summary>エラー時のフォールバック応答を生成します。</summary>
     # <arg name="error_message">エラーメッセージ。</arg>
+    # <arg name="session">この会話のセッション（任意）。</arg>
     # <returns>フォールバック応答辞書。</returns>
-    def _generate_fallback_response(self, error_message: str) -> Dict[str, Any]:
+    def _generate_fallback_response(
+        self,
+        error_message: str,
+        session: Optional[ConversationSession] = None
+    ) -> Dict[str, Any]:
         
         logger.error(f"フォールバック応答生成: {error_message}")
         
+        metrics = session.metrics if session is not None else ConversationMetrics()
+        
         return {
             "response": "申し訳ございません。ちょっと考えがまとまりませんでした。もう一度お聞かせください。",
             "followups": [
@@ -422,27 +1038,31 @@ class ConversationOrchestrator:
             "selected_acts": [SpeechAct.CLARIFY],
             "state_snapshot": {},
             "decision_metadata": {"error": error_message},
-            "metrics": self.metrics.dict()
+            "metrics": metrics.dict()
         }
     
-    # <summary>現在の会話セッションの要約を取得します。</summary>
+    # <summary>会話セッションの要約を取得します。</summary>
+    # <arg name="conversation_id">会話ID。</arg>
     # <returns>会話要約辞書（total_turns, momentum_delta, support_types_used等）。</returns>
-    def get_conversation_summary(self) -> Dict[str, Any]:
+    def get_conversation_summary(self, conversation_id: str) -> Dict[str, Any]:
+        
+        session = self.session_store.peek(conversation_id) or ConversationSession()
         
         return {
-            "total_turns": self.metrics.turns_count,
-            "momentum_delta": self.metrics.momentum_delta,
-            "support_types_used": list(set(self.support_type_history)),
-            "most_common_acts": self._get_most_common_acts(),
-            "effectiveness": self._calculate_effectiveness()
+            "total_turns": session.metrics.turns_count,
+            "momentum_delta": session.metrics.momentum_delta,
+            "support_types_used": list(set(session.support_type_history)),
+            "most_common_acts": self._get_most_common_acts(session),
+            "effectiveness": self._calculate_effectiveness(session)
         }
     
     # <summary>最も頻繁に使用された発話アクトのリストを取得します。</summary>
+    # <arg name="session">この会話のセッション。</arg>
     # <returns>上位3つの発話アクトリスト。</returns>
-    def _get_most_common_acts(self) -> List[str]:
+    def _get_most_common_acts(self, session: ConversationSession) -> List[str]:
         
         act_counts = {}
-        for acts in self.act_history:
+        for acts in session.act_history:
             for act in acts:
                 act_counts[act] = act_counts.get(act, 0) + 1
         
@@ -450,15 +1070,29 @@ class ConversationOrchestrator:
         return [act for act, _ in sorted_acts[:3]]
     
     # <summary>会話の効果スコアを計算します（簡易版）。</summary>
+    # <arg name="session">この会話のセッション。</arg>
     # <returns>効果スコア（0.0～1.0）。</returns>
-    def _calculate_effectiveness(self) -> float:
+    def _calculate_effectiveness(self, session: ConversationSession) -> float:
         
-        if self.metrics.turns_count == 0:
+        if session.metrics.turns_count == 0:
             return 0.5
         
         # 前進感と継続率から効果を推定
-        effectiveness = 0.5 + self.metrics.momentum_delta * 0.3
-        if self.metrics.turns_count > 3:
+        effectiveness = 0.5 + session.metrics.momentum_delta * 0.3
+        if session.metrics.turns_count > 3:
             effectiveness += 0.2  # 継続ボーナス
         
-        return min(1.0, max(0.0, effectiveness))
\ No newline at end of file
+        return min(1.0, max(0.0, effectiveness))
+
+def _elapsed_ms(start: float) -> float:
+    """perf_counter の開始時刻からの経過時間（ms）"""
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+async def _timed(step_timings: Dict[str, float], name: str, awaitable):
+    """awaitable の所要時間を step_timings[name] に記録して結果を返す"""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        step_timings[name] = _elapsed_ms(start)
@@ -5,7 +5,7 @@
 
 import logging
 import random
-from typing import List, Dict, Optional, Any, Tuple
+from typing import List, Dict, Optional, Any, Tuple, MutableSequence
 from .schema import StateSnapshot, SupportType, SpeechAct
 
 logger = logging.getLogger(__name__)
@@ -47,8 +47,16 @@ class PolicyEngine:
         }
     }
     
+    # 単体利用時に保持するアクト履歴の上限（直近の連続判定にしか使わない）
+    MAX_ACT_HISTORY = 10
+    
     def __init__(self):
-        """ポリシーエンジンの初期化"""
+        """
+        ポリシーエンジンの初期化
+        
+        act_history / effectiveness_cache は単体利用時のデフォルト。
+        オーケストレーターからは会話ごとのセッションの履歴を渡すため、インスタンスは共有できる
+        """
         self.act_history: List[str] = []
         self.effectiveness_cache: Dict[str, float] = {}
     
@@ -57,7 +65,8 @@ class PolicyEngine:
         state: StateSnapshot,
         support_type: str,
         history_hint: Optional[str] = None,
-        max_acts: int = 2
+        max_acts: int = 2,
+        act_history: Optional[MutableSequence[str]] = None
     ) -> Tuple[List[str], str]:
         """
         状態と支援タイプから発話アクトを選択
@@ -67,6 +76,7 @@ class PolicyEngine:
             support_type: 選択された支援タイプ
             history_hint: 会話履歴のヒント
             max_acts: 最大アクト数（1-2）
+            act_history: この会話のアクト履歴（省略時はインスタンスの履歴）。選択したアクトが追加される
             
         Returns:
             (selected_acts, reason): 選択されたアクトと理由
@@ -82,7 +92,7 @@ class PolicyEngine:
         selected_acts = self._adjust_acts_for_state(state, support_type, act_config)
         
         # 履歴に基づく調整
-        selected_acts = self._adjust_for_history(selected_acts)
+        selected_acts = self._adjust_for_history(selected_acts, act_history)
         
         # 最大数に制限
         selected_acts = selected_acts[:max_acts]
@@ -91,7 +101,11 @@ class PolicyEngine:
         reason = self._generate_selection_reason(state, support_type, selected_acts)
         
         # 履歴に追加
-        self.act_history.extend(selected_acts)
+        if act_history is not None:
+            act_history.extend(selected_acts)
+        else:
+            self.act_history.extend(selected_acts)
+            del self.act_history[:-self.MAX_ACT_HISTORY]
         
         return selected_acts, reason
     
@@ -152,14 +166,20 @@ class PolicyEngine:
         
         return unique_acts
     
-    def _adjust_for_history(self, selected_acts: List[str]) -> List[str]:
+    def _adjust_for_history(
+        self,
+        selected_acts: List[str],
+        act_history: Optional[MutableSequence[str]] = None
+    ) -> List[str]:
         """履歴に基づいてアクトを調整（同じアクトの連続を避ける）"""
         
-        if len(self.act_history) < 3:
+        if act_history is None:
+            act_history = self.act_history
+        if len(act_history) < 3:
             return selected_acts
         
-        # 直近3回のアクトを確認
-        recent_acts = self.act_history[-3:]
+        # 直近3回のアクトを確認（dequeはスライスできないため末尾から取り出す）
+        recent_acts = [act_history[-i] for i in range(3, 0, -1)]
         
         adjusted_acts = []
         for act in selected_acts:
@@ -240,16 +260,16 @@ class PolicyEngine:
         
         return "、".join(reasons[:2])
     
-    def update_effectiveness(self, act: str, effectiveness: float):
-        """アクトの効果を更新"""
+    def update_effectiveness(self, act: str, effectiveness: float, cache: Optional[Dict[str, float]] = None):
+        """アクトの効果を更新（cache 省略時はインスタンスのキャッシュ）"""
         
-        if act not in self.effectiveness_cache:
-            self.effectiveness_cache[act] = effectiveness
+        if cache is None:
+            cache = self.effectiveness_cache
+        if act not in cache:
+            cache[act] = effectiveness
         else:
             # 移動平均で更新
-            self.effectiveness_cache[act] = (
-                self.effectiveness_cache[act] * 0.7 + effectiveness * 0.3
-            )
+            cache[act] = cache[act] * 0.7 + effectiveness * 0.3
     
     def get_act_description(self, act: str) -> Dict[str, str]:
         """アクトの説明を取得"""
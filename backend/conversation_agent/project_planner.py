@@ -14,6 +14,8 @@ from .schema import StateSnapshot, ProjectPlan, NextAction, Milestone
 # prompt.pyへのパスを追加
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 from prompt.prompt import PLAN_GENERATION_PROMPT
+from module.llm_context import llm_context
+from .llm_calls import generate_response_async
 
 logger = logging.getLogger(__name__)
 
@@ -22,8 +24,10 @@ class ProjectPlanner:
 
     # <summary>ProjectPlannerクラスを初期化します。</summary>
     # <arg name="llm_client">LLMクライアント（既存のmodule.llm_apiを使用）。</arg>
-    def __init__(self, llm_client=None):
+    # <arg name="async_llm_client">非同期LLMクライアント（module.async_llm_api、任意）。</arg>
+    def __init__(self, llm_client=None, async_llm_client=None):
         self.llm_client = llm_client
+        self.async_llm_client = async_llm_client
     
     # <summary>プロジェクト計画を生成します。</summary>
     # <arg name="state">学習者の状態。</arg>
@@ -46,6 +50,30 @@ class ProjectPlanner:
         else:
             return self._generate_rule_based(state)
     
+    # <summary>generate_project_plan の非同期版です（LLM呼び出しでイベントループを塞ぎません）。</summary>
+    # <arg name="state">学習者の状態。</arg>
+    # <arg name="conversation_history">会話履歴。</arg>
+    # <arg name="use_llm">LLMを使用するか。</arg>
+    # <returns>生成されたプロジェクト計画。</returns>
+    async def generate_project_plan_async(
+        self,
+        state: StateSnapshot,
+        conversation_history: List[Dict[str, str]],
+        use_llm: bool = True
+    ) -> ProjectPlan:
+        
+        if use_llm and (self.llm_client or self.async_llm_client):
+            try:
+                messages = self._build_llm_messages(state, conversation_history)
+                with llm_context(step="plan"):
+                    response = await generate_response_async(self.llm_client, messages, self.async_llm_client)
+                return self._parse_llm_response(response)
+            except Exception as e:
+                logger.warning(f"LLM計画生成エラー、ルールベース処理を使用: {e}")
+                return self._generate_rule_based(state)
+        else:
+            return self._generate_rule_based(state)
+    
     # <summary>LLMを使用して計画を生成します。</summary>
     # <arg name="state">学習者の状態。</arg>
     # <arg name="conversation_history">会話履歴。</arg>
@@ -56,6 +84,23 @@ class ProjectPlanner:
         conversation_history: List[Dict[str, str]]
     ) -> ProjectPlan:
         
+        messages = self._build_llm_messages(state, conversation_history)
+        
+        with llm_context(step="plan"):
+            response = self.llm_client.generate_response(messages)
+        
+        return self._parse_llm_response(response)
+    
+    # <summary>計画生成用のLLMメッセージを構築します。</summary>
+    # <arg name="state">学習者の状態。</arg>
+    # <arg name="conversation_history">会話履歴。</arg>
+    # <returns>LLMに渡すメッセージリスト。</returns>
+    def _build_llm_messages(
+        self,
+        state: StateSnapshot,
+        conversation_history: List[Dict[str, str]]
+    ) -> List[Dict[str, str]]:
+        
         # プロジェクト情報の抽出
         project_context = state.project_context or {}
         theme = project_context.get('theme', '未設定')
@@ -75,13 +120,15 @@ class ProjectPlanner:
             conversation_summary=conversation_summary
         )
         
-        # LLM呼び出し
-        messages = [
+        return [
             {"role": "system", "content": "あなたは探究学習の専門家AIです。"},
             {"role": "user", "content": prompt}
         ]
-        
-        response = self.llm_client.generate_response(messages)
+    
+    # <summary>LLMの応答（JSON）を検証してプロジェクト計画に変換します。</summary>
+    # <arg name="response">LLMの応答テキスト。</arg>
+    # <returns>生成されたプロジェクト計画。</returns>
+    def _parse_llm_response(self, response: str) -> ProjectPlan:
         
         # JSON解析と検証
         try:
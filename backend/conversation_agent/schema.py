@@ -150,4 +150,14 @@ class ConversationMetrics(BaseModel):
     action_taken: bool = Field(False, description="72h以内の行動実行")
     turns_count: int = Field(0, ge=0, description="会話継続ターン数")
     satisfaction_score: Optional[float] = Field(None, ge=1.0, le=5.0, description="ユーザー満足度")
-    lens_effectiveness: Dict[str, float] = Field(default_factory=dict, description="レンズ別効果測定")
\ No newline at end of file
+    lens_effectiveness: Dict[str, float] = Field(default_factory=dict, description="レンズ別効果測定")
+    memo_hits: Dict[str, int] = Field(default_factory=dict, description="ステップ別のメモ化結果の再利用回数")
+    memo_misses: Dict[str, int] = Field(default_factory=dict, description="ステップ別の再計算回数")
+    
+    def memo_hit_rates(self) -> Dict[str, float]:
+        """ステップ別のメモ化ヒット率"""
+        steps = set(self.memo_hits) | set(self.memo_misses)
+        return {
+            step: self.memo_hits.get(step, 0) / (self.memo_hits.get(step, 0) + self.memo_misses.get(step, 0))
+            for step in steps
+        }
@@ -0,0 +1,183 @@
+"""
+会話ごとの対話エージェントセッションストア
+支援タイプ・発話アクトの履歴や会話メトリクスなど、ターンをまたいで使う状態を conversation_id ごとに分離して保持します。
+オーケストレーター自体はこの状態を持たないため、1つのインスタンスを全ユーザー・全リクエストで共有できます。
+
+- 件数（CONVERSATION_SESSION_MAX、デフォルト: 5000）と推定メモリ量（CONVERSATION_SESSION_MAX_MEMORY_MB、デフォルト: 32）
+  の上限を超えたら最も古いセッションから破棄（LRU）
+- 最終アクセスから CONVERSATION_SESSION_TTL 秒（デフォルト: 21600）経過したセッションも破棄
+- 各履歴は件数上限付きのdequeで保持し、長い会話でも1セッションのサイズは一定
+- プロセス内のストアのため、複数ワーカー間では共有されない（履歴は直近数ターンの調整にのみ使うため、
+  別ワーカーに振られた場合は短い履歴から始まるだけ）
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from .schema import ConversationMetrics
+
+logger = logging.getLogger(__name__)
+
+# 履歴の上限（支援タイプ・アクトはターン単位、recent_acts はアクト単位）
+MAX_TURN_HISTORY = 20
+MAX_RECENT_ACTS = 10
+
+# セッション1件あたりの推定サイズ（バイト）
+_SESSION_BASE_BYTES = 1024
+_HISTORY_ITEM_BYTES = 80
+_MEMO_ENTRY_BYTES = 4096
+# 履歴がすべて埋まった場合の上限（アクトは1ターン最大2個、効果キャッシュはアクト8種、メモは支援タイプと計画の2件）
+MAX_SESSION_BYTES = (
+    _SESSION_BASE_BYTES
+    + (MAX_TURN_HISTORY * 3 + MAX_RECENT_ACTS + 8) * _HISTORY_ITEM_BYTES
+    + 2 * _MEMO_ENTRY_BYTES
+)
+
+
+@dataclass
+class ConversationSession:
+    """1つの会話の対話エージェント状態"""
+    metrics: ConversationMetrics = field(default_factory=ConversationMetrics)
+    support_type_history: Deque[str] = field(default_factory=lambda: deque(maxlen=MAX_TURN_HISTORY))
+    act_history: Deque[List[str]] = field(default_factory=lambda: deque(maxlen=MAX_TURN_HISTORY))
+    recent_acts: Deque[str] = field(default_factory=lambda: deque(maxlen=MAX_RECENT_ACTS))
+    effectiveness_cache: Dict[str, float] = field(default_factory=dict)
+    # ステップ名 → (状態のフィンガープリント, 結果)（state_memo を参照）
+    memo: Dict[str, Tuple[str, Any]] = field(default_factory=dict)
+    last_access: float = field(default_factory=time.monotonic)
+
+    def estimated_size(self) -> int:
+        """メモリ上限判定用の推定サイズ（バイト）"""
+        items = (
+            len(self.support_type_history)
+            + sum(len(acts) for acts in self.act_history)
+            + len(self.recent_acts)
+            + len(self.effectiveness_cache)
+        )
+        return _SESSION_BASE_BYTES + items * _HISTORY_ITEM_BYTES + len(self.memo) * _MEMO_ENTRY_BYTES
+
+
+@dataclass
+class SessionStoreStats:
+    """セッションストアの統計"""
+    hits: int = 0
+    created: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+
+class ConversationSessionStore:
+    """conversation_id ごとのセッションを LRU / TTL / メモリ上限付きで保持"""
+
+    def __init__(
+        self,
+        max_sessions: Optional[int] = None,
+        ttl_seconds: Optional[float] = None,
+        max_memory_mb: Optional[float] = None
+    ):
+        if max_sessions is None:
+            max_sessions = int(os.environ.get("CONVERSATION_SESSION_MAX", "5000"))
+        if ttl_seconds is None:
+            ttl_seconds = float(os.environ.get("CONVERSATION_SESSION_TTL", "21600"))
+        if max_memory_mb is None:
+            max_memory_mb = float(os.environ.get("CONVERSATION_SESSION_MAX_MEMORY_MB", "32"))
+
+        self.max_sessions = max(1, max_sessions)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = int(max_memory_mb * 1024 * 1024)
+        # 1セッションのサイズには上限があるため、メモリ上限は保持件数の上限に換算して判定する
+        if self.max_bytes > 0:
+            self.max_sessions = max(1, min(self.max_sessions, self.max_bytes // MAX_SESSION_BYTES))
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, ConversationSession]" = OrderedDict()
+        self.stats = SessionStoreStats()
+
+    def get(self, conversation_id: Optional[str]) -> ConversationSession:
+        """
+        会話のセッションを取得（なければ作成）
+
+        conversation_id がない場合は保存しない一時セッションを返す
+        """
+        if not conversation_id:
+            return ConversationSession()
+
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(conversation_id)
+            if session is not None and self._is_expired(session, now):
+                del self._sessions[conversation_id]
+                self.stats.expirations += 1
+                session = None
+
+            if session is None:
+                session = ConversationSession()
+                self._sessions[conversation_id] = session
+                self.stats.created += 1
+                self._evict_if_needed(now)
+            else:
+                self.stats.hits += 1
+
+            session.last_access = now
+            self._sessions.move_to_end(conversation_id)
+            return session
+
+    def peek(self, conversation_id: str) -> Optional[ConversationSession]:
+        """アクセス順を変えずにセッションを取得（集計・デバッグ用）"""
+        with self._lock:
+            return self._sessions.get(conversation_id)
+
+    def _is_expired(self, session: ConversationSession, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - session.last_access > self.ttl_seconds
+
+    def _evict_if_needed(self, now: float) -> None:
+        # 期限切れは最も古い側に並んでいるため、先頭から順に確認する
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if not self._is_expired(oldest, now):
+                break
+            del self._sessions[oldest_id]
+            self.stats.expirations += 1
+
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.stats.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "ttl_seconds": self.ttl_seconds,
+                "estimated_bytes": sum(session.estimated_size() for session in self._sessions.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.stats.hits,
+                "created": self.stats.created,
+                "evictions": self.stats.evictions,
+                "expirations": self.stats.expirations,
+            }
+
+
+# シングルトンインスタンスを管理
+_store_instance: Optional[ConversationSessionStore] = None
+_store_lock = threading.Lock()
+
+
+def get_session_store() -> ConversationSessionStore:
+    """プロセス共通のセッションストアを取得"""
+    global _store_instance
+
+    if _store_instance is None:
+        with _store_lock:
+            if _store_instance is None:
+                _store_instance = ConversationSessionStore()
+
+    return _store_instance
@@ -7,13 +7,16 @@ import json
 import logging
 import sys
 import os
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple
 from datetime import datetime, timedelta
 from .schema import StateSnapshot, Affect, ProgressSignal
 
 # prompt.pyへのパスを追加
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
-from prompt.prompt import STATE_EXTRACT_PROMPT
+from prompt.prompt import STATE_EXTRACT_PROMPT, STATE_UPDATE_PROMPT
+from module.llm_context import llm_context
+from .llm_calls import generate_response_async
+from .state_store import ConversationState, ConversationStateStore, find_new_messages, message_key
 
 logger = logging.getLogger(__name__)
 
@@ -22,21 +25,27 @@ class StateExtractor:
     
     # <summary>状態抽出器を初期化します。</summary>
     # <arg name="llm_client">LLMクライアント（既存のmodule.llm_apiを使用）。</arg>
-    def __init__(self, llm_client=None):
+    # <arg name="async_llm_client">非同期LLMクライアント（module.async_llm_api、任意）。</arg>
+    # <arg name="state_store">会話ごとの状態ストア（任意、指定時は前回の状態からの差分抽出を行う）。</arg>
+    def __init__(self, llm_client=None, async_llm_client=None, state_store: Optional[ConversationStateStore] = None):
         self.llm_client = llm_client
+        self.async_llm_client = async_llm_client
+        self.state_store = state_store
         
     # <summary>会話履歴から状態を抽出するメイン関数です。</summary>
     # <arg name="conversation_history">[{"sender": "user/assistant", "message": "..."}]形式の履歴。</arg>
     # <arg name="project_context">プロジェクト情報（既存システムから取得）。</arg>
     # <arg name="use_llm">LLMを使用するか（Falseの場合はヒューリスティック処理）。</arg>
     # <arg name="mock_mode">最小限の状態抽出モード（ゴール、目的、ProjectContext、会話履歴のみに焦点）。</arg>
+    # <arg name="conversation_id">会話ID（任意、状態ストアによる差分抽出に使用）。</arg>
     # <returns>抽出された状態スナップショット。</returns>
     def extract_from_history(
         self,
         conversation_history: List[Dict[str, str]],
         project_context: Optional[Dict[str, Any]] = None,
         use_llm: bool = True,
-        mock_mode: bool = False #mock
+        mock_mode: bool = False, #mock
+        conversation_id: Optional[str] = None
     ) -> StateSnapshot:
         
         if mock_mode:
@@ -45,7 +54,7 @@ class StateExtractor:
         
         if use_llm and self.llm_client:
             try:
-                return self._extract_with_llm(conversation_history, project_context)
+                return self._extract_with_llm(conversation_history, project_context, conversation_id)
             except Exception as e:
                 logger.warning(f"LLM抽出エラー、フォールバック処理を使用: {e}")
                 return self._extract_heuristic(conversation_history, project_context)
@@ -53,6 +62,47 @@ class StateExtractor:
             return self._extract_heuristic(conversation_history, project_context)
 
 
+    # <summary>extract_from_history の非同期版です（LLM呼び出しでイベントループを塞ぎません）。</summary>
+    # <arg name="conversation_history">[{"sender": "user/assistant", "message": "..."}]形式の履歴。</arg>
+    # <arg name="project_context">プロジェクト情報（既存システムから取得）。</arg>
+    # <arg name="use_llm">LLMを使用するか（Falseの場合はヒューリスティック処理）。</arg>
+    # <arg name="mock_mode">最小限の状態抽出モード。</arg>
+    # <arg name="conversation_id">会話ID（任意、状態ストアによる差分抽出に使用）。</arg>
+    # <returns>抽出された状態スナップショット。</returns>
+    async def extract_from_history_async(
+        self,
+        conversation_history: List[Dict[str, str]],
+        project_context: Optional[Dict[str, Any]] = None,
+        use_llm: bool = True,
+        mock_mode: bool = False,
+        conversation_id: Optional[str] = None
+    ) -> StateSnapshot:
+        
+        if mock_mode:
+            return self._extract_minimal(conversation_history, project_context)
+        
+        if use_llm and (self.llm_client or self.async_llm_client):
+            try:
+                # 状態ストアのSQLiteの読み書きはワーカースレッドで行い、イベントループを塞がない
+                entry = await self.state_store.get_async(conversation_id) if self.state_store and conversation_id else None
+                cached_state, messages, step, updates = self._plan_llm_extraction(
+                    conversation_history, project_context, conversation_id, entry
+                )
+                if cached_state is not None:
+                    return cached_state
+                with llm_context(step=step):
+                    response = await generate_response_async(self.llm_client, messages, self.async_llm_client)
+                state = self._parse_llm_response(response, project_context, self._update_base(entry, step))
+                record = self._state_record(conversation_id, conversation_history, state, updates)
+                if record is not None:
+                    await self.state_store.put_async(*record)
+                return state
+            except Exception as e:
+                logger.warning(f"LLM抽出エラー、フォールバック処理を使用: {e}")
+                return self._extract_heuristic(conversation_history, project_context)
+        else:
+            return self._extract_heuristic(conversation_history, project_context)
+
     # <summary>LLMを使用して状態を抽出します（デフォルト関数）。</summary>
     # <arg name="conversation_history">会話履歴。</arg>
     # <arg name="project_context">プロジェクト情報（任意）。</arg>
@@ -60,39 +110,162 @@ class StateExtractor:
     def _extract_with_llm(
         self,
         conversation_history: List[Dict[str, str]],
-        project_context: Optional[Dict[str, Any]] = None
+        project_context: Optional[Dict[str, Any]] = None,
+        conversation_id: Optional[str] = None
     ) -> StateSnapshot:
         
+        entry = self.state_store.get(conversation_id) if self.state_store and conversation_id else None
+        cached_state, messages, step, updates = self._plan_llm_extraction(
+            conversation_history, project_context, conversation_id, entry
+        )
+        if cached_state is not None:
+            return cached_state
+        
+        with llm_context(step=step):
+            response = self.llm_client.generate_response(messages)
+        
+        state = self._parse_llm_response(response, project_context, self._update_base(entry, step))
+        record = self._state_record(conversation_id, conversation_history, state, updates)
+        if record is not None:
+            self.state_store.put(*record)
+        return state
+
+    # <summary>保存済みの状態から、キャッシュ利用・差分抽出・全体抽出のどれを行うか決めます。</summary>
+    # <arg name="conversation_history">会話履歴。</arg>
+    # <arg name="project_context">プロジェクト情報（任意）。</arg>
+    # <arg name="conversation_id">会話ID（任意）。</arg>
+    # <arg name="entry">状態ストアから取得した会話の状態（なければNone）。</arg>
+    # <returns>(cached_state, messages, step, updates_since_full)。キャッシュを使う場合はcached_stateのみ設定。</returns>
+    def _plan_llm_extraction(
+        self,
+        conversation_history: List[Dict[str, str]],
+        project_context: Optional[Dict[str, Any]],
+        conversation_id: Optional[str],
+        entry: Optional[ConversationState]
+    ) -> Tuple[Optional[StateSnapshot], Optional[List[Dict[str, str]]], str, int]:
+        
+        if entry is not None:
+            new_messages = find_new_messages(conversation_history, entry.last_message_key)
+            if new_messages == []:
+                # 前回の抽出以降メッセージが増えていない
+                logger.info(f"状態ストアの状態を再利用: conversation={conversation_id}")
+                state = StateSnapshot(**entry.state)
+                state.project_context = project_context
+                if project_context:
+                    state.project_id = project_context.get('id')
+                return state, None, "state_extract", entry.updates_since_full
+            
+            if new_messages and len(new_messages) <= 20 and not self.state_store.needs_full_refresh(entry):
+                logger.info(f"状態の差分抽出: conversation={conversation_id}, 新規メッセージ={len(new_messages)}件")
+                messages = self._build_update_messages(entry.state, new_messages, project_context)
+                return None, messages, "state_update", entry.updates_since_full + 1
+        
+        return None, self._build_llm_messages(conversation_history, project_context), "state_extract", 0
+
+    # <summary>差分抽出の応答に含まれない項目を引き継ぐための前回の状態を返します。</summary>
+    # <arg name="entry">状態ストアから取得した会話の状態（なければNone）。</arg>
+    # <arg name="step">_plan_llm_extraction が決めたステップ。</arg>
+    # <returns>差分抽出（state_update）の場合は前回の状態、それ以外はNone。</returns>
+    def _update_base(self, entry: Optional[ConversationState], step: str) -> Optional[Dict[str, Any]]:
+        return entry.state if entry is not None and step == "state_update" else None
+
+    # <summary>抽出した状態を状態ストアに保存する引数を組み立てます。</summary>
+    # <arg name="conversation_id">会話ID（任意）。</arg>
+    # <arg name="conversation_history">会話履歴。</arg>
+    # <arg name="state">抽出された状態スナップショット。</arg>
+    # <arg name="updates_since_full">前回の全体抽出以降の差分更新回数。</arg>
+    # <returns>state_store.put / put_async に渡す引数（保存しない場合はNone）。</returns>
+    def _state_record(
+        self,
+        conversation_id: Optional[str],
+        conversation_history: List[Dict[str, str]],
+        state: StateSnapshot,
+        updates_since_full: int
+    ) -> Optional[Tuple[str, Dict[str, Any], str, int]]:
+        if not (self.state_store and conversation_id and conversation_history):
+            return None
+        return (
+            conversation_id,
+            state.dict(exclude={'user_id', 'conversation_id', 'turn_index', 'project_context'}),
+            message_key(conversation_history[-1]),
+            updates_since_full
+        )
+
+    # <summary>前回の状態と新しいメッセージから差分更新用のLLMメッセージを構築します。</summary>
+    # <arg name="previous_state">前回の状態（辞書）。</arg>
+    # <arg name="new_messages">前回以降のメッセージ。</arg>
+    # <arg name="project_context">プロジェクト情報（任意）。</arg>
+    # <returns>LLMに渡すメッセージリスト。</returns>
+    def _build_update_messages(
+        self,
+        previous_state: Dict[str, Any],
+        new_messages: List[Dict[str, str]],
+        project_context: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, str]]:
+        
+        prompt = STATE_UPDATE_PROMPT.format(
+            previous_state=json.dumps(
+                {k: v for k, v in previous_state.items() if k != 'project_id'},
+                ensure_ascii=False
+            ),
+            new_messages=self._format_conversation(new_messages),
+            project_context=self._format_project_context(project_context)
+        )
+        
+        return [
+            {"role": "system", "content": "あなたは状態抽出を行うAIアシスタントです。"},
+            {"role": "user", "content": prompt}
+        ]
+
+    # <summary>状態抽出用のLLMメッセージを構築します。</summary>
+    # <arg name="conversation_history">会話履歴。</arg>
+    # <arg name="project_context">プロジェクト情報（任意）。</arg>
+    # <returns>LLMに渡すメッセージリスト。</returns>
+    def _build_llm_messages(
+        self,
+        conversation_history: List[Dict[str, str]],
+        project_context: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, str]]:
+        
         # 会話履歴を文字列に変換
         conversation_text = self._format_conversation(conversation_history[-20:])  # 最新20メッセージ
         
-        # プロジェクト情報を文字列に変換
-        project_text = ""
-        if project_context:
-            project_text = f"""
-            - テーマ: {project_context.get('theme', '未設定')}
-            - 問い: {project_context.get('question', '未設定')}
-            - 仮説: {project_context.get('hypothesis', '未設定')}
-            """
-        
         # プロンプト生成
         prompt = STATE_EXTRACT_PROMPT.format(
             conversation=conversation_text,
-            project_context=project_text
+            project_context=self._format_project_context(project_context)
         )
         
-        # LLM呼び出し
-        messages = [
+        return [
             {"role": "system", "content": "あなたは状態抽出を行うAIアシスタントです。"},
             {"role": "user", "content": prompt}
         ]
-        
-        response = self.llm_client.generate_response(messages)
+
+    # <summary>LLMの応答（JSON）を状態スナップショットに変換します。</summary>
+    # <arg name="response">LLMの応答テキスト。</arg>
+    # <arg name="project_context">プロジェクト情報（任意）。</arg>
+    # <arg name="previous_state">差分抽出の場合の前回の状態（応答に含まれない項目を引き継ぐ）。</arg>
+    # <returns>抽出された状態スナップショット。</returns>
+    def _parse_llm_response(
+        self,
+        response: str,
+        project_context: Optional[Dict[str, Any]] = None,
+        previous_state: Optional[Dict[str, Any]] = None
+    ) -> StateSnapshot:
         
         # JSON解析
         try:
             state_dict = json.loads(response)
             
+            # 差分抽出では応答に含まれない項目を前回の状態から引き継ぐ（ネストされた項目はキー単位で重ねる）
+            if previous_state:
+                merged = dict(previous_state)
+                for key, value in state_dict.items():
+                    if isinstance(value, dict) and isinstance(merged.get(key), dict):
+                        value = {**merged[key], **value}
+                    merged[key] = value
+                state_dict = merged
+            
             # ネストされたオブジェクトの処理
             if 'affect' in state_dict:
                 state_dict['affect'] = Affect(**state_dict['affect'])
@@ -163,6 +336,18 @@ class StateExtractor:
         
         return state
     
+    # <summary>プロジェクト情報をプロンプト用の文字列に変換します。</summary>
+    # <arg name="project_context">プロジェクト情報（任意）。</arg>
+    # <returns>フォーマットされたプロジェクト情報（なければ空文字）。</returns>
+    def _format_project_context(self, project_context: Optional[Dict[str, Any]]) -> str:
+        if not project_context:
+            return ""
+        return f"""
+            - テーマ: {project_context.get('theme', '未設定')}
+            - 問い: {project_context.get('question', '未設定')}
+            - 仮説: {project_context.get('hypothesis', '未設定')}
+            """
+    
     # <summary>会話履歴を文字列フォーマットに変換します。</summary>
     # <arg name="conversation_history">会話履歴。</arg>
     # <returns>フォーマットされた会話文字列。</returns>
@@ -0,0 +1,108 @@
+"""
+StateSnapshot のフィンガープリントによるメモ化
+支援タイプ判定と計画思考の結果を、状態の「実質的な変化」がない間は再利用するために使います。
+
+- フィンガープリントは対象フィールドを正規化（空白・大文字小文字・リストの順序を無視し、感情や進捗は段階に丸める）
+  してからハッシュ化したもの
+- 丸めの細かさ（どの程度の変化を「実質的な変化」とみなすか）は MaterialChangeRule で指定
+- 環境変数 CONVERSATION_AGENT_MEMO_RULE（strict / default / off、デフォルト: default）でルールを選択
+- 結果の保存先は会話ごとのセッション（ConversationSession.memo）
+"""
+
+import os
+import json
+import hashlib
+import logging
+from dataclasses import dataclass, replace
+from typing import Any, Dict, Optional, Tuple
+
+from .schema import StateSnapshot
+
+logger = logging.getLogger(__name__)
+
+# フィンガープリントに含めるデフォルトのフィールド
+DEFAULT_MEMO_FIELDS: Tuple[str, ...] = (
+    "goal",
+    "purpose",
+    "project_id",
+    "blockers",
+    "affect",
+    "progress_signal",
+)
+
+
+@dataclass(frozen=True)
+class MaterialChangeRule:
+    """状態の変化を「実質的な変化」とみなす基準"""
+    fields: Tuple[str, ...] = DEFAULT_MEMO_FIELDS
+    affect_step: int = 2            # 感情（0〜5）をこの幅で丸める（1なら完全一致）
+    novelty_step: float = 0.25      # 新規性比率（0〜1）をこの幅で丸める（0なら完全一致）
+    scope_step: int = 3             # スコープの広さ（1〜10）をこの幅で丸める
+    max_recent_actions: int = 3     # 過去7日間の行動数はこの値で頭打ち
+    ignore_order: bool = True       # リスト項目の順序を無視するか
+
+    def fingerprint(self, state: StateSnapshot) -> str:
+        """状態のフィンガープリントを計算"""
+        normalized = {name: self._normalize_field(name, getattr(state, name, None)) for name in self.fields}
+        payload = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+    def _normalize_field(self, name: str, value: Any) -> Any:
+        if name == "affect" and value is not None:
+            step = max(1, self.affect_step)
+            return [value.interest // step, value.anxiety // step, value.excitement // step]
+        if name == "progress_signal" and value is not None:
+            novelty = value.novelty_ratio
+            if self.novelty_step > 0:
+                novelty = int(novelty // self.novelty_step)
+            return [
+                min(value.actions_in_last_7_days, self.max_recent_actions),
+                novelty,
+                self._normalize_value(value.looping_signals),
+                (value.scope_breadth - 1) // max(1, self.scope_step),
+            ]
+        return self._normalize_value(value)
+
+    def _normalize_value(self, value: Any) -> Any:
+        if isinstance(value, str):
+            return " ".join(value.split()).lower()
+        if isinstance(value, (list, tuple)):
+            items = [self._normalize_value(item) for item in value]
+            items = [item for item in items if item not in ("", None)]
+            if self.ignore_order:
+                items = sorted(set(json.dumps(item, ensure_ascii=False, sort_keys=True) for item in items))
+            return items
+        if isinstance(value, dict):
+            return {key: self._normalize_value(item) for key, item in value.items()}
+        if hasattr(value, "dict"):
+            return self._normalize_value(value.dict())
+        return value
+
+
+# 名前付きのルール（off はメモ化しない）
+MEMO_RULES: Dict[str, Optional[MaterialChangeRule]] = {
+    "strict": MaterialChangeRule(affect_step=1, novelty_step=0.0, scope_step=1, max_recent_actions=1000, ignore_order=False),
+    "default": MaterialChangeRule(),
+    "off": None,
+}
+
+
+def get_material_change_rule(name: Optional[str] = None) -> Optional[MaterialChangeRule]:
+    """
+    名前からルールを取得（未指定時は環境変数 CONVERSATION_AGENT_MEMO_RULE）
+
+    CONVERSATION_AGENT_MEMO_FIELDS（カンマ区切り）でフィンガープリントの対象フィールドを上書きできる
+    """
+    if name is None:
+        name = os.environ.get("CONVERSATION_AGENT_MEMO_RULE", "default").lower()
+    if name not in MEMO_RULES:
+        logger.warning(f"⚠️ 不明なメモ化ルール: {name}（defaultを使用）")
+        name = "default"
+    rule = MEMO_RULES[name]
+
+    fields = os.environ.get("CONVERSATION_AGENT_MEMO_FIELDS", "")
+    if rule is not None and fields:
+        names = tuple(field.strip() for field in fields.split(",") if field.strip() in StateSnapshot.__fields__)
+        if names:
+            rule = replace(rule, fields=names)
+    return rule
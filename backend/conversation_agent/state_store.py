@@ -0,0 +1,274 @@
+"""
+会話ごとの StateSnapshot ストア
+会話ごとに最後に抽出した状態と、その状態がどのメッセージまでを反映しているかを保持し、
+次のターンでは新しいメッセージだけを渡す差分抽出に使います。
+
+- メモリ上はLRUで件数を制限（CONVERSATION_STATE_CACHE_SIZE、デフォルト: 1000）
+- CONVERSATION_STATE_DB_PATH を指定するとSQLiteに書き込み、再起動後もLRUから外れた会話も復元できる
+  （非同期の呼び出し元は get_async / put_async を使い、SQLiteの読み書きをワーカースレッドで行う）
+- 差分更新が CONVERSATION_STATE_FULL_REFRESH_INTERVAL 回（デフォルト: 5）続いたら全体を再抽出してずれを防ぐ
+"""
+
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def message_key(message: Dict[str, Any]) -> str:
+    """メッセージの識別子（DBのidがあればそれを、なければ送信者と本文のハッシュを使う）"""
+    if message.get("id") is not None:
+        return f"id:{message['id']}"
+    digest = hashlib.sha1(f"{message.get('sender', '')}:{message.get('message', '')}".encode("utf-8")).hexdigest()
+    return f"hash:{digest[:16]}"
+
+
+def find_new_messages(
+    conversation_history: List[Dict[str, Any]],
+    last_message_key: Optional[str]
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    保存済みの状態が反映している最後のメッセージより後のメッセージを取得
+
+    Returns:
+        新しいメッセージのリスト（最後のメッセージが履歴に見つからない場合はNone）
+    """
+    if not last_message_key:
+        return None
+    for index in range(len(conversation_history) - 1, -1, -1):
+        if message_key(conversation_history[index]) == last_message_key:
+            return conversation_history[index + 1:]
+    return None
+
+
+@dataclass
+class ConversationState:
+    """会話ごとに保存する状態"""
+    state: Dict[str, Any]
+    last_message_key: Optional[str]
+    updates_since_full: int = 0
+    updated_at: float = field(default_factory=time.time)
+
+
+@dataclass
+class StateStoreStats:
+    """ストアの統計"""
+    hits: int = 0
+    misses: int = 0
+    restored: int = 0
+    stores: int = 0
+    evictions: int = 0
+    persist_errors: int = 0
+
+
+class ConversationStateStore:
+    """LRUで件数を制限し、任意でSQLiteに永続化する会話状態ストア"""
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        db_path: Optional[str] = None,
+        full_refresh_interval: Optional[int] = None
+    ):
+        if max_entries is None:
+            max_entries = int(os.environ.get("CONVERSATION_STATE_CACHE_SIZE", "1000"))
+        if db_path is None:
+            db_path = os.environ.get("CONVERSATION_STATE_DB_PATH", "")
+        if full_refresh_interval is None:
+            full_refresh_interval = int(os.environ.get("CONVERSATION_STATE_FULL_REFRESH_INTERVAL", "5"))
+
+        self.max_entries = max(1, max_entries)
+        self.full_refresh_interval = max(0, full_refresh_interval)
+        self.db_path = db_path or None
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, ConversationState]" = OrderedDict()
+        self.stats = StateStoreStats()
+        self._db: Optional[sqlite3.Connection] = None
+
+        if self.db_path:
+            self._open_db()
+
+    # ---------------------------------
+    # 永続化
+    # ---------------------------------
+
+    def _open_db(self) -> None:
+        try:
+            directory = os.path.dirname(os.path.abspath(self.db_path))
+            os.makedirs(directory, exist_ok=True)
+            # asyncio.to_thread のワーカースレッドからも使うため、接続はロックで直列化する
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            # WALで1回の保存を軽くする（ロックを持つ時間を短くし、同時の読み込みを待たせない）
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS conversation_states (
+                    conversation_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    last_message_key TEXT,
+                    updates_since_full INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            self._db.commit()
+            logger.info(f"✅ 会話状態ストアの永続化を有効化: {self.db_path}")
+        except sqlite3.Error as e:
+            logger.error(f"❌ 会話状態ストアのDBを開けません（メモリのみで動作）: {e}")
+            self._db = None
+
+    def _load(self, conversation_id: str) -> Optional[ConversationState]:
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute(
+                "SELECT state, last_message_key, updates_since_full, updated_at "
+                "FROM conversation_states WHERE conversation_id = ?",
+                (conversation_id,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            self.stats.persist_errors += 1
+            logger.warning(f"⚠️ 会話状態の読み込みエラー: {e}")
+            return None
+        if row is None:
+            return None
+        return ConversationState(
+            state=json.loads(row[0]),
+            last_message_key=row[1],
+            updates_since_full=row[2],
+            updated_at=row[3]
+        )
+
+    def _persist(self, conversation_id: str, entry: ConversationState) -> None:
+        if self._db is None:
+            return
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO conversation_states "
+                "(conversation_id, state, last_message_key, updates_since_full, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (
+                    conversation_id,
+                    json.dumps(entry.state, ensure_ascii=False),
+                    entry.last_message_key,
+                    entry.updates_since_full,
+                    entry.updated_at
+                )
+            )
+            self._db.commit()
+        except sqlite3.Error as e:
+            self.stats.persist_errors += 1
+            logger.warning(f"⚠️ 会話状態の保存エラー: {e}")
+
+    # ---------------------------------
+    # 取得・保存
+    # ---------------------------------
+
+    def get(self, conversation_id: str) -> Optional[ConversationState]:
+        """会話の保存済み状態を取得（メモリになければDBから復元）"""
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None:
+                self._entries.move_to_end(conversation_id)
+                self.stats.hits += 1
+                return entry
+
+            entry = self._load(conversation_id)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self.stats.restored += 1
+            self._put_locked(conversation_id, entry)
+            return entry
+
+    def put(
+        self,
+        conversation_id: str,
+        state: Dict[str, Any],
+        last_message_key: Optional[str],
+        updates_since_full: int = 0
+    ) -> None:
+        """会話の状態を保存"""
+        entry = ConversationState(
+            state=state,
+            last_message_key=last_message_key,
+            updates_since_full=updates_since_full
+        )
+        with self._lock:
+            self.stats.stores += 1
+            self._put_locked(conversation_id, entry)
+            self._persist(conversation_id, entry)
+
+    async def get_async(self, conversation_id: str) -> Optional[ConversationState]:
+        """get の非同期版（永続化している場合はSQLiteの読み込みとロック待ちをワーカースレッドで行う）"""
+        if self._db is None:
+            return self.get(conversation_id)
+        return await asyncio.to_thread(self.get, conversation_id)
+
+    async def put_async(
+        self,
+        conversation_id: str,
+        state: Dict[str, Any],
+        last_message_key: Optional[str],
+        updates_since_full: int = 0
+    ) -> None:
+        """put の非同期版（永続化している場合はSQLiteへの書き込みとcommitをワーカースレッドで行う）"""
+        if self._db is None:
+            self.put(conversation_id, state, last_message_key, updates_since_full)
+            return
+        await asyncio.to_thread(self.put, conversation_id, state, last_message_key, updates_since_full)
+
+    def _put_locked(self, conversation_id: str, entry: ConversationState) -> None:
+        self._entries[conversation_id] = entry
+        self._entries.move_to_end(conversation_id)
+        while len(self._entries) > self.max_entries:
+            # メモリからのみ外す（永続化している場合は次回アクセス時にDBから復元）
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def needs_full_refresh(self, entry: ConversationState) -> bool:
+        """差分更新が続いたため全体を再抽出すべきか"""
+        return entry.updates_since_full >= self.full_refresh_interval
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "persistent": self._db is not None,
+                "full_refresh_interval": self.full_refresh_interval,
+                "hits": self.stats.hits,
+                "misses": self.stats.misses,
+                "restored": self.stats.restored,
+                "stores": self.stats.stores,
+                "evictions": self.stats.evictions,
+                "persist_errors": self.stats.persist_errors,
+            }
+
+
+# シングルトンインスタンスを管理
+_store_instance: Optional[ConversationStateStore] = None
+_store_lock = threading.Lock()
+
+
+def get_state_store() -> ConversationStateStore:
+    """プロセス共通の会話状態ストアを取得"""
+    global _store_instance
+
+    if _store_instance is None:
+        with _store_lock:
+            if _store_instance is None:
+                _store_instance = ConversationStateStore()
+
+    return _store_instance
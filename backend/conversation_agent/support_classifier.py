@@ -0,0 +1,286 @@
+"""
+支援タイプ判定のローカル分類器
+SupportTyper の LLM 判定結果（状態の特徴量 → 支援タイプ）をログに記録し、そのログで学習した
+多クラスロジスティック回帰（NumPy）をプロセス内で使います。確信度が閾値以上ならLLMを呼ばずに判定します。
+
+- 判定ログ: SUPPORT_TYPE_LOG_PATH（JSONL、空なら記録しない）
+- 学習済みモデル: SUPPORT_TYPE_MODEL_PATH（.npz、空またはファイルがなければ分類器を使わない）
+- 閾値: SUPPORT_TYPE_CLASSIFIER_THRESHOLD（デフォルト: 0.8）
+- 特徴量は StateSnapshot の数値項目と、テキスト項目の文字バイグラムを固定次元にハッシュしたもの
+
+オフラインでの学習と評価（LLM判定との一致率）は backend/train_support_classifier.py を使います。
+"""
+
+import os
+import json
+import time
+import zlib
+import random
+import logging
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .schema import StateSnapshot, SupportType
+
+logger = logging.getLogger(__name__)
+
+# ハッシュ特徴量の次元数
+FEATURE_DIM = 2 ** 12
+# テキスト項目のうち特徴量に使うもの（リストは各要素を使う）
+_TEXT_FIELDS = ("goal", "purpose", "blockers", "uncertainties", "options_considered", "last_action")
+_MAX_TEXT_CHARS = 200
+
+
+def extract_features(state: StateSnapshot) -> Dict[str, float]:
+    """状態スナップショットから特徴量を抽出（ログに保存する形式）"""
+    affect = state.affect
+    progress = state.progress_signal
+    features: Dict[str, float] = {
+        "bias": 1.0,
+        "affect:interest": affect.interest / 5,
+        "affect:anxiety": affect.anxiety / 5,
+        "affect:excitement": affect.excitement / 5,
+        "progress:actions": min(progress.actions_in_last_7_days, 10) / 10,
+        "progress:no_actions": float(progress.actions_in_last_7_days == 0),
+        "progress:novelty": progress.novelty_ratio,
+        "progress:scope": progress.scope_breadth / 10,
+        "progress:looping": min(len(progress.looping_signals), 5) / 5,
+        "count:blockers": min(len(state.blockers), 5) / 5,
+        "count:uncertainties": min(len(state.uncertainties), 5) / 5,
+        "count:options": min(len(state.options_considered), 5) / 5,
+        "has:goal": float(bool(state.goal)),
+        "has:purpose": float(bool(state.purpose)),
+        "has:project": float(state.project_id is not None or bool(state.project_context)),
+    }
+    for name in _TEXT_FIELDS:
+        value = getattr(state, name, None)
+        texts = value if isinstance(value, list) else [value]
+        for text in texts:
+            if not text:
+                continue
+            text = "".join(str(text).split())[:_MAX_TEXT_CHARS]
+            for i in range(len(text) - 1):
+                key = f"{name}:{text[i:i + 2]}"
+                features[key] = features.get(key, 0.0) + 1.0
+    return features
+
+
+def vectorize(features: Dict[str, float], dim: int = FEATURE_DIM) -> np.ndarray:
+    """特徴量を固定次元のベクトルに変換（テキスト特徴量はL2正規化してから加算）"""
+    vector = np.zeros(dim, dtype=np.float32)
+    text_indices: List[int] = []
+    text_values: List[float] = []
+    for key, value in features.items():
+        # Pythonのhash()はプロセスごとに変わるため、学習時と推論時で同じ値になるcrc32を使う
+        index = zlib.crc32(key.encode("utf-8")) % dim
+        if ":" in key and key.split(":", 1)[0] in _TEXT_FIELDS:
+            text_indices.append(index)
+            text_values.append(value)
+        else:
+            vector[index] += value
+    if text_values:
+        values = np.asarray(text_values, dtype=np.float32)
+        np.add.at(vector, text_indices, values / np.linalg.norm(values))
+    return vector
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class SupportTypeClassifier:
+    """ハッシュ特徴量に対する多クラスロジスティック回帰"""
+
+    def __init__(self, labels: Sequence[str] = tuple(SupportType.ALL_TYPES), dim: int = FEATURE_DIM):
+        self.labels = list(labels)
+        self.dim = dim
+        self.weights = np.zeros((dim, len(self.labels)), dtype=np.float32)
+        self.bias = np.zeros(len(self.labels), dtype=np.float32)
+
+    def fit(
+        self,
+        X: np.ndarray,
+        y: Sequence[str],
+        epochs: int = 500,
+        learning_rate: float = 2.0,
+        l2: float = 1e-4
+    ) -> "SupportTypeClassifier":
+        """バッチ勾配降下法で学習（データ件数は判定ログ程度を想定）"""
+        label_index = {label: i for i, label in enumerate(self.labels)}
+        targets = np.zeros((len(y), len(self.labels)), dtype=np.float32)
+        targets[np.arange(len(y)), [label_index[label] for label in y]] = 1.0
+
+        n = max(1, len(y))
+        for _ in range(epochs):
+            probs = _softmax(X @ self.weights + self.bias)
+            error = (probs - targets) / n
+            self.weights -= learning_rate * (X.T @ error + l2 * self.weights)
+            self.bias -= learning_rate * error.sum(axis=0)
+        return self
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        return _softmax(X @ self.weights + self.bias)
+
+    def predict(self, state: StateSnapshot) -> Tuple[str, float]:
+        """状態から (支援タイプ, 確信度) を予測"""
+        probs = self.predict_proba(vectorize(extract_features(state), self.dim)[None, :])[0]
+        best = int(probs.argmax())
+        return self.labels[best], float(probs[best])
+
+    def save(self, path: str) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, labels=np.asarray(self.labels))
+
+    @classmethod
+    def load(cls, path: str) -> "SupportTypeClassifier":
+        with np.load(path, allow_pickle=False) as data:
+            classifier = cls(labels=[str(label) for label in data["labels"]], dim=data["weights"].shape[0])
+            classifier.weights = data["weights"].astype(np.float32)
+            classifier.bias = data["bias"].astype(np.float32)
+        return classifier
+
+
+class DecisionLogger:
+    """LLMによる支援タイプ判定を学習データとしてJSONLに追記"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def log(self, state: StateSnapshot, support_type: str, confidence: float) -> None:
+        record = {
+            "features": extract_features(state),
+            "support_type": support_type,
+            "confidence": confidence,
+            "timestamp": time.time(),
+        }
+        line = json.dumps(record, ensure_ascii=False)
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logger.warning(f"⚠️ 支援タイプ判定ログの書き込みエラー: {e}")
+
+
+def load_examples(path: str, labels: Sequence[str] = tuple(SupportType.ALL_TYPES)) -> Tuple[List[Dict[str, float]], List[str]]:
+    """判定ログを読み込む（不正な行と未知の支援タイプは除外）"""
+    features: List[Dict[str, float]] = []
+    targets: List[str] = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("support_type") in labels and isinstance(record.get("features"), dict):
+                features.append(record["features"])
+                targets.append(record["support_type"])
+    return features, targets
+
+
+def evaluate(
+    classifier: SupportTypeClassifier,
+    features: List[Dict[str, float]],
+    targets: List[str],
+    threshold: float
+) -> Dict[str, Any]:
+    """LLM判定との一致率と、閾値以上でローカル判定できる割合を計算"""
+    if not targets:
+        return {"examples": 0}
+    X = np.stack([vectorize(f, classifier.dim) for f in features])
+    probs = classifier.predict_proba(X)
+    predicted = [classifier.labels[i] for i in probs.argmax(axis=1)]
+    confident = probs.max(axis=1) >= threshold
+    agree = np.asarray([p == t for p, t in zip(predicted, targets)])
+
+    per_type = {}
+    for label, count in Counter(targets).items():
+        mask = np.asarray([t == label for t in targets])
+        per_type[label] = {"examples": count, "agreement": float(agree[mask].mean())}
+
+    return {
+        "examples": len(targets),
+        "agreement": float(agree.mean()),
+        "threshold": threshold,
+        "coverage": float(confident.mean()),
+        "agreement_when_confident": float(agree[confident].mean()) if confident.any() else None,
+        "per_type": per_type,
+    }
+
+
+def train_from_log(
+    log_path: str,
+    epochs: int = 500,
+    learning_rate: float = 2.0,
+    holdout: float = 0.2,
+    threshold: float = 0.8,
+    seed: int = 0
+) -> Tuple[SupportTypeClassifier, Dict[str, Any]]:
+    """判定ログから学習し、ホールドアウトでの評価結果とともに返す"""
+    features, targets = load_examples(log_path)
+    if not targets:
+        raise ValueError(f"学習データがありません: {log_path}")
+
+    order = list(range(len(targets)))
+    random.Random(seed).shuffle(order)
+    split = int(len(order) * (1 - holdout)) if len(order) > 1 else len(order)
+    train_idx, test_idx = order[:split], order[split:]
+
+    X = np.stack([vectorize(features[i]) for i in train_idx])
+    classifier = SupportTypeClassifier().fit(X, [targets[i] for i in train_idx], epochs, learning_rate)
+    report = evaluate(classifier, [features[i] for i in test_idx], [targets[i] for i in test_idx], threshold)
+    report["train_examples"] = len(train_idx)
+    return classifier, report
+
+
+# シングルトンインスタンスを管理
+_classifier_instance: Optional[SupportTypeClassifier] = None
+_classifier_loaded = False
+_logger_instance: Optional[DecisionLogger] = None
+_logger_loaded = False
+_instance_lock = threading.Lock()
+
+
+def get_support_classifier() -> Optional[SupportTypeClassifier]:
+    """SUPPORT_TYPE_MODEL_PATH の学習済みモデルを取得（未設定・読み込み失敗時はNone）"""
+    global _classifier_instance, _classifier_loaded
+
+    if not _classifier_loaded:
+        with _instance_lock:
+            if not _classifier_loaded:
+                path = os.environ.get("SUPPORT_TYPE_MODEL_PATH", "")
+                if path and os.path.exists(path):
+                    try:
+                        _classifier_instance = SupportTypeClassifier.load(path)
+                        logger.info(f"✅ 支援タイプ分類器を読み込みました: {path}")
+                    except (OSError, KeyError, ValueError) as e:
+                        logger.error(f"❌ 支援タイプ分類器の読み込みエラー: {e}")
+                _classifier_loaded = True
+
+    return _classifier_instance
+
+
+def get_decision_logger() -> Optional[DecisionLogger]:
+    """SUPPORT_TYPE_LOG_PATH への判定ロガーを取得（未設定時はNone）"""
+    global _logger_instance, _logger_loaded
+
+    if not _logger_loaded:
+        with _instance_lock:
+            if not _logger_loaded:
+                path = os.environ.get("SUPPORT_TYPE_LOG_PATH", "")
+                if path:
+                    try:
+                        _logger_instance = DecisionLogger(path)
+                    except OSError as e:
+                        logger.error(f"❌ 支援タイプ判定ログを作成できません: {e}")
+                _logger_loaded = True
+
+    return _logger_instance
@@ -12,6 +12,14 @@ from .schema import StateSnapshot, SupportType
 # prompt.pyへのパスを追加
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 from prompt.prompt import SUPPORT_TYPE_PROMPT
+from module.llm_context import llm_context
+from .llm_calls import generate_response_async
+from .support_classifier import (
+    SupportTypeClassifier,
+    DecisionLogger,
+    get_support_classifier,
+    get_decision_logger
+)
 
 logger = logging.getLogger(__name__)
 
@@ -20,8 +28,25 @@ class SupportTyper:
     
     # <summary>支援タイプ判定器を初期化します。</summary>
     # <arg name="llm_client">LLMクライアント（既存のmodule.llm_apiを使用）。</arg>
-    def __init__(self, llm_client=None):
+    # <arg name="async_llm_client">非同期LLMクライアント（module.async_llm_api、任意）。</arg>
+    # <arg name="classifier">学習済みの支援タイプ分類器（未指定時は SUPPORT_TYPE_MODEL_PATH から読み込み）。</arg>
+    # <arg name="decision_logger">LLM判定を学習データとして記録するロガー（未指定時は SUPPORT_TYPE_LOG_PATH）。</arg>
+    # <arg name="classifier_threshold">分類器の判定を採用する確信度の下限（未指定時は SUPPORT_TYPE_CLASSIFIER_THRESHOLD）。</arg>
+    def __init__(
+        self,
+        llm_client=None,
+        async_llm_client=None,
+        classifier: Optional[SupportTypeClassifier] = None,
+        decision_logger: Optional[DecisionLogger] = None,
+        classifier_threshold: Optional[float] = None
+    ):
         self.llm_client = llm_client
+        self.async_llm_client = async_llm_client
+        self.classifier = classifier or get_support_classifier()
+        self.decision_logger = decision_logger or get_decision_logger()
+        if classifier_threshold is None:
+            classifier_threshold = float(os.environ.get("SUPPORT_TYPE_CLASSIFIER_THRESHOLD", "0.8"))
+        self.classifier_threshold = classifier_threshold
     
     # <summary>状態から支援タイプを判定します。</summary>
     # <arg name="state">状態スナップショット。</param> 
@@ -36,6 +61,9 @@ class SupportTyper:
     ) -> tuple[str, str, float]:
         
         if use_llm and self.llm_client:
+            local = self._determine_with_classifier(state)
+            if local is not None:
+                return local
             try:
                 return self._determine_with_llm(state, history_context)
             except Exception as e:
@@ -44,6 +72,33 @@ class SupportTyper:
         else:
             return self._determine_rule_based(state)
     
+    # <summary>determine_support_type の非同期版です（LLM呼び出しでイベントループを塞ぎません）。</summary>
+    # <arg name="state">状態スナップショット。</arg>
+    # <arg name="history_context">会話履歴の要約（任意）。</arg>
+    # <arg name="use_llm">LLMを使用するか。</arg>
+    # <returns>(support_type, reason, confidence)。支援タイプ、理由、確信度</returns>
+    async def determine_support_type_async(
+        self,
+        state: StateSnapshot,
+        history_context: Optional[str] = None,
+        use_llm: bool = True
+    ) -> tuple[str, str, float]:
+        
+        if use_llm and (self.llm_client or self.async_llm_client):
+            local = self._determine_with_classifier(state)
+            if local is not None:
+                return local
+            try:
+                messages = self._build_llm_messages(state, history_context)
+                with llm_context(step="support_type"):
+                    response = await generate_response_async(self.llm_client, messages, self.async_llm_client)
+                return self._record_decision(state, self._parse_llm_response(response))
+            except Exception as e:
+                logger.warning(f"LLM判定エラー、ルールベース処理を使用: {e}")
+                return self._determine_rule_based(state)
+        else:
+            return self._determine_rule_based(state)
+    
     # <summary>LLMを使用して支援タイプを判定します。</summary>
     # <arg name="state">状態スナップショット。</arg>
     # <arg name="history_context">会話履歴の要約（任意）。</arg>
@@ -54,6 +109,51 @@ class SupportTyper:
         history_context: Optional[str] = None
     ) -> tuple[str, str, float]:
         
+        messages = self._build_llm_messages(state, history_context)
+        
+        with llm_context(step="support_type"):
+            response = self.llm_client.generate_response(messages)
+        
+        return self._record_decision(state, self._parse_llm_response(response))
+    
+    # <summary>学習済み分類器で支援タイプを判定します（確信度が閾値未満ならNone）。</summary>
+    # <arg name="state">状態スナップショット。</arg>
+    # <returns>(support_type, reason, confidence)。分類器がない・確信度が低い場合はNone。</returns>
+    def _determine_with_classifier(self, state: StateSnapshot) -> Optional[tuple[str, str, float]]:
+        
+        if self.classifier is None:
+            return None
+        try:
+            support_type, confidence = self.classifier.predict(state)
+        except Exception as e:
+            logger.warning(f"支援タイプ分類器エラー、LLM判定を使用: {e}")
+            return None
+        if confidence < self.classifier_threshold or support_type not in SupportType.ALL_TYPES:
+            return None
+        
+        logger.info(f"⚡ 分類器で支援タイプを判定: {support_type}（確信度={confidence:.2f}）")
+        return support_type, "過去のLLM判定から学習したモデルによる判定", confidence
+    
+    # <summary>LLMの判定結果を分類器の学習データとして記録します。</summary>
+    # <arg name="state">状態スナップショット。</arg>
+    # <arg name="decision">(support_type, reason, confidence)。</arg>
+    # <returns>decision をそのまま返します。</returns>
+    def _record_decision(self, state: StateSnapshot, decision: tuple[str, str, float]) -> tuple[str, str, float]:
+        
+        if self.decision_logger is not None:
+            self.decision_logger.log(state, decision[0], decision[2])
+        return decision
+    
+    # <summary>支援タイプ判定用のLLMメッセージを構築します。</summary>
+    # <arg name="state">状態スナップショット。</arg>
+    # <arg name="history_context">会話履歴の要約（任意）。</arg>
+    # <returns>LLMに渡すメッセージリスト。</returns>
+    def _build_llm_messages(
+        self,
+        state: StateSnapshot,
+        history_context: Optional[str] = None
+    ) -> List[Dict[str, str]]:
+        
         # 状態をJSON形式に変換（プロジェクト情報は除く）
         state_dict = state.dict(exclude={'user_id', 'conversation_id', 'turn_index', 'project_context'})
         state_json = json.dumps(state_dict, ensure_ascii=False, indent=2)
@@ -65,13 +165,15 @@ class SupportTyper:
         if history_context:
             prompt += f"\n\n会話履歴の要約:\n{history_context}"
         
-        # LLM呼び出し
-        messages = [
+        return [
             {"role": "system", "content": "あなたは学習支援の専門家です。"},
             {"role": "user", "content": prompt}
         ]
-        
-        response = self.llm_client.generate_response(messages)
+    
+    # <summary>LLMの応答（JSON）から支援タイプを取り出します。</summary>
+    # <arg name="response">LLMの応答テキスト。</arg>
+    # <returns>(support_type, reason, confidence)。支援タイプ、理由、確信度。</returns>
+    def _parse_llm_response(self, response: str) -> tuple[str, str, float]:
         
         # JSON解析
         try:
@@ -164,6 +266,27 @@ class SupportTyper:
         
         return support_type, reason, confidence
     
+    # <summary>直近の支援タイプ履歴を踏まえて支援タイプを調整します。</summary>
+    # <arg name="support_type">判定された支援タイプ。</arg>
+    # <arg name="recent_types">直近の支援タイプ履歴（古い順）。</arg>
+    # <arg name="effectiveness_scores">支援タイプごとの効果スコア（0.0～1.0、Phase 2で実装）。</arg>
+    # <returns>調整後の支援タイプ。</returns>
+    def adjust_for_context(
+        self,
+        support_type: str,
+        recent_types: List[str],
+        effectiveness_scores: Dict[str, float]
+    ) -> str:
+        
+        # 同じ支援タイプが3回続き、効果が低いと分かっている場合のみ別の支援に切り替える
+        repeated = len(recent_types) >= 3 and all(t == support_type for t in recent_types[-3:])
+        if repeated and effectiveness_scores.get(support_type, 1.0) < 0.3:
+            alternative = SupportType.REFRAMING if support_type != SupportType.REFRAMING else SupportType.PATHFINDING
+            logger.info(f"支援タイプ調整: {support_type} → {alternative}（同じ支援が続き効果が低いため）")
+            return alternative
+        
+        return support_type
+    
     # <summary>支援タイプの特性情報を取得します。</summary>
     # <arg name="support_type">支援タイプ。</arg>
     # <returns>支援タイプの特性辞書（focus, approach, typical_acts, outcome）。</returns>
@@ -13,6 +13,8 @@ from datetime import datetime, timezone
 import aiohttp
 from dataclasses import dataclass
 
+from vector_index import VectorIndex, get_vector_index
+
 logger = logging.getLogger(__name__)
 
 @dataclass
@@ -38,7 +40,8 @@ class EmbeddingClient:
             "openai": {
                 "model": os.environ.get("EMBEDDING_MODEL", "text-embedding-ada-002"),
                 "dim": 1536,
-                "endpoint": "https://api.openai.com/v1/embeddings"
+                # OPENAI_BASE_URLでローカルのスタブサーバーに向けられる
+                "endpoint": (os.environ.get("OPENAI_BASE_URL") or "https://api.openai.com/v1").rstrip("/") + "/embeddings"
             },
             "cohere": {
                 "model": "embed-english-v2.0",
@@ -204,15 +207,18 @@ class EmbeddingClient:
 class SemanticSearch:
     """
     意味的類似検索とMMRリランキング
+    検索対象は会話ごとのプロセス内ベクトルインデックス（vector_index.VectorIndex）
     """
     
     def __init__(
         self,
         embedding_client: EmbeddingClient,
-        supabase_client=None
+        supabase_client=None,
+        vector_index: Optional[VectorIndex] = None
     ):
         self.embedding_client = embedding_client
         self.supabase = supabase_client
+        self.vector_index = vector_index or get_vector_index()
         
         # MMRパラメータ
         self.mmr_lambda = float(os.environ.get("MMR_LAMBDA", "0.7"))
@@ -245,18 +251,14 @@ class SemanticSearch:
         # クエリの埋め込み生成
         query_embedding = await self.embedding_client.generate_embedding(query)
         
-        # Supabaseから類似検索（Phase 2で実装）
-        if self.supabase:
-            results = await self._search_with_supabase(
-                query_embedding,
-                conversation_id,
-                k * 2,  # MMR用に多めに取得
-                min_similarity,
-                exclude_recent_n
-            )
-        else:
-            # モック結果（開発用）
-            results = self._get_mock_results(k)
+        # プロセス内のベクトルインデックスから類似検索
+        results = self._search_index(
+            query_embedding,
+            conversation_id,
+            k * 2,  # MMR用に多めに取得
+            min_similarity,
+            exclude_recent_n
+        )
         
         # MMRリランキング
         if use_mmr and len(results) > k:
@@ -269,7 +271,7 @@ class SemanticSearch:
         
         return results
     
-    async def _search_with_supabase(
+    def _search_index(
         self,
         query_embedding: np.ndarray,
         conversation_id: str,
@@ -277,21 +279,15 @@ class SemanticSearch:
         min_similarity: float,
         exclude_recent_n: int
     ) -> List[SearchResult]:
-        """Supabaseで類似検索（Phase 2で実装）"""
-        # TODO: pgvectorを使った検索を実装
-        return []
-    
-    def _get_mock_results(self, k: int) -> List[SearchResult]:
-        """モック検索結果（開発用）"""
-        results = []
-        for i in range(k):
-            results.append(SearchResult(
-                id=i,
-                text=f"過去のメッセージ {i+1}: これはテスト用のモックメッセージです。",
-                score=0.9 - i * 0.1,
-                metadata={"created_at": datetime.now(timezone.utc).isoformat()}
-            ))
-        return results
+        """プロセス内のベクトルインデックスで類似検索（DBへの往復なし）"""
+        hits = self.vector_index.search(
+            conversation_id,
+            query_embedding,
+            k=k,
+            min_similarity=min_similarity,
+            exclude_recent_n=exclude_recent_n
+        )
+        return [SearchResult(id=hit.id, text=hit.text, score=hit.score, metadata=hit.metadata) for hit in hits]
     
     def _mmr_rerank(
         self,
@@ -0,0 +1,170 @@
+"""
+会話履歴の正規化
+DBから取得した履歴をLLMに渡す前に、応答の後から付け足した装飾や毎ターン作り直す情報を取り除き、
+1メッセージあたりのトークン数に上限を設けます。保存済みの chat_logs.message は変更しません。
+
+- フォローアップ候補（"**次にできること:**" の箇条書き）を取り除く（次のターンで新しく生成されるため）
+- dev_system_prompt の構造化出力のうち [要約]・[理由タグ] のブロックを取り除く（[回答]・[問い]・[次の一歩] は残す）
+- 正規化後のトークン数が HISTORY_MESSAGE_MAX_TOKENS を超えるメッセージは先頭から収まる分だけ残す
+  （トークン数はデフォルトで文字数で概算。日本語はほぼ1文字1トークンのため毎ターンtiktokenで数えない）
+- ENABLE_HISTORY_NORMALIZATION=false で無効化（履歴をそのまま使う）
+- 正規化したメッセージ数・削減した文字数を集計
+"""
+
+import os
+import re
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 応答の末尾に付け足すフォローアップ候補（optimized_endpoints で付与）
+FOLLOWUP_BLOCK_PATTERN = re.compile(r"\n*\*\*次にできること:\*\*\s*\n(?:[ \t]*[•・\-\*][^\n]*(?:\n|$))*\s*$")
+
+# 構造化出力のラベル行（例: "[要約] …"）
+SECTION_LABEL_PATTERN = re.compile(r"^\s*[\[［](要約|回答|問い|提案|次の一歩|理由タグ)[\]］]")
+
+# 履歴から取り除くブロック
+DROPPED_SECTIONS = frozenset({"要約", "理由タグ"})
+
+TRUNCATION_MARKER = "…"
+
+
+@dataclass
+class NormalizationStats:
+    """正規化の集計"""
+    messages: int = 0
+    changed: int = 0                  # 装飾・ブロックを取り除いたメッセージ数
+    truncated: int = 0                # 上限で切り詰めたメッセージ数
+    chars_before: int = 0
+    chars_after: int = 0
+
+
+class HistoryNormalizer:
+    """LLMに渡す会話履歴の正規化"""
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        max_message_tokens: Optional[int] = None,
+        token_counter: Optional[Callable[[str], int]] = None
+    ):
+        if enabled is None:
+            enabled = os.environ.get("ENABLE_HISTORY_NORMALIZATION", "true").lower() == "true"
+        if max_message_tokens is None:
+            max_message_tokens = int(os.environ.get("HISTORY_MESSAGE_MAX_TOKENS", "400"))
+
+        self.enabled = enabled
+        self.max_message_tokens = max_message_tokens
+        self.token_counter = token_counter or len
+
+        self._lock = threading.Lock()
+        self._stats = NormalizationStats()
+
+    def normalize(self, conversation_history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        履歴を正規化したコピーを返す（message 以外のキーはそのまま）
+
+        Args:
+            conversation_history: chat_logs の行（sender, message を含む）
+        """
+        if not self.enabled or not conversation_history:
+            return conversation_history or []
+
+        normalized = []
+        changed = truncated = chars_before = chars_after = 0
+        for msg in conversation_history:
+            original = msg.get("message") or ""
+            text = original
+            if msg.get("sender") != "user":
+                text = self.strip_derived(text)
+                changed += int(text != original)
+            capped = self.cap_tokens(text)
+            truncated += int(capped != text)
+
+            chars_before += len(original)
+            chars_after += len(capped)
+            normalized.append({**msg, "message": capped} if capped != original else msg)
+
+        with self._lock:
+            self._stats.messages += len(conversation_history)
+            self._stats.changed += changed
+            self._stats.truncated += truncated
+            self._stats.chars_before += chars_before
+            self._stats.chars_after += chars_after
+
+        if changed or truncated:
+            logger.debug(
+                f"🧹 履歴を正規化: {len(conversation_history)}件中 除去{changed}件・切り詰め{truncated}件, "
+                f"{chars_before}→{chars_after}文字"
+            )
+        return normalized
+
+    def strip_derived(self, text: str) -> str:
+        """アシスタントの応答からフォローアップ候補と [要約]・[理由タグ] のブロックを取り除く"""
+        text = FOLLOWUP_BLOCK_PATTERN.sub("", text)
+        if "[" not in text and "［" not in text:
+            return text
+
+        kept = []
+        dropping = False
+        for line in text.split("\n"):
+            label = SECTION_LABEL_PATTERN.match(line)
+            if label:
+                dropping = label.group(1) in DROPPED_SECTIONS
+            if not dropping:
+                kept.append(line)
+        return re.sub(r"\n{3,}", "\n\n", "\n".join(kept)).strip()
+
+    def cap_tokens(self, text: str) -> str:
+        """上限を超えるメッセージを先頭から収まる分だけ残して切り詰める"""
+        if self.max_message_tokens <= 0 or self.token_counter(text) <= self.max_message_tokens:
+            return text
+
+        # 残す文字数を二分探索
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.token_counter(text[:middle] + TRUNCATION_MARKER) <= self.max_message_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return text[:low].rstrip() + TRUNCATION_MARKER
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """正規化したメッセージ数と削減した文字数"""
+        with self._lock:
+            stats = self._stats
+            return {
+                "enabled": self.enabled,
+                "max_message_tokens": self.max_message_tokens,
+                "messages": stats.messages,
+                "changed": stats.changed,
+                "truncated": stats.truncated,
+                "chars_before": stats.chars_before,
+                "chars_after": stats.chars_after,
+                "reduction_ratio": 1 - stats.chars_after / stats.chars_before if stats.chars_before else 0,
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats = NormalizationStats()
+
+
+# シングルトンインスタンスを管理
+_normalizer_instance: Optional[HistoryNormalizer] = None
+_normalizer_lock = threading.Lock()
+
+
+def get_history_normalizer() -> HistoryNormalizer:
+    """プロセス共通の履歴正規化を取得"""
+    global _normalizer_instance
+
+    if _normalizer_instance is None:
+        with _normalizer_lock:
+            if _normalizer_instance is None:
+                _normalizer_instance = HistoryNormalizer()
+
+    return _normalizer_instance
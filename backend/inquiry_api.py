@@ -8,13 +8,55 @@ from typing import List, Optional, Dict, Any
 from datetime import datetime
 import json
 import asyncio
-from openai import AsyncOpenAI
-import os
+
+from module.http_clients import get_shared_async_openai_client
+from module.llm_coalescer import get_llm_coalescer, make_request_key
+from module.rate_pacer import get_rate_pacer
+from module.fair_scheduler import get_fair_scheduler
+from module.circuit_breaker import get_circuit_breaker
+from module.llm_usage import record_llm_usage
+from response_cache import get_response_cache, make_cache_key, normalize_text, normalize_keywords
 
 router = APIRouter(prefix="/api/inquiry", tags=["inquiry"])
 
-# OpenAI clientをasyncで初期化
-client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+async def create_chat_completion(**kwargs):
+    """
+    同一内容の同時リクエストを1回のOpenAI呼び出しにまとめてChat Completionを生成
+    （授業中に同じキーワードが一斉に送られるケースの重複課金を防ぐ）
+    """
+    key = make_request_key(
+        kwargs.get("model"),
+        kwargs.get("messages", []),
+        temperature=kwargs.get("temperature"),
+        max_tokens=kwargs.get("max_tokens")
+    )
+    return await get_llm_coalescer().run(key, lambda: _paced_chat_completion(**kwargs))
+
+
+async def _paced_chat_completion(**kwargs):
+    """
+    公平スケジューラの実行枠と共有レートペーサーの枠を確保してからOpenAIを呼び出す
+    （サーキットが open の場合は CircuitOpenError で即座に失敗し、各エンドポイントの既定応答に切り替わる）
+    """
+    # プロセス共通のkeep-alive接続プールを使う非同期クライアント（終了時は close_shared_clients で閉じる）
+    client = get_shared_async_openai_client()
+
+    breaker = get_circuit_breaker("openai")
+
+    async def send(slot):
+        # サーキットブレーカーは待機列・ペーサーの内側でHTTP呼び出しだけを囲む
+        async with breaker.guard():
+            response = await client.chat.completions.create(**kwargs)
+        slot.record_usage(response)
+        return response
+
+    # open なら待機列に並ばずに失敗させ、429はペーサーのクールダウン後に1回だけ再試行
+    breaker.raise_if_open()
+    async with get_fair_scheduler().slot():
+        response = await get_rate_pacer().run_paced(kwargs.get("messages", []), kwargs.get("max_tokens"), send)
+    record_llm_usage(kwargs.get("model"), response)
+    return response
 
 class RelatedWordsRequest(BaseModel):
     keyword: str
@@ -59,6 +101,12 @@ async def get_related_words(request: RelatedWordsRequest):
     """
     キーワードから関連語を提案する
     """
+    cache = get_response_cache()
+    cache_key = make_cache_key("related-words", {"keyword": normalize_text(request.keyword)})
+    cached = cache.get("related-words", cache_key)
+    if cached is not None:
+        return RelatedWordsResponse(**cached)
+    
     try:
         prompt = f"""
         「{request.keyword}」という言葉から連想される関連キーワードを5つ提案してください。
@@ -72,7 +120,7 @@ async def get_related_words(request: RelatedWordsRequest):
         回答は単語またh短いフレーズのリストで返してください。
         """
         
-        response = await client.chat.completions.create(
+        response = await create_chat_completion(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "あなたは探究学習をサポートするアシスタントです。"},
@@ -88,7 +136,10 @@ async def get_related_words(request: RelatedWordsRequest):
                       for line in content.split("\n") 
                       if line.strip() and not line.startswith("#")][:5]
         
-        return RelatedWordsResponse(suggestions=suggestions)
+        result = RelatedWordsResponse(suggestions=suggestions)
+        if suggestions:
+            cache.set("related-words", cache_key, result.dict())
+        return result
     
     except Exception as e:
         print(f"Error in get_related_words: {e}")
@@ -108,6 +159,15 @@ async def create_clusters(request: ClusterRequest):
     """
     キーワードをクラスタリングする
     """
+    cache = get_response_cache()
+    cache_key = make_cache_key("cluster", {
+        "keywords": normalize_keywords(request.keywords),
+        "max_clusters": request.max_clusters
+    })
+    cached = cache.get("cluster", cache_key)
+    if cached is not None:
+        return ClusterResponse(**cached)
+    
     try:
         prompt = f"""
         以下のキーワードを意味的に近いグループに分類してください。
@@ -123,7 +183,7 @@ async def create_clusters(request: ClusterRequest):
         ]
         """
         
-        response = await client.chat.completions.create(
+        response = await create_chat_completion(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "あなたはキーワードを分類する専門家です。"},
@@ -139,7 +199,9 @@ async def create_clusters(request: ClusterRequest):
         json_match = re.search(r'\[.*\]', content, re.DOTALL)
         if json_match:
             clusters = json.loads(json_match.group())
-            return ClusterResponse(clusters=clusters)
+            result = ClusterResponse(clusters=clusters)
+            cache.set("cluster", cache_key, result.dict())
+            return result
         else:
             # フォールバック
             return ClusterResponse(clusters=[
@@ -158,6 +220,15 @@ async def generate_deep_questions(request: DeepQuestionRequest):
     """
     キーワードを深める問いを生成する
     """
+    cache = get_response_cache()
+    cache_key = make_cache_key("deep-questions", {
+        "keyword": normalize_text(request.keyword),
+        "context": normalize_text(request.context)
+    })
+    cached = cache.get("deep-questions", cache_key)
+    if cached is not None:
+        return DeepQuestionResponse(**cached)
+    
     try:
         prompt = f"""
         「{request.keyword}」について深く探究するための問いを4つ生成してください。
@@ -172,7 +243,7 @@ async def generate_deep_questions(request: DeepQuestionRequest):
         各問いは短く具体的にしてください。
         """
         
-        response = await client.chat.completions.create(
+        response = await create_chat_completion(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "あなたは探究学習の問いを作る専門家です。"},
@@ -194,7 +265,10 @@ async def generate_deep_questions(request: DeepQuestionRequest):
                     "category": categories[i % 4]
                 })
         
-        return DeepQuestionResponse(questions=questions)
+        result = DeepQuestionResponse(questions=questions)
+        if questions:
+            cache.set("deep-questions", cache_key, result.dict())
+        return result
     
     except Exception as e:
         print(f"Error in generate_deep_questions: {e}")
@@ -210,6 +284,15 @@ async def evaluate_question(request: EvaluateQuestionRequest):
     """
     問いを4つの観点で評価する
     """
+    cache = get_response_cache()
+    cache_key = make_cache_key("evaluate", {
+        "question": request.question,
+        "context": request.context or {}
+    })
+    cached = cache.get("evaluate", cache_key)
+    if cached is not None:
+        return EvaluateQuestionResponse(**cached)
+    
     try:
         prompt = f"""
         以下の探究の問いを評価してください：
@@ -231,7 +314,7 @@ async def evaluate_question(request: EvaluateQuestionRequest):
         }}
         """
         
-        response = await client.chat.completions.create(
+        response = await create_chat_completion(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "あなたは探究学習の問いを評価する専門家です。"},
@@ -247,11 +330,13 @@ async def evaluate_question(request: EvaluateQuestionRequest):
         json_match = re.search(r'\{.*\}', content, re.DOTALL)
         if json_match:
             result = json.loads(json_match.group())
-            return EvaluateQuestionResponse(
+            evaluation = EvaluateQuestionResponse(
                 scores=result["scores"],
                 comment=result["comment"],
                 suggestions=result["suggestions"]
             )
+            cache.set("evaluate", cache_key, evaluation.dict())
+            return evaluation
     
     except Exception as e:
         print(f"Error in evaluate_question: {e}")
@@ -296,7 +381,7 @@ async def inquiry_chat(request: InquiryChatRequest):
         - Step 4: 最終的な問いの決定を支援する
         """
         
-        response = await client.chat.completions.create(
+        response = await create_chat_completion(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -0,0 +1,134 @@
+"""
+キーワード判定のマイクロベンチマーク
+メッセージの重要度分類（ImportanceClassifier.classify）について、
+従来方式（パターンごとの re.findall）と KeywordMatcher による1回の走査を比較します。
+
+実行例:
+    python keyword_matcher_benchmark.py --messages 2000 --repeat 5
+    python keyword_matcher_benchmark.py --messages 500 --fragments 60   # 長いメッセージ
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+from typing import Callable, Dict, List, Tuple
+
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from memory_manager import ImportanceClassifier, MessageImportance
+
+# 従来方式の重要度パターン（パターンごとに re.findall）
+LEGACY_IMPORTANCE_PATTERNS = {
+    MessageImportance.CRITICAL: [
+        r"(結論|まとめ|要約|決定|方針|重要)",
+        r"(プロジェクト|テーマ|問い|仮説).*?(決定|確定|設定)",
+        r"(最も重要|核心|本質|要点)",
+    ],
+    MessageImportance.HIGH: [
+        r"(なぜ|どうして|理由|原因)",
+        r"(仮説|推測|考察|分析)",
+        r"(発見|気づき|洞察|インサイト)",
+        r"(課題|問題|困難|障害)",
+    ],
+    MessageImportance.MEDIUM: [
+        r"(説明|解説|定義|意味)",
+        r"(例えば|具体的|事例|ケース)",
+        r"(比較|違い|特徴|性質)",
+        r"(確認|チェック|見直し)",
+    ],
+    MessageImportance.LOW: [
+        r"(簡単|基本|基礎|初歩)",
+        r"(補足|追加|参考)",
+        r"(ありがとう|お願い|了解|わかりました)",
+    ],
+    MessageImportance.TRIVIAL: [
+        r"(こんにちは|よろしく|お疲れ様)",
+        r"(はい|いいえ|そうです|違います)$",
+    ],
+}
+
+_FRAGMENTS = [
+    "研究テーマを決めたいのですが", "なぜこの結果になるのか知りたいです", "仮説を立てて検証してみました",
+    "不安でなかなか始められません", "例えば地域の歴史について調べると", "ありがとうございます",
+    "今週中に資料をまとめる予定です", "どうすればいいかわからない", "面白い発見がありました！",
+    "先行研究と比較すると違いがあります", "テーマは環境問題に決定しました", "はい",
+]
+
+
+class LegacyImportanceClassifier(ImportanceClassifier):
+    """従来の ImportanceClassifier.classify（パターンごとに re.findall）"""
+
+    def classify(self, message: str, sender: str = "user") -> Tuple[MessageImportance, List[str]]:
+        length_score = min(len(message) / 100, 3)
+        detected_keywords = []
+        importance_scores = {level: 0 for level in MessageImportance}
+
+        for importance, patterns in LEGACY_IMPORTANCE_PATTERNS.items():
+            for pattern in patterns:
+                matches = re.findall(pattern, message, re.IGNORECASE)
+                if matches:
+                    importance_scores[importance] += len(matches)
+                    detected_keywords.extend(matches)
+
+        max_importance = MessageImportance.MEDIUM
+        max_score = 0
+        for importance, score in importance_scores.items():
+            if score > max_score:
+                max_score = score
+                max_importance = importance
+
+        if sender == "assistant" and max_importance.value < MessageImportance.HIGH.value:
+            max_importance = MessageImportance(min(max_importance.value + 1, MessageImportance.HIGH.value))
+        if length_score > 2 and max_importance == MessageImportance.TRIVIAL:
+            max_importance = MessageImportance.LOW
+
+        return max_importance, list(set(detected_keywords))
+
+
+def _make_messages(count: int, max_fragments: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        "。".join(rng.choice(_FRAGMENTS) for _ in range(rng.randint(1, max_fragments)))
+        for _ in range(count)
+    ]
+
+
+def _measure(func: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_benchmark(message_count: int, repeat: int, max_fragments: int = 6) -> Dict[str, Dict[str, float]]:
+    messages = _make_messages(message_count, max_fragments)
+    classifier = ImportanceClassifier()
+    legacy_classifier = LegacyImportanceClassifier()
+
+    results = {
+        "importance_classify": {
+            "legacy": _measure(lambda: [legacy_classifier.classify(m) for m in messages], repeat) / len(messages),
+            "matcher": _measure(lambda: [classifier.classify(m) for m in messages], repeat) / len(messages),
+        },
+    }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="キーワード判定のマイクロベンチマーク")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--fragments", type=int, default=6, help="1メッセージあたりの最大文数（メッセージの長さ）")
+    args = parser.parse_args()
+
+    print(f"{'対象':<22}{'従来(us)':>12}{'マッチャー(us)':>16}{'比率':>8}")
+    for name, timings in run_benchmark(args.messages, args.repeat, args.fragments).items():
+        legacy_us = timings["legacy"] * 1e6
+        matcher_us = timings["matcher"] * 1e6
+        print(f"{name:<22}{legacy_us:>12.1f}{matcher_us:>16.1f}{legacy_us / matcher_us:>8.2f}x")
@@ -4,15 +4,15 @@ LLMクライアントプール管理システム
 """
 
 import asyncio
-import threading
 import time
 import logging
+from collections import deque
 from typing import List, Optional, Dict, Any
-from queue import Queue, Empty
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from module.llm_api import learning_plannner
 from module.async_llm_api import AsyncLearningPlanner
+from module.http_clients import get_shared_openai_client, get_shared_async_openai_client
 
 logger = logging.getLogger(__name__)
 
@@ -31,7 +31,11 @@ class ConnectionMetrics:
 class LLMConnectionPool:
     """
     LLMクライアントのコネクションプール
-    複数のクライアントインスタンスを管理し、並列処理を実現
+    
+    asyncioのプリミティブだけで同時実行枠を管理し、取得時のスレッド切り替えを行わない。
+    クライアントはプロセス共通のOpenAIクライアント（1つのkeep-alive HTTPトランスポート）を
+    共有する軽量なラッパー1組のみを保持し、プールサイズ分のクライアント・接続プールは作らない。
+    接続数の上限は module.http_clients の環境変数で設定する。
     """
     
     def __init__(
@@ -46,19 +50,21 @@ class LLMConnectionPool:
         self.connection_timeout = connection_timeout
         self.health_check_interval = health_check_interval
         
-        # コネクションプール
-        self._pool: Queue[learning_plannner] = Queue(maxsize=pool_size)
-        self._async_pool: Queue[AsyncLearningPlanner] = Queue(maxsize=pool_size)
+        # 共有クライアント（initializeで作成）
+        self._sync_client: Optional[learning_plannner] = None
+        self._async_client: Optional[AsyncLearningPlanner] = None
         
         # 制御用
-        self._semaphore = asyncio.Semaphore(pool_size)
-        self._lock = threading.Lock()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._in_use = 0  # 取得中の同時実行枠数（空き枠の算出用）
+        self._waiting = 0
+        self._init_lock: Optional[asyncio.Lock] = None
         self._initialized = False
         self._shutdown = False
         
         # メトリクス
         self.metrics = ConnectionMetrics()
-        self._response_times: List[float] = []
+        self._response_times: deque = deque(maxlen=100)
         
         # ヘルスチェック用タスク
         self._health_check_task: Optional[asyncio.Task] = None
@@ -68,99 +74,89 @@ class LLMConnectionPool:
         if self._initialized:
             return
         
-        logger.info(f"🚀 LLMコネクションプール初期化開始 (サイズ: {self.pool_size})")
+        if self._init_lock is None:
+            self._init_lock = asyncio.Lock()
         
-        try:
-            # 同期クライアントプールの作成
-            for i in range(self.pool_size):
-                try:
-                    client = learning_plannner()
-                    self._pool.put(client)
-                    logger.debug(f"✅ 同期クライアント {i+1}/{self.pool_size} 作成完了")
-                except Exception as e:
-                    logger.error(f"❌ 同期クライアント {i+1} 作成エラー: {e}")
-                    # 作成できない場合は続行（最低1個あれば良い）
-                    if self._pool.qsize() == 0 and i == self.pool_size - 1:
-                        raise Exception("同期クライアントを1つも作成できませんでした")
-            
-            # 非同期クライアントプールの作成
-            for i in range(self.pool_size):
-                try:
-                    async_client = AsyncLearningPlanner(pool_size=1)  # 個別プール
-                    self._async_pool.put(async_client)
-                    logger.debug(f"✅ 非同期クライアント {i+1}/{self.pool_size} 作成完了")
-                except Exception as e:
-                    logger.error(f"❌ 非同期クライアント {i+1} 作成エラー: {e}")
-            
-            self._initialized = True
-            
-            # ヘルスチェックタスクを開始
-            self._health_check_task = asyncio.create_task(self._health_check_loop())
+        async with self._init_lock:
+            if self._initialized:
+                return
             
-            logger.info(f"✅ LLMコネクションプール初期化完了 (同期: {self._pool.qsize()}, 非同期: {self._async_pool.qsize()})")
+            logger.info(f"🚀 LLMコネクションプール初期化開始 (サイズ: {self.pool_size})")
             
-        except Exception as e:
-            logger.error(f"❌ LLMコネクションプール初期化失敗: {e}")
-            raise
+            try:
+                sync_openai = get_shared_openai_client()
+                async_openai = get_shared_async_openai_client()
+                self._sync_client = learning_plannner(client=sync_openai)
+                self._async_client = AsyncLearningPlanner(
+                    pool_size=self.pool_size,
+                    sync_client=sync_openai,
+                    async_client=async_openai
+                )
+                self._slots = asyncio.Semaphore(self.pool_size)
+                self._initialized = True
+                
+                # ヘルスチェックタスクを開始
+                self._health_check_task = asyncio.create_task(self._health_check_loop())
+                
+                logger.info(f"✅ LLMコネクションプール初期化完了 (同時実行枠: {self.pool_size}, 共有HTTPトランスポート)")
+                
+            except Exception as e:
+                logger.error(f"❌ LLMコネクションプール初期化失敗: {e}")
+                raise
     
     @asynccontextmanager
-    async def get_sync_client(self):
-        """
-        同期クライアントを取得（コンテキストマネージャー）
-        
-        Usage:
-            async with pool.get_sync_client() as client:
-                response = await asyncio.to_thread(
-                    client.generate_response,
-                    messages
-                )
-        """
+    async def _acquire_slot(self):
+        """同時実行枠を取得（待機数の上限とタイムアウト付き）"""
         if not self._initialized:
             await self.initialize()
         
-        client = None
+        if self._waiting >= self.max_queue_size:
+            self.metrics.error_count += 1
+            self.metrics.last_error_time = time.time()
+            raise Exception("クライアント取得待ちが上限に達しました")
+        
         start_time = time.time()
+        self._waiting += 1
+        self.metrics.queue_size = self._waiting
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.connection_timeout)
+        except asyncio.TimeoutError:
+            self.metrics.error_count += 1
+            self.metrics.last_error_time = time.time()
+            raise Exception("クライアント取得タイムアウト")
+        finally:
+            self._waiting -= 1
+            self.metrics.queue_size = self._waiting
         
+        self._in_use += 1
+        self.metrics.active_connections += 1
         try:
-            # セマフォで同時接続数を制御
-            async with self._semaphore:
-                self.metrics.active_connections += 1
-                
-                # プールからクライアントを取得
-                try:
-                    client = await asyncio.wait_for(
-                        asyncio.to_thread(self._pool.get, block=True),
-                        timeout=self.connection_timeout
-                    )
-                except asyncio.TimeoutError:
-                    self.metrics.error_count += 1
-                    self.metrics.last_error_time = time.time()
-                    raise Exception("クライアント取得タイムアウト")
-                
-                yield client
-                
+            yield
         finally:
-            # クライアントをプールに戻す
-            if client is not None:
-                try:
-                    self._pool.put(client, block=False)
-                except:
-                    # プールが満杯の場合は無視（稀なケース）
-                    pass
-            
-            # メトリクス更新
+            self._in_use -= 1
+            self._slots.release()
             self.metrics.active_connections -= 1
             self.metrics.total_requests += 1
             
-            response_time = time.time() - start_time
-            self._response_times.append(response_time)
-            
             # 応答時間の移動平均を計算（直近100リクエスト）
-            if len(self._response_times) > 100:
-                self._response_times = self._response_times[-100:]
-            
+            self._response_times.append(time.time() - start_time)
             self.metrics.avg_response_time = sum(self._response_times) / len(self._response_times)
     
+    @asynccontextmanager
+    async def get_sync_client(self):
+        """
+        同期クライアントを取得（コンテキストマネージャー）
+        
+        Usage:
+            async with pool.get_sync_client() as client:
+                response = await asyncio.to_thread(
+                    client.generate_response,
+                    messages
+                )
+        """
+        async with self._acquire_slot():
+            yield self._sync_client
+    
     @asynccontextmanager
     async def get_async_client(self):
         """
@@ -170,45 +166,11 @@ class LLMConnectionPool:
             async with pool.get_async_client() as client:
                 response = await client.generate_response_async(messages)
         """
-        if not self._initialized:
-            await self.initialize()
-        
-        client = None
-        start_time = time.time()
-        
-        try:
-            async with self._semaphore:
-                self.metrics.active_connections += 1
-                
-                try:
-                    client = await asyncio.wait_for(
-                        asyncio.to_thread(self._async_pool.get, block=True),
-                        timeout=self.connection_timeout
-                    )
-                except asyncio.TimeoutError:
-                    self.metrics.error_count += 1
-                    self.metrics.last_error_time = time.time()
-                    raise Exception("非同期クライアント取得タイムアウト")
-                
-                yield client
-                
-        finally:
-            if client is not None:
-                try:
-                    self._async_pool.put(client, block=False)
-                except:
-                    pass
-            
-            self.metrics.active_connections -= 1
-            self.metrics.total_requests += 1
-            
-            response_time = time.time() - start_time
-            self._response_times.append(response_time)
-            
-            if len(self._response_times) > 100:
-                self._response_times = self._response_times[-100:]
-            
-            self.metrics.avg_response_time = sum(self._response_times) / len(self._response_times)
+        async with self._acquire_slot():
+            yield self._async_client
+    
+    def _available_slots(self) -> int:
+        return self.pool_size - self._in_use if self._slots is not None else 0
     
     async def _health_check_loop(self):
         """定期ヘルスチェック"""
@@ -223,19 +185,15 @@ class LLMConnectionPool:
     
     async def _health_check(self):
         """プールの健全性をチェック"""
-        sync_pool_size = self._pool.qsize()
-        async_pool_size = self._async_pool.qsize()
+        available = self._available_slots()
         
-        logger.info(f"🏥 ヘルスチェック - 同期プール: {sync_pool_size}/{self.pool_size}, "
-                   f"非同期プール: {async_pool_size}/{self.pool_size}, "
+        logger.info(f"🏥 ヘルスチェック - 空き枠: {available}/{self.pool_size}, "
+                   f"待機: {self._waiting}, "
                    f"アクティブ接続: {self.metrics.active_connections}")
         
-        # プールサイズが半分以下になったら警告
-        if sync_pool_size < self.pool_size // 2:
-            logger.warning(f"⚠️ 同期クライアントプールサイズ低下: {sync_pool_size}/{self.pool_size}")
-        
-        if async_pool_size < self.pool_size // 2:
-            logger.warning(f"⚠️ 非同期クライアントプールサイズ低下: {async_pool_size}/{self.pool_size}")
+        # 待機が発生し続けている場合の警告
+        if self._waiting > self.pool_size:
+            logger.warning(f"⚠️ クライアント取得待ちが多いです: {self._waiting}")
         
         # エラー率が高い場合の警告
         if self.metrics.total_requests > 0:
@@ -245,10 +203,12 @@ class LLMConnectionPool:
     
     async def get_metrics(self) -> Dict[str, Any]:
         """メトリクス情報を取得"""
+        available = self._available_slots()
         return {
             "pool_size": self.pool_size,
-            "sync_available": self._pool.qsize(),
-            "async_available": self._async_pool.qsize(),
+            "sync_available": available,
+            "async_available": available,
+            "waiting": self._waiting,
             "active_connections": self.metrics.active_connections,
             "total_requests": self.metrics.total_requests,
             "error_count": self.metrics.error_count,
@@ -259,7 +219,7 @@ class LLMConnectionPool:
         }
     
     async def shutdown(self):
-        """プールをシャットダウン"""
+        """プールをシャットダウン（共有HTTPトランスポートは他の利用者がいるため閉じない）"""
         logger.info("🛑 LLMコネクションプールシャットダウン開始")
         
         self._shutdown = True
@@ -272,20 +232,9 @@ class LLMConnectionPool:
             except asyncio.CancelledError:
                 pass
         
-        # プール内のクライアントをクリーンアップ
-        while not self._pool.empty():
-            try:
-                client = self._pool.get_nowait()
-                # 必要に応じてクライアントのクリーンアップ処理
-            except Empty:
-                break
-        
-        while not self._async_pool.empty():
-            try:
-                client = self._async_pool.get_nowait()
-                # 必要に応じてクライアントのクリーンアップ処理
-            except Empty:
-                break
+        self._sync_client = None
+        self._async_client = None
+        self._initialized = False
         
         logger.info("✅ LLMコネクションプールシャットダウン完了")
 
@@ -337,7 +286,11 @@ async def shutdown_llm_pool():
 # ===================================
 
 async def benchmark_pool_vs_single():
-    """プール使用と単一インスタンスのベンチマーク"""
+    """
+    プール使用と単一インスタンスのベンチマーク
+    
+    OPENAI_BASE_URL をスタブサーバー（mock_openai_server.py）に向けると料金をかけずに計測できる
+    """
     import time
     
     # 単一インスタンス（従来方式）
@@ -3,14 +3,20 @@ LLMクライアント負荷分散システム
 複数の戦略でリクエストを分散し、パフォーマンスを最適化
 """
 
+import os
 import asyncio
 import random
 import time
 import logging
-from typing import List, Dict, Any, Optional, Callable
+from collections import deque
+from contextlib import aclosing
+from typing import List, Dict, Any, Optional, Callable, AsyncIterator, Deque
 from enum import Enum
 from dataclasses import dataclass, field
 from llm_pool_manager import LLMConnectionPool, get_llm_pool
+from module.llm_coalescer import get_llm_coalescer, make_request_key
+from module.model_router import get_model_router
+from module.token_budget import TokenBudget, get_token_budget_policy
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +44,105 @@ class PoolNode:
     health_score: float = 1.0  # 0.0-1.0の健全性スコア
 
 
+@dataclass
+class HedgingMetrics:
+    """ヘッジリクエストのメトリクス"""
+    total_requests: int = 0
+    hedges_sent: int = 0
+    hedge_wins: int = 0          # ヘッジ側が先に完了（最初のトークンを返した）回数
+    budget_denied: int = 0       # 閾値を超えたが予算不足でヘッジしなかった回数
+    cancelled_attempts: int = 0  # 負けた側をキャンセルした回数
+
+
+class HedgingPolicy:
+    """
+    ヘッジ（遅い呼び出しへの追加リクエスト）の判定
+    
+    - 閾値: モデル（と計測対象）ごとに直近の所要時間のパーセンタイル（デフォルトp90）
+    - 予算: ヘッジ数をリクエスト数の一定割合＋バースト分に制限し、上流への追加負荷を抑える
+    """
+    
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        percentile: Optional[float] = None,
+        budget_ratio: Optional[float] = None,
+        min_delay: Optional[float] = None,
+        max_delay: Optional[float] = None,
+        default_delay: Optional[float] = None,
+        window_size: int = 200,
+        min_samples: int = 20,
+        budget_burst: int = 2
+    ):
+        if enabled is None:
+            enabled = os.environ.get("ENABLE_LLM_HEDGING", "false").lower() == "true"
+        self.enabled = enabled
+        self.percentile = percentile or float(os.environ.get("LLM_HEDGE_PERCENTILE", "0.9"))
+        self.budget_ratio = budget_ratio if budget_ratio is not None else float(os.environ.get("LLM_HEDGE_BUDGET_RATIO", "0.1"))
+        self.min_delay = min_delay if min_delay is not None else float(os.environ.get("LLM_HEDGE_MIN_DELAY", "1.0"))
+        self.max_delay = max_delay if max_delay is not None else float(os.environ.get("LLM_HEDGE_MAX_DELAY", "20.0"))
+        self.default_delay = default_delay if default_delay is not None else float(os.environ.get("LLM_HEDGE_DEFAULT_DELAY", "8.0"))
+        self.window_size = window_size
+        self.min_samples = min_samples
+        self.budget_burst = budget_burst
+        
+        self._latencies: Dict[str, Deque[float]] = {}
+        self.metrics = HedgingMetrics()
+    
+    def delay_for(self, key: str) -> Optional[float]:
+        """ヘッジを送るまでの待ち時間（ヘッジ無効時はNone）"""
+        if not self.enabled:
+            return None
+        samples = self._latencies.get(key)
+        if not samples or len(samples) < self.min_samples:
+            delay = self.default_delay
+        else:
+            ordered = sorted(samples)
+            delay = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+        return min(max(delay, self.min_delay), self.max_delay)
+    
+    def record_latency(self, key: str, seconds: float) -> None:
+        samples = self._latencies.get(key)
+        if samples is None:
+            samples = self._latencies[key] = deque(maxlen=self.window_size)
+        samples.append(seconds)
+    
+    def try_spend(self) -> bool:
+        """予算内ならヘッジ1回分を消費してTrue"""
+        allowed = self.budget_ratio * self.metrics.total_requests + self.budget_burst
+        if self.metrics.hedges_sent + 1 > allowed:
+            self.metrics.budget_denied += 1
+            return False
+        self.metrics.hedges_sent += 1
+        return True
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        m = self.metrics
+        return {
+            "enabled": self.enabled,
+            "total_requests": m.total_requests,
+            "hedges_sent": m.hedges_sent,
+            "hedge_rate": m.hedges_sent / m.total_requests if m.total_requests else 0,
+            "hedge_wins": m.hedge_wins,
+            "win_rate": m.hedge_wins / m.hedges_sent if m.hedges_sent else 0,
+            "budget_denied": m.budget_denied,
+            "cancelled_attempts": m.cancelled_attempts,
+            "thresholds": {key: self.delay_for(key) for key in self._latencies},
+        }
+
+
+async def _cancel_all(tasks) -> int:
+    """未完了タスクをキャンセルし、終了を待つ（キャンセル数を返す）"""
+    cancelled = 0
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+            cancelled += 1
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return cancelled
+
+
 class LLMLoadBalancer:
     """
     LLMクライアントの負荷分散器
@@ -73,6 +178,9 @@ class LLMLoadBalancer:
         self.pool_configs = pool_configs
         self._initialized = False
         self._health_check_task: Optional[asyncio.Task] = None
+        
+        # テールレイテンシ対策のヘッジリクエスト
+        self.hedging = HedgingPolicy()
     
     async def initialize(self):
         """負荷分散器を初期化"""
@@ -141,8 +249,188 @@ class LLMLoadBalancer:
         else:
             return node.pool.get_sync_client()
     
-    async def _select_node(self) -> Optional[PoolNode]:
-        """戦略に基づいてノードを選択"""
+    # ===================================
+    # ヘッジ付き生成
+    # ===================================
+    
+    async def generate_response_hedged(self, messages: List[Dict[str, Any]]) -> str:
+        """
+        ヘッジ付きで応答を生成
+        
+        最初の呼び出しが閾値（直近のp90）以内に完了しなければ別ノードに2つ目を送り、
+        先に完了した方を採用して残りはキャンセルする。同一内容の同時リクエストは合流させる。
+        """
+        if not self._initialized:
+            await self.initialize()
+        
+        # モデルの振り分けはヘッジの外側で行い、ヘッジの待ち時間はモデルごとの統計を使う
+        router = get_model_router()
+        default_model = self._model_name()
+        decision = router.route(messages, default_model)
+        budget = get_token_budget_policy().budget()
+        key = make_request_key(decision.model, messages, temperature=0.7, max_tokens=budget.max_tokens)
+        return await get_llm_coalescer().run(
+            key,
+            lambda: router.run(decision, default_model, lambda model: self._run_hedged(messages, model, budget))
+        )
+    
+    async def _run_hedged(self, messages: List[Dict[str, Any]], model: str, budget: Optional[TokenBudget] = None) -> str:
+        self.hedging.metrics.total_requests += 1
+        delay = self.hedging.delay_for(model)
+        start = time.monotonic()
+        
+        primary_node = await self._select_node()
+        primary = asyncio.ensure_future(self._attempt(primary_node, messages, model, budget))
+        tasks = [primary]
+        hedge: Optional[asyncio.Task] = None
+        
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.hedging.try_spend():
+                    logger.info(f"🪁 ヘッジリクエスト送信 ({delay:.1f}秒経過)")
+                    hedge_node = await self._select_node(exclude=primary_node)
+                    hedge = asyncio.ensure_future(self._attempt(hedge_node, messages, model, budget))
+                    tasks.append(hedge)
+            
+            pending = set(tasks)
+            last_error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedging.metrics.hedge_wins += 1
+                        self.hedging.record_latency(model, time.monotonic() - start)
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            self.hedging.metrics.cancelled_attempts += await _cancel_all(tasks)
+    
+    async def _attempt(
+        self,
+        node: Optional[PoolNode],
+        messages: List[Dict[str, Any]],
+        model: Optional[str] = None,
+        budget: Optional[TokenBudget] = None
+    ) -> str:
+        """1ノードでの生成（合流層は通さない）"""
+        if node is None:
+            raise Exception("利用可能なプールノードがありません")
+        
+        node.current_requests += 1
+        node.total_requests += 1
+        node.last_used = time.time()
+        try:
+            async with node.pool.get_async_client() as client:
+                return await client._generate_response_uncoalesced(messages, model, budget)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            node.error_count += 1
+            raise
+        finally:
+            node.current_requests -= 1
+    
+    async def generate_response_streaming_hedged(self, messages: List[Dict[str, Any]]) -> AsyncIterator[str]:
+        """
+        ヘッジ付きストリーミング生成
+        
+        最初のトークンが閾値（最初のトークンまでの時間のp90）以内に届かなければ2つ目を開始し、
+        先に最初のトークンを返したストリームを採用する（負けた側は閉じる）。
+        """
+        if not self._initialized:
+            await self.initialize()
+        
+        key = f"{self._model_name()}:first_token"
+        self.hedging.metrics.total_requests += 1
+        delay = self.hedging.delay_for(key)
+        start = time.monotonic()
+        
+        primary_node = await self._select_node()
+        streams = {}
+        
+        def open_stream(node):
+            stream = self._stream_attempt(node, messages)
+            task = asyncio.ensure_future(stream.__anext__())
+            streams[task] = stream
+            return task
+        
+        primary = open_stream(primary_node)
+        hedge: Optional[asyncio.Task] = None
+        winner_stream = None
+        first_token: Optional[str] = None
+        
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait([primary], timeout=delay)
+                if not done and self.hedging.try_spend():
+                    logger.info(f"🪁 ストリーミングのヘッジリクエスト送信 ({delay:.1f}秒経過)")
+                    hedge = open_stream(await self._select_node(exclude=primary_node))
+            
+            pending = set(streams)
+            last_error: Optional[BaseException] = None
+            while pending and winner_stream is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    error = task.exception()
+                    if error is None or isinstance(error, StopAsyncIteration):
+                        winner_stream = streams[task]
+                        first_token = task.result() if error is None else None
+                        if task is hedge:
+                            self.hedging.metrics.hedge_wins += 1
+                        self.hedging.record_latency(key, time.monotonic() - start)
+                        break
+                    last_error = error
+            
+            if winner_stream is None:
+                raise last_error
+        finally:
+            # 負けた側（または全て）を閉じる
+            losers = [task for task, stream in streams.items() if stream is not winner_stream]
+            self.hedging.metrics.cancelled_attempts += await _cancel_all(losers)
+            for task in losers:
+                await streams[task].aclose()
+        
+        async with aclosing(winner_stream):
+            if first_token is None:
+                return
+            yield first_token
+            async for token in winner_stream:
+                yield token
+    
+    async def _stream_attempt(self, node: Optional[PoolNode], messages: List[Dict[str, Any]]) -> AsyncIterator[str]:
+        """1ノードでのストリーミング生成"""
+        if node is None:
+            raise Exception("利用可能なプールノードがありません")
+        
+        node.current_requests += 1
+        node.total_requests += 1
+        node.last_used = time.time()
+        try:
+            async with node.pool.get_async_client() as client:
+                async with aclosing(client.generate_response_streaming(messages)) as stream:
+                    async for token in stream:
+                        yield token
+        except (asyncio.CancelledError, GeneratorExit):
+            raise
+        except Exception:
+            node.error_count += 1
+            raise
+        finally:
+            node.current_requests -= 1
+    
+    def _model_name(self) -> str:
+        """レイテンシ統計のキーに使うモデル名"""
+        for node in self.nodes:
+            client = getattr(node.pool, "_async_client", None)
+            if client is not None:
+                return client.model
+        return "default"
+    
+    async def _select_node(self, exclude: Optional[PoolNode] = None) -> Optional[PoolNode]:
+        """戦略に基づいてノードを選択（excludeを指定すると可能な限りそのノードを避ける）"""
         if not self.nodes:
             return None
         
@@ -152,6 +440,9 @@ class LLMLoadBalancer:
             logger.warning("⚠️ 健全なノードがありません。全ノードを対象にします。")
             healthy_nodes = self.nodes
         
+        if exclude is not None and len(healthy_nodes) > 1:
+            healthy_nodes = [node for node in healthy_nodes if node is not exclude]
+        
         # アダプティブ戦略の場合は動的に戦略を変更
         if self.strategy == LoadBalanceStrategy.ADAPTIVE:
             await self._update_adaptive_strategy()
@@ -346,6 +637,7 @@ class LLMLoadBalancer:
             "total_nodes": len(self.nodes),
             "healthy_nodes": len([n for n in self.nodes if n.health_score > 0.3]),
             "strategy_performance": self.strategy_performance,
+            "hedging": self.hedging.get_metrics(),
             "initialized": self._initialized
         }
     
@@ -398,12 +690,23 @@ async def get_load_balancer(
     return _global_load_balancer
 
 
+def get_hedging_metrics() -> Optional[Dict[str, Any]]:
+    """グローバル負荷分散器のヘッジメトリクス（未初期化時はNone）"""
+    if _global_load_balancer is None:
+        return None
+    return _global_load_balancer.hedging.get_metrics()
+
+
 # ===================================
 # 使用例
 # ===================================
 
 async def example_usage():
-    """負荷分散器の使用例"""
+    """
+    負荷分散器の使用例
+    
+    OPENAI_BASE_URL をスタブサーバー（mock_openai_server.py）に向けると料金をかけずに実行できる
+    """
     
     # 負荷分散器を取得
     load_balancer = await get_load_balancer(
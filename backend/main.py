@@ -2,6 +2,7 @@ from fastapi import FastAPI, HTTPException, Depends, status, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.exception_handlers import http_exception_handler
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import sys
@@ -37,7 +38,21 @@ from async_helpers import (
     parallel_save_chat_logs
 )
 from module.async_llm_api import get_async_llm_client
-from optimized_endpoints import optimized_chat_with_ai
+from module.llm_coalescer import get_llm_coalescer
+from module.rate_pacer import get_rate_pacer
+from module.fair_scheduler import get_fair_scheduler
+from module.llm_context import llm_context, classify_endpoint
+from module.http_clients import close_shared_clients
+from module.circuit_breaker import CircuitOpenError, get_all_circuit_metrics
+from module.llm_usage import collect_usage, get_usage_recorder
+from module.model_router import get_model_router
+from module.token_budget import get_token_budget_policy
+from context_strategy import get_context_strategy_selector
+from history_normalizer import get_history_normalizer
+from vector_index import get_vector_index
+from load_balancer import get_hedging_metrics
+from response_cache import get_response_cache, make_cache_key, normalize_text, normalize_keywords
+from optimized_endpoints import optimized_chat_with_ai, optimized_chat_stream_with_ai, circuit_open_http_exception, route_hints
 from conversation_agent.optimized_conversation_agent import optimized_chat_with_conversation_agent
 
 # 探究学習APIルーターのインポート
@@ -113,6 +128,42 @@ ENABLE_CONVERSATION_AGENT = os.environ.get("ENABLE_CONVERSATION_AGENT", "false")
 auth_cache = {}
 AUTH_CACHE_TTL = 300  # 5分
 
+
+class LLMContextMiddleware:
+    """
+    リクエストごとにLLM呼び出しコンテキスト（スケジューリング用ユーザーキー・エンドポイント分類）を設定
+    
+    認証済み（auth_cacheに有効なエントリがある）トークンはユーザー単位、
+    それ以外はクライアントIP単位で公平スケジューラのキューに並ぶ
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        headers = dict(scope.get("headers") or [])
+        user_id = None
+        authorization = headers.get(b"authorization", b"").decode("latin-1")
+        if authorization.lower().startswith("bearer "):
+            cached = auth_cache.get(authorization[7:].strip())
+            if cached and time.time() - cached["timestamp"] < AUTH_CACHE_TTL:
+                user_id = cached["user_id"]
+        
+        if user_id is not None:
+            user_key = f"user:{user_id}"
+        else:
+            client_ip = headers.get(b"x-real-ip", b"").decode("latin-1")
+            if not client_ip and scope.get("client"):
+                client_ip = scope["client"][0]
+            user_key = f"ip:{client_ip or 'unknown'}"
+        
+        with llm_context(user_key=user_key, user_id=user_id, endpoint=classify_endpoint(scope.get("path", ""))):
+            await self.app(scope, receive, send)
+
 app = FastAPI(
     title="探Qメイト API (最適化版)",
     description="AI探究学習支援アプリケーションのバックエンドAPI（パフォーマンス最適化）",
@@ -126,6 +177,7 @@ app.include_router(inquiry_router)
 
 # パフォーマンス最適化ミドルウェア
 app.add_middleware(GZipMiddleware, minimum_size=1000)  # レスポンス圧縮
+app.add_middleware(LLMContextMiddleware)  # LLM公平スケジューリング用のユーザー識別
 
 # CORS設定
 # 開発環境でNginxリバースプロキシを使用する場合は不要
@@ -145,6 +197,11 @@ if os.environ.get("ENABLE_CORS", "false").lower() == "true":
         allow_headers=["*"],
     )
 
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+    """OpenAI障害でサーキットが open の間は503で即座に応答する"""
+    return await http_exception_handler(request, circuit_open_http_exception(exc))
+
 # セキュリティスキーム
 security = HTTPBearer()
 
@@ -209,6 +266,7 @@ class UserResponse(BaseModel):
 class ChatMessage(BaseModel):
     message: str
     context: Optional[str] = None
+    orchestrator_mode: Optional[str] = None  # 対話エージェントの処理モード（multi / fused、未指定時はサーバー設定）
     # ページ依存フィールドを削除（独立設計のため）
     # page: Optional[str] = "general"  # 削除
     # page_id: Optional[str] = None     # 削除  
@@ -226,6 +284,7 @@ class ChatResponse(BaseModel):
     project_plan: Optional[Dict[str, Any]] = None
     decision_metadata: Optional[Dict[str, Any]] = None
     metrics: Optional[Dict[str, Any]] = None
+    followups: Optional[List[str]] = None
 
 # Conversation Agent専用モデル（検証用）
 class ConversationAgentRequest(BaseModel):
@@ -236,6 +295,7 @@ class ConversationAgentRequest(BaseModel):
     history_limit: int = 50
     debug_mode: bool = False  # デバッグ情報を含めるか
     mock_mode: bool = True  # モックモードで動作するか
+    orchestrator_mode: Optional[str] = None  # 処理モード（multi / fused、未指定時はサーバー設定）
 
 class ConversationAgentResponse(BaseModel):
     """対話エージェント検証用レスポンスモデル"""
@@ -444,12 +504,22 @@ async def startup_event():
             logger.error(f"❌ 非同期LLMクライアント初期化エラー: {e}")
             async_llm_client = None
         
+        # チャットのコンテキスト構築（累積要約の保存先と生成用クライアント、関連発話の検索用の埋め込みクライアント）
+        embedding_client = None
+        if os.environ.get("ENABLE_EMBEDDINGS", "false").lower() == "true":
+            from embedding_utils import EmbeddingClient
+            embedding_client = EmbeddingClient(provider=os.environ.get("EMBEDDING_PROVIDER", "openai"))
+        get_context_strategy_selector().configure(
+            supabase_client=supabase, llm_client=async_llm_client, embedding_client=embedding_client
+        )
+        
         # Phase 1: 対話エージェント初期化
         if ENABLE_CONVERSATION_AGENT and CONVERSATION_AGENT_AVAILABLE:
             try:
                 conversation_orchestrator = ConversationOrchestrator(
                     llm_client=llm_client,
-                    use_mock=True  # Phase 1ではモックモード
+                    use_mock=True,  # Phase 1ではモックモード
+                    async_llm_client=async_llm_client
                 )
                 logger.info("✅ 対話エージェント初期化完了（モックモード）")
             except Exception as e:
@@ -478,6 +548,13 @@ async def shutdown_event():
     """アプリケーション終了時のクリーンアップ"""
     global auth_cache
     auth_cache.clear()
+    
+    # 共有HTTPトランスポートの接続を閉じる
+    try:
+        await close_shared_clients()
+    except Exception as e:
+        logger.warning(f"共有LLMクライアントのクローズエラー（無視）: {e}")
+    
     logger.info("アプリケーション終了")
 
 def get_current_user_cached(credentials: HTTPAuthorizationCredentials = Depends(security)) -> int:
@@ -718,6 +795,30 @@ async def register(user_data: UserRegister):
     except Exception as e:
         handle_database_error(e, "ユーザーの登録")
 
+@app.post("/chat/stream", dependencies=[Depends(chat_rate_limiter)])
+async def chat_with_ai_stream(
+    chat_data: ChatMessage,
+    request: Request,
+    current_user: int = Depends(get_current_user_cached)
+):
+    """AIとのチャット（SSEストリーミング版）"""
+    if async_llm_client is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="ストリーミング用LLMクライアントが初期化されていません"
+        )
+    
+    return await optimized_chat_stream_with_ai(
+        chat_data=chat_data,
+        current_user=current_user,
+        request=request,
+        supabase=supabase,
+        llm_client=llm_client,
+        conversation_orchestrator=conversation_orchestrator,
+        ENABLE_CONVERSATION_AGENT=ENABLE_CONVERSATION_AGENT,
+        MAX_CHAT_MESSAGE_LENGTH=MAX_CHAT_MESSAGE_LENGTH
+    )
+
 @app.post("/chat", response_model=ChatResponse, dependencies=[Depends(chat_rate_limiter)])
 async def chat_with_ai(
     chat_data: ChatMessage,
@@ -750,7 +851,8 @@ async def chat_with_ai(
             state_snapshot=result.state_snapshot,
             project_plan=result.project_plan,
             decision_metadata=result.decision_metadata,
-            metrics=result.metrics
+            metrics=result.metrics,
+            followups=result.followups
         )
     else:
         # 既存の処理にフォールバック
@@ -777,6 +879,7 @@ async def chat_with_ai(
             history_limit = 30  # 履歴取得を最小限に抑える
             history_response = supabase.table("chat_logs").select("id, sender, message, created_at").eq("conversation_id", conversation_id).order("created_at", desc=False).limit(history_limit).execute()
             conversation_history = history_response.data if history_response.data is not None else []
+            conversation_history = get_history_normalizer().normalize(conversation_history)
 
             if conversation_history is None:
                 # エラーログを残す
@@ -821,13 +924,14 @@ async def chat_with_ai(
             agent_payload = {}
             
             # 従来の処理
-            response = llm_client.generate_response(messages)
+            with collect_usage() as usage, llm_context(step="reply", **route_hints(user_message)):
+                response = llm_client.generate_response(messages)
             ai_context_data = {
                 "timestamp": datetime.now(timezone.utc).isoformat()
             }
             
-            # トークン使用量を計算（使用しない）
-            token_usage = None
+            # 実際のusageから集計したトークン使用量
+            token_usage = usage.to_dict()
             
             ai_message_data = {
                 "user_id": current_user,
@@ -1538,6 +1642,20 @@ async def generate_theme_suggestions(
     try:
         validate_supabase()
         
+        # 提案内容はプロンプトに影響する入力（テーマ・深さの区分・興味関心）だけで決まるためキャッシュする
+        response_cache = get_response_cache()
+        cache_key = make_cache_key("theme-deep-dive", {
+            "theme": normalize_text(request.theme),
+            "deep": request.depth >= 2,
+            "user_interests": normalize_keywords(request.user_interests)
+        })
+        cached = response_cache.get("theme-deep-dive", cache_key)
+        if cached is not None:
+            return ThemeDeepDiveResponse(
+                suggestions=cached["suggestions"],
+                context_info={"depth": request.depth, "suggestions_count": len(cached["suggestions"])}
+            )
+        
         if llm_client is None:
             raise HTTPException(
                 status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
@@ -1582,6 +1700,10 @@ async def generate_theme_suggestions(
                 if suggestion and len(suggestion) <= 50:
                     suggestions.append(suggestion)
         
+        # LLMから得た提案のみをキャッシュ（既定の提案で補完したものは登録しない）
+        if len(suggestions) >= 5:
+            response_cache.set("theme-deep-dive", cache_key, {"suggestions": suggestions[:7]})
+        
         # 最低5個、最大7個に調整
         if len(suggestions) < 5:
             default_suggestions = [
@@ -2082,7 +2204,8 @@ async def chat_with_conversation_agent(
             llm_client=llm_client,
             conversation_orchestrator=conversation_orchestrator,
             CONVERSATION_AGENT_AVAILABLE=CONVERSATION_AGENT_AVAILABLE,
-            ENABLE_CONVERSATION_AGENT=ENABLE_CONVERSATION_AGENT
+            ENABLE_CONVERSATION_AGENT=ENABLE_CONVERSATION_AGENT,
+            async_llm_client=async_llm_client
         )
         
         # 既存のConversationAgentResponseモデルに変換
@@ -2127,7 +2250,8 @@ async def chat_with_conversation_agent(
                 try:
                     temp_orchestrator = ConversationOrchestrator(
                         llm_client=llm_client,
-                        use_mock=request.mock_mode
+                        use_mock=request.mock_mode,
+                        async_llm_client=async_llm_client
                     )
                     logger.info(f"✅ 対話エージェント一時初期化完了（mock={request.mock_mode}）")
                 except Exception as e:
@@ -2194,7 +2318,7 @@ async def chat_with_conversation_agent(
 
                     if history_response.data:
                         conversation_history = [
-                            {"sender": msg["sender"], "message": msg["message"]}
+                            {"id": msg.get("id"), "sender": msg["sender"], "message": msg["message"]}
                             for msg in history_response.data
                         ]
                         logger.info(f"📜 対話履歴取得: {len(conversation_history)}件")
@@ -2205,12 +2329,13 @@ async def chat_with_conversation_agent(
             try:
                 agent_start = time.time()
 
-                agent_result = temp_orchestrator.process_turn(
+                agent_result = await temp_orchestrator.process_turn_async(
                     user_message=request.message,
                     conversation_history=conversation_history,
                     project_context=project_context,
                     user_id=current_user,
-                    conversation_id=conversation_id
+                    conversation_id=conversation_id,
+                    mode=request.orchestrator_mode
                 )
 
                 agent_time = time.time() - agent_start
@@ -2361,6 +2486,10 @@ async def get_conversation_agent_status(
                     "has_llm_client": conversation_orchestrator.llm_client is not None if hasattr(conversation_orchestrator, 'llm_client') else False,
                     "mock_mode": conversation_orchestrator.use_mock if hasattr(conversation_orchestrator, 'use_mock') else None
                 }
+                if getattr(conversation_orchestrator, 'state_store', None) is not None:
+                    status["orchestrator_info"]["state_store"] = conversation_orchestrator.state_store.get_stats()
+                if getattr(conversation_orchestrator, 'session_store', None) is not None:
+                    status["orchestrator_info"]["session_store"] = conversation_orchestrator.session_store.get_stats()
             except Exception as e:
                 status["orchestrator_info"] = {"error": str(e)}
         
@@ -2404,7 +2533,8 @@ async def initialize_conversation_agent(
         # 新しいオーケストレーターを初期化
         conversation_orchestrator = ConversationOrchestrator(
             llm_client=llm_client,
-            use_mock=mock_mode
+            use_mock=mock_mode,
+            async_llm_client=async_llm_client
         )
         
         logger.info(f"✅ 対話エージェント手動初期化完了（mock={mock_mode}）")
@@ -2527,7 +2657,7 @@ async def get_llm_system_metrics(
             metrics = phase1_llm_manager.get_metrics()
             health = phase1_llm_manager.health_check()
             
-            return {
+            result = {
                 "phase1_system": {
                     "metrics": metrics,
                     "health": health,
@@ -2539,7 +2669,7 @@ async def get_llm_system_metrics(
                 }
             }
         else:
-            return {
+            result = {
                 "phase1_system": {
                     "status": "not_initialized" if PHASE1_AVAILABLE else "not_available",
                     "message": "Phase 1システムが初期化されていません" if PHASE1_AVAILABLE else "Phase 1システムが利用不可です"
@@ -2550,6 +2680,22 @@ async def get_llm_system_metrics(
                     "message": "既存システムのみ動作中"
                 }
             }
+        
+        # 全LLM呼び出し経路で共有している層のメトリクス
+        result["coalescing"] = get_llm_coalescer().get_metrics()
+        result["rate_pacer"] = get_rate_pacer().get_metrics()
+        result["fair_scheduler"] = get_fair_scheduler().get_metrics()
+        result["hedging"] = get_hedging_metrics()
+        result["circuit_breakers"] = get_all_circuit_metrics()
+        result["token_usage"] = get_usage_recorder().get_metrics()
+        result["model_routing"] = get_model_router().get_metrics()
+        result["token_budget"] = get_token_budget_policy().get_metrics()
+        result["context_strategies"] = get_context_strategy_selector().get_metrics()
+        result["history_normalization"] = get_history_normalizer().get_metrics()
+        result["vector_index"] = get_vector_index().get_metrics()
+        result["response_cache"] = get_response_cache().get_stats()
+        
+        return result
             
     except Exception as e:
         logger.error(f"メトリクス取得エラー: {e}")
@@ -12,6 +12,9 @@ from dataclasses import dataclass
 from enum import Enum
 import logging
 
+from module.llm_usage import estimate_cost
+from module.keyword_matcher import KeywordMatcher
+
 logger = logging.getLogger(__name__)
 
 class MessageImportance(Enum):
@@ -82,61 +85,77 @@ class TokenManager:
         """利用可能な残りトークン数を取得"""
         return self.max_tokens - self.reserved_tokens - current_tokens
     
-    def estimate_cost(self, input_tokens: int, output_tokens: int) -> Dict[str, float]:
-        """トークン数からコストを推定（USD）"""
-        # GPT-4の価格（2024年1月時点の推定）
-        pricing = {
-            "gpt-4": {"input": 0.03, "output": 0.06},  # per 1K tokens
-            "gpt-4-turbo": {"input": 0.01, "output": 0.03},
-            "gpt-3.5-turbo": {"input": 0.0005, "output": 0.0015},
-            "gpt-4.1-nano": {"input": 0.001, "output": 0.002}  # 推定値
-        }
-        
-        model_pricing = pricing.get(self.model, pricing["gpt-4"])
-        input_cost = (input_tokens / 1000) * model_pricing["input"]
-        output_cost = (output_tokens / 1000) * model_pricing["output"]
-        
-        return {
-            "input_cost": input_cost,
-            "output_cost": output_cost,
-            "total_cost": input_cost + output_cost,
-            "input_tokens": input_tokens,
-            "output_tokens": output_tokens
-        }
+    def estimate_cost(self, input_tokens: int, output_tokens: int, cached_tokens: int = 0) -> Dict[str, float]:
+        """トークン数からコストを推定（USD、価格表は module.llm_usage と共通）"""
+        return estimate_cost(self.model, input_tokens, output_tokens, cached_tokens)
 
 class ImportanceClassifier:
     """メッセージの重要度を分類するクラス"""
     
-    # 重要度を判定するためのキーワードパターン
-    IMPORTANCE_PATTERNS = {
+    # 重要度を判定するためのキーワード（各グループの出現数を重要度のスコアに加算）
+    IMPORTANCE_KEYWORDS = {
         MessageImportance.CRITICAL: [
-            r"(結論|まとめ|要約|決定|方針|重要)",
-            r"(プロジェクト|テーマ|問い|仮説).*?(決定|確定|設定)",
-            r"(最も重要|核心|本質|要点)",
+            ["結論", "まとめ", "要約", "決定", "方針", "重要"],
+            ["最も重要", "核心", "本質", "要点"],
         ],
         MessageImportance.HIGH: [
-            r"(なぜ|どうして|理由|原因)",
-            r"(仮説|推測|考察|分析)",
-            r"(発見|気づき|洞察|インサイト)",
-            r"(課題|問題|困難|障害)",
+            ["なぜ", "どうして", "理由", "原因"],
+            ["仮説", "推測", "考察", "分析"],
+            ["発見", "気づき", "洞察", "インサイト"],
+            ["課題", "問題", "困難", "障害"],
         ],
         MessageImportance.MEDIUM: [
-            r"(説明|解説|定義|意味)",
-            r"(例えば|具体的|事例|ケース)",
-            r"(比較|違い|特徴|性質)",
+            ["説明", "解説", "定義", "意味"],
+            ["例えば", "具体的", "事例", "ケース"],
+            ["比較", "違い", "特徴", "性質"],
         ],
         MessageImportance.LOW: [
-            r"(確認|チェック|見直し)",
-            r"(簡単|基本|基礎|初歩)",
-            r"(補足|追加|参考)",
+            ["確認", "チェック", "見直し"],
+            ["簡単", "基本", "基礎", "初歩"],
+            ["補足", "追加", "参考"],
+        ],
+        MessageImportance.TRIVIAL: [
+            ["ありがとう", "お願い", "了解", "わかりました"],
+            ["こんにちは", "よろしく", "お疲れ様"],
         ],
+    }
+    # 前半のキーワードの後に同じ行で後半のキーワードが続く場合に加算
+    IMPORTANCE_SEQUENCES = {
+        MessageImportance.CRITICAL: [
+            (["プロジェクト", "テーマ", "問い", "仮説"], ["決定", "確定", "設定"]),
+        ],
+    }
+    # メッセージがこれらのキーワードで終わる場合に加算
+    IMPORTANCE_ENDINGS = {
         MessageImportance.TRIVIAL: [
-            r"(ありがとう|お願い|了解|わかりました)",
-            r"(こんにちは|よろしく|お疲れ様)",
-            r"(はい|いいえ|そうです|違います)$",
-        ]
+            ["はい", "いいえ", "そうです", "違います"],
+        ],
     }
     
+    def __init__(self):
+        # 全パターンを1つのマッチャーにまとめ、メッセージごとに1回の走査で判定する
+        categories = {}
+        self._group_importance = {}
+        self._sequence_categories = []
+        self._ending_categories = []
+        for importance, groups in self.IMPORTANCE_KEYWORDS.items():
+            for i, keywords in enumerate(groups):
+                category = f"{importance.name}:{i}"
+                categories[category] = keywords
+                self._group_importance[category] = importance
+        for importance, groups in self.IMPORTANCE_SEQUENCES.items():
+            for i, (first, second) in enumerate(groups):
+                categories[f"{importance.name}:seq{i}:first"] = first
+                categories[f"{importance.name}:seq{i}:second"] = second
+                self._sequence_categories.append(
+                    (importance, f"{importance.name}:seq{i}:first", f"{importance.name}:seq{i}:second")
+                )
+        for importance, groups in self.IMPORTANCE_ENDINGS.items():
+            for i, keywords in enumerate(groups):
+                categories[f"{importance.name}:end{i}"] = keywords
+                self._ending_categories.append((importance, f"{importance.name}:end{i}"))
+        self.matcher = KeywordMatcher(categories)
+    
     def classify(self, message: str, sender: str = "user") -> Tuple[MessageImportance, List[str]]:
         """
         メッセージの重要度を分類
@@ -148,15 +167,26 @@ class ImportanceClassifier:
         length_score = min(len(message) / 100, 3)  # 最大3ポイント
         
         # キーワードマッチング
+        hits = self.matcher.scan(message)
         detected_keywords = []
         importance_scores = {level: 0 for level in MessageImportance}
         
-        for importance, patterns in self.IMPORTANCE_PATTERNS.items():
-            for pattern in patterns:
-                matches = re.findall(pattern, message, re.IGNORECASE)
-                if matches:
-                    importance_scores[importance] += len(matches)
-                    detected_keywords.extend(matches)
+        for category, importance in self._group_importance.items():
+            found = hits.found(category)
+            if found:
+                importance_scores[importance] += sum(found.values())
+                detected_keywords.extend(found)
+        
+        for importance, first, second in self._sequence_categories:
+            for pair in hits.sequences(first, second):
+                importance_scores[importance] += 1
+                detected_keywords.extend(pair)
+        
+        for importance, category in self._ending_categories:
+            keyword = hits.ending(category)
+            if keyword:
+                importance_scores[importance] += 1
+                detected_keywords.append(keyword)
         
         # 最も高いスコアの重要度を選択
         max_importance = MessageImportance.MEDIUM  # デフォルト
@@ -341,6 +371,7 @@ class MemoryManager:
             }
             # メタデータを保持（デバッグ用）
             optimized_msg["_metadata"] = {
+                "id": msg.id,
                 "importance": msg.importance.name,
                 "keywords": msg.keywords,
                 "token_count": msg.token_count,
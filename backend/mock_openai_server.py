@@ -0,0 +1,503 @@
+"""
+OpenAI互換のローカルスタブサーバー（ベンチマーク用）
+実際のOpenAI APIを呼ばずに、プール・負荷分散器・チャット経路の処理能力を再現性のある条件で計測します。
+
+対応エンドポイント:
+    POST /v1/chat/completions   （stream=True と stream_options.include_usage に対応）
+    POST /v1/responses
+    POST /v1/embeddings         （encoding_format=float / base64）
+    GET  /v1/models
+    GET  /mock/stats            受信数・注入したエラー数・同時処理数
+    POST /mock/reset            統計と乱数列をリセット
+
+- 最初のトークンまでの時間は対数正規分布に従い、一定確率で裾の重い遅延（tail）を加える
+- 生成は tokens_per_second の速度で行い、ストリーミングではトークンごとに送る
+- 429（Retry-After付き）と500を指定した確率で注入する
+- 出力テキストと埋め込みは入力のハッシュから決まり、同じ入力には常に同じ内容を返す
+- 遅延とエラーはリクエストの到着順とシードから決まるため、同じ条件なら同じ系列になる
+
+既存クライアントは環境変数 OPENAI_BASE_URL でこのサーバーに向けられる:
+    python mock_openai_server.py --profile openai-like --port 8099
+    OPENAI_BASE_URL=http://127.0.0.1:8099/v1 OPENAI_API_KEY=sk-mock python performance_comparison.py
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import array
+import base64
+import random
+import asyncio
+import hashlib
+import argparse
+import threading
+import logging
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, replace
+from typing import Any, Deque, Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from module.rate_pacer import estimate_prompt_tokens
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class MockProfile:
+    """遅延・生成速度・エラー注入の設定"""
+    ttft_median: float = 0.8              # 最初のトークンまでの時間の中央値（秒）
+    ttft_sigma: float = 0.4               # 対数正規分布のσ
+    tail_probability: float = 0.02        # 裾の重い遅延が起きる確率
+    tail_multiplier: float = 8.0          # 裾の遅延の倍率
+    tokens_per_second: float = 60.0       # 生成速度
+    min_completion_tokens: int = 40       # 応答トークン数の範囲（max_tokensで頭打ち）
+    max_completion_tokens: int = 200
+    rate_limit_probability: float = 0.0   # 429を返す確率
+    server_error_probability: float = 0.0 # 500を返す確率
+    retry_after: float = 1.0              # 429のRetry-After（秒）
+    rpm_limit: int = 0                    # 直近60秒の受信数がこれを超えたら429（0で無効）
+    embedding_dim: int = 1536
+    embedding_latency: float = 0.05
+    seed: int = 42
+
+
+# 代表的な設定
+PROFILES: Dict[str, MockProfile] = {
+    # 遅延なし（単体テスト・オーバーヘッド計測用）
+    "instant": MockProfile(
+        ttft_median=0.0, ttft_sigma=0.0, tail_probability=0.0,
+        tokens_per_second=0.0, embedding_latency=0.0
+    ),
+    # 通常時のOpenAIに近い分布
+    "openai-like": MockProfile(),
+    # 裾の重い遅延が頻発する状態（ヘッジの評価用）
+    "heavy-tail": MockProfile(ttft_median=1.0, ttft_sigma=0.6, tail_probability=0.1, tail_multiplier=10.0),
+    # 障害時（429と500が多発）
+    "degraded": MockProfile(
+        ttft_median=2.0, ttft_sigma=0.8, tail_probability=0.1,
+        tokens_per_second=25.0, rate_limit_probability=0.15, server_error_probability=0.1
+    ),
+}
+
+# 応答テキストの語彙（決定的に選ぶ）
+_VOCABULARY = [
+    "探究", "の", "テーマ", "を", "深める", "ために", "、", "まず", "身近な", "疑問", "から",
+    "考えて", "みましょう", "。", "問い", "は", "仮説", "と", "検証", "に", "つながり", "ます",
+    "具体的な", "データ", "を", "集める", "ことで", "新しい", "視点", "が", "見えて", "きます",
+]
+
+
+def _digest(payload: Any) -> bytes:
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).digest()
+
+
+def generate_tokens(request_payload: Any, limit: Optional[int], profile: MockProfile) -> List[str]:
+    """入力から決まる応答トークン列（同じ入力には同じ出力）"""
+    rng = random.Random(_digest(request_payload))
+    count = rng.randint(profile.min_completion_tokens, max(profile.min_completion_tokens, profile.max_completion_tokens))
+    if limit:
+        count = min(count, int(limit))
+    return [rng.choice(_VOCABULARY) for _ in range(max(1, count))]
+
+
+def generate_embedding(text: str, dim: int) -> List[float]:
+    """テキストから決まる正規化済みベクトル"""
+    rng = random.Random(_digest(["embedding", text]))
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dim)]
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+@dataclass
+class MockServerStats:
+    """スタブサーバーの受信統計"""
+    requests: int = 0
+    chat_completions: int = 0
+    streamed: int = 0
+    responses: int = 0
+    embeddings: int = 0
+    rate_limited: int = 0
+    server_errors: int = 0
+    in_flight: int = 0
+    max_in_flight: int = 0
+    completion_tokens: int = 0
+
+
+class MockOpenAIState:
+    """リクエストの到着順に遅延・エラーを割り当てる"""
+
+    def __init__(self, profile: MockProfile):
+        self.profile = profile
+        self.reset()
+
+    def reset(self) -> None:
+        self.stats = MockServerStats()
+        self._sequence = 0
+        self._arrivals: Deque[float] = deque()
+
+    def next_plan(self) -> Dict[str, Any]:
+        """次のリクエストの遅延とエラーを決める（シードと到着順から決定的）"""
+        self._sequence += 1
+        self.stats.requests += 1
+        profile = self.profile
+        rng = random.Random(f"{profile.seed}:{self._sequence}")
+
+        ttft = 0.0
+        if profile.ttft_median > 0:
+            ttft = rng.lognormvariate(math.log(profile.ttft_median), profile.ttft_sigma)
+        if rng.random() < profile.tail_probability:
+            ttft *= profile.tail_multiplier
+
+        error = None
+        roll = rng.random()
+        if self._over_rpm_limit() or roll < profile.rate_limit_probability:
+            error = 429
+        elif roll < profile.rate_limit_probability + profile.server_error_probability:
+            error = 500
+        return {"ttft": ttft, "error": error}
+
+    def _over_rpm_limit(self) -> bool:
+        if not self.profile.rpm_limit:
+            return False
+        now = time.monotonic()
+        self._arrivals.append(now)
+        while self._arrivals and now - self._arrivals[0] > 60.0:
+            self._arrivals.popleft()
+        return len(self._arrivals) > self.profile.rpm_limit
+
+    def generation_time(self, tokens: int) -> float:
+        if self.profile.tokens_per_second <= 0:
+            return 0.0
+        return tokens / self.profile.tokens_per_second
+
+
+def _error_response(status_code: int, retry_after: float) -> JSONResponse:
+    if status_code == 429:
+        return JSONResponse(
+            status_code=429,
+            headers={"retry-after": f"{retry_after:g}"},
+            content={"error": {
+                "message": "Rate limit reached (mock)",
+                "type": "requests",
+                "param": None,
+                "code": "rate_limit_exceeded",
+            }},
+        )
+    return JSONResponse(
+        status_code=500,
+        content={"error": {
+            "message": "The server had an error while processing your request (mock)",
+            "type": "server_error",
+            "param": None,
+            "code": None,
+        }},
+    )
+
+
+def _usage(prompt_tokens: int, completion_tokens: int) -> Dict[str, Any]:
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": 0},
+        "completion_tokens_details": {"reasoning_tokens": 0},
+    }
+
+
+def create_app(profile: Optional[MockProfile] = None) -> FastAPI:
+    """スタブサーバーのアプリケーションを作成"""
+    state = MockOpenAIState(profile or PROFILES["openai-like"])
+    app = FastAPI(title="Mock OpenAI API", docs_url=None, redoc_url=None)
+    app.state.mock = state
+
+    async def admit() -> Optional[JSONResponse]:
+        """遅延（TTFT）を待ち、エラーを注入する場合はそのレスポンスを返す"""
+        plan = state.next_plan()
+        if plan["error"] is not None:
+            # エラーは短い遅延で返す（接続確立・受付程度）
+            await asyncio.sleep(min(plan["ttft"], 0.05))
+            if plan["error"] == 429:
+                state.stats.rate_limited += 1
+            else:
+                state.stats.server_errors += 1
+            return _error_response(plan["error"], state.profile.retry_after)
+        await asyncio.sleep(plan["ttft"])
+        return None
+
+    def enter() -> None:
+        state.stats.in_flight += 1
+        state.stats.max_in_flight = max(state.stats.max_in_flight, state.stats.in_flight)
+
+    def leave() -> None:
+        state.stats.in_flight -= 1
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        state.stats.chat_completions += 1
+        enter()
+        streaming = False
+        try:
+            error = await admit()
+            if error is not None:
+                return error
+
+            model = body.get("model", "gpt-4.1")
+            messages = body.get("messages", [])
+            prompt_tokens = estimate_prompt_tokens(messages)
+            limit = body.get("max_tokens") or body.get("max_completion_tokens")
+            tokens = generate_tokens([model, messages, body.get("temperature")], limit, state.profile)
+            state.stats.completion_tokens += len(tokens)
+            completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:24]}"
+            created = int(time.time())
+
+            if body.get("stream"):
+                include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+                state.stats.streamed += 1
+                streaming = True
+                return StreamingResponse(
+                    _stream_chat(completion_id, created, model, tokens, prompt_tokens, include_usage),
+                    media_type="text/event-stream",
+                )
+
+            await asyncio.sleep(state.generation_time(len(tokens)))
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens), "refusal": None},
+                    "finish_reason": "stop" if limit is None or len(tokens) < int(limit) else "length",
+                    "logprobs": None,
+                }],
+                "usage": _usage(prompt_tokens, len(tokens)),
+                "system_fingerprint": "fp_mock",
+            }
+        finally:
+            if not streaming:
+                leave()
+
+    async def _stream_chat(completion_id, created, model, tokens, prompt_tokens, include_usage):
+        """トークンごとにチャンクを送る（切断時はここで打ち切られる）"""
+        interval = state.generation_time(1)
+
+        def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None, usage=None) -> str:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "system_fingerprint": "fp_mock",
+                "choices": [] if usage is not None else [{
+                    "index": 0, "delta": delta, "finish_reason": finish_reason, "logprobs": None
+                }],
+                "usage": usage,
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        try:
+            yield chunk({"role": "assistant", "content": ""})
+            for token in tokens:
+                if interval:
+                    await asyncio.sleep(interval)
+                yield chunk({"content": token})
+            yield chunk({}, finish_reason="stop")
+            if include_usage:
+                yield chunk({}, usage=_usage(prompt_tokens, len(tokens)))
+            yield "data: [DONE]\n\n"
+        finally:
+            leave()
+
+    @app.post("/v1/responses")
+    async def responses(request: Request):
+        body = await request.json()
+        state.stats.responses += 1
+        enter()
+        try:
+            error = await admit()
+            if error is not None:
+                return error
+
+            model = body.get("model", "gpt-4.1")
+            items = body.get("input", [])
+            prompt_tokens = estimate_prompt_tokens(items if isinstance(items, list) else [{"content": items}])
+            tokens = generate_tokens([model, items, body.get("tools")], body.get("max_output_tokens"), state.profile)
+            state.stats.completion_tokens += len(tokens)
+            await asyncio.sleep(state.generation_time(len(tokens)))
+            return {
+                "id": f"resp_mock_{uuid.uuid4().hex[:24]}",
+                "object": "response",
+                "created_at": int(time.time()),
+                "model": model,
+                "status": "completed",
+                "output": [{
+                    "type": "message",
+                    "id": f"msg_mock_{uuid.uuid4().hex[:24]}",
+                    "status": "completed",
+                    "role": "assistant",
+                    "content": [{"type": "output_text", "text": "".join(tokens), "annotations": []}],
+                }],
+                "parallel_tool_calls": True,
+                "tool_choice": "auto",
+                "tools": body.get("tools", []),
+                "usage": {
+                    "input_tokens": prompt_tokens,
+                    "input_tokens_details": {"cached_tokens": 0},
+                    "output_tokens": len(tokens),
+                    "output_tokens_details": {"reasoning_tokens": 0},
+                    "total_tokens": prompt_tokens + len(tokens),
+                },
+            }
+        finally:
+            leave()
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        state.stats.embeddings += 1
+        enter()
+        try:
+            error = await admit()
+            if error is not None:
+                return error
+
+            inputs = body.get("input", [])
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            dim = int(body.get("dimensions") or state.profile.embedding_dim)
+            await asyncio.sleep(state.profile.embedding_latency)
+
+            data = []
+            for index, text in enumerate(inputs):
+                vector = generate_embedding(str(text), dim)
+                if body.get("encoding_format") == "base64":
+                    # OpenAI SDKは既定でbase64（float32リトルエンディアン）を要求する
+                    packed = array.array("f", vector)
+                    if sys.byteorder != "little":
+                        packed.byteswap()
+                    embedding: Any = base64.b64encode(packed.tobytes()).decode("ascii")
+                else:
+                    embedding = vector
+                data.append({"object": "embedding", "index": index, "embedding": embedding})
+
+            prompt_tokens = sum(estimate_prompt_tokens([{"content": str(t)}]) for t in inputs)
+            return {
+                "object": "list",
+                "data": data,
+                "model": body.get("model", "text-embedding-ada-002"),
+                "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+            }
+        finally:
+            leave()
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [
+            {"id": name, "object": "model", "created": 0, "owned_by": "mock"}
+            for name in ("gpt-4.1", "gpt-4.1-mini", "gpt-3.5-turbo", "text-embedding-ada-002")
+        ]}
+
+    @app.get("/mock/stats")
+    async def stats():
+        return {"profile": asdict(state.profile), "stats": asdict(state.stats)}
+
+    @app.post("/mock/reset")
+    async def reset():
+        state.reset()
+        return {"status": "reset"}
+
+    return app
+
+
+@contextmanager
+def run_mock_server(profile: Optional[MockProfile] = None, host: str = "127.0.0.1", port: int = 8099):
+    """
+    スタブサーバーを別スレッドで起動し、OPENAI_BASE_URL をそこに向ける
+
+    共有OpenAIクライアントは初回生成時のbase URLを使い続けるため、
+    クライアントを作る前（ベンチマークの開始時）に使うこと
+
+    使い方:
+        with run_mock_server(PROFILES["heavy-tail"]) as base_url:
+            asyncio.run(run_comprehensive_benchmark())
+    """
+    import uvicorn
+
+    config = uvicorn.Config(create_app(profile), host=host, port=port, log_level="warning", access_log=False)
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    deadline = time.monotonic() + 10.0
+    while not server.started:
+        if not thread.is_alive() or time.monotonic() > deadline:
+            raise RuntimeError(f"スタブサーバーを起動できませんでした: {host}:{port}")
+        time.sleep(0.05)
+
+    base_url = f"http://{host}:{port}/v1"
+    previous = {key: os.environ.get(key) for key in ("OPENAI_BASE_URL", "OPENAI_API_KEY")}
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["OPENAI_API_KEY"] = previous["OPENAI_API_KEY"] or "sk-mock"
+    logger.info(f"🧪 スタブOpenAIサーバー起動: {base_url}")
+    try:
+        yield base_url
+    finally:
+        server.should_exit = True
+        thread.join(timeout=5.0)
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def resolve_profile(name: str, **overrides: Any) -> MockProfile:
+    """プロファイル名とCLI/環境変数の上書きから設定を作る"""
+    if name not in PROFILES:
+        raise ValueError(f"未知のプロファイル: {name}（{', '.join(PROFILES)}）")
+    return replace(PROFILES[name], **{k: v for k, v in overrides.items() if v is not None})
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="OpenAI互換のローカルスタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--profile", default=os.environ.get("MOCK_OPENAI_PROFILE", "openai-like"), choices=list(PROFILES))
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--ttft-median", type=float)
+    parser.add_argument("--ttft-sigma", type=float)
+    parser.add_argument("--tail-probability", type=float)
+    parser.add_argument("--tail-multiplier", type=float)
+    parser.add_argument("--tokens-per-second", type=float)
+    parser.add_argument("--rate-limit-probability", type=float)
+    parser.add_argument("--server-error-probability", type=float)
+    parser.add_argument("--rpm-limit", type=int)
+    args = parser.parse_args()
+
+    profile = resolve_profile(
+        args.profile,
+        seed=args.seed,
+        ttft_median=args.ttft_median,
+        ttft_sigma=args.ttft_sigma,
+        tail_probability=args.tail_probability,
+        tail_multiplier=args.tail_multiplier,
+        tokens_per_second=args.tokens_per_second,
+        rate_limit_probability=args.rate_limit_probability,
+        server_error_probability=args.server_error_probability,
+        rpm_limit=args.rpm_limit,
+    )
+    print(f"Mock OpenAI API: http://{args.host}:{args.port}/v1  profile={args.profile} {asdict(profile)}")
+    uvicorn.run(create_app(profile), host=args.host, port=args.port, log_level="warning")
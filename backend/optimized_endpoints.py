@@ -3,13 +3,17 @@
 並列処理と非同期処理を活用してパフォーマンスを改善
 """
 
+import os
+import math
 import asyncio
 import json
 import time
 import logging
-from typing import Optional, Dict, Any, List
+from contextlib import aclosing
+from typing import Optional, Dict, Any, List, AsyncIterator
 from datetime import datetime, timezone
-from fastapi import HTTPException, Depends, status
+from fastapi import HTTPException, Depends, status, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from async_helpers import (
@@ -20,9 +24,18 @@ from async_helpers import (
     rate_limited_openai_call
 )
 from module.async_llm_api import get_async_llm_client
+from module.llm_context import set_llm_context, llm_context
+from module.llm_usage import collect_usage
+from module.circuit_breaker import CircuitOpenError
+from load_balancer import get_load_balancer
+from memory_manager import ImportanceClassifier
+from context_strategy import get_context_strategy_selector
 
 logger = logging.getLogger(__name__)
 
+# モデル振り分け用のユーザー発話の重要度判定（キーワード判定のみでLLMは呼ばない）
+_importance_classifier = ImportanceClassifier()
+
 
 class OptimizedChatResponse(BaseModel):
     """最適化されたチャットレスポンスモデル"""
@@ -37,6 +50,7 @@ class OptimizedChatResponse(BaseModel):
     decision_metadata: Optional[Dict[str, Any]] = None
     metrics: Optional[Dict[str, Any]] = None
     performance_metrics: Optional[Dict[str, Any]] = None  # パフォーマンス指標を追加
+    followups: Optional[List[str]] = None  # 対話エージェントのフォローアップ候補
 
 async def optimized_chat_with_ai(
     chat_data,
@@ -87,6 +101,9 @@ async def optimized_chat_with_ai(
         if chat_data.message and len(chat_data.message) > MAX_CHAT_MESSAGE_LENGTH:
             raise HTTPException(status_code=400, detail="Message too long")
         
+        # 公平スケジューリング用に認証済みユーザーを、モデル振り分け用に発話の重要度と長さを設定
+        set_llm_context(user_id=current_user, user_key=f"user:{current_user}", **route_hints(chat_data.message))
+        
         # ヘルパー初期化
         db_helper = AsyncDatabaseHelper(supabase)
         context_builder = AsyncProjectContextBuilder(db_helper)
@@ -128,44 +145,57 @@ async def optimized_chat_with_ai(
         # ====================
         # Step 2: メッセージ構築
         # ====================
+        # 会話ごとに割り当てたコンテキスト戦略で構築し、プロンプトのトークン数と構築時間を記録
         system_prompt_with_context = build_system_prompt(project_context)
-        messages = build_message_history(system_prompt_with_context, conversation_history, chat_data.message)
+        context = await get_context_strategy_selector().build(
+            conversation_id, system_prompt_with_context, conversation_history, chat_data.message
+        )
+        messages = context.messages
+        metrics.update(context.to_metrics())
         
         # ====================
         # Step 3: LLM応答生成（並列化可能な場合）
         # ====================
         llm_start = time.time()
         agent_payload = {}
+        followups = None
         
-        if ENABLE_CONVERSATION_AGENT and conversation_orchestrator is not None:
-            # 対話エージェント処理
-            try:
-                agent_result = await process_with_conversation_agent(
-                    conversation_orchestrator,
-                    chat_data.message,
-                    conversation_history,
-                    project,
-                    project_id,
-                    current_user,
-                    conversation_id
-                )
-                response = agent_result["response"]
-                agent_payload = extract_agent_payload(agent_result)
-                
-                # followupsがある場合
-                if agent_result.get("followups"):
-                    followup_text = "\n\n**次にできること:**\n" + "\n".join([f"• {f}" for f in agent_result["followups"][:3]])
-                    response += followup_text
-                
-                logger.info(f"✅ 対話エージェント処理完了: {agent_result.get('support_type')}")
-                
-            except Exception as e:
-                logger.error(f"❌ 対話エージェントエラー、フォールバック: {e}")
-                # フォールバック: 非同期LLM呼び出し
-                response = await async_llm.generate_with_fallback(messages)
-        else:
-            # 通常の非同期LLM呼び出し
-            response = await async_llm.generate_response_async(messages)
+        # ブロック内のLLM呼び出し（対話エージェントの各ステップを含む）のトークン使用量を合計
+        with collect_usage() as usage:
+            if ENABLE_CONVERSATION_AGENT and conversation_orchestrator is not None:
+                # 対話エージェント処理
+                try:
+                    agent_result = await process_with_conversation_agent(
+                        conversation_orchestrator,
+                        chat_data.message,
+                        context.history,
+                        project,
+                        project_id,
+                        current_user,
+                        conversation_id,
+                        orchestrator_mode=chat_data.orchestrator_mode
+                    )
+                    response = agent_result["response"]
+                    agent_payload = extract_agent_payload(agent_result)
+                    
+                    # followupsがある場合
+                    # （JSON版は応答を1回で返すため並行生成は使わず、応答と同じ呼び出しで生成した候補を返す）
+                    followups = agent_result.get("followups") or None
+                    if followups:
+                        followup_text = "\n\n**次にできること:**\n" + "\n".join([f"• {f}" for f in followups[:3]])
+                        response += followup_text
+                    
+                    logger.info(f"✅ 対話エージェント処理完了: {agent_result.get('support_type')}")
+                    
+                except Exception as e:
+                    logger.error(f"❌ 対話エージェントエラー、フォールバック: {e}")
+                    # フォールバック: 非同期LLM呼び出し
+                    with llm_context(step="reply"):
+                        response = await async_llm.generate_with_fallback(messages)
+            else:
+                # 通常の非同期LLM呼び出し
+                with llm_context(step="reply"):
+                    response = await generate_chat_reply(async_llm, messages)
         
         metrics["llm_response_time"] = time.time() - llm_start
         logger.info(f"📊 LLM応答時間: {metrics['llm_response_time']:.2f}秒")
@@ -232,14 +262,18 @@ async def optimized_chat_with_ai(
         return OptimizedChatResponse(
             response=response,
             timestamp=datetime.now(timezone.utc).isoformat(),
-            token_usage=None,  # トークン使用量は削除
+            token_usage=usage.to_dict(),
             context_metadata={"has_project_context": bool(project_context)},
             performance_metrics=metrics,
+            followups=followups,
             **agent_payload
         )
         
     except HTTPException:
         raise
+    except CircuitOpenError as e:
+        logger.warning(f"⛔ OpenAI障害のため即時失敗: {e}")
+        raise circuit_open_http_exception(e)
     except Exception as e:
         import traceback
         logger.error(f"Chat API Error: {str(e)}\nTraceback: {traceback.format_exc()}")
@@ -254,6 +288,347 @@ async def optimized_chat_with_ai(
         )
 
 
+# SSEでクライアント切断を確認する間隔（秒）
+STREAM_DISCONNECT_CHECK_INTERVAL = 0.5
+
+
+async def optimized_chat_stream_with_ai(
+    chat_data,
+    current_user: int,
+    request: Request,
+    supabase,
+    llm_client,
+    conversation_orchestrator,
+    ENABLE_CONVERSATION_AGENT: bool,
+    MAX_CHAT_MESSAGE_LENGTH: int = 2000
+) -> StreamingResponse:
+    """
+    ストリーミング版 chat_with_ai エンドポイント（Server-Sent Events）
+    
+    トークンを生成されるそばから `delta` イベントとして送信し、最初のトークンまでの
+    待ち時間を短縮する。chat_logs の2行と会話タイムスタンプはストリーム完了後にのみ
+    書き込み、クライアントが切断した場合は生成を打ち切って何も保存しない。
+    
+    送信イベント:
+        start:     {"conversation_id"}
+        delta:     {"content"}
+        done:      {"response", "timestamp", "saved", "performance_metrics", "token_usage", ...agent_payload}
+        followups: {"followups"}（ENABLE_SPECULATIVE_FOLLOWUPS時、ログ保存とdoneの送信後に送信）
+        error:     {"detail"}
+    
+    Returns:
+        StreamingResponse (text/event-stream)
+    """
+    start_time = time.time()
+    metrics = {
+        "db_fetch_time": 0,
+        "time_to_first_token": None,
+        "llm_response_time": 0,
+        "db_save_time": 0,
+        "total_time": 0
+    }
+    
+    # 検証とコンテキスト取得はストリーム開始前に行い、エラーは通常のHTTPステータスで返す
+    if not supabase:
+        raise HTTPException(status_code=500, detail="データベース接続が初期化されていません")
+    
+    if llm_client is None and not ENABLE_CONVERSATION_AGENT:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="LLMクライアントが初期化されていません"
+        )
+    
+    if chat_data.message and len(chat_data.message) > MAX_CHAT_MESSAGE_LENGTH:
+        raise HTTPException(status_code=400, detail="Message too long")
+    
+    set_llm_context(user_id=current_user, user_key=f"user:{current_user}", **route_hints(chat_data.message))
+    db_helper = AsyncDatabaseHelper(supabase)
+    context_builder = AsyncProjectContextBuilder(db_helper)
+    async_llm = get_async_llm_client()
+    page_id = "general"
+    use_agent = ENABLE_CONVERSATION_AGENT and conversation_orchestrator is not None
+    
+    try:
+        db_fetch_start = time.time()
+        conversation_id = await asyncio.to_thread(
+            lambda: get_or_create_conversation_sync(supabase, current_user, "general")
+        )
+        
+        history_limit = 20
+        if chat_data.message and len(chat_data.message) > 500:
+            history_limit = 50
+        elif use_agent:
+            history_limit = 100
+        
+        project_id, project_context, project, conversation_history = await parallel_fetch_context_and_history(
+            db_helper=db_helper,
+            context_builder=context_builder,
+            page_id=page_id,
+            conversation_id=conversation_id,
+            user_id=current_user,
+            history_limit=history_limit
+        )
+        metrics["db_fetch_time"] = time.time() - db_fetch_start
+        
+        system_prompt_with_context = build_system_prompt(project_context)
+        context = await get_context_strategy_selector().build(
+            conversation_id, system_prompt_with_context, conversation_history, chat_data.message
+        )
+        messages = context.messages
+        metrics.update(context.to_metrics())
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ ストリーミングチャット準備エラー: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"AI応答の生成でエラーが発生しました: {str(e)}"
+        )
+    
+    async def event_stream() -> AsyncIterator[str]:
+        # 並行生成中のフォローアップ候補（切断・エラーで抜けた場合も finally で破棄する）
+        agent_result: Dict[str, Any] = {}
+        try:
+            yield format_sse_event("start", {"conversation_id": conversation_id})
+            
+            llm_start = time.time()
+            chunks: List[str] = []
+            agent_payload: Dict[str, Any] = {}
+            
+            # 生成中のLLM呼び出しのトークン使用量を合計し、doneイベントで返す
+            with collect_usage() as usage, llm_context(step="reply"):
+                try:
+                    if use_agent:
+                        # 対話エージェントは応答全体を一括生成するため、1つのdeltaとして送る
+                        try:
+                            agent_result = await process_with_conversation_agent(
+                                conversation_orchestrator,
+                                chat_data.message,
+                                context.history,
+                                project,
+                                project_id,
+                                current_user,
+                                conversation_id,
+                                orchestrator_mode=chat_data.orchestrator_mode,
+                                speculative_followups=is_speculative_followups_enabled()
+                            )
+                            response = agent_result["response"]
+                            agent_payload = extract_agent_payload(agent_result)
+                            # 並行生成中のフォローアップ候補は応答の送信後に別イベントで送る
+                            if "followups_task" not in agent_result and agent_result.get("followups"):
+                                response += "\n\n**次にできること:**\n" + "\n".join([f"• {f}" for f in agent_result["followups"][:3]])
+                        except Exception as e:
+                            logger.error(f"❌ 対話エージェントエラー、フォールバック: {e}")
+                            response = await async_llm.generate_with_fallback(messages)
+                        
+                        if await request.is_disconnected():
+                            logger.info("🔌 クライアント切断のためストリームを中断（未保存）")
+                            return
+                        metrics["time_to_first_token"] = time.time() - llm_start
+                        chunks.append(response)
+                        yield format_sse_event("delta", {"content": response})
+                    else:
+                        try:
+                            async for event in _stream_llm_tokens(
+                                async_llm, messages, request, chunks, metrics, llm_start
+                            ):
+                                yield event
+                        except CircuitOpenError:
+                            raise
+                        except Exception as e:
+                            if chunks:
+                                raise
+                            # 最初のトークン前の失敗は非ストリーミング呼び出しでフォールバック
+                            logger.warning(f"⚠️ ストリーミング開始失敗、フォールバック: {e}")
+                            response = await async_llm.generate_with_fallback(messages)
+                            metrics["time_to_first_token"] = time.time() - llm_start
+                            chunks.append(response)
+                            yield format_sse_event("delta", {"content": response})
+                        
+                        if metrics.get("client_disconnected"):
+                            logger.info("🔌 クライアント切断のためストリームを中断（未保存）")
+                            return
+                
+                except asyncio.CancelledError:
+                    # サーバー側でのキャンセル（切断検知）時は保存せずに終了
+                    logger.info("🔌 ストリームがキャンセルされました（未保存）")
+                    raise
+                except CircuitOpenError as e:
+                    logger.warning(f"⛔ OpenAI障害のため即時失敗: {e}")
+                    yield format_sse_event("error", {
+                        "detail": "AIサービスが一時的に利用できません。しばらくしてから再度お試しください",
+                        "retry_after": math.ceil(e.retry_after)
+                    })
+                    return
+                except Exception as e:
+                    logger.error(f"❌ ストリーミング応答エラー: {e}")
+                    yield format_sse_event("error", {"detail": "AI応答の生成でエラーが発生しました"})
+                    return
+            
+            metrics["llm_response_time"] = time.time() - llm_start
+            response = "".join(chunks)
+            
+            # ストリーム完了後にのみログとタイムスタンプを書き込む
+            save_start = time.time()
+            user_msg_data = {
+                "user_id": current_user,
+                "page_id": page_id,
+                "sender": "user",
+                "message": chat_data.message,
+                "conversation_id": conversation_id,
+                "context_data": build_context_data(project_id=project_id, project=project)
+            }
+            ai_msg_data = {
+                "user_id": current_user,
+                "page_id": page_id,
+                "sender": "assistant",
+                "message": response,
+                "conversation_id": conversation_id,
+                "context_data": build_ai_context_data(
+                    project_context=project_context,
+                    project_id=project_id,
+                    agent_payload=agent_payload,
+                    is_agent=bool(agent_payload)
+                )
+            }
+            user_saved, ai_saved = await parallel_save_chat_logs(db_helper, user_msg_data, ai_msg_data)
+            await update_conversation_timestamp_async(db_helper, conversation_id)
+            metrics["db_save_time"] = time.time() - save_start
+            metrics["total_time"] = time.time() - start_time
+            
+            logger.info(
+                f"📊 ストリーミング完了: TTFT={metrics['time_to_first_token'] or 0:.2f}秒, "
+                f"合計={metrics['total_time']:.2f}秒"
+            )
+            
+            yield format_sse_event("done", {
+                "response": response,
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "saved": bool(user_saved and ai_saved),
+                "context_metadata": {"has_project_context": bool(project_context)},
+                "performance_metrics": metrics,
+                "token_usage": usage.to_dict(),
+                **agent_payload
+            })
+            
+            # フォローアップ候補は応答の保存・doneの送信を待たせず、最後に別イベントで送る
+            if "followups_task" in agent_result:
+                followups = await resolve_followups(agent_result)
+                if followups:
+                    yield format_sse_event("followups", {"followups": followups})
+        finally:
+            discard_followups(agent_result)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            # nginx等のプロキシでバッファリングさせない
+            "X-Accel-Buffering": "no",
+            # GZipMiddlewareにチャンクを溜め込ませないため無圧縮を明示
+            "Content-Encoding": "identity",
+        }
+    )
+
+
+async def _stream_llm_tokens(
+    async_llm,
+    messages: List[Dict[str, Any]],
+    request: Request,
+    chunks: List[str],
+    metrics: Dict[str, Any],
+    llm_start: float
+) -> AsyncIterator[str]:
+    """LLMのトークンをdeltaイベントとして中継し、切断を検知したら上流を閉じる"""
+    last_check = time.monotonic()
+    
+    if is_hedging_enabled():
+        balancer = await get_load_balancer()
+        source = balancer.generate_response_streaming_hedged(messages)
+    else:
+        source = async_llm.generate_response_streaming(messages)
+    
+    async with aclosing(source) as token_stream:
+        async for token in token_stream:
+            if metrics["time_to_first_token"] is None:
+                metrics["time_to_first_token"] = time.time() - llm_start
+            
+            now = time.monotonic()
+            if now - last_check >= STREAM_DISCONNECT_CHECK_INTERVAL:
+                last_check = now
+                if await request.is_disconnected():
+                    metrics["client_disconnected"] = True
+                    return
+            
+            chunks.append(token)
+            yield format_sse_event("delta", {"content": token})
+
+
+def is_hedging_enabled() -> bool:
+    """ヘッジリクエスト（遅い応答に対する2つ目の呼び出し）を使うか"""
+    return os.environ.get("ENABLE_LLM_HEDGING", "false").lower() == "true"
+
+
+def is_speculative_followups_enabled() -> bool:
+    """対話エージェントのフォローアップ候補を応答生成と並行して別の呼び出しで生成するか"""
+    return os.environ.get("ENABLE_SPECULATIVE_FOLLOWUPS", "false").lower() == "true"
+
+
+async def resolve_followups(agent_result: Dict[str, Any]) -> List[str]:
+    """並行生成中のフォローアップ候補を待つ（SPECULATIVE_FOLLOWUPS_TIMEOUT を過ぎたら打ち切って空を返す）"""
+    task = agent_result.pop("followups_task", None)
+    if task is None:
+        return agent_result.get("followups") or []
+    timeout = float(os.environ.get("SPECULATIVE_FOLLOWUPS_TIMEOUT", "10"))
+    try:
+        followups = await asyncio.wait_for(task, timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠️ フォローアップ候補の生成が{timeout:.0f}秒以内に完了しなかったため省略")
+        return []
+    agent_result["followups"] = followups
+    return followups
+
+
+def discard_followups(agent_result: Dict[str, Any]) -> None:
+    """並行生成中のフォローアップ候補を破棄（クライアント切断・エラー時）"""
+    task = agent_result.pop("followups_task", None)
+    if task is not None and not task.done():
+        task.cancel()
+
+
+def route_hints(message: Optional[str]) -> Dict[str, Any]:
+    """ユーザー発話からモデル振り分けのシグナル（llm_context の importance / message_chars）を作成"""
+    if not message:
+        return {}
+    importance, _ = _importance_classifier.classify(message)
+    return {"importance": importance.value, "message_chars": len(message)}
+
+
+async def generate_chat_reply(async_llm, messages: List[Dict[str, Any]]) -> str:
+    """通常のLLM応答生成（ENABLE_LLM_HEDGING時は負荷分散器のヘッジ付き生成を使用）"""
+    if is_hedging_enabled():
+        balancer = await get_load_balancer()
+        return await balancer.generate_response_hedged(messages)
+    return await async_llm.generate_response_async(messages)
+
+
+def circuit_open_http_exception(error: CircuitOpenError) -> HTTPException:
+    """サーキットopen時の503レスポンス（Retry-After付き）"""
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="AIサービスが一時的に利用できません。しばらくしてから再度お試しください",
+        headers={"Retry-After": str(max(1, math.ceil(error.retry_after)))}
+    )
+
+
+def format_sse_event(event: str, data: Dict[str, Any]) -> str:
+    """SSEイベント文字列を生成（dataは改行を含まないよう1行のJSONにする）"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
 # =====================================
 # ヘルパー関数群
 # =====================================
@@ -298,23 +673,6 @@ def build_system_prompt(project_context: Optional[str]) -> str:
     return system_prompt_with_context
 
 
-def build_message_history(
-    system_prompt: str, 
-    conversation_history: List[Dict[str, Any]], 
-    user_message: str
-) -> List[Dict[str, str]]:
-    """メッセージ履歴を構築"""
-    messages = [{"role": "system", "content": system_prompt}]
-    
-    if conversation_history:
-        for history_msg in conversation_history:
-            role = "user" if history_msg["sender"] == "user" else "assistant"
-            messages.append({"role": role, "content": history_msg["message"]})
-    
-    messages.append({"role": "user", "content": user_message})
-    return messages
-
-
 def build_context_data(
     project_id: Optional[int],
     project: Optional[Dict[str, Any]]
@@ -368,14 +726,21 @@ async def process_with_conversation_agent(
     project: Optional[Dict[str, Any]],
     project_id: Optional[int],
     user_id: int,
-    conversation_id: str
+    conversation_id: str,
+    orchestrator_mode: Optional[str] = None,
+    speculative_followups: bool = False
 ) -> Dict[str, Any]:
-    """対話エージェントでの処理を非同期化"""
+    """
+    対話エージェントでの処理を非同期化（orchestrator_mode で multi / fused を切り替え）
+    
+    speculative_followups の場合、結果の followups_task でフォローアップ候補を後から受け取る（ストリーミング版のみ）
+    """
     # 履歴フォーマット変換
     agent_history = []
     for history_msg in conversation_history:
         sender = "user" if history_msg["sender"] == "user" else "assistant"
         agent_history.append({
+            "id": history_msg.get("id"),  # 状態ストアの差分抽出で使用
             "sender": sender,
             "message": history_msg["message"]
         })
@@ -390,14 +755,15 @@ async def process_with_conversation_agent(
             "id": project_id
         }
     
-    # 対話エージェント処理（非同期ラップ）
-    return await asyncio.to_thread(
-        orchestrator.process_turn,
+    # 対話エージェント処理（非同期パイプライン）
+    return await orchestrator.process_turn_async(
         user_message=user_message,
         conversation_history=agent_history,
         project_context=agent_project_context,
         user_id=user_id,
-        conversation_id=conversation_id
+        conversation_id=conversation_id,
+        mode=orchestrator_mode,
+        speculative_followups=speculative_followups
     )
 
 
@@ -1,8 +1,14 @@
 """
 パフォーマンス比較とベンチマーク
 単一インスタンス vs プール vs 負荷分散の性能測定
+
+--mock を指定するとOpenAI互換のローカルスタブサーバー（mock_openai_server.py）に対して計測し、
+API料金をかけずに同じ遅延・エラー条件で繰り返し比較できる:
+    python performance_comparison.py --mock heavy-tail --users 50
 """
 
+import os
+import argparse
 import asyncio
 import time
 import statistics
@@ -306,15 +312,11 @@ class PerformanceBenchmark:
             print("負荷分散方式（バランスの取れた性能）")
 
 
-async def run_comprehensive_benchmark():
+async def run_comprehensive_benchmark(concurrent_users: int = 20, timeout: float = 30.0):
     """包括的ベンチマークを実行"""
     benchmark = PerformanceBenchmark()
     results = []
     
-    # テスト設定
-    concurrent_users = 20
-    timeout = 30.0
-    
     try:
         # 1. 単一インスタンス
         result = await benchmark.benchmark_single_instance(concurrent_users, timeout)
@@ -401,9 +403,31 @@ async def stress_test(concurrent_users: int = 50, duration_seconds: int = 60):
     print(f"   平均RPS: {total_requests/actual_duration:.1f}")
 
 
-if __name__ == "__main__":
+def _run_all(args):
     # 基本ベンチマーク
-    asyncio.run(run_comprehensive_benchmark())
+    asyncio.run(run_comprehensive_benchmark(concurrent_users=args.users, timeout=args.timeout))
     
     # ストレステスト
-    asyncio.run(stress_test(concurrent_users=30, duration_seconds=30))
\ No newline at end of file
+    if args.stress_seconds > 0:
+        asyncio.run(stress_test(concurrent_users=args.stress_users, duration_seconds=args.stress_seconds))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="単一インスタンス・プール・負荷分散の性能比較")
+    parser.add_argument("--mock", metavar="PROFILE", help="ローカルのスタブサーバーで計測（instant / openai-like / heavy-tail / degraded）")
+    parser.add_argument("--mock-port", type=int, default=8099)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--stress-users", type=int, default=30)
+    parser.add_argument("--stress-seconds", type=int, default=30)
+    args = parser.parse_args()
+    
+    if args.mock:
+        from mock_openai_server import resolve_profile, run_mock_server
+        
+        # スタブ側で429を注入するため、ローカルのペーサーで処理能力を頭打ちにしない
+        os.environ.setdefault("ENABLE_LLM_PACER", "false")
+        with run_mock_server(resolve_profile(args.mock), port=args.mock_port):
+            _run_all(args)
+    else:
+        _run_all(args)
\ No newline at end of file
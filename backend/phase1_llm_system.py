@@ -9,6 +9,7 @@ from typing import Optional, Dict, Any, Union, List
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from module.llm_api import learning_plannner
+from module.circuit_breaker import CircuitOpenError, STATE_OPEN, get_circuit_breaker
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +26,7 @@ class LLMSystemMetrics:
     error_count: int = 0
     pool_error_count: int = 0
     legacy_error_count: int = 0
+    circuit_rejected_count: int = 0
     last_error_time: Optional[float] = None
     system_start_time: float = field(default_factory=time.time)
 
@@ -51,9 +53,12 @@ class Phase1LLMManager:
         
         # システム状態
         self._initialized = False
-        self._pool_healthy = True
         self._consecutive_pool_errors = 0
         
+        # 上流の健全性はAsyncLearningPlannerと共有のサーキットブレーカーで判定する
+        # （open中は即座に失敗し、reset_timeout後の試行呼び出しで自動復旧）
+        self.breaker = get_circuit_breaker("openai")
+        
         # 既存のレガシークライアント（必須・常に利用可能）
         self.legacy_client: Optional[learning_plannner] = None
         
@@ -138,6 +143,11 @@ class Phase1LLMManager:
             self.pool_enabled = False
             raise
     
+    @property
+    def _pool_healthy(self) -> bool:
+        """上流が利用可能か（サーキットが open でない）"""
+        return self.breaker.state != STATE_OPEN
+    
     def should_use_pool(self) -> bool:
         """
         プールを使用すべきかを判定
@@ -172,8 +182,12 @@ class Phase1LLMManager:
             
         Returns:
             LLMからの応答文字列
+            
+        Raises:
+            CircuitOpenError: OpenAIの障害でサーキットが open の場合（フォールバックせず即座に失敗）
         """
         start_time = time.time()
+        use_pool = False
         
         try:
             # メトリクス更新
@@ -189,7 +203,6 @@ class Phase1LLMManager:
                 
                 # プール成功時の処理
                 self._consecutive_pool_errors = 0
-                self._pool_healthy = True
                 
                 if self.debug_mode:
                     logger.debug(f"✅ プールでの処理完了: {time.time() - start_time:.2f}秒")
@@ -206,6 +219,15 @@ class Phase1LLMManager:
                 
                 return response
                 
+        except CircuitOpenError as e:
+            # 上流障害中: レガシーも同じ上流を呼ぶためフォールバックしない
+            self.metrics.error_count += 1
+            self.metrics.circuit_rejected_count += 1
+            self.metrics.last_error_time = time.time()
+            if self.debug_mode:
+                logger.debug(f"⛔ サーキットopenのため即時失敗: {e}")
+            raise
+        
         except Exception as e:
             # エラー処理とメトリクス更新
             self.metrics.error_count += 1
@@ -219,11 +241,6 @@ class Phase1LLMManager:
                 self._consecutive_pool_errors += 1
                 self.metrics.pool_error_count += 1
                 
-                # エラーが多い場合はプールを一時的に無効化
-                if self._consecutive_pool_errors >= self.fallback_threshold:
-                    logger.warning(f"⚠️ プールエラーが{self.fallback_threshold}回連続、一時的に無効化")
-                    self._pool_healthy = False
-                
                 try:
                     response = await self._generate_with_legacy(messages)
                     self.metrics.legacy_requests += 1
@@ -261,11 +278,13 @@ class Phase1LLMManager:
             
             client = self._pool_clients[client_index]
             
-            # 非同期実行
-            response = await asyncio.wait_for(
-                asyncio.to_thread(client.generate_response, messages),
-                timeout=self.pool_timeout
-            )
+            # 非同期実行（スレッド内の呼び出しはタイムアウト後も完了まで残るため、
+            # サーキットブレーカーへの記録はこの層で1回だけ行い、タイムアウトは障害として数える）
+            async with self.breaker.guard_thread():
+                response = await asyncio.wait_for(
+                    asyncio.to_thread(client.generate_response, messages),
+                    timeout=self.pool_timeout
+                )
             
             return response
     
@@ -289,6 +308,7 @@ class Phase1LLMManager:
                 "initialized": self._initialized,
                 "pool_enabled": self.pool_enabled,
                 "pool_healthy": self._pool_healthy,
+                "circuit_state": self.breaker.state,
                 "pool_size": len(self._pool_clients),
                 "legacy_available": self.legacy_client is not None,
                 "uptime_seconds": uptime
@@ -308,8 +328,10 @@ class Phase1LLMManager:
                 "pool_errors": self.metrics.pool_error_count,
                 "legacy_errors": self.metrics.legacy_error_count,
                 "error_rate": self.metrics.error_count / max(self.metrics.total_requests, 1),
-                "consecutive_pool_errors": self._consecutive_pool_errors
+                "consecutive_pool_errors": self._consecutive_pool_errors,
+                "circuit_rejected": self.metrics.circuit_rejected_count
             },
+            "circuit_breaker": self.breaker.get_metrics(),
             "configuration": {
                 "pool_size": self.pool_size,
                 "pool_timeout": self.pool_timeout,
@@ -335,6 +357,10 @@ class Phase1LLMManager:
         if self._consecutive_pool_errors >= self.fallback_threshold:
             issues.append(f"プールエラーが{self._consecutive_pool_errors}回連続")
         
+        circuit_state = self.breaker.state
+        if circuit_state != "closed":
+            issues.append(f"サーキットブレーカーが{circuit_state}（OpenAI障害の可能性）")
+        
         error_rate = self.metrics.error_count / max(self.metrics.total_requests, 1)
         if error_rate > 0.1:  # 10%以上
             issues.append(f"エラー率が高い: {error_rate:.1%}")
@@ -419,7 +445,12 @@ LLM_POOL_TIMEOUT=30.0         # プールタイムアウト秒（デフォルト
 
 # === フォールバック設定 ===
 LLM_AUTO_FALLBACK=true        # 自動フォールバック（デフォルト: true）
-LLM_FALLBACK_ERROR_THRESHOLD=3 # フォールバック閾値（デフォルト: 3）
+LLM_FALLBACK_ERROR_THRESHOLD=3 # 健全性チェックで警告する連続プールエラー数（デフォルト: 3）
+
+# === サーキットブレーカー（AsyncLearningPlannerと共有） ===
+LLM_CIRCUIT_FAILURE_THRESHOLD=5  # open にする連続失敗回数（デフォルト: 5）
+LLM_CIRCUIT_RESET_TIMEOUT=30     # half_open で試行するまでの秒数（デフォルト: 30）
+LLM_CIRCUIT_HALF_OPEN_MAX=1      # half_open で同時に通す試行数（デフォルト: 1）
 
 # === 監視・デバッグ ===
 LLM_POOL_DEBUG=false          # デバッグモード（デフォルト: false）
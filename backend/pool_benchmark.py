@@ -0,0 +1,178 @@
+"""
+LLMコネクションプールのオーバーヘッド比較ベンチマーク
+従来方式（queue.Queue + asyncio.to_thread、スロットごとに個別のOpenAIクライアント）と
+asyncioネイティブ方式（共有HTTPトランスポート）の取得レイテンシとメモリ使用量を比較します。
+
+OpenAI APIは呼び出さず、プールの構築とクライアントの取得・返却のみを計測します。
+
+実行例:
+    python pool_benchmark.py --pool-size 10 --requests 2000 --concurrency 50
+"""
+
+import os
+import gc
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+import tracemalloc
+from dataclasses import dataclass, asdict
+from queue import Queue
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List
+
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# クライアント生成にはAPIキーが必要（実際の呼び出しは行わない）
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark-dummy")
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+from module.llm_api import learning_plannner
+from module.async_llm_api import AsyncLearningPlanner
+from llm_pool_manager import LLMConnectionPool
+
+
+@dataclass
+class PoolBenchmarkResult:
+    """ベンチマーク結果"""
+    method: str
+    build_time_ms: float
+    build_memory_kb: float
+    http_clients: int
+    acquire_p50_us: float
+    acquire_p99_us: float
+    acquire_mean_us: float
+    throughput_per_sec: float
+
+
+class LegacyThreadQueuePool:
+    """
+    比較用: 変更前の LLMConnectionPool と同じ構成
+    スロットごとに learning_plannner / AsyncLearningPlanner（それぞれ個別のOpenAIクライアント）を作り、
+    queue.Queue から asyncio.to_thread で取り出す
+    """
+
+    def __init__(self, pool_size: int):
+        api_key = os.environ["OPENAI_API_KEY"]
+        self._semaphore = asyncio.Semaphore(pool_size)
+        self._async_pool: Queue = Queue(maxsize=pool_size)
+        self._sync_pool: Queue = Queue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self._sync_pool.put(learning_plannner(client=OpenAI(api_key=api_key)))
+            self._async_pool.put(AsyncLearningPlanner(
+                pool_size=1,
+                sync_client=OpenAI(api_key=api_key),
+                async_client=AsyncOpenAI(api_key=api_key, timeout=30.0, max_retries=2)
+            ))
+
+    @asynccontextmanager
+    async def get_async_client(self):
+        client = None
+        try:
+            async with self._semaphore:
+                client = await asyncio.wait_for(
+                    asyncio.to_thread(self._async_pool.get, block=True),
+                    timeout=30.0
+                )
+                yield client
+        finally:
+            if client is not None:
+                self._async_pool.put(client, block=False)
+
+
+def _count_http_clients() -> int:
+    """生存しているhttpxクライアント（＝接続プール）の数"""
+    gc.collect()
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, (httpx.Client, httpx.AsyncClient)))
+
+
+async def _build(factory: Callable[[], Any]):
+    """プール構築時間とメモリ増加量を計測"""
+    gc.collect()
+    baseline_clients = _count_http_clients()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+
+    pool = factory()
+    if isinstance(pool, LLMConnectionPool):
+        await pool.initialize()
+
+    build_time = time.perf_counter() - start
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return pool, build_time, (after - before) / 1024, _count_http_clients() - baseline_clients
+
+
+async def _measure_acquire(pool, requests: int, concurrency: int) -> Dict[str, float]:
+    """クライアントの取得・返却レイテンシを並列度concurrencyで計測"""
+    latencies: List[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            async with pool.get_async_client():
+                latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(requests)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "p50": latencies[len(latencies) // 2] * 1e6,
+        "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6,
+        "mean": statistics.mean(latencies) * 1e6,
+        "throughput": requests / elapsed,
+    }
+
+
+async def run_pool_benchmark(pool_size: int = 10, requests: int = 2000, concurrency: int = 50) -> List[PoolBenchmarkResult]:
+    """従来方式と新方式を同条件で計測"""
+    results = []
+    for method, factory in (
+        ("legacy_thread_queue", lambda: LegacyThreadQueuePool(pool_size)),
+        ("asyncio_shared_transport", lambda: LLMConnectionPool(pool_size=pool_size, max_queue_size=requests)),
+    ):
+        pool, build_time, build_memory, http_clients = await _build(factory)
+        stats = await _measure_acquire(pool, requests, concurrency)
+        if isinstance(pool, LLMConnectionPool):
+            await pool.shutdown()
+
+        results.append(PoolBenchmarkResult(
+            method=method,
+            build_time_ms=build_time * 1000,
+            build_memory_kb=build_memory,
+            http_clients=http_clients,
+            acquire_p50_us=stats["p50"],
+            acquire_p99_us=stats["p99"],
+            acquire_mean_us=stats["mean"],
+            throughput_per_sec=stats["throughput"],
+        ))
+        del pool
+    return results
+
+
+def _print_results(results: List[PoolBenchmarkResult]) -> None:
+    print(f"{'method':<26}{'build ms':>10}{'build KB':>10}{'httpx':>7}{'p50 us':>10}{'p99 us':>10}{'mean us':>10}{'acq/s':>10}")
+    for r in results:
+        print(
+            f"{r.method:<26}{r.build_time_ms:>10.1f}{r.build_memory_kb:>10.0f}{r.http_clients:>7}"
+            f"{r.acquire_p50_us:>10.1f}{r.acquire_p99_us:>10.1f}{r.acquire_mean_us:>10.1f}{r.throughput_per_sec:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LLMコネクションプールのオーバーヘッド比較")
+    parser.add_argument("--pool-size", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    _print_results(asyncio.run(run_pool_benchmark(args.pool_size, args.requests, args.concurrency)))
@@ -0,0 +1,249 @@
+"""
+ステートレスな生成系エンドポイント向けのレスポンスキャッシュ
+リクエスト内容だけで結果が決まるエンドポイント（関連語・クラスタリング・問い生成など）の
+LLM応答を、TTLとメモリ上限付きのLRUで保持します。
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# エントリ1件あたりの管理オーバーヘッド概算（バイト）
+_ENTRY_OVERHEAD_BYTES = 200
+
+
+@dataclass
+class EndpointCacheStats:
+    """エンドポイント別のキャッシュ統計"""
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+
+@dataclass
+class _CacheEntry:
+    endpoint: str
+    payload: bytes
+    size: int
+    expires_at: float
+
+
+def normalize_text(text: Optional[str]) -> str:
+    """
+    キャッシュキー用にテキストを正規化
+    NFKC正規化（全角英数・半角カナの統一）、前後空白除去、連続空白の圧縮、大文字小文字の同一視
+    """
+    if not text:
+        return ""
+    normalized = unicodedata.normalize("NFKC", str(text))
+    return " ".join(normalized.split()).casefold()
+
+
+def normalize_keywords(keywords: Optional[Iterable[str]]) -> list:
+    """キーワードリストを正規化し、順序に依存しないようソートする（重複は除外）"""
+    if not keywords:
+        return []
+    return sorted({normalize_text(k) for k in keywords if normalize_text(k)})
+
+
+def _normalize_value(value: Any) -> Any:
+    """dict/list内の文字列を再帰的に正規化"""
+    if isinstance(value, str):
+        return normalize_text(value)
+    if isinstance(value, dict):
+        return {str(k): _normalize_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize_value(v) for v in value]
+    return value
+
+
+def make_cache_key(endpoint: str, content: Dict[str, Any]) -> str:
+    """エンドポイント名と正規化済みリクエスト内容からキャッシュキーを生成"""
+    canonical = json.dumps(
+        {"endpoint": endpoint, "content": _normalize_value(content)},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    TTL付きLRUレスポンスキャッシュ
+
+    値はJSONにシリアライズしたバイト列で保持し、そのサイズで合計メモリを管理する。
+    取り出し時は毎回デシリアライズするため、呼び出し側が結果を変更しても
+    キャッシュ内容には影響しない。
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        default_ttl: Optional[float] = None,
+        disabled_endpoints: Optional[Iterable[str]] = None,
+        enabled: Optional[bool] = None
+    ):
+        if enabled is None:
+            enabled = os.environ.get("ENABLE_RESPONSE_CACHE", "true").lower() == "true"
+        if disabled_endpoints is None:
+            disabled_endpoints = [
+                e.strip() for e in os.environ.get("RESPONSE_CACHE_DISABLED_ENDPOINTS", "").split(",")
+                if e.strip()
+            ]
+
+        self.enabled = enabled
+        self.max_entries = max_entries or int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+        self.max_bytes = max_bytes or int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+        self.default_ttl = default_ttl or float(os.environ.get("RESPONSE_CACHE_TTL_SEC", "21600"))
+        self.disabled_endpoints = set(disabled_endpoints)
+
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._stats: Dict[str, EndpointCacheStats] = {}
+
+        logger.info(
+            f"🗄️ ResponseCache初期化: enabled={self.enabled}, max_entries={self.max_entries}, "
+            f"max_bytes={self.max_bytes}, ttl={self.default_ttl}s, disabled={sorted(self.disabled_endpoints)}"
+        )
+
+    def is_enabled(self, endpoint: str) -> bool:
+        """エンドポイントでキャッシュが有効か"""
+        return self.enabled and endpoint not in self.disabled_endpoints
+
+    def get(self, endpoint: str, key: str) -> Optional[Any]:
+        """キャッシュ済みの値を取得（未登録・期限切れ・無効化時はNone）"""
+        if not self.is_enabled(endpoint):
+            return None
+
+        with self._lock:
+            stats = self._stats_for(endpoint)
+            entry = self._entries.get(key)
+            if entry is None:
+                stats.misses += 1
+                return None
+
+            if entry.expires_at <= time.monotonic():
+                self._remove(key)
+                stats.expirations += 1
+                stats.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            stats.hits += 1
+            payload = entry.payload
+
+        return json.loads(payload)
+
+    def set(self, endpoint: str, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """
+        値をキャッシュに登録
+
+        成功したLLM応答のみを登録すること（フォールバック応答は登録しない）
+
+        Returns:
+            登録できたか（無効化時や単体で上限を超える値はFalse）
+        """
+        if not self.is_enabled(endpoint):
+            return False
+
+        payload = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        size = len(payload) + len(key) + _ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = _CacheEntry(
+                endpoint=endpoint,
+                payload=payload,
+                size=size,
+                expires_at=time.monotonic() + (ttl if ttl is not None else self.default_ttl)
+            )
+            self._total_bytes += size
+            self._stats_for(endpoint).stores += 1
+            self._evict_if_needed()
+
+        return True
+
+    def clear(self) -> None:
+        """全エントリを削除（統計は保持）"""
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._total_bytes -= entry.size
+
+    def _evict_if_needed(self) -> None:
+        """上限を超えている間、最も古く使われたエントリから追い出す"""
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes
+        ):
+            key, entry = next(iter(self._entries.items()))
+            self._remove(key)
+            self._stats_for(entry.endpoint).evictions += 1
+
+    def _stats_for(self, endpoint: str) -> EndpointCacheStats:
+        stats = self._stats.get(endpoint)
+        if stats is None:
+            stats = self._stats[endpoint] = EndpointCacheStats()
+        return stats
+
+    def get_stats(self) -> Dict[str, Any]:
+        """キャッシュ統計を取得"""
+        with self._lock:
+            endpoints = {}
+            total_hits = total_misses = 0
+            for name, s in self._stats.items():
+                lookups = s.hits + s.misses
+                endpoints[name] = {
+                    "hits": s.hits,
+                    "misses": s.misses,
+                    "stores": s.stores,
+                    "evictions": s.evictions,
+                    "expirations": s.expirations,
+                    "hit_rate": s.hits / lookups if lookups > 0 else 0,
+                    "enabled": self.is_enabled(name),
+                }
+                total_hits += s.hits
+                total_misses += s.misses
+
+            total_lookups = total_hits + total_misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hit_rate": total_hits / total_lookups if total_lookups > 0 else 0,
+                "endpoints": endpoints,
+            }
+
+
+# シングルトンインスタンスを管理
+_response_cache_instance: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> ResponseCache:
+    """プロセス共通のレスポンスキャッシュを取得"""
+    global _response_cache_instance
+
+    if _response_cache_instance is None:
+        _response_cache_instance = ResponseCache()
+
+    return _response_cache_instance
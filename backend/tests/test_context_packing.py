@@ -0,0 +1,390 @@
+"""
+コンテキスト構築のテスト
+ContextManager のパッキング（メッセージごとのトークン数のキャッシュ・予算内での直近会話の選択・使われない枠の再配分）と、
+会話ごとのコンテキスト戦略の割り当て・計測、累積要約の更新と保存、ベクトルインデックスからの関連発話の検索を確認
+"""
+
+import unittest
+import asyncio
+import sys
+import os
+import json
+from unittest.mock import patch
+
+import numpy as np
+
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from context_manager import ContextManager
+from context_strategy import ContextStrategySelector
+from types import SimpleNamespace
+
+from module.llm_context import get_llm_context, llm_context
+from module.llm_usage import collect_usage, record_llm_usage
+from vector_index import VectorIndex
+
+
+class _CountingCounter:
+    """1文字1トークンとして数え、呼び出された回数を記録するカウンター"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, text):
+        self.calls += 1
+        return len(text)
+
+
+def _history(count, length=40):
+    return [
+        {"id": i, "sender": "user" if i % 2 == 0 else "assistant", "message": f"{i:03d}" + "あ" * (length - 3)}
+        for i in range(count)
+    ]
+
+
+class TestContextPacking(unittest.TestCase):
+
+    def _manager(self, budget=1000, n_recent=50):
+        manager = ContextManager(token_counter=_CountingCounter())
+        manager.token_budget = budget
+        manager.n_recent = n_recent
+        return manager
+
+    def _build(self, manager, history, user_message="質問です"):
+        return asyncio.run(manager.build_context(
+            user_message=user_message,
+            conversation_id="test-conversation",
+            system_prompt="あなたは学習支援の専門家です。",
+            conversation_history=history
+        ))
+
+    def test_recent_is_longest_suffix_within_budget(self):
+        """直近会話は予算に収まる範囲で新しい方から連続して選ばれる"""
+        manager = self._manager()
+        history = _history(40)
+        section = manager._build_recent_context(history, 200, 40)
+
+        # 1メッセージ = "user: " などの接頭辞 + 40文字 + 区切り1
+        kept = section.content.split("\n")
+        self.assertTrue(kept[-1].endswith(history[-1]["message"]))
+        self.assertLessEqual(section.tokens, 200)
+        next_cost = manager._message_tokens(history[-len(kept) - 1])
+        self.assertGreater(section.tokens + next_cost, 200)
+
+    def test_message_tokens_are_cached_by_id(self):
+        """2回目の構築ではメッセージのトークン数を数え直さない"""
+        manager = self._manager()
+        history = _history(30)
+        self._build(manager, history)
+        counter = manager.token_counter
+        calls_after_first = counter.calls
+
+        _, metrics = self._build(manager, history + _history(31)[30:])
+        self.assertEqual(metrics.token_cache_hits, 30)
+        # 新しい1件とシステムプロンプト・ユーザーメッセージ・要約だけを数える
+        self.assertLessEqual(counter.calls - calls_after_first, 6)
+
+    def test_unused_section_budget_is_reallocated(self):
+        """要約・検索結果がない場合、その枠は直近会話に回る"""
+        manager = self._manager(budget=1000)
+        history = [{"id": i, "sender": "user", "message": "あ" * 60} for i in range(40)]
+        messages, metrics = self._build(manager, history)
+
+        available = 1000 - len("質問です") - manager.reserve_tokens
+        self.assertEqual(metrics.summary_tokens, 0)
+        self.assertGreater(metrics.allocation["RECENT"], int(available * manager.recent_ratio))
+        self.assertGreater(metrics.reallocated_tokens, 0)
+        self.assertLessEqual(sum(metrics.allocation.values()), available)
+        self.assertLessEqual(metrics.total_tokens, available)
+        self.assertEqual(messages[-1], {"role": "user", "content": "質問です"})
+
+    def test_concurrent_builds_keep_their_own_metrics(self):
+        """埋め込みの生成で中断する間に別の会話を構築しても、それぞれの呼び出しのメトリクスを返す"""
+        class _SlowEmbeddings:
+            async def generate_embedding(self, text):
+                await asyncio.sleep(0.01)
+                return np.ones(4)
+
+            async def generate_batch_embeddings(self, texts):
+                return [np.ones(4) for _ in texts]
+
+        manager = ContextManager(
+            embedding_client=_SlowEmbeddings(), token_counter=_CountingCounter(), vector_index=VectorIndex(root_dir="")
+        )
+        manager.token_budget = 3000
+        manager.n_recent = 50
+
+        async def scenario():
+            return await asyncio.gather(
+                manager.build_context("質問です", "conv-a", "システム", _history(12)),
+                manager.build_context("質問です", "conv-b", "システム", _history(3)),
+            )
+
+        (_, metrics_a), (_, metrics_b) = asyncio.run(scenario())
+
+        self.assertIsNot(metrics_a, metrics_b)
+        self.assertEqual(metrics_a.recent_messages, 12)
+        self.assertEqual(metrics_b.recent_messages, 3)
+        self.assertGreater(metrics_a.recent_tokens, metrics_b.recent_tokens)
+
+
+class _CharEncoding:
+    """1文字1トークンのエンコーディング（tiktoken のエンコーディングファイルを取得しないため）"""
+
+    def encode(self, text):
+        return list(text)
+
+
+class TestContextStrategy(unittest.TestCase):
+
+    def setUp(self):
+        encoding = patch("memory_manager.tiktoken.encoding_for_model", return_value=_CharEncoding())
+        encoding.start()
+        self.addCleanup(encoding.stop)
+
+    def test_assignment_is_sticky_and_weighted(self):
+        """同じ会話には常に同じ方式が割り当てられ、重みに沿って振り分けられる"""
+        selector = ContextStrategySelector(weights={"raw": 1, "budgeted": 1, "memory": 2})
+        assigned = [selector.assign(f"conv-{i}") for i in range(400)]
+        self.assertEqual(assigned, [selector.assign(f"conv-{i}") for i in range(400)])
+        self.assertGreater(assigned.count("memory"), assigned.count("raw"))
+        self.assertEqual(set(assigned), {"raw", "budgeted", "memory"})
+
+    def test_budgeted_strategies_shrink_prompt_and_are_recorded(self):
+        """budgeted / memory は予算内に収め、方式ごとにトークン数と構築時間を記録する"""
+        selector = ContextStrategySelector(weights={"raw": 1}, token_budget=800)
+        history = _history(60)
+
+        contexts = {
+            strategy: asyncio.run(selector.build("conv-1", "あなたは学習支援の専門家です。", history, "質問です", strategy))
+            for strategy in ("raw", "budgeted", "memory")
+        }
+
+        self.assertEqual(len(contexts["raw"].history), 60)
+        for strategy in ("budgeted", "memory"):
+            context = contexts[strategy]
+            self.assertEqual(context.strategy, strategy)
+            self.assertLess(context.prompt_tokens, contexts["raw"].prompt_tokens)
+            self.assertLess(len(context.history), 60)
+            self.assertTrue(all("_metadata" not in message for message in context.messages))
+        # budgeted は直近の発話から選ぶ
+        self.assertEqual(contexts["budgeted"].history[-1], history[-1])
+
+        metrics = selector.get_metrics()["strategies"]
+        self.assertEqual(set(metrics), {"raw", "budgeted", "memory"})
+        self.assertEqual(metrics["memory"]["turns"], 1)
+
+    def test_concurrent_budgeted_builds_select_their_own_history(self):
+        """budgeted を同時に構築しても、それぞれの会話で直近会話に含めた発話を返す"""
+        class _SlowEmbeddings:
+            async def generate_embedding(self, text):
+                await asyncio.sleep(0.01)
+                return np.ones(4)
+
+            async def generate_batch_embeddings(self, texts):
+                return [np.ones(4) for _ in texts]
+
+        manager = ContextManager(
+            embedding_client=_SlowEmbeddings(), token_counter=_CountingCounter(), vector_index=VectorIndex(root_dir="")
+        )
+        manager.token_budget = 3000
+        manager.n_recent = 50
+        selector = ContextStrategySelector(weights={"budgeted": 1}, context_manager=manager)
+        long_history, short_history = _history(12), _history(3)
+
+        async def scenario():
+            return await asyncio.gather(
+                selector.build("conv-a", "システム", long_history, "質問です", "budgeted"),
+                selector.build("conv-b", "システム", short_history, "質問です", "budgeted"),
+            )
+
+        long_context, short_context = asyncio.run(scenario())
+
+        self.assertEqual(long_context.history, long_history)
+        self.assertEqual(short_context.history, short_history)
+
+
+class _SummaryLLM:
+    """累積要約の呼び出しを記録する非同期LLMクライアント"""
+
+    def __init__(self):
+        self.calls = []
+        self.contexts = []
+
+    async def generate_response_async(self, messages):
+        self.calls.append((get_llm_context().step, messages[-1]["content"]))
+        self.contexts.append(get_llm_context())
+        record_llm_usage("gpt-4.1-mini", SimpleNamespace(prompt_tokens=100, completion_tokens=20))
+        return f"- 要約{len(self.calls)}"
+
+
+class _FakeQuery:
+    def __init__(self, table, update=None):
+        self.table = table
+        self.update_values = update
+
+    def select(self, columns):
+        return self
+
+    def eq(self, column, value):
+        return self
+
+    def execute(self):
+        if self.update_values is not None:
+            self.table.row.update(self.update_values)
+        return type("Result", (), {"data": [dict(self.table.row)]})()
+
+
+class _FakeConversations:
+    """chat_conversations の1行だけを持つ Supabase クライアント"""
+
+    def __init__(self, metadata):
+        self.row = {"metadata": metadata}
+
+    def table(self, name):
+        return self
+
+    def select(self, columns):
+        return _FakeQuery(self).select(columns)
+
+    def update(self, values):
+        return _FakeQuery(self, values)
+
+
+class TestRollingSummary(unittest.TestCase):
+
+    def _manager(self, supabase=None, llm=None):
+        manager = ContextManager(supabase_client=supabase, token_counter=_CountingCounter(), llm_client=llm)
+        manager.token_budget = 2000
+        manager.n_recent = 8
+        manager.summary_rotate_every = 10
+        manager.summary_pressure_tokens = 100000
+        return manager
+
+    def test_old_messages_are_folded_off_the_request_path_and_persisted(self):
+        """しきい値を超えた古い発話を別タスクで要約に取り込み、他のメタデータを残して保存し、次のターンから使う"""
+        llm = _SummaryLLM()
+        supabase = _FakeConversations(json.dumps({"title_source": "auto"}))
+        manager = self._manager(supabase, llm)
+
+        async def scenario():
+            history = _history(30)
+            await manager.build_context("質問です", "conv-1", "システム", history)
+            task = manager._summary_tasks["conv-1"]
+            self.assertEqual(llm.calls, [])  # 構築は要約を待たない
+            await task
+
+            messages, metrics = await manager.build_context("質問です", "conv-1", "システム", history)
+            return messages, metrics
+
+        messages, metrics = asyncio.run(scenario())
+
+        self.assertEqual(len(llm.calls), 1)
+        step, prompt = llm.calls[0]
+        self.assertEqual(step, "rolling_summary")
+        self.assertIn("000", prompt)
+        self.assertNotIn("022", prompt)  # 直近会話（最後の8件）は取り込まない
+        self.assertIn("これまでの会話の要約\n- 要約1", messages[0]["content"])
+        self.assertEqual(metrics.summary_updates, 1)
+
+        stored = json.loads(supabase.row["metadata"])
+        self.assertEqual(stored["title_source"], "auto")
+        self.assertEqual(stored["rolling_summary"]["summarized_until"], 21)
+        self.assertEqual(stored["rolling_summary"]["summarized_messages"], 22)
+
+    def test_background_summary_does_not_inherit_request_context(self):
+        """別タスクの要約はリクエストの使用量に合算されず、ユーザーのキーではなく background として実行される"""
+        llm = _SummaryLLM()
+        manager = self._manager(llm=llm)
+
+        async def scenario():
+            with collect_usage() as usage, llm_context(user_key="user:1", endpoint="chat", step="reply"):
+                _, metrics = await manager.build_context("質問です", "conv-3", "システム", _history(30))
+                await manager._summary_tasks["conv-3"]
+            return usage, metrics
+
+        usage, _ = asyncio.run(scenario())
+
+        self.assertEqual(len(llm.calls), 1)
+        context = llm.contexts[0]
+        self.assertEqual(context.endpoint, "background")
+        self.assertEqual(context.step, "rolling_summary")
+        self.assertIsNone(context.user_key)
+        self.assertIsNone(usage.to_dict())
+
+    def test_summary_is_loaded_and_only_new_messages_are_folded(self):
+        """保存済みの要約を読み込み、要約済みの位置より後の発話だけを取り込む"""
+        llm = _SummaryLLM()
+        supabase = _FakeConversations({"rolling_summary": {"text": "- 以前の要約", "summarized_until": 21, "summarized_messages": 22}})
+        manager = self._manager(supabase, llm)
+        history = _history(40)
+
+        updated = asyncio.run(manager.rotate_summary_if_needed("conv-2", 40, conversation_history=history))
+
+        self.assertTrue(updated)
+        prompt = llm.calls[0][1]
+        self.assertIn("- 以前の要約", prompt)
+        self.assertNotIn("021", prompt)
+        self.assertIn("022", prompt)
+        self.assertIn("031", prompt)
+        self.assertNotIn("032", prompt)
+        self.assertEqual(supabase.row["metadata"]["rolling_summary"]["summarized_until"], 31)
+        self.assertEqual(supabase.row["metadata"]["rolling_summary"]["summarized_messages"], 32)
+
+
+class _TopicEmbeddings:
+    """話題ごとの基底ベクトルを返す埋め込みクライアント（本文に含まれる話題の和）"""
+
+    TOPICS = ("部活", "天気", "数学", "音楽")
+
+    def __init__(self):
+        self.texts = []
+
+    async def generate_embedding(self, text):
+        self.texts.append(text)
+        return np.array([float(topic in text) for topic in self.TOPICS])
+
+    async def generate_batch_embeddings(self, texts):
+        return [await self.generate_embedding(text) for text in texts]
+
+
+class TestRetrievedContext(unittest.TestCase):
+
+    def test_related_old_messages_are_retrieved_from_the_index(self):
+        """インデックスにない履歴は別タスクで追加し、次のターンから直近会話以外の類似発話を RETRIEVED に入れる"""
+        embeddings = _TopicEmbeddings()
+        manager = ContextManager(
+            embedding_client=embeddings, token_counter=_CountingCounter(), vector_index=VectorIndex(root_dir="")
+        )
+        manager.token_budget = 3000
+        manager.n_recent = 4
+        manager.k_retrieve = 2
+        manager.retrieved_ratio = 0.3
+        history = [
+            {"id": 1, "sender": "user", "message": "部活のデータを集めたい"},
+            {"id": 2, "sender": "assistant", "message": "天気の話です"},
+            {"id": 3, "sender": "user", "message": "数学の宿題"},
+            {"id": 4, "sender": "user", "message": "音楽が好き"},
+            {"id": 5, "sender": "user", "message": "部活の記録をつけた"},
+            {"id": 6, "sender": "assistant", "message": "天気"},
+            {"id": 7, "sender": "user", "message": "数学"},
+        ]
+
+        async def scenario():
+            _, first = await manager.build_context("部活について", "conv-1", "システム", history)
+            self.assertEqual(first.retrieval_hits, 0)
+            await manager._index_tasks["conv-1"]
+            return await manager.build_context("部活について", "conv-1", "システム", history)
+
+        messages, metrics = asyncio.run(scenario())
+
+        self.assertEqual(metrics.retrieval_hits, 1)
+        self.assertIn("## 関連する過去の会話\n- user: 部活のデータを集めたい", messages[0]["content"])
+        self.assertNotIn("- user: 部活の記録をつけた", messages[0]["content"])  # 直近会話に含まれる
+        self.assertEqual(embeddings.texts.count("部活のデータを集めたい"), 1)  # 埋め込みは1回だけ
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+会話履歴の正規化のテスト
+フォローアップ候補・[要約]・[理由タグ]の除去と、1メッセージあたりの長さの上限を確認
+"""
+
+import unittest
+import sys
+import os
+
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from history_normalizer import HistoryNormalizer
+
+
+STRUCTURED_REPLY = """[要約] 部活の経験から問いを探している
+[回答] 練習メニューの記録を見返すのがよさそうです。
+[問い] どの練習がいちばん楽しかったですか？
+[次の一歩] 先週の練習メモを1つ選ぶ
+[理由タグ] 未確定:きっかけ / 歩幅:小"""
+
+FOLLOWUP_REPLY = "記録を見返してみましょう。\n\n**次にできること:**\n• 練習メモを読む\n• 気づきを1つ書く"
+
+
+class TestHistoryNormalizer(unittest.TestCase):
+
+    def test_strips_derived_content_from_assistant_messages(self):
+        """アシスタントの応答からフォローアップ候補と [要約]・[理由タグ] を取り除き、元の行は変更しない"""
+        normalizer = HistoryNormalizer(enabled=True, max_message_tokens=0)
+        history = [
+            {"id": 1, "sender": "user", "message": "[要約] はユーザーの入力なので残す"},
+            {"id": 2, "sender": "assistant", "message": STRUCTURED_REPLY},
+            {"id": 3, "sender": "assistant", "message": FOLLOWUP_REPLY},
+        ]
+
+        normalized = normalizer.normalize(history)
+
+        self.assertEqual(normalized[0]["message"], history[0]["message"])
+        self.assertEqual(
+            normalized[1]["message"],
+            "[回答] 練習メニューの記録を見返すのがよさそうです。\n"
+            "[問い] どの練習がいちばん楽しかったですか？\n"
+            "[次の一歩] 先週の練習メモを1つ選ぶ"
+        )
+        self.assertEqual(normalized[2]["message"], "記録を見返してみましょう。")
+        self.assertEqual([msg["id"] for msg in normalized], [1, 2, 3])
+        self.assertEqual(history[2]["message"], FOLLOWUP_REPLY)
+
+        metrics = normalizer.get_metrics()
+        self.assertEqual(metrics["changed"], 2)
+        self.assertGreater(metrics["reduction_ratio"], 0)
+
+    def test_caps_long_messages(self):
+        """上限を超えるメッセージは先頭から収まる分だけ残す"""
+        normalizer = HistoryNormalizer(enabled=True, max_message_tokens=50)
+        history = [
+            {"sender": "user", "message": "あ" * 200},
+            {"sender": "assistant", "message": "い" * 30},
+        ]
+
+        normalized = normalizer.normalize(history)
+
+        self.assertEqual(len(normalized[0]["message"]), 50)
+        self.assertTrue(normalized[0]["message"].endswith("…"))
+        self.assertIs(normalized[1], history[1])
+        self.assertEqual(normalizer.get_metrics()["truncated"], 1)
+
+    def test_disabled_returns_history_unchanged(self):
+        normalizer = HistoryNormalizer(enabled=False)
+        history = [{"sender": "assistant", "message": FOLLOWUP_REPLY}]
+        self.assertIs(normalizer.normalize(history), history)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,755 @@
+"""
+LLM呼び出し共通層のテスト
+リクエスト合流・レートペーサー・公平スケジューラ・ヘッジ・サーキットブレーカー・使用量集計などのモジュール単体の振る舞いを確認
+"""
+
+import unittest
+import asyncio
+import time
+import threading
+from types import SimpleNamespace
+import sys
+import os
+
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from module.llm_coalescer import LLMRequestCoalescer, make_request_key
+from module.rate_pacer import RatePacer, estimate_prompt_tokens
+from module.fair_scheduler import FairScheduler
+from module.llm_context import llm_context, get_llm_context
+from module.circuit_breaker import CircuitBreaker, CircuitOpenError
+from module.llm_usage import LLMUsageRecorder, collect_usage, estimate_cost, extract_usage
+from module.model_router import ModelRouter
+from module.token_budget import TokenBudgetPolicy
+from load_balancer import LLMLoadBalancer, PoolNode, HedgingPolicy
+
+
+class TestLLMRequestCoalescer(unittest.TestCase):
+    """シングルフライト合流のテスト"""
+
+    def test_request_key_is_canonical(self):
+        """辞書のキー順序が違っても同じキーになる"""
+        a = make_request_key("gpt", [{"role": "user", "content": "植物"}], 0.7, 100)
+        b = make_request_key("gpt", [{"content": "植物", "role": "user"}], 0.7, 100)
+        c = make_request_key("gpt", [{"role": "user", "content": "植物"}], 0.8, 100)
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+
+    def test_concurrent_identical_calls_share_upstream(self):
+        """同時の同一リクエストは上流呼び出し1回にまとまる"""
+        coalescer = LLMRequestCoalescer(enabled=True)
+        calls = []
+
+        async def upstream():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "応答"
+
+        async def run():
+            return await asyncio.gather(*[coalescer.run("k", upstream) for _ in range(4)])
+
+        results = asyncio.run(run())
+        self.assertEqual(results, ["応答"] * 4)
+        self.assertEqual(len(calls), 1)
+        metrics = coalescer.get_metrics()
+        self.assertEqual(metrics["coalesced_requests"], 3)
+        self.assertAlmostEqual(metrics["hit_rate"], 0.75)
+        self.assertEqual(metrics["in_flight"], 0)
+
+    def test_error_is_shared_and_not_cached(self):
+        """上流エラーは相乗り全員に伝わり、次の呼び出しは再実行される"""
+        coalescer = LLMRequestCoalescer(enabled=True)
+
+        async def failing():
+            await asyncio.sleep(0)
+            raise RuntimeError("upstream")
+
+        async def run():
+            return await asyncio.gather(
+                coalescer.run("k", failing), coalescer.run("k", failing),
+                return_exceptions=True
+            )
+
+        results = asyncio.run(run())
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in results))
+        self.assertEqual(coalescer.get_metrics()["upstream_calls"], 1)
+
+        asyncio.run(run())
+        self.assertEqual(coalescer.get_metrics()["upstream_calls"], 2)
+
+    def test_leader_cancellation_does_not_affect_followers(self):
+        """最初の呼び出し元がキャンセルされても相乗りした呼び出しは結果を受け取る"""
+        coalescer = LLMRequestCoalescer(enabled=True)
+
+        async def upstream():
+            await asyncio.sleep(0.02)
+            return "ok"
+
+        async def run():
+            leader = asyncio.ensure_future(coalescer.run("k", upstream))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(coalescer.run("k", upstream))
+            await asyncio.sleep(0.005)
+            leader.cancel()
+            return await follower
+
+        self.assertEqual(asyncio.run(run()), "ok")
+
+    def test_caller_after_cancellation_starts_new_upstream(self):
+        """待機者が全員キャンセルした直後に同じキーで来た呼び出しは、打ち切り中のタスクに相乗りしない"""
+        coalescer = LLMRequestCoalescer(enabled=True)
+        calls = []
+
+        async def upstream():
+            calls.append(1)
+            await asyncio.sleep(0.02)
+            return "ok"
+
+        async def run():
+            first = asyncio.ensure_future(coalescer.run("k", upstream))
+            await asyncio.sleep(0.005)
+            first.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            # 打ち切ったタスクの完了コールバックより前に来た呼び出し
+            return await coalescer.run("k", upstream)
+
+        self.assertEqual(asyncio.run(run()), "ok")
+        self.assertEqual(len(calls), 2)
+
+
+class TestRatePacer(unittest.TestCase):
+    """RPM/TPMペーサーのテスト"""
+
+    def test_prompt_token_estimate(self):
+        """日本語は1文字≒1トークン、英語は4文字≒1トークンで見積もる"""
+        ja = estimate_prompt_tokens([{"role": "user", "content": "あ" * 100}])
+        en = estimate_prompt_tokens([{"role": "user", "content": "a" * 100}])
+        self.assertGreaterEqual(ja, 100)
+        self.assertLess(en, ja)
+
+    def test_requests_within_limit_are_not_delayed(self):
+        pacer = RatePacer(rpm_limit=60, tpm_limit=100_000, enabled=True)
+        for _ in range(5):
+            self.assertEqual(pacer.reserve(100).wait_time, 0.0)
+
+    def test_tpm_exhaustion_queues_locally(self):
+        """TPMを使い切ると、補充されるまでの待ち時間が返る"""
+        pacer = RatePacer(rpm_limit=1000, tpm_limit=6000, enabled=True)
+        self.assertEqual(pacer.reserve(6000).wait_time, 0.0)
+        wait = pacer.reserve(600).wait_time
+        # 6000TPM = 100トークン/秒なので600トークンは約6秒待ち
+        self.assertAlmostEqual(wait, 6.0, delta=0.1)
+        self.assertEqual(pacer.get_metrics()["delayed_requests"], 1)
+
+    def test_settle_refunds_overestimate(self):
+        pacer = RatePacer(rpm_limit=1000, tpm_limit=6000, enabled=True)
+        reservation = pacer.reserve(6000)
+        pacer.settle(reservation, 1000)
+        self.assertEqual(pacer.reserve(1000).wait_time, 0.0)
+
+    def test_rate_limit_error_sets_cooldown(self):
+        pacer = RatePacer(rpm_limit=1000, tpm_limit=100_000, enabled=True)
+
+        class FakeRateLimitError(Exception):
+            status_code = 429
+            response = None
+
+        with self.assertRaises(FakeRateLimitError):
+            with pacer.paced_sync([{"role": "user", "content": "hi"}], 10):
+                raise FakeRateLimitError()
+
+        self.assertEqual(pacer.get_metrics()["rate_limited_responses"], 1)
+        self.assertGreater(pacer.reserve(1).wait_time, 0.0)
+
+    def test_rate_limited_call_is_retried_once_after_cooldown(self):
+        """429はクールダウンを待ってから枠を取り直して1回だけ再試行し、2回目の429はそのまま送出する"""
+        pacer = RatePacer(rpm_limit=1000, tpm_limit=100_000, enabled=True)
+
+        class FakeRateLimitError(Exception):
+            status_code = 429
+            response = SimpleNamespace(headers={"retry-after": "0.05"})
+
+        attempts = []
+
+        async def flaky(slot):
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise FakeRateLimitError()
+            return "ok"
+
+        async def always_limited(slot):
+            attempts.append(time.monotonic())
+            raise FakeRateLimitError()
+
+        async def run():
+            self.assertEqual(await pacer.run_paced([], 10, flaky), "ok")
+            self.assertGreaterEqual(attempts[1] - attempts[0], 0.04)
+            attempts.clear()
+            with self.assertRaises(FakeRateLimitError):
+                await pacer.run_paced([], 10, always_limited)
+            self.assertEqual(len(attempts), 2)
+
+        asyncio.run(run())
+        metrics = pacer.get_metrics()
+        self.assertEqual(metrics["rate_limited_responses"], 3)
+        self.assertEqual(metrics["rate_limit_retries"], 2)
+
+    def test_shared_clients_do_not_retry_inside_sdk(self):
+        """ペーサーを通すクライアントはSDK内部でリトライしない"""
+        from unittest import mock
+        from module import http_clients
+
+        with mock.patch.dict(os.environ, {"OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "test")}):
+            self.addCleanup(asyncio.run, http_clients.close_shared_clients())
+            self.assertEqual(http_clients.get_shared_openai_client().max_retries, 0)
+            self.assertEqual(http_clients.get_shared_async_openai_client().max_retries, 0)
+
+    def test_cancelled_wait_returns_reservation(self):
+        """待機中にキャンセルされた呼び出しの枠は返却される"""
+        pacer = RatePacer(rpm_limit=1000, tpm_limit=6000, enabled=True)
+        pacer.reserve(6000)
+
+        async def run():
+            async def call():
+                async with pacer.paced([], max_tokens=600):
+                    pass
+            task = asyncio.ensure_future(call())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        self.assertEqual(pacer.get_metrics()["cancelled_reservations"], 1)
+
+
+class TestFairScheduler(unittest.TestCase):
+    """ユーザー単位の公平スケジューラのテスト"""
+
+    def _run_burst(self, scheduler, requests):
+        """(user, endpoint) のリストを同時に投入し、実行が始まった順序を返す"""
+        order = []
+
+        async def job(user, endpoint):
+            async with scheduler.slot(user, endpoint):
+                order.append(user)
+                await asyncio.sleep(0.005)
+
+        async def run():
+            # 最初に枠を埋めておき、以降のリクエストを全てキューに並ばせる
+            blocker = asyncio.ensure_future(job("blocker", "other"))
+            await asyncio.sleep(0)
+            await asyncio.gather(blocker, *[job(u, e) for u, e in requests])
+
+        asyncio.run(run())
+        return order[1:]
+
+    def test_heavy_user_does_not_starve_others(self):
+        """大量に投入したユーザーがいても、他ユーザーのリクエストが先頭付近で処理される"""
+        scheduler = FairScheduler(capacity=1, per_user_max=1, class_weights={})
+        requests = [("heavy", "inquiry")] * 6 + [("light", "chat")]
+        order = self._run_burst(scheduler, requests)
+        self.assertLessEqual(order.index("light"), 1)
+
+    def test_weights_favor_chat(self):
+        """重みが大きい分類のリクエストは、同時に並んだ他分類より先に処理される"""
+        scheduler = FairScheduler(capacity=1, per_user_max=1, class_weights={"chat": 2, "inquiry": 1})
+        order = self._run_burst(scheduler, [("a", "inquiry"), ("b", "chat")])
+        self.assertEqual(order, ["b", "a"])
+
+    def test_per_user_cap_applies_only_while_others_wait(self):
+        """上限に達したユーザーは他ユーザーの待機者を先に通し、他に待機者がいなければ空き枠を使う"""
+        scheduler = FairScheduler(capacity=3, per_user_max=1, class_weights={})
+        order = []
+
+        async def job(user):
+            await scheduler.acquire(user, "chat")
+            order.append(user)
+
+        async def run():
+            for _ in range(3):
+                await scheduler.acquire("x", "chat")
+            jobs = [asyncio.ensure_future(job(u)) for u in ("u", "u", "v", "u")]
+            await asyncio.sleep(0)
+            for _ in range(3):
+                scheduler.release("x")
+                await asyncio.sleep(0)
+            self.assertEqual(order, ["u", "v", "u"])
+            self.assertEqual(scheduler._active_by_user, {"u": 2, "v": 1})
+            scheduler.release("v")
+            await asyncio.gather(*jobs)
+            self.assertEqual(scheduler._active_by_user, {"u": 3})
+
+        asyncio.run(run())
+
+    def test_single_user_uses_idle_slots_and_metrics(self):
+        """他ユーザーが並んでいなければ上限を超えて空き枠を使う"""
+        scheduler = FairScheduler(capacity=4, per_user_max=2, class_weights={})
+        peak = {"value": 0}
+
+        async def job():
+            async with scheduler.slot("u", "chat"):
+                peak["value"] = max(peak["value"], scheduler._active_by_user.get("u", 0))
+                await asyncio.sleep(0.005)
+
+        async def run():
+            await asyncio.gather(*[job() for _ in range(5)])
+
+        asyncio.run(run())
+        self.assertEqual(peak["value"], 4)
+        metrics = scheduler.get_metrics()
+        self.assertEqual(metrics["active"], 0)
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertEqual(metrics["users"]["u"]["requests"], 5)
+        self.assertGreater(metrics["users"]["u"]["max_wait_time"], 0)
+
+    def test_cancelled_waiter_is_removed(self):
+        scheduler = FairScheduler(capacity=1, per_user_max=1, class_weights={})
+
+        async def run():
+            await scheduler.acquire("a", "chat")
+            waiter = asyncio.ensure_future(scheduler.acquire("b", "chat"))
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.queue_depth, 1)
+            waiter.cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.queue_depth, 0)
+            scheduler.release("a")
+            self.assertEqual(scheduler.get_metrics()["active"], 0)
+
+        asyncio.run(run())
+
+    def test_user_key_from_llm_context(self):
+        """引数を省略した場合はllm_contextのユーザーキーを使う"""
+        scheduler = FairScheduler(capacity=2, per_user_max=1, class_weights={})
+
+        async def run():
+            with llm_context(user_key="user:7", endpoint="chat"):
+                async with scheduler.slot():
+                    self.assertIn("user:7", scheduler._active_by_user)
+            self.assertIsNone(get_llm_context().user_key)
+
+        asyncio.run(run())
+
+
+class _FakeClient:
+    """応答時間を指定できるLLMクライアント"""
+    model = "fake-model"
+
+    def __init__(self, delays):
+        self.delays = list(delays)
+        self.cancelled = 0
+
+    async def _generate_response_uncoalesced(self, messages, model=None, budget=None):
+        delay = self.delays.pop(0)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return f"done:{delay}"
+
+    async def generate_response_streaming(self, messages):
+        delay = self.delays.pop(0)
+        try:
+            await asyncio.sleep(delay)
+            for token in ("a", "b"):
+                yield f"{token}{delay}"
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled += 1
+            raise
+
+
+class _FakePool:
+    def __init__(self, client):
+        self._async_client = client
+
+    def get_async_client(self):
+        from contextlib import asynccontextmanager
+
+        @asynccontextmanager
+        async def ctx():
+            yield self._async_client
+        return ctx()
+
+
+class TestHedgedRequests(unittest.TestCase):
+    """LLMLoadBalancerのヘッジリクエストのテスト"""
+
+    def _balancer(self, delays_per_node, **policy):
+        balancer = LLMLoadBalancer(pool_configs=[])
+        balancer._initialized = True
+        balancer.nodes = [PoolNode(pool=_FakePool(_FakeClient(d))) for d in delays_per_node]
+        balancer.hedging = HedgingPolicy(enabled=True, min_delay=0.01, max_delay=1.0, default_delay=0.02, **policy)
+        return balancer
+
+    def test_slow_primary_is_hedged_and_loser_cancelled(self):
+        balancer = self._balancer([[0.5], [0.01]])
+        result = asyncio.run(balancer.generate_response_hedged([{"role": "user", "content": "x"}]))
+        self.assertEqual(result, "done:0.01")
+        metrics = balancer.hedging.get_metrics()
+        self.assertEqual(metrics["hedges_sent"], 1)
+        self.assertEqual(metrics["win_rate"], 1.0)
+        self.assertEqual(balancer.nodes[0].pool._async_client.cancelled, 1)
+        self.assertEqual(balancer.nodes[0].current_requests, 0)
+
+    def test_fast_primary_is_not_hedged(self):
+        balancer = self._balancer([[0.001], [0.001]])
+        asyncio.run(balancer.generate_response_hedged([{"role": "user", "content": "y"}]))
+        self.assertEqual(balancer.hedging.get_metrics()["hedges_sent"], 0)
+
+    def test_budget_limits_hedges(self):
+        balancer = self._balancer([[0.05] * 5, [0.05] * 5], budget_ratio=0.0, budget_burst=1)
+
+        async def run():
+            for i in range(3):
+                await balancer.generate_response_hedged([{"role": "user", "content": str(i)}])
+
+        asyncio.run(run())
+        metrics = balancer.hedging.get_metrics()
+        self.assertEqual(metrics["hedges_sent"], 1)
+        self.assertEqual(metrics["budget_denied"], 2)
+
+    def test_streaming_first_token_race(self):
+        balancer = self._balancer([[0.5], [0.01]])
+
+        async def run():
+            return [t async for t in balancer.generate_response_streaming_hedged([{"role": "user", "content": "z"}])]
+
+        self.assertEqual(asyncio.run(run()), ["a0.01", "b0.01"])
+        self.assertEqual(balancer.hedging.get_metrics()["hedge_wins"], 1)
+        self.assertEqual(balancer.nodes[0].pool._async_client.cancelled, 1)
+
+
+class _UpstreamError(Exception):
+    status_code = 500
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """closed / open / half_open のサーキットブレーカーのテスト"""
+
+    def _breaker(self, **kwargs):
+        params = dict(failure_threshold=3, reset_timeout=0.05, half_open_max_calls=1, enabled=True)
+        params.update(kwargs)
+        return CircuitBreaker("test", **params)
+
+    def _fail(self, breaker, exc_type=_UpstreamError):
+        with self.assertRaises(exc_type):
+            with breaker.guard_sync():
+                raise exc_type()
+
+    def test_opens_after_consecutive_failures_and_fails_fast(self):
+        breaker = self._breaker()
+        for _ in range(3):
+            self._fail(breaker)
+
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(CircuitOpenError) as ctx:
+            with breaker.guard_sync():
+                self.fail("open中は呼び出されない")
+        self.assertGreater(ctx.exception.retry_after, 0)
+        metrics = breaker.get_metrics()
+        self.assertEqual(metrics["rejected_calls"], 1)
+        self.assertEqual(metrics["transitions"], {"closed->open": 1})
+
+    def test_client_errors_do_not_count(self):
+        """400などのリクエスト起因のエラーは上流障害として数えない"""
+        class BadRequest(Exception):
+            status_code = 400
+
+        breaker = self._breaker()
+        for _ in range(5):
+            self._fail(breaker, BadRequest)
+        self.assertEqual(breaker.state, "closed")
+
+    def test_rate_limit_does_not_count(self):
+        """429はレートペーサーのクールダウンで扱うため、連続してもサーキットは open にならない"""
+        class RateLimited(Exception):
+            status_code = 429
+
+        breaker = self._breaker()
+        for _ in range(5):
+            self._fail(breaker, RateLimited)
+        self.assertEqual(breaker.state, "closed")
+
+    def test_precheck_fails_fast_without_taking_probe(self):
+        """待機列に並ぶ前の事前チェックは open なら即座に失敗し、half_open ではプローブ枠を消費しない"""
+        breaker = self._breaker()
+        for _ in range(3):
+            self._fail(breaker)
+        with self.assertRaises(CircuitOpenError):
+            breaker.raise_if_open()
+
+        time.sleep(0.06)
+        breaker.raise_if_open()
+        breaker.raise_if_open()
+        with breaker.guard_sync():
+            pass
+        self.assertEqual(breaker.state, "closed")
+
+    def test_thread_timeout_is_recorded_once(self):
+        """スレッドで実行した呼び出しはタイムアウトで1回だけ障害として数え、後から完了しても記録しない"""
+        breaker = self._breaker()
+        finished = threading.Event()
+
+        def slow_call():
+            with breaker.guard_sync():
+                time.sleep(0.05)
+            finished.set()
+            return "late"
+
+        async def run():
+            with self.assertRaises(asyncio.TimeoutError):
+                async with breaker.guard_thread():
+                    await asyncio.wait_for(asyncio.to_thread(slow_call), timeout=0.01)
+
+        asyncio.run(run())
+        self.assertTrue(finished.wait(1))
+        metrics = breaker.get_metrics()
+        self.assertEqual((metrics["failed_calls"], metrics["successful_calls"]), (1, 0))
+
+        # スレッド外では guard_sync がこれまでどおり記録する
+        with breaker.guard_sync():
+            pass
+        self.assertEqual(breaker.get_metrics()["successful_calls"], 1)
+
+    def test_half_open_probe_success_closes(self):
+        breaker = self._breaker()
+        for _ in range(3):
+            self._fail(breaker)
+        time.sleep(0.06)
+
+        async def run():
+            async def probe():
+                async with breaker.guard():
+                    await asyncio.sleep(0.02)
+
+            task = asyncio.ensure_future(probe())
+            await asyncio.sleep(0)
+            # プローブ中の2件目は拒否される
+            with self.assertRaises(CircuitOpenError):
+                async with breaker.guard():
+                    pass
+            await task
+
+        asyncio.run(run())
+        self.assertEqual(breaker.state, "closed")
+        self.assertEqual(
+            breaker.get_metrics()["transitions"],
+            {"closed->open": 1, "open->half_open": 1, "half_open->closed": 1}
+        )
+
+    def test_half_open_probe_failure_reopens(self):
+        breaker = self._breaker()
+        for _ in range(3):
+            self._fail(breaker)
+        time.sleep(0.06)
+        self._fail(breaker)
+
+        self.assertEqual(breaker.state, "open")
+        self.assertEqual(breaker.get_metrics()["transitions"]["half_open->open"], 1)
+
+    def test_cancelled_probe_releases_slot(self):
+        breaker = self._breaker()
+        for _ in range(3):
+            self._fail(breaker)
+        time.sleep(0.06)
+
+        async def run():
+            async def probe():
+                async with breaker.guard():
+                    await asyncio.sleep(10)
+
+            task = asyncio.ensure_future(probe())
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            async with breaker.guard():
+                pass
+
+        asyncio.run(run())
+        self.assertEqual(breaker.state, "closed")
+
+
+def _chat_response(prompt, completion, cached=0, model="gpt-4.1-2025-04-14"):
+    usage = SimpleNamespace(
+        prompt_tokens=prompt,
+        completion_tokens=completion,
+        total_tokens=prompt + completion,
+        prompt_tokens_details=SimpleNamespace(cached_tokens=cached),
+    )
+    return SimpleNamespace(model=model, usage=usage)
+
+
+class TestLLMUsage(unittest.TestCase):
+    """トークン使用量・コスト集計のテスト"""
+
+    def test_extract_usage_from_both_apis(self):
+        self.assertEqual(extract_usage(_chat_response(100, 20, cached=64)), (100, 20, 64))
+        responses_usage = SimpleNamespace(
+            input_tokens=50, output_tokens=10, input_tokens_details=SimpleNamespace(cached_tokens=0)
+        )
+        self.assertEqual(extract_usage(SimpleNamespace(usage=responses_usage)), (50, 10, 0))
+        self.assertIsNone(extract_usage(SimpleNamespace(usage=None)))
+
+    def test_cached_tokens_are_discounted(self):
+        full = estimate_cost("gpt-4.1", 1000, 0)["total_cost"]
+        cached = estimate_cost("gpt-4.1-2025-04-14", 1000, 0, cached_tokens=1000)["total_cost"]
+        self.assertAlmostEqual(full, 0.002)
+        self.assertAlmostEqual(cached, 0.0005)
+
+    def test_records_are_tagged_by_context_and_collected_per_request(self):
+        recorder = LLMUsageRecorder()
+
+        async def run():
+            with collect_usage() as usage, llm_context(user_key="user:1", endpoint="chat"):
+                with llm_context(step="state_extract"):
+                    # 対話エージェントの同期処理はスレッドで実行される
+                    await asyncio.to_thread(recorder.record, "gpt-4.1", _chat_response(300, 50))
+                with llm_context(step="reply"):
+                    recorder.record("gpt-4.1", _chat_response(500, 200, cached=256))
+            return usage.to_dict()
+
+        request_usage = asyncio.run(run())
+        self.assertEqual(request_usage["calls"], 2)
+        self.assertEqual(request_usage["prompt_tokens"], 800)
+        self.assertEqual(request_usage["cached_tokens"], 256)
+        self.assertEqual(set(request_usage["by_step"]), {"state_extract", "reply"})
+
+        metrics = recorder.get_metrics()
+        steps = {(row["endpoint"], row["model"], row["step"]) for row in metrics["breakdown"]}
+        self.assertIn(("chat", "gpt-4.1-2025-04-14", "reply"), steps)
+        self.assertEqual(metrics["top_users"]["user:1"]["calls"], 2)
+
+
+
+class TestModelRouter(unittest.TestCase):
+    """モデル振り分けのテスト"""
+
+    def _router(self, step_overrides=None):
+        return ModelRouter(
+            enabled=True, small_model="small-model", large_model="",
+            step_overrides=step_overrides or {}, large_support_types={"視点転換"},
+            short_message_chars=20, long_message_chars=400
+        )
+
+    def test_route_by_signals_and_step_overrides(self):
+        router = self._router(step_overrides={"state_extract": "small"})
+        messages = [{"role": "user", "content": "ありがとう"}]
+
+        with llm_context(step="reply", importance=1, message_chars=5):
+            self.assertEqual(router.route(messages, "big-model").model, "small-model")
+        with llm_context(step="reply", importance=5, message_chars=5):
+            self.assertEqual(router.route(messages, "big-model").model, "big-model")
+        with llm_context(step="reply", support_type="視点転換"):
+            self.assertEqual(router.route(messages, "big-model").reason, "support_type")
+        with llm_context(step="reply", message_chars=1000):
+            self.assertEqual(router.route(messages, "big-model").reason, "long_message")
+        with llm_context(step="state_extract", importance=5):
+            self.assertEqual(router.route(messages, "big-model").tier, "small")
+        self.assertEqual(ModelRouter(enabled=False).route(messages, "big-model").reason, "disabled")
+
+    def test_failed_or_empty_small_call_escalates(self):
+        router = self._router()
+        calls = []
+
+        async def call(model):
+            calls.append(model)
+            if model == "small-model":
+                raise RuntimeError("boom")
+            return "ok"
+
+        with llm_context(step="reply", importance=1):
+            decision = router.route([], "big-model")
+            self.assertEqual(asyncio.run(router.run(decision, "big-model", call)), "ok")
+            self.assertEqual(router.run_sync(decision, "big-model", lambda model: "" if model == "small-model" else "ok"), "ok")
+        self.assertEqual(calls, ["small-model", "big-model"])
+
+        by_step = router.get_metrics()["by_step"]["reply"]
+        self.assertEqual(by_step["small"]["escalations"], 2)
+        self.assertEqual(by_step["small"]["errors"], 2)
+        self.assertEqual(by_step["large"]["calls"], 2)
+
+    def test_rate_limited_small_call_does_not_escalate(self):
+        """429はレートペーサーの再試行後も続いている場合、大きいモデルに送らずにそのまま送出する"""
+        router = self._router()
+        calls = []
+
+        class RateLimited(Exception):
+            status_code = 429
+
+        async def call(model):
+            calls.append(model)
+            raise RateLimited()
+
+        def call_sync(model):
+            calls.append(model)
+            raise RateLimited()
+
+        with llm_context(step="reply", importance=1):
+            decision = router.route([], "big-model")
+            with self.assertRaises(RateLimited):
+                asyncio.run(router.run(decision, "big-model", call))
+            with self.assertRaises(RateLimited):
+                router.run_sync(decision, "big-model", call_sync)
+        self.assertEqual(calls, ["small-model", "small-model"])
+
+        by_step = router.get_metrics()["by_step"]["reply"]
+        self.assertEqual(by_step["small"]["errors"], 2)
+        self.assertEqual(by_step["small"]["escalations"], 0)
+        self.assertNotIn("large", by_step)
+
+
+def _completion(tokens, finish_reason="stop"):
+    return SimpleNamespace(
+        usage=SimpleNamespace(completion_tokens=tokens),
+        choices=[SimpleNamespace(finish_reason=finish_reason, message=SimpleNamespace(content="x"))]
+    )
+
+
+class TestTokenBudget(unittest.TestCase):
+
+    def test_default_budget_by_step_and_support_type(self):
+        policy = TokenBudgetPolicy(enabled=True, max_tokens=2000)
+        with llm_context(step="support_type"):
+            self.assertEqual(policy.budget().max_tokens, 300)
+        with llm_context(step="reply", support_type="道筋提示"):
+            self.assertEqual(policy.budget().max_tokens, 1200)
+        with llm_context(step="reply", support_type="理解深化"):
+            self.assertEqual(policy.budget().max_tokens, 600)
+            # 呼び出し元の指定を優先
+            self.assertEqual(policy.budget(150).max_tokens, 150)
+
+    def test_budget_adapts_to_observed_completions(self):
+        policy = TokenBudgetPolicy(enabled=True, percentile=0.99, headroom=1.2, min_samples=10, max_tokens=2000)
+        with llm_context(step="state_extract"):
+            for tokens in range(100, 200, 10):
+                policy.observe(policy.budget(), _completion(tokens))
+            budget = policy.budget()
+        self.assertEqual(budget.source, "observed")
+        self.assertEqual(budget.max_tokens, 228)  # 190 × 1.2
+
+    def test_truncated_call_is_retried_and_reported(self):
+        policy = TokenBudgetPolicy(enabled=True, min_samples=100, max_tokens=2000)
+        limits = []
+
+        async def call(limit):
+            limits.append(limit)
+            return _completion(limit, "length" if limit < 2000 else "stop")
+
+        with llm_context(step="reply", support_type="絞り込み"):
+            asyncio.run(policy.complete(policy.budget(), call))
+
+        self.assertEqual(limits, [700, 2000])
+        row = policy.get_metrics()["budgets"][0]
+        self.assertEqual(row["truncation_rate"], 1.0)
+        self.assertEqual(row["retries"], 1)
+        self.assertEqual(row["truncated_after_retry"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
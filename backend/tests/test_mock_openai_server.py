@@ -0,0 +1,113 @@
+"""
+OpenAI互換スタブサーバーのテスト
+実際のOpenAI SDKからスタブを呼び出し、応答形式・決定性・エラー注入を確認
+"""
+
+import unittest
+import asyncio
+import sys
+import os
+
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from mock_openai_server import PROFILES, create_app, resolve_profile
+
+
+def _client(app) -> AsyncOpenAI:
+    return AsyncOpenAI(
+        api_key="sk-mock",
+        base_url="http://mock/v1",
+        max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.ASGITransport(app=app)),
+    )
+
+
+class TestMockOpenAIServer(unittest.TestCase):
+    """スタブサーバーのテスト"""
+
+    messages = [{"role": "user", "content": "探究テーマの決め方を教えて"}]
+
+    def test_chat_completion_is_deterministic(self):
+        app = create_app(PROFILES["instant"])
+
+        async def run():
+            client = _client(app)
+            first = await client.chat.completions.create(model="gpt-4.1", messages=self.messages, max_tokens=30)
+            second = await client.chat.completions.create(model="gpt-4.1", messages=self.messages, max_tokens=30)
+            return first, second
+
+        first, second = asyncio.run(run())
+        self.assertTrue(first.choices[0].message.content)
+        self.assertEqual(first.choices[0].message.content, second.choices[0].message.content)
+        self.assertLessEqual(first.usage.completion_tokens, 30)
+        self.assertGreater(first.usage.prompt_tokens, 0)
+
+    def test_streaming_matches_non_streaming(self):
+        app = create_app(PROFILES["instant"])
+
+        async def run():
+            client = _client(app)
+            full = await client.chat.completions.create(model="gpt-4.1", messages=self.messages)
+            stream = await client.chat.completions.create(
+                model="gpt-4.1", messages=self.messages, stream=True, stream_options={"include_usage": True}
+            )
+            parts, usage = [], None
+            async for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+            return full, "".join(parts), usage
+
+        full, streamed, usage = asyncio.run(run())
+        self.assertEqual(streamed, full.choices[0].message.content)
+        self.assertEqual(usage.completion_tokens, full.usage.completion_tokens)
+
+    def test_responses_and_embeddings(self):
+        app = create_app(PROFILES["instant"])
+
+        async def run():
+            client = _client(app)
+            resp = await client.responses.create(model="gpt-4.1", input=[{"role": "user", "content": "hi"}])
+            emb = await client.embeddings.create(model="text-embedding-ada-002", input=["a", "b", "a"])
+            return resp, emb
+
+        resp, emb = asyncio.run(run())
+        self.assertTrue(resp.output_text)
+        self.assertGreater(resp.usage.output_tokens, 0)
+        self.assertEqual(len(emb.data), 3)
+        self.assertEqual(len(emb.data[0].embedding), 1536)
+        self.assertAlmostEqual(emb.data[0].embedding[0], emb.data[2].embedding[0], places=6)
+        self.assertAlmostEqual(sum(v * v for v in emb.data[0].embedding), 1.0, places=3)
+
+    def test_error_injection(self):
+        app = create_app(resolve_profile("instant", rate_limit_probability=1.0, retry_after=3.0))
+
+        async def run():
+            with self.assertRaises(openai.RateLimitError) as ctx:
+                await _client(app).chat.completions.create(model="gpt-4.1", messages=self.messages)
+            return ctx.exception
+
+        error = asyncio.run(run())
+        self.assertEqual(error.status_code, 429)
+        self.assertEqual(error.response.headers["retry-after"], "3")
+        self.assertEqual(app.state.mock.stats.rate_limited, 1)
+
+    def test_latency_plan_is_reproducible(self):
+        """同じシードなら到着順ごとの遅延とエラーの系列が一致する"""
+        profile = resolve_profile("degraded", seed=7)
+        first = create_app(profile).state.mock
+        second = create_app(profile).state.mock
+        plans = [first.next_plan() for _ in range(50)]
+        self.assertEqual(plans, [second.next_plan() for _ in range(50)])
+        self.assertTrue(any(p["error"] == 429 for p in plans))
+
+
+if __name__ == "__main__":
+    unittest.main()
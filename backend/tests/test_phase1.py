@@ -4,12 +4,17 @@ Phase 1: 対話エージェント機能のテスト
 """
 
 import unittest
+import asyncio
+import re
+import json
 import sys
 import os
+import tempfile
 from unittest.mock import Mock, patch
 
 # プロジェクトルートをパスに追加
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 
 from conversation_agent.schema import (
     StateSnapshot, Affect, ProgressSignal, SupportType, SpeechAct, ProjectPlan
@@ -19,6 +24,11 @@ from conversation_agent.support_typer import SupportTyper
 from conversation_agent.policies import PolicyEngine
 from conversation_agent.orchestrator import ConversationOrchestrator
 from conversation_agent.project_planner import ProjectPlanner
+from conversation_agent.state_store import ConversationStateStore
+from conversation_agent.session_store import ConversationSessionStore
+from conversation_agent.state_memo import MaterialChangeRule
+from conversation_agent.support_classifier import DecisionLogger, SupportTypeClassifier, train_from_log, load_examples
+from module.keyword_matcher import KeywordMatcher
 
 class TestStateExtractor(unittest.TestCase):
     """状態抽出エンジンのテスト"""
@@ -99,6 +109,137 @@ class TestStateExtractor(unittest.TestCase):
         self.assertEqual(state.goal, "学習目標の明確化")
         self.assertEqual(state.purpose, "効果的な学習を進める")
         self.assertIsNone(state.project_context)
+    
+    def test_incremental_extraction_with_state_store(self):
+        """2回目以降は前回の状態と新しいメッセージだけで差分抽出し、永続化した状態は再起動後も使われる"""
+        prompts = []
+        
+        class RecordingClient:
+            def generate_response(self, messages):
+                prompts.append(messages[1]["content"])
+                return json.dumps({"goal": f"目標{len(prompts)}", "blockers": []}, ensure_ascii=False)
+        
+        history = [
+            {"id": 1, "sender": "user", "message": "研究テーマを決めたいです"},
+            {"id": 2, "sender": "assistant", "message": "どの分野に興味がありますか？"},
+        ]
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "state.db")
+            store = ConversationStateStore(max_entries=10, db_path=db_path, full_refresh_interval=2)
+            extractor = StateExtractor(RecordingClient(), state_store=store)
+            
+            extractor.extract_from_history(history, conversation_id="c1")
+            history.append({"id": 3, "sender": "user", "message": "環境問題です"})
+            state = extractor.extract_from_history(history, conversation_id="c1")
+            
+            self.assertEqual(len(prompts), 2)
+            self.assertIn("前回の状態", prompts[1])
+            self.assertIn("環境問題です", prompts[1])
+            self.assertNotIn("研究テーマを決めたいです", prompts[1])
+            self.assertEqual(state.goal, "目標2")
+            
+            # メッセージが増えていなければLLMを呼ばない
+            self.assertEqual(extractor.extract_from_history(history, conversation_id="c1").goal, "目標2")
+            self.assertEqual(len(prompts), 2)
+            
+            # 再起動後（新しいストア）もDBから復元して差分抽出し、上限に達したら全体を再抽出する
+            restarted = StateExtractor(RecordingClient(), state_store=ConversationStateStore(
+                max_entries=10, db_path=db_path, full_refresh_interval=2
+            ))
+            history.append({"id": 4, "sender": "user", "message": "特に海洋プラスチック"})
+            restarted.extract_from_history(history, conversation_id="c1")
+            self.assertIn("前回の状態", prompts[2])
+            history.append({"id": 5, "sender": "user", "message": "調べ方を知りたい"})
+            restarted.extract_from_history(history, conversation_id="c1")
+            self.assertIn("研究テーマを決めたいです", prompts[3])
+    
+    def test_incremental_update_keeps_fields_missing_from_response(self):
+        """差分抽出の応答に含まれない項目は前回の状態を引き継ぐ"""
+        responses = [
+            {"goal": "研究テーマを決める", "purpose": "環境問題を理解する", "resources": ["図書館"],
+             "affect": {"interest": 4, "anxiety": 2, "excitement": 3}},
+            {"goal": "海洋プラスチックを調べる", "affect": {"anxiety": 4}},
+        ]
+        
+        class ScriptedClient:
+            def generate_response(self, messages):
+                return json.dumps(responses.pop(0), ensure_ascii=False)
+        
+        history = [{"id": 1, "sender": "user", "message": "研究テーマを決めたいです"}]
+        extractor = StateExtractor(ScriptedClient(), state_store=ConversationStateStore(max_entries=10))
+        extractor.extract_from_history(history, conversation_id="c1")
+        history.append({"id": 2, "sender": "user", "message": "海洋プラスチックが気になります"})
+        state = extractor.extract_from_history(history, conversation_id="c1")
+        
+        self.assertEqual(state.goal, "海洋プラスチックを調べる")
+        self.assertEqual(state.purpose, "環境問題を理解する")
+        self.assertEqual(state.resources, ["図書館"])
+        self.assertEqual((state.affect.interest, state.affect.anxiety, state.affect.excitement), (4, 4, 3))
+        self.assertEqual(extractor.state_store.get("c1").state["purpose"], "環境問題を理解する")
+    
+    def test_async_extraction_keeps_state_store_io_off_event_loop(self):
+        """非同期版は永続化した状態ストアの読み書きをイベントループのスレッドで行わない"""
+        import threading
+        
+        class AsyncClient:
+            async def generate_response_async(self, messages):
+                return json.dumps({"goal": "目標", "blockers": []}, ensure_ascii=False)
+        
+        history = [{"id": 1, "sender": "user", "message": "研究テーマを決めたいです"}]
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            store = ConversationStateStore(max_entries=10, db_path=os.path.join(tmp, "state.db"))
+            io_threads = []
+            original_get, original_put = store.get, store.put
+            store.get = lambda *args: io_threads.append(threading.get_ident()) or original_get(*args)
+            store.put = lambda *args: io_threads.append(threading.get_ident()) or original_put(*args)
+            extractor = StateExtractor(None, state_store=store, async_llm_client=AsyncClient())
+            
+            async def run():
+                state = await extractor.extract_from_history_async(history, conversation_id="c1")
+                return state, threading.get_ident()
+            
+            state, loop_thread = asyncio.run(run())
+            self.assertEqual(state.goal, "目標")
+            self.assertEqual(len(io_threads), 2)
+            self.assertNotIn(loop_thread, io_threads)
+            self.assertIsNotNone(store.get("c1"))
+
+class TestKeywordMatcher(unittest.TestCase):
+    """キーワードマッチャーのテスト"""
+    
+    def test_matches_regex_semantics(self):
+        """重なり・組み合わせ・末尾の判定が正規表現と同じ結果になる"""
+        matcher = KeywordMatcher({
+            "critical": ["結論", "要約", "重要"],
+            "core": ["最も重要", "要点"],
+            "subject": ["テーマ", "問い"],
+            "decided": ["決定", "確定"],
+            "reply": ["はい", "そうです"],
+        })
+        text = "最も重要約と重要点。テーマを決定\n問いは未定で確定はい"
+        hits = matcher.scan(text)
+        
+        for category, keywords in matcher.categories.items():
+            pattern = "(" + "|".join(keywords) + ")"
+            expected = re.findall(pattern, text)
+            self.assertEqual(hits.count(category), len(expected), category)
+            self.assertEqual(set(hits.found(category)), set(expected), category)
+        self.assertEqual(hits.sequences("subject", "decided"), re.findall("(テーマ|問い).*?(決定|確定)", text))
+        self.assertEqual(hits.ending("reply"), "はい")
+        self.assertEqual(hits.occurrences("critical"), [(2, 4, "重要"), (3, 5, "要約"), (6, 8, "重要")])
+        self.assertEqual(hits.count("missing"), 0)
+    
+    def test_heuristic_keywords(self):
+        """ヒューリスティック抽出のキーワード判定は定義順の優先度を保つ"""
+        extractor = StateExtractor(llm_client=None)
+        state = extractor._analyze_keywords(StateSnapshot(), ["今月までに", "今日はどうすればいいかわからない"])
+        
+        self.assertEqual(state.blockers, ["わからないいる状況"])
+        self.assertEqual(state.uncertainties, ["方法や選択に関する疑問"])
+        self.assertEqual(state.time_horizon, "今日")
+        self.assertEqual(extractor._estimate_affect(["ワクワクするけど不安"]).anxiety, 4)
 
 class TestSupportTyper(unittest.TestCase):
     """支援タイプ判定のテスト"""
@@ -145,6 +286,39 @@ class TestSupportTyper(unittest.TestCase):
         support_type, reason, confidence = self.typer._determine_rule_based(state)
         
         self.assertIn(support_type, [SupportType.NARROWING, SupportType.DECISION])
+    
+    def test_classifier_replaces_llm_when_confident(self):
+        """LLM判定のログで学習した分類器の確信度が高ければLLMを呼ばない"""
+        anxious = StateSnapshot(goal="発表準備", affect=Affect(anxiety=5), progress_signal=ProgressSignal(actions_in_last_7_days=0))
+        looping = StateSnapshot(goal="テーマ選び", progress_signal=ProgressSignal(looping_signals=["同じ質問"], actions_in_last_7_days=3))
+        
+        with tempfile.TemporaryDirectory() as tmp:
+            log_path = os.path.join(tmp, "support_type_log.jsonl")
+            llm = Mock()
+            llm.generate_response.return_value = json.dumps({"support_type": SupportType.ACTIVATION, "confidence": 0.9})
+            typer = SupportTyper(llm_client=llm, decision_logger=DecisionLogger(log_path))
+            typer.classifier = None
+            for _ in range(10):
+                typer.determine_support_type(anxious)
+            llm.generate_response.return_value = json.dumps({"support_type": SupportType.REFRAMING, "confidence": 0.9})
+            for _ in range(10):
+                typer.determine_support_type(looping)
+            self.assertEqual(len(load_examples(log_path)[1]), 20)
+            
+            classifier, _ = train_from_log(log_path, holdout=0.0)
+            model_path = os.path.join(tmp, "support_type_model.npz")
+            classifier.save(model_path)
+            typer.classifier = SupportTypeClassifier.load(model_path)
+            llm.generate_response.reset_mock()
+            
+            self.assertEqual(typer.determine_support_type(anxious)[0], SupportType.ACTIVATION)
+            self.assertEqual(typer.determine_support_type(looping)[0], SupportType.REFRAMING)
+            llm.generate_response.assert_not_called()
+            
+            # 確信度が閾値に届かなければLLMで判定する
+            typer.classifier_threshold = 1.01
+            typer.determine_support_type(anxious)
+            self.assertEqual(llm.generate_response.call_count, 1)
 
 class TestProjectPlanner(unittest.TestCase):
     """プロジェクト計画思考のテスト"""
@@ -319,6 +493,25 @@ class TestConversationOrchestrator(unittest.TestCase):
         self.assertIn("next_actions", project_plan)
         self.assertTrue(project_plan["north_star"])  # 空でないことを確認
     
+    def test_sessions_are_isolated_per_conversation(self):
+        """履歴とメトリクスは会話ごとに分離され、セッション数は上限で制限される"""
+        store = ConversationSessionStore(max_sessions=2, ttl_seconds=0, max_memory_mb=0)
+        orchestrator = ConversationOrchestrator(llm_client=None, use_mock=True, session_store=store)
+        
+        for _ in range(3):
+            orchestrator.process_turn("研究テーマを決めたいです", [], conversation_id="conv-a")
+        result = orchestrator.process_turn("研究テーマを決めたいです", [], conversation_id="conv-b")
+        
+        self.assertEqual(result["metrics"]["turns_count"], 1)
+        self.assertEqual(store.peek("conv-a").metrics.turns_count, 3)
+        self.assertEqual(len(store.peek("conv-b").act_history), 1)
+        self.assertEqual(orchestrator.get_conversation_summary("conv-a")["total_turns"], 3)
+        
+        # 上限を超えたら最も古い会話から破棄
+        orchestrator.process_turn("研究テーマを決めたいです", [], conversation_id="conv-c")
+        self.assertIsNone(store.peek("conv-a"))
+        self.assertEqual(store.get_stats()["evictions"], 1)
+    
     def test_error_handling(self):
         """エラーハンドリングのテスト"""
         # 無効な入力でもフォールバック応答が返されることを確認
@@ -327,6 +520,227 @@ class TestConversationOrchestrator(unittest.TestCase):
         self.assertIn("response", result)
         self.assertIn("followups", result)
         self.assertEqual(result["support_type"], SupportType.UNDERSTANDING)
+    
+    def test_process_turn_async_runs_plan_concurrently(self):
+        """非同期版では計画思考が支援タイプ判定・応答生成と並行して実行される"""
+        
+        class SlowAsyncClient:
+            async def generate_response_async(self, messages):
+                await asyncio.sleep(0.05)
+                system = messages[0]["content"]
+                if "探究学習の専門家AI" in system:
+                    return "{}"  # 検証に失敗させてルールベース計画にフォールバック
+                if "natural_reply" in messages[1]["content"]:
+                    return json.dumps({"natural_reply": "まず問いを一つに絞りましょう", "followups": ["はい"]})
+                return json.dumps({"support_type": SupportType.PATHFINDING, "reason": "テスト", "confidence": 0.8})
+        
+        orchestrator = ConversationOrchestrator(
+            llm_client=None, use_mock=False, async_llm_client=SlowAsyncClient(), enable_planning=True
+        )
+        result = asyncio.run(orchestrator.process_turn_async(
+            user_message="何から調べればいいですか？",
+            conversation_history=[{"sender": "user", "message": "研究テーマを決めたいです"}],
+            user_id=1,
+            conversation_id="test-conv-async"
+        ))
+        
+        self.assertEqual(result["support_type"], SupportType.PATHFINDING)
+        self.assertIsNotNone(result["project_plan"])
+        timings = result["metrics"]["step_timings"]
+        self.assertEqual(result["metrics"]["pipeline"], "async")
+        for step in ["state_extract", "plan", "support_type", "select_acts", "reply", "critical_path", "total"]:
+            self.assertIn(step, timings)
+        # 計画思考は支援タイプ判定・応答生成と並行するため、合計は各ステップの和より短い
+        sequential = timings["state_extract"] + timings["plan"] + timings["support_type"] + timings["reply"]
+        self.assertLess(timings["total"], sequential - 0.5 * timings["plan"])
+    
+    def test_speculative_followups_run_alongside_reply(self):
+        """フォローアップ候補は応答生成と並行して生成され、応答はその完了を待たない"""
+        
+        class ConcurrentClient:
+            def __init__(self):
+                self.in_flight = 0
+                self.max_in_flight = 0
+                self.reply_prompt = None
+            
+            async def generate_response_async(self, messages):
+                prompt = messages[1]["content"]
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                try:
+                    if "natural_reply" in prompt:
+                        self.reply_prompt = prompt
+                        await asyncio.sleep(0.02)
+                        return json.dumps({"natural_reply": "まず問いを一つに絞りましょう"}, ensure_ascii=False)
+                    if "followups" in prompt:
+                        await asyncio.sleep(0.1)
+                        return json.dumps({"followups": ["問いを書き出す", "資料を探す", "先生に相談する", "余分"]}, ensure_ascii=False)
+                    return json.dumps({"support_type": SupportType.PATHFINDING, "reason": "テスト", "confidence": 0.8})
+                finally:
+                    self.in_flight -= 1
+        
+        async def run():
+            client = ConcurrentClient()
+            orchestrator = ConversationOrchestrator(llm_client=None, async_llm_client=client)
+            result = await orchestrator.process_turn_async(
+                user_message="何から調べればいいですか？", conversation_history=[], speculative_followups=True
+            )
+            # 応答が返った時点ではフォローアップ候補はまだ生成中
+            self.assertFalse(result["followups_task"].done())
+            followups = await result["followups_task"]
+            return client, result, followups
+        
+        client, result, followups = asyncio.run(run())
+        
+        self.assertEqual(result["response"], "まず問いを一つに絞りましょう")
+        self.assertEqual(result["followups"], [])
+        self.assertEqual(followups, ["問いを書き出す", "資料を探す", "先生に相談する"])
+        self.assertEqual(client.max_in_flight, 2)
+        self.assertNotIn("followups", client.reply_prompt)
+        self.assertIn("followups", result["metrics"]["step_timings"])
+    
+    def test_json_chat_returns_followups(self):
+        """JSON版 /chat は並行生成を使わず、応答と同じ呼び出しで生成したフォローアップ候補をレスポンスで返す"""
+        from types import SimpleNamespace
+        from unittest.mock import AsyncMock
+        import optimized_endpoints
+        
+        class ReplyClient:
+            def __init__(self):
+                self.prompts = []
+            
+            async def generate_response_async(self, messages):
+                prompt = messages[1]["content"]
+                self.prompts.append(prompt)
+                if "natural_reply" in prompt:
+                    return json.dumps({
+                        "natural_reply": "まず問いを一つに絞りましょう",
+                        "followups": ["問いを書き出す", "資料を探す"]
+                    }, ensure_ascii=False)
+                return json.dumps({"support_type": SupportType.PATHFINDING, "reason": "テスト", "confidence": 0.8})
+        
+        client = ReplyClient()
+        orchestrator = ConversationOrchestrator(llm_client=None, async_llm_client=client)
+        context = SimpleNamespace(messages=[], history=[], to_metrics=lambda: {})
+        selector = SimpleNamespace(build=AsyncMock(return_value=context))
+        save = AsyncMock(return_value=(True, True))
+        
+        with patch.dict(os.environ, {"ENABLE_SPECULATIVE_FOLLOWUPS": "true"}), \
+                patch.object(optimized_endpoints, "get_or_create_conversation_sync", return_value="conv-json"), \
+                patch.object(optimized_endpoints, "parallel_fetch_context_and_history",
+                             AsyncMock(return_value=(None, None, None, []))), \
+                patch.object(optimized_endpoints, "get_context_strategy_selector", return_value=selector), \
+                patch.object(optimized_endpoints, "parallel_save_chat_logs", save), \
+                patch.object(optimized_endpoints, "update_conversation_timestamp_async", AsyncMock()), \
+                patch.object(optimized_endpoints, "get_async_llm_client", return_value=Mock()):
+            result = asyncio.run(optimized_endpoints.optimized_chat_with_ai(
+                chat_data=SimpleNamespace(message="何から調べればいいですか？", orchestrator_mode=None),
+                current_user=1,
+                supabase=Mock(),
+                llm_client=Mock(),
+                conversation_orchestrator=orchestrator,
+                ENABLE_CONVERSATION_AGENT=True
+            ))
+        
+        self.assertEqual(result.followups, ["問いを書き出す", "資料を探す"])
+        self.assertIn("• 問いを書き出す", result.response)
+        # フォローアップ候補だけの呼び出しはしない
+        self.assertFalse(any("natural_reply" not in p and "followups" in p for p in client.prompts))
+        self.assertEqual(save.await_args.args[2]["message"], result.response)
+    
+    def test_fused_mode_single_call(self):
+        """fusedモードは1回の呼び出しで状態・支援タイプ・アクト・応答を生成し、不正な部分はルールベースで補う"""
+        
+        class FusedClient:
+            def __init__(self, payload):
+                self.payload = payload
+                self.calls = 0
+            
+            async def generate_response_async(self, messages):
+                self.calls += 1
+                return self.payload
+        
+        valid = FusedClient(json.dumps({
+            "state": {"goal": "AIと教育の関係を調べる", "purpose": "探究テーマを決める", "blockers": ["調べ方がわからない"]},
+            "support_type": SupportType.PATHFINDING,
+            "support_reason": "進め方が分からないため",
+            "confidence": 0.8,
+            "selected_acts": [SpeechAct.OUTLINE, "Unknown", SpeechAct.PROBE],
+            "natural_reply": "まず調べたい問いを一つ書き出してみましょう。",
+            "followups": ["問いを書き出す", "資料を探す", "先生に相談する", "余分な候補"]
+        }, ensure_ascii=False))
+        orchestrator = ConversationOrchestrator(llm_client=None, async_llm_client=valid)
+        result = asyncio.run(orchestrator.process_turn_async(
+            user_message="何から調べればいいですか？", conversation_history=[], mode="fused"
+        ))
+        
+        self.assertEqual(valid.calls, 1)
+        self.assertEqual(result["metrics"]["orchestrator_mode"], "fused")
+        self.assertEqual(result["state_snapshot"]["goal"], "AIと教育の関係を調べる")
+        self.assertEqual(result["support_type"], SupportType.PATHFINDING)
+        self.assertEqual(result["selected_acts"], [SpeechAct.OUTLINE, SpeechAct.PROBE])
+        self.assertEqual(len(result["followups"]), 3)
+        self.assertNotIn("fallbacks", result["decision_metadata"])
+        
+        broken = FusedClient("JSONではない応答")
+        orchestrator = ConversationOrchestrator(llm_client=None, async_llm_client=broken)
+        result = asyncio.run(orchestrator.process_turn_async(
+            user_message="不安でなかなか始められません", conversation_history=[], mode="fused"
+        ))
+        
+        self.assertTrue(result["response"])
+        self.assertIn(result["support_type"], SupportType.ALL_TYPES)
+        self.assertIn("json", result["decision_metadata"]["fallbacks"])
+        self.assertIn("reply", result["decision_metadata"]["fallbacks"])
+
+class TestStateMemo(unittest.TestCase):
+    """状態フィンガープリントによるメモ化のテスト"""
+    
+    def test_material_change_rule(self):
+        """表記ゆれ・順序・小さな感情の変化は同じ状態、ブロッカーの追加は実質的な変化とみなす"""
+        rule = MaterialChangeRule()
+        base = StateSnapshot(goal="AIと教育", blockers=["時間がない", "資料がない"], affect=Affect(anxiety=2))
+        same = StateSnapshot(goal=" AIと教育 ", blockers=["資料がない", "時間がない"], affect=Affect(anxiety=3),
+                             last_action="本を読んだ")
+        changed = StateSnapshot(goal="AIと教育", blockers=["時間がない", "資料がない", "やる気が出ない"],
+                                affect=Affect(anxiety=2))
+        
+        self.assertEqual(rule.fingerprint(base), rule.fingerprint(same))
+        self.assertNotEqual(rule.fingerprint(base), rule.fingerprint(changed))
+        self.assertNotEqual(
+            MaterialChangeRule(affect_step=1).fingerprint(base),
+            MaterialChangeRule(affect_step=1).fingerprint(same)
+        )
+    
+    def test_orchestrator_reuses_support_type_and_plan(self):
+        """状態が変わらない間は支援タイプ判定と計画思考を再計算しない"""
+        orchestrator = ConversationOrchestrator(
+            llm_client=None, use_mock=True, enable_planning=True,
+            session_store=ConversationSessionStore(), memo_rule="default"
+        )
+        typer = orchestrator.support_typer
+        planner = orchestrator.project_planner
+        typer.determine_support_type = Mock(wraps=typer.determine_support_type)
+        planner.generate_project_plan = Mock(wraps=planner.generate_project_plan)
+        history = [{"sender": "user", "message": "研究テーマを決めたいです"}]
+        
+        first = orchestrator.process_turn("何から始めればいいですか？", history, conversation_id="memo-conv")
+        second = orchestrator.process_turn("何から始めればいいですか？", history, conversation_id="memo-conv")
+        
+        self.assertEqual(typer.determine_support_type.call_count, 1)
+        self.assertEqual(planner.generate_project_plan.call_count, 1)
+        self.assertEqual(second["support_type"], first["support_type"])
+        self.assertEqual(second["project_plan"], first["project_plan"])
+        self.assertEqual(second["metrics"]["memo_hit_rates"], {"support_type": 0.5, "plan": 0.5})
+        
+        # 別の会話では再利用しない
+        orchestrator.process_turn("何から始めればいいですか？", history, conversation_id="memo-conv-2")
+        self.assertEqual(typer.determine_support_type.call_count, 2)
+        
+        # メモ化を無効にすると毎ターン再計算する
+        orchestrator.memo_rule = None
+        orchestrator.process_turn("何から始めればいいですか？", history, conversation_id="memo-conv")
+        self.assertEqual(typer.determine_support_type.call_count, 3)
 
 # テストケースのサンプルデータ
 SAMPLE_CONVERSATIONS = [
@@ -0,0 +1,88 @@
+"""
+レスポンスキャッシュのテスト
+キー正規化・TTL・LRU追い出し・エンドポイント別無効化を確認
+"""
+
+import unittest
+import sys
+import os
+import time
+
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from response_cache import ResponseCache, make_cache_key, normalize_text, normalize_keywords
+
+
+class TestCacheKey(unittest.TestCase):
+    """キャッシュキー正規化のテスト"""
+
+    def test_nfkc_and_whitespace_normalization(self):
+        """全角英数・余分な空白・大文字小文字の違いは同じキーになる"""
+        self.assertEqual(normalize_text("  ＡＩ　と  教育 "), "ai と 教育")
+        a = make_cache_key("related-words", {"keyword": normalize_text("ＡＩ")})
+        b = make_cache_key("related-words", {"keyword": normalize_text("ai")})
+        self.assertEqual(a, b)
+
+    def test_keyword_order_is_ignored(self):
+        """キーワードリストの順序に依存しない"""
+        self.assertEqual(normalize_keywords(["環境", "エネルギー"]), normalize_keywords(["エネルギー", "環境 "]))
+
+    def test_endpoint_is_part_of_key(self):
+        """同じ内容でもエンドポイントが違えば別キー"""
+        self.assertNotEqual(make_cache_key("a", {"k": 1}), make_cache_key("b", {"k": 1}))
+
+
+class TestResponseCache(unittest.TestCase):
+    """ResponseCacheのテスト"""
+
+    def test_hit_and_miss_counters(self):
+        cache = ResponseCache(max_entries=10, max_bytes=10_000, default_ttl=60, enabled=True, disabled_endpoints=[])
+        self.assertIsNone(cache.get("cluster", "k"))
+        cache.set("cluster", "k", {"clusters": [{"name": "A"}]})
+        self.assertEqual(cache.get("cluster", "k"), {"clusters": [{"name": "A"}]})
+
+        stats = cache.get_stats()["endpoints"]["cluster"]
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_returned_value_is_a_copy(self):
+        """取り出した値を変更してもキャッシュ内容は変わらない"""
+        cache = ResponseCache(max_entries=10, max_bytes=10_000, default_ttl=60, enabled=True, disabled_endpoints=[])
+        cache.set("e", "k", {"suggestions": ["a"]})
+        cache.get("e", "k")["suggestions"].append("b")
+        self.assertEqual(cache.get("e", "k"), {"suggestions": ["a"]})
+
+    def test_ttl_expiration(self):
+        cache = ResponseCache(max_entries=10, max_bytes=10_000, default_ttl=60, enabled=True, disabled_endpoints=[])
+        cache.set("e", "k", {"v": 1}, ttl=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("e", "k"))
+        self.assertEqual(cache.get_stats()["endpoints"]["e"]["expirations"], 1)
+        self.assertEqual(cache.get_stats()["entries"], 0)
+
+    def test_lru_eviction_by_entries_and_bytes(self):
+        cache = ResponseCache(max_entries=2, max_bytes=10_000, default_ttl=60, enabled=True, disabled_endpoints=[])
+        cache.set("e", "a", 1)
+        cache.set("e", "b", 2)
+        cache.get("e", "a")  # a を最近使用に
+        cache.set("e", "c", 3)
+        self.assertIsNone(cache.get("e", "b"))
+        self.assertEqual(cache.get("e", "a"), 1)
+        self.assertEqual(cache.get_stats()["endpoints"]["e"]["evictions"], 1)
+
+        small = ResponseCache(max_entries=100, max_bytes=600, default_ttl=60, enabled=True, disabled_endpoints=[])
+        for i in range(5):
+            small.set("e", f"k{i}", "x" * 100)
+        self.assertLessEqual(small.get_stats()["bytes"], 600)
+        self.assertIsNotNone(small.get("e", "k4"))
+
+    def test_per_endpoint_opt_out(self):
+        cache = ResponseCache(max_entries=10, max_bytes=10_000, default_ttl=60, enabled=True, disabled_endpoints=["evaluate"])
+        self.assertFalse(cache.set("evaluate", "k", {"v": 1}))
+        self.assertIsNone(cache.get("evaluate", "k"))
+        self.assertTrue(cache.set("cluster", "k", {"v": 1}))
+
+
+if __name__ == "__main__":
+    unittest.main()
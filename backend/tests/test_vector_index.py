@@ -0,0 +1,98 @@
+"""
+プロセス内ベクトルインデックスのテスト
+上位k件の検索と絞り込み（exclude_recent_n・exclude_ids・min_similarity）、追記専用セグメントの保存と読み込みを確認
+"""
+
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+
+import numpy as np
+
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_index import VectorIndex, VECTORS_FILE, RECORDS_FILE
+
+
+def _vectors(count, dim=8, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, dim)).astype(np.float32)
+
+
+class TestVectorIndexSearch(unittest.TestCase):
+
+    def test_top_k_matches_brute_force_and_filters(self):
+        """上位k件は全件のコサイン類似度の順位と一致し、直近・指定ID・類似度の下限で除外できる"""
+        index = VectorIndex(root_dir="")
+        vectors = _vectors(200)
+        ids = list(range(200))
+        self.assertEqual(index.add("conv", ids, [f"text{i}" for i in ids], vectors), 200)
+
+        query = vectors[10] + 0.1 * vectors[20]
+        normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        expected = np.argsort(-(normalized @ (query / np.linalg.norm(query))))
+
+        hits = index.search("conv", query, k=5)
+        self.assertEqual([hit.id for hit in hits], expected[:5].tolist())
+        self.assertEqual(hits[0].text, "text10")
+        self.assertTrue(all(a.score >= b.score for a, b in zip(hits, hits[1:])))
+
+        filtered = index.search("conv", query, k=5, exclude_ids=[10], exclude_recent_n=190)
+        self.assertTrue(all(hit.id < 10 for hit in filtered))
+
+        self.assertTrue(all(hit.score >= 0.3 for hit in index.search("conv", query, k=200, min_similarity=0.3)))
+        self.assertEqual(index.search("other", query, k=5), [])
+
+    def test_duplicate_ids_and_zero_vectors_are_skipped(self):
+        index = VectorIndex(root_dir="")
+        vectors = _vectors(3)
+        vectors[2] = 0
+        self.assertEqual(index.add("conv", [1, 1, 2], ["a", "b", "c"], vectors), 1)
+        self.assertEqual(index.add("conv", [1, 3], ["a", "d"], _vectors(2, seed=1)), 1)
+        self.assertEqual(index.missing_ids("conv", [1, 2, 3, 4]), [2, 4])
+
+
+class TestVectorIndexSegments(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_segments_are_memory_mapped_after_restart(self):
+        """保存したベクトルは再起動後にメモリマップで読み込まれ、その後の追記も続けて保存される"""
+        vectors = _vectors(20)
+        VectorIndex(root_dir=self.root).add("conv", list(range(10)), [str(i) for i in range(10)], vectors[:10])
+
+        reloaded = VectorIndex(root_dir=self.root)
+        hits = reloaded.search("conv", vectors[3], k=1)
+        self.assertEqual(hits[0].id, 3)
+        self.assertIsInstance(reloaded._namespaces["conv"].base, np.memmap)
+
+        reloaded.add("conv", list(range(10, 20)), [str(i) for i in range(10, 20)], vectors[10:])
+        self.assertEqual(reloaded.search("conv", vectors[15], k=1)[0].id, 15)
+        self.assertEqual(VectorIndex(root_dir=self.root).search("conv", vectors[15], k=1)[0].id, 15)
+
+    def test_partial_write_is_trimmed_on_load(self):
+        """書き込みが途中で止まったセグメントは短い方に揃えて読み込み、追記の位置がずれない"""
+        vectors = _vectors(6)
+        index = VectorIndex(root_dir=self.root)
+        index.add("conv", list(range(5)), [str(i) for i in range(5)], vectors[:5])
+        directory = index._namespace_dir("conv")
+        with open(os.path.join(directory, VECTORS_FILE), "ab") as f:
+            f.write(b"\x00" * 10)
+        with open(os.path.join(directory, RECORDS_FILE), "a", encoding="utf-8") as f:
+            f.write('{"id": 5, "te')
+
+        reloaded = VectorIndex(root_dir=self.root)
+        self.assertEqual(reloaded.missing_ids("conv", [4, 5]), [5])
+        reloaded.add("conv", [5], ["5"], vectors[5:])
+
+        restarted = VectorIndex(root_dir=self.root)
+        self.assertEqual(restarted.search("conv", vectors[5], k=1)[0].id, 5)
+        self.assertEqual(restarted.search("conv", vectors[2], k=1)[0].id, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+"""
+支援タイプ分類器の学習と評価
+SUPPORT_TYPE_LOG_PATH に記録したLLMの判定ログから分類器を学習し、LLM判定との一致率を表示します。
+保存したモデルを SUPPORT_TYPE_MODEL_PATH に指定すると、SupportTyper が確信度の高いターンでLLMの代わりに使います。
+
+実行例:
+    python train_support_classifier.py train --log data/support_type_log.jsonl --model data/support_type_model.npz
+    python train_support_classifier.py evaluate --log data/support_type_log.jsonl --model data/support_type_model.npz --threshold 0.8
+"""
+
+import os
+import sys
+import json
+import argparse
+
+# プロジェクトルートをパスに追加
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversation_agent.support_classifier import (
+    SupportTypeClassifier,
+    evaluate,
+    load_examples,
+    train_from_log
+)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="支援タイプ分類器の学習と評価")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = subparsers.add_parser("train", help="判定ログから学習してモデルを保存（ホールドアウトで評価）")
+    train_parser.add_argument("--log", required=True, help="判定ログ（JSONL）")
+    train_parser.add_argument("--model", required=True, help="保存先（.npz）")
+    train_parser.add_argument("--epochs", type=int, default=500)
+    train_parser.add_argument("--learning-rate", type=float, default=2.0)
+    train_parser.add_argument("--holdout", type=float, default=0.2)
+    train_parser.add_argument("--threshold", type=float, default=0.8)
+
+    eval_parser = subparsers.add_parser("evaluate", help="判定ログに対するLLM判定との一致率を表示")
+    eval_parser.add_argument("--log", required=True, help="判定ログ（JSONL）")
+    eval_parser.add_argument("--model", required=True, help="学習済みモデル（.npz）")
+    eval_parser.add_argument("--threshold", type=float, default=0.8)
+
+    args = parser.parse_args()
+
+    if args.command == "train":
+        classifier, report = train_from_log(
+            args.log, epochs=args.epochs, learning_rate=args.learning_rate,
+            holdout=args.holdout, threshold=args.threshold
+        )
+        classifier.save(args.model)
+        print(f"モデルを保存しました: {args.model}")
+    else:
+        classifier = SupportTypeClassifier.load(args.model)
+        features, targets = load_examples(args.log, classifier.labels)
+        report = evaluate(classifier, features, targets, args.threshold)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
@@ -0,0 +1,366 @@
+"""
+プロセス内ベクトルインデックス
+会話ごとに埋め込みベクトルを連続した float32 行列として保持し、pgvector やDBへの往復なしに
+コサイン類似度の上位k件を行列積1回で求めます（1ターンあたり数ミリ秒）。
+
+- ベクトルは正規化して保存し、類似度は内積で計算（ゼロベクトルは保存しない）
+- VECTOR_INDEX_DIR を指定すると会話ごとに追記専用のセグメントに書き込み、再起動後はメモリマップで読み込む
+  （<ディレクトリ>/<会話キーのハッシュ>/ に vectors.f32: 生の float32 行 / records.jsonl: 行ごとのID・本文・メタデータ /
+  meta.json: 会話キーと次元数。書き込みが途中で止まった場合は読み込み時に短い方に揃える）
+- 読み込み後に追加したベクトルは容量を倍々に確保したメモリ上の行列に追記
+- 検索は exclude_recent_n（追加順で最後のn件を除外）・exclude_ids・min_similarity で絞り込み、argpartition で上位k件を選ぶ
+- メモリ上に保持する会話数は VECTOR_INDEX_MAX_NAMESPACES（LRU、外れた会話はディスクから読み直す）
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VECTORS_FILE = "vectors.f32"
+RECORDS_FILE = "records.jsonl"
+META_FILE = "meta.json"
+
+
+@dataclass
+class VectorHit:
+    """検索結果"""
+    id: Any
+    text: str
+    score: float
+    metadata: Dict[str, Any] = field(default_factory=dict)
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+class _Namespace:
+    """1つの会話のベクトル（メモリマップした読み込み済み部分 + メモリ上の追記部分）"""
+
+    def __init__(self, dim: int, base: Optional[np.ndarray] = None):
+        self.dim = dim
+        self.base = base if base is not None else np.empty((0, dim), dtype=np.float32)
+        self.tail = np.empty((0, dim), dtype=np.float32)
+        self.tail_size = 0
+        self.ids: List[Any] = []
+        self.texts: List[str] = []
+        self.metadata: List[Dict[str, Any]] = []
+        self.positions: Dict[Any, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def append_records(self, ids: Sequence[Any], texts: Sequence[str], metadata: Sequence[Dict[str, Any]]):
+        for msg_id, text, meta in zip(ids, texts, metadata):
+            self.positions[msg_id] = len(self.ids)
+            self.ids.append(msg_id)
+            self.texts.append(text)
+            self.metadata.append(meta)
+
+    def append_vectors(self, vectors: np.ndarray):
+        needed = self.tail_size + len(vectors)
+        if needed > len(self.tail):
+            capacity = max(needed, 2 * len(self.tail), 64)
+            grown = np.empty((capacity, self.dim), dtype=np.float32)
+            grown[:self.tail_size] = self.tail[:self.tail_size]
+            self.tail = grown
+        self.tail[self.tail_size:needed] = vectors
+        self.tail_size = needed
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        tail = self.tail[:self.tail_size]
+        if not len(self.base):
+            return tail @ query
+        if not len(tail):
+            return np.asarray(self.base @ query)
+        return np.concatenate([self.base @ query, tail @ query])
+
+
+class VectorIndex:
+    """会話ごとの埋め込みベクトルのインデックス"""
+
+    def __init__(self, root_dir: Optional[str] = None, max_namespaces: Optional[int] = None):
+        if root_dir is None:
+            root_dir = os.environ.get("VECTOR_INDEX_DIR", "")
+        if max_namespaces is None:
+            max_namespaces = int(os.environ.get("VECTOR_INDEX_MAX_NAMESPACES", "1000"))
+
+        self.root_dir = root_dir or None
+        self.max_namespaces = max(1, max_namespaces)
+
+        self._lock = threading.Lock()
+        self._namespaces: "OrderedDict[str, _Namespace]" = OrderedDict()
+        self._searches = 0
+        self._search_seconds = 0.0
+        self._added = 0
+
+        if self.root_dir:
+            os.makedirs(self.root_dir, exist_ok=True)
+
+    # ---------------------------------
+    # 追加
+    # ---------------------------------
+
+    def add(
+        self,
+        namespace: str,
+        ids: Sequence[Any],
+        texts: Sequence[str],
+        vectors: Iterable[Any],
+        metadata: Optional[Sequence[Dict[str, Any]]] = None
+    ) -> int:
+        """
+        ベクトルを追加（登録済みのIDとゼロベクトルは無視）
+
+        Returns:
+            追加した件数
+        """
+        matrix = np.asarray(list(vectors) if not isinstance(vectors, np.ndarray) else vectors, dtype=np.float32)
+        if matrix.ndim != 2 or not len(matrix):
+            return 0
+        metadata = list(metadata) if metadata is not None else [{} for _ in ids]
+
+        with self._lock:
+            space = self._get_namespace(namespace, dim=matrix.shape[1])
+            if matrix.shape[1] != space.dim:
+                raise ValueError(f"ベクトルの次元が一致しません: {matrix.shape[1]} != {space.dim}")
+
+            # 登録済み・同じバッチ内で重複するID（最初の1件を残す）とゼロベクトルを除く
+            keep = []
+            seen = set()
+            for index, msg_id in enumerate(ids):
+                if msg_id in space.positions or msg_id in seen or not np.any(matrix[index]):
+                    continue
+                seen.add(msg_id)
+                keep.append(index)
+            if not keep:
+                return 0
+
+            rows = _normalize_rows(matrix[keep])
+            new_ids = [ids[index] for index in keep]
+            new_texts = [texts[index] for index in keep]
+            new_metadata = [metadata[index] or {} for index in keep]
+
+            if self.root_dir:
+                self._append_segment(namespace, space.dim, rows, new_ids, new_texts, new_metadata)
+            space.append_vectors(rows)
+            space.append_records(new_ids, new_texts, new_metadata)
+            self._added += len(keep)
+            return len(keep)
+
+    def contains(self, namespace: str, msg_id: Any) -> bool:
+        with self._lock:
+            space = self._get_namespace(namespace)
+            return space is not None and msg_id in space.positions
+
+    def missing_ids(self, namespace: str, ids: Iterable[Any]) -> List[Any]:
+        """まだ登録されていないID（入力の順序のまま）"""
+        with self._lock:
+            space = self._get_namespace(namespace)
+            if space is None:
+                return list(ids)
+            return [msg_id for msg_id in ids if msg_id not in space.positions]
+
+    # ---------------------------------
+    # 検索
+    # ---------------------------------
+
+    def search(
+        self,
+        namespace: str,
+        query: Any,
+        k: int = 10,
+        min_similarity: float = 0.0,
+        exclude_recent_n: int = 0,
+        exclude_ids: Optional[Iterable[Any]] = None
+    ) -> List[VectorHit]:
+        """
+        コサイン類似度の上位k件（類似度の高い順）
+
+        Args:
+            exclude_recent_n: 追加順で最後のn件を除外（直近会話としてプロンプトに入っている発話）
+            exclude_ids: 除外するID
+        """
+        start = time.perf_counter()
+        query = np.asarray(query, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(query))
+
+        with self._lock:
+            space = self._get_namespace(namespace)
+            if space is None or not len(space) or norm == 0 or k <= 0:
+                return []
+            if query.shape[0] != space.dim:
+                raise ValueError(f"ベクトルの次元が一致しません: {query.shape[0]} != {space.dim}")
+
+            scores = space.scores(query / norm)
+            valid = scores >= min_similarity
+            if exclude_recent_n > 0:
+                valid[max(0, len(scores) - exclude_recent_n):] = False
+            for msg_id in exclude_ids or ():
+                position = space.positions.get(msg_id)
+                if position is not None:
+                    valid[position] = False
+
+            candidates = np.flatnonzero(valid)
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+            ordered = candidates[np.argsort(-scores[candidates], kind="stable")]
+            hits = [
+                VectorHit(space.ids[i], space.texts[i], float(scores[i]), dict(space.metadata[i]))
+                for i in ordered
+            ]
+
+            self._searches += 1
+            self._search_seconds += time.perf_counter() - start
+        return hits
+
+    # ---------------------------------
+    # セグメント
+    # ---------------------------------
+
+    def _namespace_dir(self, namespace: str) -> str:
+        digest = hashlib.sha1(namespace.encode("utf-8")).hexdigest()[:20]
+        return os.path.join(self.root_dir, digest)
+
+    def _get_namespace(self, namespace: str, dim: Optional[int] = None) -> Optional[_Namespace]:
+        """メモリ上の会話を取得（なければディスクから読み込み、dim の指定があれば新しく作る）"""
+        space = self._namespaces.get(namespace)
+        if space is not None:
+            self._namespaces.move_to_end(namespace)
+            return space
+
+        if self.root_dir:
+            space = self._load_segment(namespace)
+        if space is None and dim is not None:
+            space = _Namespace(dim)
+        if space is None:
+            return None
+
+        self._namespaces[namespace] = space
+        if len(self._namespaces) > self.max_namespaces:
+            self._namespaces.popitem(last=False)
+        return space
+
+    def _load_segment(self, namespace: str) -> Optional[_Namespace]:
+        directory = self._namespace_dir(namespace)
+        meta_path = os.path.join(directory, META_FILE)
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                dim = int(json.load(f)["dim"])
+            vectors_path = os.path.join(directory, VECTORS_FILE)
+            records_path = os.path.join(directory, RECORDS_FILE)
+
+            records = []
+            if os.path.exists(records_path):
+                with open(records_path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            records.append(json.loads(line))
+                        except json.JSONDecodeError:
+                            break
+            vectors_size = os.path.getsize(vectors_path) if os.path.exists(vectors_path) else 0
+
+            # 書き込みが途中で止まった場合は短い方に揃える（以降の追記の位置がずれないように）
+            count = min(vectors_size // (4 * dim), len(records))
+            if vectors_size != count * 4 * dim:
+                os.truncate(vectors_path, count * 4 * dim)
+            if len(records) != count or self._has_partial_line(records_path):
+                with open(records_path, "w", encoding="utf-8") as f:
+                    for record in records[:count]:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+            base = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(count, dim)) if count else None
+            space = _Namespace(dim, base)
+            space.append_records(
+                [record.get("id") for record in records[:count]],
+                [record.get("text", "") for record in records[:count]],
+                [record.get("metadata") or {} for record in records[:count]]
+            )
+            return space
+        except Exception as e:
+            logger.error(f"❌ ベクトルインデックスの読み込みエラー（空のインデックスで継続）: {e}")
+            return None
+
+    @staticmethod
+    def _has_partial_line(records_path: str) -> bool:
+        """末尾に途中まで書かれた行があるか"""
+        if not os.path.exists(records_path) or not os.path.getsize(records_path):
+            return False
+        with open(records_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b"\n"
+
+    def _append_segment(
+        self,
+        namespace: str,
+        dim: int,
+        rows: np.ndarray,
+        ids: List[Any],
+        texts: List[str],
+        metadata: List[Dict[str, Any]]
+    ):
+        directory = self._namespace_dir(namespace)
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, META_FILE)
+        if not os.path.exists(meta_path):
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump({"namespace": namespace, "dim": dim}, f, ensure_ascii=False)
+
+        with open(os.path.join(directory, VECTORS_FILE), "ab") as f:
+            f.write(np.ascontiguousarray(rows, dtype="<f4").tobytes())
+        with open(os.path.join(directory, RECORDS_FILE), "a", encoding="utf-8") as f:
+            for msg_id, text, meta in zip(ids, texts, metadata):
+                f.write(json.dumps({"id": msg_id, "text": text, "metadata": meta}, ensure_ascii=False, default=str) + "\n")
+
+    # ---------------------------------
+    # メトリクス
+    # ---------------------------------
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "persistent": self.root_dir is not None,
+                "namespaces": len(self._namespaces),
+                "vectors": sum(len(space) for space in self._namespaces.values()),
+                "added": self._added,
+                "searches": self._searches,
+                "average_search_ms": self._search_seconds / self._searches * 1000 if self._searches else 0,
+            }
+
+    def reset(self) -> None:
+        """メモリ上の会話を破棄（ディスクのセグメントは残す）"""
+        with self._lock:
+            self._namespaces.clear()
+            self._searches = 0
+            self._search_seconds = 0.0
+            self._added = 0
+
+
+# シングルトンインスタンスを管理
+_index_instance: Optional[VectorIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_vector_index() -> VectorIndex:
+    """プロセス共通のベクトルインデックスを取得"""
+    global _index_instance
+
+    if _index_instance is None:
+        with _index_lock:
+            if _index_instance is None:
+                _index_instance = VectorIndex()
+
+    return _index_instance
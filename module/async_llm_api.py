@@ -4,12 +4,20 @@
 """
 
 import os
+import time
 import asyncio
 from typing import List, Dict, Any, Optional
 from openai import AsyncOpenAI, OpenAI
-from dotenv import load_dotenv
 from prompt.prompt import dev_system_prompt, system_prompt
 from module.llm_api import learning_plannner
+from module.llm_coalescer import get_llm_coalescer, make_request_key
+from module.rate_pacer import RATE_LIMIT_RETRIES, get_rate_pacer
+from module.fair_scheduler import get_fair_scheduler
+from module.http_clients import get_shared_async_openai_client
+from module.circuit_breaker import CircuitOpenError
+from module.llm_usage import record_llm_usage
+from module.model_router import get_model_router
+from module.token_budget import TokenBudget, extract_completion, get_token_budget_policy
 
 
 class AsyncLearningPlanner(learning_plannner):
@@ -18,29 +26,28 @@ class AsyncLearningPlanner(learning_plannner):
     既存のクラスを継承し、非同期メソッドを追加
     """
     
-    def __init__(self, pool_size: int = 5):
+    def __init__(
+        self,
+        pool_size: int = 5,
+        sync_client: Optional[OpenAI] = None,
+        async_client: Optional[AsyncOpenAI] = None
+    ):
         """
         初期化
         
         Args:
-            pool_size: 並列処理用のクライアントプール数
+            pool_size: LLM同時実行枠数（共有スケジューラの初回生成時のみ有効）
+            sync_client: 同期OpenAIクライアント（省略時は共有クライアント）
+            async_client: 非同期OpenAIクライアント（省略時は共有クライアント。
+                          タイムアウト30秒、HTTP接続プールをプロセス内で共有。
+                          429はSDKではなくレートペーサーで再試行）
         """
-        super().__init__()
-        
-        # 非同期クライアントの初期化
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OpenAI APIキーが設定されていません。環境変数OPENAI_API_KEYを設定してください。")
-        
-        # 非同期クライアントを作成
-        self.async_client = AsyncOpenAI(
-            api_key=api_key,
-            timeout=30.0,  # タイムアウトを30秒に設定
-            max_retries=2   # リトライを2回に制限
-        )
+        super().__init__(client=sync_client)
         
-        # セマフォでAPI同時呼び出し数を制限
-        self.semaphore = asyncio.Semaphore(pool_size)
+        self.async_client = async_client or get_shared_async_openai_client()
+        
+        # API同時呼び出し数をユーザー単位の公平スケジューラで制限
+        self.scheduler = get_fair_scheduler(capacity=pool_size)
         
         # メトリクス収集用
         self.request_count = 0
@@ -50,48 +57,88 @@ class AsyncLearningPlanner(learning_plannner):
         """
         対話履歴を考慮してLLMから非同期で応答を生成
         
+        同一内容の呼び出しが同時に進行中の場合は上流呼び出しを共有する
+        
         Args:
             messages: メッセージ履歴
             
         Returns:
             LLMからの応答テキスト
+            
+        Raises:
+            CircuitOpenError: OpenAIの障害でサーキットが open の場合
         """
+        # 振り分けたモデルごとに合流させる（同じ内容でもモデルが違えば別の呼び出し）
+        router = get_model_router()
+        decision = router.route(messages, self.model)
+        budget = get_token_budget_policy().budget()
+        key = make_request_key(decision.model, messages, temperature=0.7, max_tokens=budget.max_tokens)
+        return await get_llm_coalescer().run(
+            key,
+            lambda: router.run(
+                decision, self.model,
+                lambda model: self._generate_response_uncoalesced(messages, model, budget)
+            )
+        )
+    
+    async def _generate_response_uncoalesced(
+        self,
+        messages: List[Dict[str, Any]],
+        model: Optional[str] = None,
+        budget: Optional[TokenBudget] = None
+    ) -> str:
+        """generate_response_async の実処理（合流層・モデル振り分けを通さない）"""
         import time
         start_time = time.time()
+        model = model or self.model
+        policy = get_token_budget_policy()
+        budget = budget or policy.budget()
+        
+        async def call(limit: int):
+            async def send(slot):
+                # サーキットブレーカーはHTTP呼び出しだけを囲む（プローブが待機列で枠を占有しない）
+                async with self.breaker.guard():
+                    response = await self.async_client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=0.7,
+                        max_tokens=limit
+                    )
+                slot.record_usage(response)
+                return response
+            
+            # サーキットが open なら待機列に並ぶ前に即座に失敗させる（429はペーサーが1回だけ再試行）
+            self.breaker.raise_if_open()
+            async with self.scheduler.slot():
+                response = await get_rate_pacer().run_paced(messages, limit, send)
+            record_llm_usage(model, response)
+            return response
         
         try:
-            # セマフォを使用して同時実行数を制限
-            async with self.semaphore:
-                response = await self.async_client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    temperature=0.7,
-                    max_tokens=2000
-                )
-                
-                # メトリクス更新
-                response_time = time.time() - start_time
-                self.request_count += 1
-                self.total_response_time += response_time
-                
-                if self.request_count % 10 == 0:  # 10リクエストごとにログ
-                    avg_time = self.total_response_time / self.request_count
-                    import logging
-                    logger = logging.getLogger(__name__)
-                    logger.info(f"📊 OpenAI API平均応答時間: {avg_time:.2f}秒")
-                
-                return response.choices[0].message.content
+            # 予算で打ち切られた場合は上限の予算で再試行
+            response = await policy.complete(budget, call)
+            
+            # メトリクス更新
+            response_time = time.time() - start_time
+            self.request_count += 1
+            self.total_response_time += response_time
+            
+            if self.request_count % 10 == 0:  # 10リクエストごとにログ
+                avg_time = self.total_response_time / self.request_count
+                import logging
+                logger = logging.getLogger(__name__)
+                logger.info(f"📊 OpenAI API平均応答時間: {avg_time:.2f}秒")
+            
+            return response.choices[0].message.content
                 
+        except CircuitOpenError:
+            raise
         except Exception as e:
             import logging
             logger = logging.getLogger(__name__)
             logger.error(f"❌ OpenAI API非同期呼び出しエラー: {e}")
-            
-            # フォールバック: 同期版を非同期で実行
-            return await asyncio.to_thread(
-                self.generate_response,
-                messages
-            )
+            # 同期クライアントでの再試行は障害中の上流への負荷を倍増させるため行わない
+            raise
     
     async def generate_response_streaming(
         self, 
@@ -108,32 +155,73 @@ class AsyncLearningPlanner(learning_plannner):
         Yields:
             レスポンスのチャンク
         """
+        # ストリーミングは送信済みのチャンクを取り消せないため、エスカレーション・打ち切り時の再試行はせず振り分けと予算だけ適用
+        router = get_model_router()
+        decision = router.route(messages, self.model)
+        model = decision.model
+        policy = get_token_budget_policy()
+        budget = policy.budget()
+        start = time.perf_counter()
+        failed = False
+        pacer = get_rate_pacer()
+        stream = None
         try:
-            async with self.semaphore:
-                stream = await self.async_client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    temperature=0.7,
-                    max_tokens=2000,
-                    stream=True
-                )
+            self.breaker.raise_if_open()
+            async with self.scheduler.slot():
+                for attempt in range(RATE_LIMIT_RETRIES + 1):
+                    try:
+                        async with pacer.paced(messages, budget.max_tokens) as slot, self.breaker.guard():
+                            stream = await self.async_client.chat.completions.create(
+                                model=model,
+                                messages=messages,
+                                temperature=0.7,
+                                max_tokens=budget.max_tokens,
+                                stream=True,
+                                stream_options={"include_usage": True}
+                            )
+                            
+                            full_content = ""
+                            completion_tokens = None
+                            finish_reason = None
+                            try:
+                                async for chunk in stream:
+                                    tokens, reason = extract_completion(chunk)
+                                    completion_tokens = tokens if tokens is not None else completion_tokens
+                                    finish_reason = reason or finish_reason
+                                    if chunk.usage is not None:
+                                        # include_usage 指定時は最後のチャンクにusageが入る
+                                        slot.record_usage(chunk.usage)
+                                        record_llm_usage(model, chunk.usage)
+                                    if chunk.choices and chunk.choices[0].delta.content is not None:
+                                        content = chunk.choices[0].delta.content
+                                        full_content += content
+                                        
+                                        if callback:
+                                            await callback(content)
+                                        
+                                        yield content
+                            finally:
+                                # 呼び出し側が途中で離脱した場合も上流の生成を打ち切る
+                                await stream.close()
+                        break
+                    except Exception as e:
+                        # ストリーム開始前の429だけクールダウン後に1回再試行（送信済みのチャンクは取り消せない）
+                        if stream is not None or attempt >= RATE_LIMIT_RETRIES or not pacer.should_retry(e):
+                            raise
                 
-                full_content = ""
-                async for chunk in stream:
-                    if chunk.choices[0].delta.content is not None:
-                        content = chunk.choices[0].delta.content
-                        full_content += content
-                        
-                        if callback:
-                            await callback(content)
-                        
-                        yield content
+                # 最後まで受信した場合だけ出力トークン数と打ち切りを記録
+                policy.observe_completion(budget, completion_tokens, finish_reason)
                 
+        except CircuitOpenError:
+            raise
         except Exception as e:
+            failed = True
             import logging
             logger = logging.getLogger(__name__)
             logger.error(f"❌ ストリーミングAPI呼び出しエラー: {e}")
             raise
+        finally:
+            router.record(decision, time.perf_counter() - start, ok=not failed)
     
     async def batch_generate_responses(
         self, 
@@ -187,6 +275,9 @@ class AsyncLearningPlanner(learning_plannner):
             # まずメインモデルで試行
             return await self.generate_response_async(messages)
             
+        except CircuitOpenError:
+            # フォールバックモデルも同じ上流のため試行しない
+            raise
         except Exception as primary_error:
             import logging
             logger = logging.getLogger(__name__)
@@ -195,14 +286,24 @@ class AsyncLearningPlanner(learning_plannner):
             if fallback_model:
                 try:
                     # フォールバックモデルで再試行
-                    async with self.semaphore:
-                        response = await self.async_client.chat.completions.create(
-                            model=fallback_model,
-                            messages=messages,
-                            temperature=0.7,
-                            max_tokens=1500  # フォールバックは少し制限
-                        )
-                        return response.choices[0].message.content
+                    budget = get_token_budget_policy().budget()
+                    
+                    async def send(slot):
+                        async with self.breaker.guard():
+                            response = await self.async_client.chat.completions.create(
+                                model=fallback_model,
+                                messages=messages,
+                                temperature=0.7,
+                                max_tokens=budget.max_tokens
+                            )
+                        slot.record_usage(response)
+                        return response
+                    
+                    self.breaker.raise_if_open()
+                    async with self.scheduler.slot():
+                        response = await get_rate_pacer().run_paced(messages, budget.max_tokens, send)
+                    record_llm_usage(fallback_model, response)
+                    return response.choices[0].message.content
                         
                 except Exception as fallback_error:
                     logger.error(f"❌ フォールバックモデルもエラー: {fallback_error}")
@@ -217,17 +318,13 @@ class AsyncLearningPlanner(learning_plannner):
         Returns:
             メトリクス情報のDict
         """
-        if self.request_count == 0:
-            return {
-                "total_requests": 0,
-                "average_response_time": 0,
-                "active_connections": self.semaphore._value if hasattr(self.semaphore, '_value') else None
-            }
-        
+        scheduler_metrics = self.scheduler.get_metrics()
         return {
             "total_requests": self.request_count,
-            "average_response_time": self.total_response_time / self.request_count,
-            "active_connections": self.semaphore._value if hasattr(self.semaphore, '_value') else None
+            "average_response_time": self.total_response_time / self.request_count if self.request_count else 0,
+            "active_connections": scheduler_metrics["active"],
+            "queue_depth": scheduler_metrics["queue_depth"],
+            "circuit_state": self.breaker.state
         }
 
 
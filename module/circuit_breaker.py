@@ -0,0 +1,373 @@
+"""
+LLM呼び出し用サーキットブレーカー
+上流（OpenAI）の障害時に呼び出しを即座に失敗させ、タイムアウト待ちのスレッドや
+リクエストが各ワーカーに積み上がるのを防ぎます。
+
+状態遷移:
+    closed    通常状態。連続失敗が閾値に達すると open へ
+    open      呼び出しを CircuitOpenError で即座に拒否。reset_timeout 経過後に half_open へ
+    half_open 試行呼び出し（プローブ）を上限数まで通す。成功で closed、失敗で再び open へ
+
+設定（環境変数）:
+    ENABLE_LLM_CIRCUIT_BREAKER     有効化（デフォルト: true）
+    LLM_CIRCUIT_FAILURE_THRESHOLD  open にする連続失敗回数（デフォルト: 5）
+    LLM_CIRCUIT_RESET_TIMEOUT      open から half_open に移るまでの秒数（デフォルト: 30）
+    LLM_CIRCUIT_HALF_OPEN_MAX      half_open で同時に通すプローブ数（デフォルト: 1）
+"""
+
+import os
+import time
+import threading
+import logging
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# guard_thread の内側か（スレッドで実行される guard_sync は記録せず、呼び出し側でまとめて1回記録する）
+_guarded_by_caller: ContextVar[bool] = ContextVar("circuit_guarded_by_caller", default=False)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """サーキットが open のため呼び出しを拒否したことを示す例外"""
+
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = max(0.0, retry_after)
+        super().__init__(
+            f"LLMサービスが一時的に利用できません（サーキット '{name}' が open、"
+            f"{self.retry_after:.0f}秒後に再試行）"
+        )
+
+
+def is_upstream_failure(exc: BaseException) -> bool:
+    """
+    上流の障害として数える例外か判定
+
+    接続エラー・タイムアウト・5xxは障害とみなす。
+    429（レート制限）はレートペーサーのクールダウンで扱うため数えない。
+    その他の4xx（不正なリクエストなど）も上流が応答できているため数えない
+    """
+    status_code = getattr(exc, "status_code", None)
+    if isinstance(status_code, int) and 400 <= status_code < 500:
+        return status_code == 408
+    return True
+
+
+@dataclass
+class CircuitMetrics:
+    """サーキットブレーカーのメトリクス"""
+    total_calls: int = 0
+    successful_calls: int = 0
+    failed_calls: int = 0
+    rejected_calls: int = 0
+    probe_calls: int = 0
+    transitions: Dict[str, int] = field(default_factory=dict)
+    last_failure: Optional[str] = None
+    last_failure_time: Optional[float] = None
+
+
+class CircuitBreaker:
+    """
+    closed / open / half_open の3状態を持つサーキットブレーカー
+
+    使い方（guard はスケジューラ・ペーサーの待機の内側で、HTTP呼び出しだけを囲む）:
+        breaker.raise_if_open()
+        async with scheduler.slot(), pacer.paced(messages) as slot:
+            async with breaker.guard():
+                response = await client.chat.completions.create(...)
+
+        with breaker.guard_sync():
+            response = client.chat.completions.create(...)
+
+    asyncio.to_thread 経由の同期呼び出しからも使われるため、状態はロックで保護する
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: Optional[int] = None,
+        reset_timeout: Optional[float] = None,
+        half_open_max_calls: Optional[int] = None,
+        enabled: Optional[bool] = None,
+        max_recorded_transitions: int = 50
+    ):
+        self.name = name
+        if failure_threshold is None:
+            failure_threshold = int(os.environ.get("LLM_CIRCUIT_FAILURE_THRESHOLD", "5"))
+        if reset_timeout is None:
+            reset_timeout = float(os.environ.get("LLM_CIRCUIT_RESET_TIMEOUT", "30"))
+        if half_open_max_calls is None:
+            half_open_max_calls = int(os.environ.get("LLM_CIRCUIT_HALF_OPEN_MAX", "1"))
+        if enabled is None:
+            enabled = os.environ.get("ENABLE_LLM_CIRCUIT_BREAKER", "true").lower() == "true"
+
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = max(0.0, reset_timeout)
+        self.half_open_max_calls = max(1, half_open_max_calls)
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._state = STATE_CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._half_open_in_flight = 0
+        self._recent_transitions: Deque[Dict[str, Any]] = deque(maxlen=max_recorded_transitions)
+        self.metrics = CircuitMetrics()
+
+    # ---------------------------------
+    # 状態
+    # ---------------------------------
+
+    @property
+    def state(self) -> str:
+        """現在の状態（open でリセット時間が経過していれば half_open に遷移させる）"""
+        with self._lock:
+            self._refresh_state()
+            return self._state
+
+    def _refresh_state(self) -> None:
+        if self._state == STATE_OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._transition(STATE_HALF_OPEN)
+
+    def _retry_after(self) -> float:
+        return self.reset_timeout - (time.monotonic() - self._opened_at)
+
+    def _transition(self, new_state: str) -> None:
+        old_state = self._state
+        if old_state == new_state:
+            return
+        self._state = new_state
+        if new_state == STATE_OPEN:
+            self._opened_at = time.monotonic()
+        if new_state != STATE_HALF_OPEN:
+            self._half_open_in_flight = 0
+
+        key = f"{old_state}->{new_state}"
+        self.metrics.transitions[key] = self.metrics.transitions.get(key, 0) + 1
+        self._recent_transitions.append({
+            "from": old_state,
+            "to": new_state,
+            "at": time.time(),
+            "consecutive_failures": self._consecutive_failures,
+        })
+
+        if new_state == STATE_OPEN:
+            logger.warning(
+                f"🚨 サーキット '{self.name}' open（連続失敗{self._consecutive_failures}回、"
+                f"{self.reset_timeout:.0f}秒間呼び出しを遮断）"
+            )
+        elif new_state == STATE_HALF_OPEN:
+            logger.info(f"🔁 サーキット '{self.name}' half_open（試行呼び出しを許可）")
+        else:
+            logger.info(f"✅ サーキット '{self.name}' closed（上流が復旧）")
+
+    # ---------------------------------
+    # 呼び出しの許可と結果の記録
+    # ---------------------------------
+
+    def raise_if_open(self) -> None:
+        """
+        待機列に並ぶ前の事前チェック（open なら待たずに失敗させる。プローブ枠は消費しない）
+
+        Raises:
+            CircuitOpenError: open の場合
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._refresh_state()
+            if self._state == STATE_OPEN:
+                self.metrics.rejected_calls += 1
+                raise CircuitOpenError(self.name, self._retry_after())
+
+    def before_call(self) -> bool:
+        """
+        呼び出し前のチェック
+
+        Returns:
+            half_open のプローブとして許可された場合True
+
+        Raises:
+            CircuitOpenError: open、またはプローブ枠が埋まっている場合
+        """
+        if not self.enabled:
+            return False
+
+        with self._lock:
+            self._refresh_state()
+            if self._state == STATE_OPEN:
+                self.metrics.rejected_calls += 1
+                raise CircuitOpenError(self.name, self._retry_after())
+            if self._state == STATE_HALF_OPEN:
+                if self._half_open_in_flight >= self.half_open_max_calls:
+                    self.metrics.rejected_calls += 1
+                    raise CircuitOpenError(self.name, 0.0)
+                self._half_open_in_flight += 1
+                self.metrics.probe_calls += 1
+                self.metrics.total_calls += 1
+                return True
+            self.metrics.total_calls += 1
+            return False
+
+    def record_success(self, probe: bool = False) -> None:
+        """呼び出し成功を記録"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.metrics.successful_calls += 1
+            self._consecutive_failures = 0
+            if probe and self._state == STATE_HALF_OPEN:
+                self._transition(STATE_CLOSED)
+
+    def record_failure(self, exc: Optional[BaseException] = None, probe: bool = False) -> None:
+        """呼び出し失敗を記録"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.metrics.failed_calls += 1
+            self.metrics.last_failure = repr(exc) if exc is not None else None
+            self.metrics.last_failure_time = time.time()
+            self._consecutive_failures += 1
+            if self._state == STATE_HALF_OPEN:
+                if probe:
+                    self._transition(STATE_OPEN)
+            elif self._state == STATE_CLOSED and self._consecutive_failures >= self.failure_threshold:
+                self._transition(STATE_OPEN)
+
+    def _release_probe(self, probe: bool) -> None:
+        """結果を判定できなかったプローブ（キャンセルなど）の枠を返す"""
+        if not probe:
+            return
+        with self._lock:
+            if self._state == STATE_HALF_OPEN and self._half_open_in_flight > 0:
+                self._half_open_in_flight -= 1
+
+    def _record_exception(self, exc: Exception, probe: bool) -> None:
+        if is_upstream_failure(exc):
+            self.record_failure(exc, probe=probe)
+        else:
+            # 上流は応答できている
+            self.record_success(probe=probe)
+
+    @asynccontextmanager
+    async def guard(self):
+        """非同期呼び出しをサーキットブレーカーで保護する"""
+        probe = self.before_call()
+        try:
+            yield
+        except Exception as e:
+            self._record_exception(e, probe)
+            raise
+        except BaseException:
+            # キャンセルや呼び出し側の離脱は上流の成否として数えない
+            self._release_probe(probe)
+            raise
+        else:
+            self.record_success(probe=probe)
+
+    @asynccontextmanager
+    async def guard_thread(self):
+        """
+        asyncio.to_thread で実行する同期呼び出しを、呼び出し側でまとめて保護する
+
+        タイムアウトで待つのをやめてもスレッド内の呼び出しは完了まで続くため、スレッド内の guard_sync では
+        記録せず、ここで1回だけ記録する（タイムアウトは障害として数える）
+        """
+        probe = self.before_call()
+        token = _guarded_by_caller.set(True)
+        try:
+            yield
+        except CircuitOpenError:
+            # スレッド内の事前チェックで拒否された（上流は呼んでいない）
+            self._release_probe(probe)
+            raise
+        except Exception as e:
+            self._record_exception(e, probe)
+            raise
+        except BaseException:
+            self._release_probe(probe)
+            raise
+        else:
+            self.record_success(probe=probe)
+        finally:
+            _guarded_by_caller.reset(token)
+
+    @contextmanager
+    def guard_sync(self):
+        """同期呼び出しをサーキットブレーカーで保護する（guard_thread の内側では呼び出し側が記録する）"""
+        if _guarded_by_caller.get():
+            yield
+            return
+        probe = self.before_call()
+        try:
+            yield
+        except Exception as e:
+            self._record_exception(e, probe)
+            raise
+        except BaseException:
+            self._release_probe(probe)
+            raise
+        else:
+            self.record_success(probe=probe)
+
+    # ---------------------------------
+    # メトリクス
+    # ---------------------------------
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """状態と遷移履歴を取得"""
+        with self._lock:
+            self._refresh_state()
+            return {
+                "name": self.name,
+                "enabled": self.enabled,
+                "state": self._state,
+                "consecutive_failures": self._consecutive_failures,
+                "retry_after": max(0.0, self._retry_after()) if self._state == STATE_OPEN else 0.0,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout,
+                "half_open_max_calls": self.half_open_max_calls,
+                "total_calls": self.metrics.total_calls,
+                "successful_calls": self.metrics.successful_calls,
+                "failed_calls": self.metrics.failed_calls,
+                "rejected_calls": self.metrics.rejected_calls,
+                "probe_calls": self.metrics.probe_calls,
+                "transitions": dict(self.metrics.transitions),
+                "recent_transitions": list(self._recent_transitions),
+                "last_failure": self.metrics.last_failure,
+                "last_failure_time": self.metrics.last_failure_time,
+            }
+
+
+# 名前ごとのシングルトンインスタンスを管理
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str = "openai") -> CircuitBreaker:
+    """
+    プロセス共通のサーキットブレーカーを取得
+
+    Args:
+        name: 保護対象の上流名（同じ上流を呼ぶクライアントは同じ名前を使う）
+    """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(name)
+    return breaker
+
+
+def get_all_circuit_metrics() -> Dict[str, Dict[str, Any]]:
+    """全サーキットブレーカーのメトリクスを取得"""
+    return {name: breaker.get_metrics() for name, breaker in list(_breakers.items())}
@@ -0,0 +1,295 @@
+"""
+ユーザー単位の重み付き公平キューイング（WFQ）
+LLMの同時実行枠をユーザーごとに公平に割り当てます。
+
+- 各ユーザー（フロー）のリクエストに仮想終了時刻を割り当て、最小のものから枠を割り当てる。
+  連続してリクエストを送るユーザーほど後ろに並ぶ
+- エンドポイントの分類ごとに重みを設定でき、重みが大きいほど早く順番が回る
+- 1ユーザーが同時に使える枠数に上限を設け、混雑時の占有を防ぐ
+  （上限は他ユーザーの待機者がいる間だけ適用し、空き枠は遊ばせない）
+"""
+
+import os
+import math
+import heapq
+import time
+import asyncio
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from module.llm_context import get_llm_context
+
+logger = logging.getLogger(__name__)
+
+ANONYMOUS_USER_KEY = "anonymous"
+
+
+def _parse_class_weights(raw: str) -> Dict[str, float]:
+    """"chat:2,inquiry:1" 形式の重み設定をパース"""
+    weights = {}
+    for item in raw.split(","):
+        if ":" not in item:
+            continue
+        name, value = item.split(":", 1)
+        try:
+            weights[name.strip()] = max(float(value), 0.01)
+        except ValueError:
+            continue
+    return weights
+
+
+@dataclass
+class UserQueueStats:
+    """ユーザーごとの待ち時間統計"""
+    requests: int = 0
+    total_wait_time: float = 0.0
+    max_wait_time: float = 0.0
+    last_seen: float = 0.0
+
+
+class _Waiter:
+    __slots__ = ("tag", "seq", "user_key", "future", "enqueued_at")
+
+    def __init__(self, tag: float, seq: int, user_key: str, future: "asyncio.Future"):
+        self.tag = tag
+        self.seq = seq
+        self.user_key = user_key
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.tag, self.seq) < (other.tag, other.seq)
+
+
+class FairScheduler:
+    """
+    asyncio.Semaphore の代わりに使う公平スケジューラ
+
+    使い方:
+        async with scheduler.slot():
+            ...  # LLM呼び出し
+    ユーザーキーとエンドポイント分類は引数で渡すか、省略時は llm_context から取得する
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        per_user_max: Optional[int] = None,
+        class_weights: Optional[Dict[str, float]] = None,
+        max_tracked_users: int = 1000
+    ):
+        self.capacity = max(1, int(capacity))
+        if per_user_max is None:
+            per_user_max = int(os.environ.get("LLM_FAIR_PER_USER_MAX", "0")) or max(1, math.ceil(self.capacity / 3))
+        self.per_user_max = max(1, per_user_max)
+        if class_weights is None:
+            class_weights = _parse_class_weights(
+                os.environ.get("LLM_FAIR_CLASS_WEIGHTS", "chat:2,inquiry:1,games:1,other:1")
+            )
+        self.class_weights = class_weights
+        self.max_tracked_users = max_tracked_users
+
+        self._active_total = 0
+        self._active_by_user: Dict[str, int] = {}
+        self._queue: List[_Waiter] = []
+        self._queued_by_user: Dict[str, int] = {}
+        self._last_finish: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._seq = itertools.count()
+
+        self._user_stats: Dict[str, UserQueueStats] = {}
+        self.total_dispatched = 0
+        self.max_queue_depth = 0
+
+        logger.info(
+            f"⚖️ FairScheduler初期化: capacity={self.capacity}, per_user_max={self.per_user_max}, "
+            f"weights={self.class_weights}"
+        )
+
+    # ---------------------------------
+    # 取得と解放
+    # ---------------------------------
+
+    @asynccontextmanager
+    async def slot(self, user_key: Optional[str] = None, endpoint_class: Optional[str] = None):
+        """実行枠を取得し、ブロックを抜けたら解放する"""
+        user_key, endpoint_class = self._resolve(user_key, endpoint_class)
+        await self.acquire(user_key, endpoint_class)
+        try:
+            yield
+        finally:
+            self.release(user_key)
+
+    async def acquire(self, user_key: Optional[str] = None, endpoint_class: Optional[str] = None) -> float:
+        """
+        実行枠を取得（空きがなければ公平順に待機）
+
+        Returns:
+            待ち時間（秒）
+        """
+        user_key, endpoint_class = self._resolve(user_key, endpoint_class)
+        weight = self.class_weights.get(endpoint_class, 1.0)
+
+        # 仮想終了時刻: 待機中のフローの続きか、現在の仮想時刻から開始
+        start = max(self._virtual_time, self._last_finish.get(user_key, 0.0))
+        tag = start + 1.0 / weight
+        self._last_finish[user_key] = tag
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(tag, next(self._seq), user_key, future)
+        heapq.heappush(self._queue, waiter)
+        self._queued_by_user[user_key] = self._queued_by_user.get(user_key, 0) + 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        self._dispatch()
+
+        try:
+            # 空きがあれば _dispatch で即座に割り当て済み（この await は待機しない）
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 枠を割り当てられた直後にキャンセルされた場合は返却する
+                self._release_key(user_key)
+            else:
+                self._remove_waiter(waiter)
+            raise
+
+    def release(self, user_key: Optional[str] = None) -> None:
+        """実行枠を解放（acquire と同じユーザーキーを解決する）"""
+        user_key, _ = self._resolve(user_key, None)
+        self._release_key(user_key)
+
+    def _release_key(self, user_key: str) -> None:
+        self._active_total -= 1
+        remaining = self._active_by_user.get(user_key, 1) - 1
+        if remaining > 0:
+            self._active_by_user[user_key] = remaining
+        else:
+            self._active_by_user.pop(user_key, None)
+        self._dispatch()
+
+    def _resolve(self, user_key: Optional[str], endpoint_class: Optional[str]):
+        if user_key is None or endpoint_class is None:
+            ctx = get_llm_context()
+            user_key = user_key or ctx.user_key or ANONYMOUS_USER_KEY
+            endpoint_class = endpoint_class or ctx.endpoint or "other"
+        return user_key, endpoint_class
+
+    def _grant(self, user_key: str, tag: float, wait: float) -> None:
+        self._active_total += 1
+        self._active_by_user[user_key] = self._active_by_user.get(user_key, 0) + 1
+        self._virtual_time = max(self._virtual_time, tag - 1e-9)
+        self.total_dispatched += 1
+        self._record_wait(user_key, wait)
+
+    def _dispatch(self) -> None:
+        """
+        空き枠に、上限に達していないユーザーの中で仮想時刻が最小の待機者を割り当てる
+
+        上限に達したユーザーの待機者しか残っていない場合は、空き枠を遊ばせずに仮想時刻順で割り当てる
+        """
+        deferred: List[_Waiter] = []
+        while self._queue and self._active_total < self.capacity:
+            waiter = heapq.heappop(self._queue)
+            if waiter.future.done():
+                # キャンセル済み（_remove_waiterで集計済み）
+                continue
+            if self._active_by_user.get(waiter.user_key, 0) >= self.per_user_max:
+                deferred.append(waiter)
+                continue
+            self._start(waiter)
+        for waiter in deferred:
+            if self._active_total < self.capacity and not self._queue:
+                self._start(waiter)
+            else:
+                heapq.heappush(self._queue, waiter)
+
+    def _start(self, waiter: _Waiter) -> None:
+        self._decrement_queued(waiter.user_key)
+        wait = time.monotonic() - waiter.enqueued_at
+        self._grant(waiter.user_key, waiter.tag, wait)
+        waiter.future.set_result(wait)
+
+    def _remove_waiter(self, waiter: _Waiter) -> None:
+        """キャンセルされた待機者を取り除く（ヒープからは遅延削除）"""
+        self._decrement_queued(waiter.user_key)
+        if all(w.future.done() for w in self._queue):
+            self._queue.clear()
+        self._dispatch()
+
+    def _decrement_queued(self, user_key: str) -> None:
+        remaining = self._queued_by_user.get(user_key, 1) - 1
+        if remaining > 0:
+            self._queued_by_user[user_key] = remaining
+        else:
+            self._queued_by_user.pop(user_key, None)
+            if user_key not in self._active_by_user:
+                # 待機も実行もしていないフローは次回、現在の仮想時刻から再開
+                self._last_finish.pop(user_key, None)
+
+    def _record_wait(self, user_key: str, wait: float) -> None:
+        stats = self._user_stats.get(user_key)
+        if stats is None:
+            if len(self._user_stats) >= self.max_tracked_users:
+                oldest = min(self._user_stats, key=lambda k: self._user_stats[k].last_seen)
+                del self._user_stats[oldest]
+            stats = self._user_stats[user_key] = UserQueueStats()
+        stats.requests += 1
+        stats.total_wait_time += wait
+        stats.max_wait_time = max(stats.max_wait_time, wait)
+        stats.last_seen = time.monotonic()
+
+    # ---------------------------------
+    # メトリクス
+    # ---------------------------------
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(self._queued_by_user.values())
+
+    def get_metrics(self, top_n: int = 20) -> Dict[str, Any]:
+        """キュー深さとユーザー別待ち時間を取得（待ち時間の長い順に上位のみ）"""
+        users = sorted(
+            self._user_stats.items(),
+            key=lambda item: item[1].total_wait_time,
+            reverse=True
+        )[:top_n]
+        return {
+            "capacity": self.capacity,
+            "per_user_max": self.per_user_max,
+            "active": self._active_total,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "queued_by_user": dict(self._queued_by_user),
+            "total_dispatched": self.total_dispatched,
+            "users": {
+                key: {
+                    "requests": s.requests,
+                    "average_wait_time": s.total_wait_time / s.requests if s.requests else 0,
+                    "max_wait_time": s.max_wait_time,
+                }
+                for key, s in users
+            },
+        }
+
+
+# シングルトンインスタンスを管理
+_scheduler_instance: Optional[FairScheduler] = None
+
+
+def get_fair_scheduler(capacity: int = 10) -> FairScheduler:
+    """
+    プロセス共通の公平スケジューラを取得
+
+    Args:
+        capacity: 同時実行枠数（初回のみ有効。環境変数 LLM_MAX_CONCURRENCY が優先）
+    """
+    global _scheduler_instance
+
+    if _scheduler_instance is None:
+        capacity = int(os.environ.get("LLM_MAX_CONCURRENCY", "0")) or capacity
+        _scheduler_instance = FairScheduler(capacity=capacity)
+
+    return _scheduler_instance
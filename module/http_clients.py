@@ -0,0 +1,105 @@
+"""
+OpenAIクライアントの共有HTTPトランスポート
+プロセス内の全LLMクライアントで1つのkeep-alive接続プールを共有し、
+クライアントごとに接続プール・ソケットが増えるのを防ぎます。
+
+接続数の上限は環境変数で設定できます:
+    LLM_HTTP_MAX_CONNECTIONS      最大同時接続数（デフォルト: 20）
+    LLM_HTTP_MAX_KEEPALIVE        keep-aliveで保持する接続数（デフォルト: 10）
+    LLM_HTTP_KEEPALIVE_EXPIRY     keep-alive接続の保持秒数（デフォルト: 30）
+    OPENAI_BASE_URL               APIのベースURL（ローカルのスタブサーバーでの計測用。未設定時はOpenAI本番）
+
+共有クライアントはすべて RatePacer を通して呼び出すため、SDK内部のリトライは無効にしています
+（429はペーサーのクールダウンと1回の再試行で扱う。module/rate_pacer.py 参照）。
+"""
+
+import os
+import threading
+import logging
+from typing import Optional
+
+import httpx
+from openai import AsyncOpenAI, OpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+
+logger = logging.getLogger(__name__)
+
+# 非同期クライアントのタイムアウト（AsyncLearningPlannerの従来設定）
+ASYNC_CLIENT_TIMEOUT = 30.0
+# SDK内部のリトライ回数（429がトークンバケットを素通りしないよう無効にする）
+CLIENT_MAX_RETRIES = 0
+
+_lock = threading.Lock()
+_sync_client: Optional[OpenAI] = None
+_async_client: Optional[AsyncOpenAI] = None
+
+
+def get_http_limits() -> httpx.Limits:
+    """環境変数から接続数の上限を取得"""
+    return httpx.Limits(
+        max_connections=int(os.environ.get("LLM_HTTP_MAX_CONNECTIONS", "20")),
+        max_keepalive_connections=int(os.environ.get("LLM_HTTP_MAX_KEEPALIVE", "10")),
+        keepalive_expiry=float(os.environ.get("LLM_HTTP_KEEPALIVE_EXPIRY", "30")),
+    )
+
+
+def get_openai_base_url() -> Optional[str]:
+    """OpenAI APIのベースURL（未設定ならNoneでSDKの既定値を使用）"""
+    return os.getenv("OPENAI_BASE_URL") or None
+
+
+def _require_api_key() -> str:
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OpenAI APIキーが設定されていません。環境変数OPENAI_API_KEYを設定してください。")
+    return api_key
+
+
+def get_shared_openai_client() -> OpenAI:
+    """共有HTTPトランスポートを使う同期OpenAIクライアントを取得"""
+    global _sync_client
+
+    if _sync_client is None:
+        with _lock:
+            if _sync_client is None:
+                _sync_client = OpenAI(
+                    api_key=_require_api_key(),
+                    base_url=get_openai_base_url(),
+                    max_retries=CLIENT_MAX_RETRIES,
+                    http_client=DefaultHttpxClient(limits=get_http_limits()),
+                )
+                logger.info(f"🔌 共有OpenAIクライアント（同期）を作成: {_sync_client.base_url}")
+
+    return _sync_client
+
+
+def get_shared_async_openai_client() -> AsyncOpenAI:
+    """共有HTTPトランスポートを使う非同期OpenAIクライアントを取得"""
+    global _async_client
+
+    if _async_client is None:
+        with _lock:
+            if _async_client is None:
+                _async_client = AsyncOpenAI(
+                    api_key=_require_api_key(),
+                    base_url=get_openai_base_url(),
+                    timeout=ASYNC_CLIENT_TIMEOUT,
+                    max_retries=CLIENT_MAX_RETRIES,
+                    http_client=DefaultAsyncHttpxClient(limits=get_http_limits()),
+                )
+                logger.info(f"🔌 共有OpenAIクライアント（非同期）を作成: {_async_client.base_url}")
+
+    return _async_client
+
+
+async def close_shared_clients() -> None:
+    """共有クライアントの接続を閉じる（アプリケーション終了時）"""
+    global _sync_client, _async_client
+
+    with _lock:
+        sync_client, async_client = _sync_client, _async_client
+        _sync_client = _async_client = None
+
+    if sync_client is not None:
+        sync_client.close()
+    if async_client is not None:
+        await async_client.close()
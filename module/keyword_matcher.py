@@ -0,0 +1,207 @@
+"""
+複数カテゴリのキーワードを1回の走査で検出するマッチャー
+全カテゴリのキーワードを1つの正規表現にまとめてコンパイルし、テキストを1回走査するだけで
+カテゴリごとの出現を取得します。メッセージの重要度分類など、コンテキスト内の全メッセージに対して
+出現数を数えるキーワード判定で使います。
+
+- 出現数は正規表現の findall の1回の走査で求め、出現位置は同じカテゴリのキーワードが重なる場合や
+  sequences() など位置が必要な場合にだけ求める（重なりも含めてすべて検出）
+- 有無の判定だけなら、最初に見つかった時点で打ち切れる in の方が全体を走査する正規表現より速いため、
+  このマッチャーは使わない（ヒューリスティックな状態抽出は in のまま）
+- found() / count() は正規表現の findall と同じく、カテゴリ内で重ならない出現を数える
+- 「Aの後に同じ行でBが続く」（A.*?B 相当）や「末尾がAで終わる」（A$ 相当）も走査結果から判定できる
+"""
+
+import re
+from collections import Counter
+from typing import Dict, List, Mapping, Optional, Sequence, Set, Tuple
+
+# (開始位置, 終了位置, キーワード)
+Occurrence = Tuple[int, int, str]
+# (マッチ開始からのオフセット, キーワード, カテゴリ, テキストでの確認が必要か)
+_Overlap = Tuple[int, str, Tuple[str, ...], bool]
+
+
+class KeywordHits:
+    """1つのテキストに対する走査結果"""
+
+    def __init__(self, matcher: "KeywordMatcher", text: str):
+        self.text = text
+        self._matcher = matcher
+        self._matches: Optional[List[str]] = None
+        self._found: Optional[Dict[str, Dict[str, int]]] = None
+        self._occurrences: Optional[Dict[str, List[Occurrence]]] = None
+
+    def _matched_keywords(self) -> List[str]:
+        # 正規表現による1回の走査（重ならないマッチのキーワード、出現順）
+        if self._matches is None:
+            self._matches = self._matcher._pattern.findall(self.text) if self._matcher._pattern else []
+        return self._matches
+
+    def _all_occurrences(self) -> Dict[str, List[Occurrence]]:
+        if self._occurrences is None:
+            self._occurrences = self._matcher._find_occurrences(self.text)
+        return self._occurrences
+
+    def _count_matches(self) -> Optional[Dict[str, Dict[str, int]]]:
+        """
+        マッチ結果からカテゴリごとの重ならない出現を集計（出現位置を求めない）
+
+        同じカテゴリのキーワード同士が重なる可能性がある場合は、位置から判定するため None を返す
+        """
+        found: Dict[str, Dict[str, int]] = {}
+        overlaps = self._matcher._overlaps
+        for matched, number in Counter(self._matched_keywords()).items():
+            categories_in_match: Set[str] = set()
+            for offset, keyword, categories, verify in overlaps[matched]:
+                if verify:
+                    # マッチにまたがって出現しうる場合（つなげた文字列がテキストにある場合）だけ位置から判定
+                    if matched[:offset] + keyword in self.text:
+                        return None
+                    continue
+                for category in categories:
+                    if category in categories_in_match:
+                        return None
+                    categories_in_match.add(category)
+                    bucket = found.setdefault(category, {})
+                    bucket[keyword] = bucket.get(keyword, 0) + number
+        return found
+
+    def _found_keywords(self) -> Dict[str, Dict[str, int]]:
+        if self._found is None:
+            found = self._count_matches()
+            if found is None:
+                found = {}
+                for category, occurrences in self._all_occurrences().items():
+                    counts: Dict[str, int] = {}
+                    cursor = 0
+                    for start, end, keyword in occurrences:
+                        if start >= cursor:
+                            counts[keyword] = counts.get(keyword, 0) + 1
+                            cursor = end
+                    found[category] = counts
+            self._found = found
+        return self._found
+
+    def found(self, category: str) -> Dict[str, int]:
+        """カテゴリ内で重ならない出現のキーワードと回数（re.findall と同じ数え方）"""
+        return self._found_keywords().get(category, {})
+
+    def count(self, category: str) -> int:
+        """カテゴリ内で重ならない出現の数"""
+        return sum(self.found(category).values())
+
+    def occurrences(self, category: str) -> List[Occurrence]:
+        """カテゴリの全出現（開始位置順）"""
+        return self._all_occurrences().get(category, [])
+
+    def sequences(self, first: str, second: str) -> List[Tuple[str, str]]:
+        """
+        first のキーワードの後に同じ行で second のキーワードが続く組（re.findall("(A).*?(B)") と同じ結果）
+        """
+        if not self.found(first) or not self.found(second):
+            return []
+        return self._matcher._sequence_pattern(first, second).findall(self.text)
+
+    def ending(self, category: str) -> Optional[str]:
+        """テキストの末尾（末尾の改行1つは無視）にあるキーワード（re.search("(A)$") と同じ判定）"""
+        text = self.text[:-1] if self.text.endswith("\n") else self.text
+        endings = [keyword for keyword in self._matcher.categories.get(category, ()) if text.endswith(keyword)]
+        return max(endings, key=len) if endings else None
+
+
+class KeywordMatcher:
+    """カテゴリごとのキーワードをまとめてコンパイルしたマッチャー"""
+
+    def __init__(self, categories: Mapping[str, Sequence[str]], ignore_case: bool = True):
+        self.ignore_case = ignore_case
+        self.categories: Dict[str, Tuple[str, ...]] = {
+            category: tuple(self._normalize(keyword) for keyword in keywords if keyword)
+            for category, keywords in categories.items()
+        }
+
+        keyword_categories: Dict[str, List[str]] = {}
+        for category, keywords in self.categories.items():
+            for keyword in dict.fromkeys(keywords):
+                keyword_categories.setdefault(keyword, []).append(category)
+        keywords = sorted(keyword_categories, key=len, reverse=True)
+
+        # 正規表現は重ならないマッチしか返さないため、マッチしたキーワードと重なる他のキーワードを事前に求めておく
+        # - 内側に含まれるキーワードはマッチだけで確定
+        # - 末尾にまたがるキーワードはマッチ後にテキストで確認
+        self._overlaps: Dict[str, Tuple[_Overlap, ...]] = {}
+        for keyword in keywords:
+            overlaps = []
+            for other in keywords:
+                for offset in range(len(keyword)):
+                    if keyword.startswith(other, offset):
+                        overlaps.append((offset, other, tuple(keyword_categories[other]), False))
+                    elif offset > 0 and len(other) > len(keyword) - offset and other.startswith(keyword[offset:]):
+                        overlaps.append((offset, other, tuple(keyword_categories[other]), True))
+            self._overlaps[keyword] = tuple(sorted(overlaps, key=lambda item: (item[0], -len(item[1]))))
+
+        self._sequence_patterns: Dict[Tuple[str, str], re.Pattern] = {}
+        self._pattern: Optional[re.Pattern] = None
+        if keywords:
+            self._pattern = re.compile(self._trie_pattern(keywords))
+
+    @staticmethod
+    def _trie_pattern(keywords: Sequence[str]) -> str:
+        """
+        キーワードを先頭文字から枝分かれするトライ形式の正規表現にする
+
+        各位置で先頭文字により候補が絞られるため、キーワードを単純に並べた選択より速い。
+        続きのあるキーワードは省略可能なグループにするので、同じ位置では最長のキーワードにマッチする
+        """
+        trie: Dict[str, dict] = {}
+        for keyword in keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[""] = {}
+
+        def render(node: Dict[str, dict]) -> str:
+            branches = [re.escape(char) + render(child) for char, child in sorted(node.items()) if char]
+            if not branches:
+                return ""
+            body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+            return f"(?:{body})?" if "" in node else body
+
+        return render(trie)
+
+    def _sequence_pattern(self, first: str, second: str) -> re.Pattern:
+        # 組み合わせごとにコンパイルしてキャッシュ（選択はカテゴリの定義順）
+        key = (first, second)
+        pattern = self._sequence_patterns.get(key)
+        if pattern is None:
+            groups = ["(" + "|".join(re.escape(keyword) for keyword in self.categories[name]) + ")" for name in key]
+            pattern = re.compile(".*?".join(groups))
+            self._sequence_patterns[key] = pattern
+        return pattern
+
+    def _normalize(self, text: str) -> str:
+        return text.lower() if self.ignore_case else text
+
+    def scan(self, text: str) -> KeywordHits:
+        """テキストを走査（実際の走査は結果を最初に参照したときに行う）"""
+        return KeywordHits(self, self._normalize(text or ""))
+
+    def _find_occurrences(self, text: str) -> Dict[str, List[Occurrence]]:
+        occurrences: Dict[str, List[Occurrence]] = {}
+        if self._pattern is None:
+            return occurrences
+        overlaps = self._overlaps
+        for match in self._pattern.finditer(text):
+            start = match.start()
+            for offset, keyword, categories, verify in overlaps[match.group()]:
+                position = start + offset
+                if verify and not text.startswith(keyword, position):
+                    continue
+                occurrence = (position, position + len(keyword), keyword)
+                for category in categories:
+                    bucket = occurrences.get(category)
+                    if bucket is None:
+                        occurrences[category] = [occurrence]
+                    else:
+                        bucket.append(occurrence)
+        return occurrences
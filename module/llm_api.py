@@ -1,21 +1,31 @@
 import os
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from openai import OpenAI
 from dotenv import load_dotenv
 from prompt.prompt import system_prompt, dev_system_prompt
+from module.rate_pacer import get_rate_pacer
+from module.http_clients import get_shared_openai_client
+from module.circuit_breaker import get_circuit_breaker
+from module.llm_usage import record_llm_usage
+from module.model_router import get_model_router
+from module.token_budget import get_token_budget_policy
+
+# .envの読み込みはインスタンスごとではなくモジュール読み込み時に1回だけ行う
+load_dotenv()
 
 class learning_plannner():
-    def __init__(self):
-        load_dotenv()
+    def __init__(self, client: Optional[OpenAI] = None):
+        """
+        Args:
+            client: 使用するOpenAIクライアント（省略時はプロセス共通の共有クライアント）
+        """
         self.model = "gpt-4.1"
         
-        # 環境変数からAPIキーを取得
-        api_key = os.getenv("OPENAI_API_KEY")
-        
-        if not api_key:
-            raise ValueError("OpenAI APIキーが設定されていません。環境変数OPENAI_API_KEYを設定してください。")
+        # APIキー未設定時は get_shared_openai_client が ValueError を送出する
+        self.client = client or get_shared_openai_client()
         
-        self.client = OpenAI(api_key=api_key)
+        # OpenAI障害時に即座に失敗させるサーキットブレーカー（非同期クライアントと共有）
+        self.breaker = get_circuit_breaker("openai")
 
     def generate_response(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = None) -> str:
         """
@@ -24,23 +34,48 @@ class learning_plannner():
         Args:
             messages: 必須。[{"role": "system/user/assistant", "content": "..."}]
             temperature: 応答の創造性（0.0-1.0）
-            max_tokens: 最大トークン数
+            max_tokens: 最大トークン数（未指定時はステップ・支援タイプごとの予算）
             
         Returns:
             str: 生成された応答テキスト
+            
+        Raises:
+            CircuitOpenError: OpenAIの障害でサーキットが open の場合
         """
-        request_params = {
-            "model": self.model,
-            "messages": messages,
-            "temperature": temperature
-        }
+        router = get_model_router()
+        decision = router.route(messages, self.model)
+        # 未指定時はステップ・支援タイプごとの予算を使う
+        policy = get_token_budget_policy()
+        budget = policy.budget(max_tokens)
         
-        if max_tokens is not None:
-            request_params["max_tokens"] = max_tokens
+        def create(model: str) -> str:
+            def call(limit: int):
+                request_params = {
+                    "model": model,
+                    "messages": messages,
+                    "temperature": temperature,
+                    "max_tokens": limit
+                }
+                
+                def send(slot):
+                    # サーキットブレーカーはペーサーの待機の内側でHTTP呼び出しだけを囲む
+                    with self.breaker.guard_sync():
+                        response = self.client.chat.completions.create(**request_params)
+                    slot.record_usage(response)
+                    return response
+                
+                # open なら待機せずに失敗させ、429はペーサーのクールダウン後に1回だけ再試行
+                self.breaker.raise_if_open()
+                response = get_rate_pacer().run_paced_sync(messages, limit, send)
+                record_llm_usage(model, response)
+                return response
             
-        response = self.client.chat.completions.create(**request_params)
-
-        return response.choices[0].message.content
+            # 予算で打ち切られた場合は上限の予算で再試行
+            response = policy.complete_sync(budget, call)
+            return response.choices[0].message.content
+        
+        # 軽いターンは小さいモデルで処理し、失敗・空の応答なら大きいモデルで再試行
+        return router.run_sync(decision, self.model, create)
     
     def generate_response_with_WebSearch(self, messages: List[Dict[str, Any]]) -> str:
         """
@@ -53,12 +88,21 @@ class learning_plannner():
             WebSearch結果を含むLLMからの応答
         """
         input_items = self._to_input_items(messages)
-        resp = self.client.responses.create(
-            model=self.model,
-            input=input_items,
-            tools=[{"type": "web_search_preview"}],
-            store=True,
-        )
+        
+        def send(slot):
+            with self.breaker.guard_sync():
+                resp = self.client.responses.create(
+                    model=self.model,
+                    input=input_items,
+                    tools=[{"type": "web_search_preview"}],
+                    store=True,
+                )
+            slot.record_usage(resp)
+            return resp
+        
+        self.breaker.raise_if_open()
+        resp = get_rate_pacer().run_paced_sync(messages, None, send)
+        record_llm_usage(self.model, resp)
         return resp.output_text
     
     def _to_input_items(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
@@ -0,0 +1,155 @@
+"""
+LLMリクエストのシングルフライト（重複リクエスト合流）
+同一内容のLLM呼び出しが同時に発生した場合、上流への呼び出しを1回にまとめ、
+全ての呼び出し元で同じ結果を共有します。
+"""
+
+import os
+import json
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass
+class CoalescingMetrics:
+    """合流メトリクス"""
+    total_requests: int = 0        # 合流層に到達した呼び出し数
+    upstream_calls: int = 0        # 実際に上流へ送った呼び出し数
+    coalesced_requests: int = 0    # 既存の呼び出しに相乗りした数
+    upstream_errors: int = 0
+    max_waiters: int = 0           # 1つの上流呼び出しを待った最大呼び出し元数
+
+
+class _InFlight:
+    """進行中の上流呼び出しと待機者数"""
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Task"):
+        self.task = task
+        self.waiters = 0
+
+
+def make_request_key(
+    model: str,
+    messages: List[Dict[str, Any]],
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    **extra: Any
+) -> str:
+    """
+    モデル・メッセージ・生成パラメータから正規化したハッシュキーを生成
+
+    キーの順序や空白の違いに影響されないよう、ソート済みのJSONでハッシュ化する
+    """
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+    }
+    if extra:
+        payload["extra"] = extra
+    canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class LLMRequestCoalescer:
+    """
+    同一キーの同時実行中リクエストを1つの上流呼び出しに合流させる
+
+    上流呼び出しは独立したタスクとして実行するため、最初の呼び出し元が
+    キャンセルされても相乗りしている他の呼び出し元には影響しない。
+    待機者が全員いなくなった場合のみ上流タスクをキャンセルする。
+    """
+
+    def __init__(self, enabled: Optional[bool] = None):
+        if enabled is None:
+            enabled = os.environ.get("ENABLE_LLM_COALESCING", "true").lower() == "true"
+        self.enabled = enabled
+        self._inflight: Dict[str, _InFlight] = {}
+        self.metrics = CoalescingMetrics()
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[T]]) -> T:
+        """
+        キーが同じ進行中の呼び出しがあれば相乗りし、なければ factory を実行する
+
+        Args:
+            key: make_request_key で生成したキー
+            factory: 上流呼び出しを行うコルーチンを返す関数
+
+        Returns:
+            上流呼び出しの結果（相乗りした呼び出し元全員で同じオブジェクトを共有）
+        """
+        self.metrics.total_requests += 1
+
+        if not self.enabled:
+            self.metrics.upstream_calls += 1
+            return await factory()
+
+        entry = self._inflight.get(key)
+        if entry is not None and (entry.task.done() or entry.task.cancelling()):
+            # 完了済み・打ち切り中の呼び出しには相乗りせず、新しく上流へ送る
+            entry = None
+        if entry is None:
+            self.metrics.upstream_calls += 1
+            entry = _InFlight(asyncio.ensure_future(factory()))
+            self._inflight[key] = entry
+            entry.task.add_done_callback(lambda t, k=key: self._on_done(k, t))
+        else:
+            self.metrics.coalesced_requests += 1
+            logger.debug(f"🔗 同一LLMリクエストに合流: {key[:12]}")
+
+        entry.waiters += 1
+        self.metrics.max_waiters = max(self.metrics.max_waiters, entry.waiters)
+        try:
+            return await asyncio.shield(entry.task)
+        finally:
+            entry.waiters -= 1
+            if entry.waiters == 0 and not entry.task.done():
+                # 誰も結果を待っていないので上流呼び出しを打ち切る
+                # （打ち切り中のタスクに後から来た呼び出し元が相乗りしないよう、先に進行中テーブルから外す）
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
+                entry.task.cancel()
+
+    def _on_done(self, key: str, task: "asyncio.Task") -> None:
+        """完了した呼び出しを進行中テーブルから外す"""
+        if self._inflight.get(key) is not None and self._inflight[key].task is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.metrics.upstream_errors += 1
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """合流メトリクスを取得"""
+        total = self.metrics.total_requests
+        return {
+            "enabled": self.enabled,
+            "total_requests": total,
+            "upstream_calls": self.metrics.upstream_calls,
+            "coalesced_requests": self.metrics.coalesced_requests,
+            "hit_rate": self.metrics.coalesced_requests / total if total > 0 else 0,
+            "upstream_errors": self.metrics.upstream_errors,
+            "in_flight": len(self._inflight),
+            "max_waiters": self.metrics.max_waiters,
+        }
+
+
+# シングルトンインスタンスを管理
+_coalescer_instance: Optional[LLMRequestCoalescer] = None
+
+
+def get_llm_coalescer() -> LLMRequestCoalescer:
+    """プロセス共通の合流層を取得"""
+    global _coalescer_instance
+
+    if _coalescer_instance is None:
+        _coalescer_instance = LLMRequestCoalescer()
+
+    return _coalescer_instance
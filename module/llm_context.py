@@ -0,0 +1,75 @@
+"""
+LLM呼び出しのリクエストコンテキスト
+エンドポイントで設定したユーザーや処理ステップなどの情報を、contextvars を通じて
+LLMクライアント内部（スケジューラ・計測など）まで引数を増やさずに伝搬します。
+
+asyncio のタスクや asyncio.to_thread で実行される同期処理にもコンテキストは引き継がれます。
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from typing import Any, Optional
+
+
+@dataclass(frozen=True)
+class LLMCallContext:
+    """LLM呼び出し元の情報"""
+    user_key: Optional[str] = None        # スケジューリング用のユーザーキー（"user:1" / "ip:127.0.0.1"）
+    user_id: Optional[int] = None         # 認証済みユーザーID
+    endpoint: Optional[str] = None        # エンドポイントの分類（chat / inquiry / games / other、リクエスト外の別タスクは background）
+    step: Optional[str] = None            # 処理ステップ（reply / state_extract / support_type など）
+    # モデル振り分け（module.model_router）のシグナル
+    importance: Optional[int] = None      # ユーザー発話の重要度（memory_manager.MessageImportance の値）
+    message_chars: Optional[int] = None   # ユーザー発話の文字数
+    support_type: Optional[str] = None    # 対話エージェントの支援タイプ
+
+
+_current_context: ContextVar[LLMCallContext] = ContextVar("llm_call_context", default=LLMCallContext())
+
+
+def get_llm_context() -> LLMCallContext:
+    """現在のLLM呼び出しコンテキストを取得"""
+    return _current_context.get()
+
+
+def set_llm_context(**fields: Any) -> None:
+    """
+    現在のコンテキストを更新（リクエスト単位で設定する場合に使用）
+
+    Noneを渡したフィールドは変更しない
+    """
+    updates = {k: v for k, v in fields.items() if v is not None}
+    _current_context.set(replace(_current_context.get(), **updates))
+
+
+@contextmanager
+def llm_context(**fields: Any):
+    """
+    ブロック内だけコンテキストを上書きする
+
+    使い方:
+        with llm_context(step="state_extract"):
+            llm_client.generate_response(messages)
+    """
+    updates = {k: v for k, v in fields.items() if v is not None}
+    token = _current_context.set(replace(_current_context.get(), **updates))
+    try:
+        yield _current_context.get()
+    finally:
+        try:
+            _current_context.reset(token)
+        except ValueError:
+            # SSEの非同期ジェネレーターが別のコンテキストで閉じられた場合（そのコンテキストは破棄される）
+            pass
+
+
+def classify_endpoint(path: str) -> str:
+    """リクエストパスからエンドポイントの分類を決定"""
+    if path.startswith("/chat") or path.startswith("/conversation-agent"):
+        return "chat"
+    if path.startswith("/api/inquiry"):
+        return "inquiry"
+    if path.startswith("/framework-games"):
+        return "games"
+    return "other"
@@ -0,0 +1,261 @@
+"""
+LLM呼び出しのトークン使用量とコストの集計
+各レスポンスの usage（入力・出力・キャッシュ済みトークン）を、llm_context のユーザー・エンドポイント・
+処理ステップとモデル名で分類してプロセス内に集計します。
+
+- 集計は (エンドポイント, モデル, ステップ) ごとのカウンタとユーザー別合計のみ（呼び出し単位のログは持たない）
+- collect_usage() のブロック内で行われた呼び出しはリクエスト単位でも合計され、/chat の token_usage に使う
+"""
+
+import threading
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Tuple
+
+from module.llm_context import get_llm_context
+
+logger = logging.getLogger(__name__)
+
+# モデル別の価格（USD / 1Kトークン）。cached_input はプロンプトキャッシュ適用分の入力価格
+MODEL_PRICING: Dict[str, Dict[str, float]] = {
+    "gpt-4": {"input": 0.03, "output": 0.06},
+    "gpt-4-turbo": {"input": 0.01, "output": 0.03},
+    "gpt-3.5-turbo": {"input": 0.0005, "output": 0.0015},
+    "gpt-4o": {"input": 0.0025, "cached_input": 0.00125, "output": 0.01},
+    "gpt-4o-mini": {"input": 0.00015, "cached_input": 0.000075, "output": 0.0006},
+    "gpt-4.1": {"input": 0.002, "cached_input": 0.0005, "output": 0.008},
+    "gpt-4.1-mini": {"input": 0.0004, "cached_input": 0.0001, "output": 0.0016},
+    "gpt-4.1-nano": {"input": 0.0001, "cached_input": 0.000025, "output": 0.0004},
+}
+DEFAULT_PRICING_MODEL = "gpt-4"
+
+
+def get_model_pricing(model: Optional[str]) -> Dict[str, float]:
+    """モデル名から価格を取得（日付付きのスナップショット名は前方一致で解決）"""
+    if model in MODEL_PRICING:
+        return MODEL_PRICING[model]
+    if model:
+        # "gpt-4.1-mini-2025-04-14" → "gpt-4.1-mini"（長い名前を優先）
+        for name in sorted(MODEL_PRICING, key=len, reverse=True):
+            if model.startswith(name + "-"):
+                return MODEL_PRICING[name]
+    return MODEL_PRICING[DEFAULT_PRICING_MODEL]
+
+
+def estimate_cost(model: Optional[str], input_tokens: int, output_tokens: int, cached_tokens: int = 0) -> Dict[str, float]:
+    """
+    トークン数からコストを推定（USD）
+
+    Args:
+        input_tokens: 入力トークン数（キャッシュ済み分を含む）
+        cached_tokens: 入力のうちプロンプトキャッシュが適用されたトークン数
+    """
+    pricing = get_model_pricing(model)
+    cached_tokens = min(cached_tokens, input_tokens)
+    input_cost = (
+        (input_tokens - cached_tokens) / 1000 * pricing["input"]
+        + cached_tokens / 1000 * pricing.get("cached_input", pricing["input"])
+    )
+    output_cost = output_tokens / 1000 * pricing["output"]
+    return {
+        "input_cost": input_cost,
+        "output_cost": output_cost,
+        "total_cost": input_cost + output_cost,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+    }
+
+
+def extract_usage(response: Any) -> Optional[Tuple[int, int, int]]:
+    """
+    レスポンス（またはusage）から (入力, 出力, キャッシュ済み入力) トークン数を取り出す
+
+    Chat Completions（prompt_tokens / completion_tokens）と
+    Responses API（input_tokens / output_tokens）のどちらにも対応
+    """
+    usage = getattr(response, "usage", response)
+    if usage is None:
+        return None
+    prompt = getattr(usage, "prompt_tokens", None)
+    if prompt is None:
+        prompt = getattr(usage, "input_tokens", None)
+    completion = getattr(usage, "completion_tokens", None)
+    if completion is None:
+        completion = getattr(usage, "output_tokens", None)
+    if prompt is None and completion is None:
+        return None
+
+    details = getattr(usage, "prompt_tokens_details", None) or getattr(usage, "input_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    return int(prompt or 0), int(completion or 0), int(cached)
+
+
+@dataclass
+class UsageTotals:
+    """トークン使用量の合計"""
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    cost: float = 0.0
+
+    def add(self, prompt: int, completion: int, cached: int, cost: float) -> None:
+        self.calls += 1
+        self.prompt_tokens += prompt
+        self.completion_tokens += completion
+        self.cached_tokens += cached
+        self.cost += cost
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "estimated_cost_usd": round(self.cost, 6),
+        }
+
+
+@dataclass
+class RequestUsage:
+    """1リクエスト内のLLM呼び出しの合計（ステップ別の内訳付き）"""
+    total: UsageTotals = field(default_factory=UsageTotals)
+    by_step: Dict[str, UsageTotals] = field(default_factory=dict)
+    models: Dict[str, int] = field(default_factory=dict)
+
+    def add(self, model: str, step: str, prompt: int, completion: int, cached: int, cost: float) -> None:
+        self.total.add(prompt, completion, cached, cost)
+        self.by_step.setdefault(step, UsageTotals()).add(prompt, completion, cached, cost)
+        self.models[model] = self.models.get(model, 0) + 1
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        """APIレスポンス用（LLM呼び出しがなければNone）"""
+        if not self.total.calls:
+            return None
+        result = self.total.to_dict()
+        result["models"] = dict(self.models)
+        result["by_step"] = {step: totals.to_dict() for step, totals in self.by_step.items()}
+        return result
+
+
+_request_usage: ContextVar[Optional[RequestUsage]] = ContextVar("llm_request_usage", default=None)
+
+UNSPECIFIED_STEP = "unspecified"
+
+
+class LLMUsageRecorder:
+    """トークン使用量のプロセス内集計"""
+
+    def __init__(self, max_tracked_users: int = 1000):
+        self.max_tracked_users = max_tracked_users
+        self._lock = threading.Lock()
+        self._by_key: Dict[Tuple[str, str, str], UsageTotals] = {}
+        self._by_user: Dict[str, UsageTotals] = {}
+        self._total = UsageTotals()
+        self.untracked_responses = 0   # usageを含まないレスポンス数
+
+    def record(self, model: Optional[str], response: Any) -> None:
+        """レスポンスの usage を現在の llm_context の分類で記録"""
+        usage = extract_usage(response)
+        if usage is None:
+            self.untracked_responses += 1
+            return
+        prompt, completion, cached = usage
+        model = getattr(response, "model", None) or model or "unknown"
+        ctx = get_llm_context()
+        endpoint = ctx.endpoint or "other"
+        step = ctx.step or UNSPECIFIED_STEP
+        user = ctx.user_key or (f"user:{ctx.user_id}" if ctx.user_id is not None else "anonymous")
+        cost = estimate_cost(model, prompt, completion, cached)["total_cost"]
+
+        with self._lock:
+            self._total.add(prompt, completion, cached, cost)
+            key = (endpoint, model, step)
+            totals = self._by_key.get(key)
+            if totals is None:
+                totals = self._by_key[key] = UsageTotals()
+            totals.add(prompt, completion, cached, cost)
+
+            user_totals = self._by_user.get(user)
+            if user_totals is None:
+                if len(self._by_user) >= self.max_tracked_users:
+                    # 使用量の最も少ないユーザーを集計から外す
+                    del self._by_user[min(self._by_user, key=lambda k: self._by_user[k].cost)]
+                user_totals = self._by_user[user] = UsageTotals()
+            user_totals.add(prompt, completion, cached, cost)
+
+        request_usage = _request_usage.get()
+        if request_usage is not None:
+            request_usage.add(model, step, prompt, completion, cached, cost)
+
+    def get_metrics(self, top_users: int = 20) -> Dict[str, Any]:
+        """エンドポイント・モデル・ステップ別の集計とコスト上位ユーザーを取得"""
+        with self._lock:
+            breakdown = [
+                {"endpoint": endpoint, "model": model, "step": step, **totals.to_dict()}
+                for (endpoint, model, step), totals in self._by_key.items()
+            ]
+            users = sorted(self._by_user.items(), key=lambda item: item[1].cost, reverse=True)[:top_users]
+            return {
+                "total": self._total.to_dict(),
+                "untracked_responses": self.untracked_responses,
+                "breakdown": sorted(breakdown, key=lambda row: row["estimated_cost_usd"], reverse=True),
+                "top_users": {key: totals.to_dict() for key, totals in users},
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._by_key.clear()
+            self._by_user.clear()
+            self._total = UsageTotals()
+            self.untracked_responses = 0
+
+
+@contextmanager
+def collect_usage():
+    """
+    ブロック内のLLM呼び出しのトークン使用量をリクエスト単位で合計する
+
+    使い方:
+        with collect_usage() as usage:
+            response = await async_llm.generate_response_async(messages)
+        token_usage = usage.to_dict()
+    """
+    usage = RequestUsage()
+    token = _request_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        try:
+            _request_usage.reset(token)
+        except ValueError:
+            # SSEの非同期ジェネレーターが別のコンテキストで閉じられた場合（そのコンテキストは破棄される）
+            pass
+
+
+# シングルトンインスタンスを管理
+_recorder_instance: Optional[LLMUsageRecorder] = None
+_recorder_lock = threading.Lock()
+
+
+def get_usage_recorder() -> LLMUsageRecorder:
+    """プロセス共通の使用量レコーダーを取得"""
+    global _recorder_instance
+
+    if _recorder_instance is None:
+        with _recorder_lock:
+            if _recorder_instance is None:
+                _recorder_instance = LLMUsageRecorder()
+
+    return _recorder_instance
+
+
+def record_llm_usage(model: Optional[str], response: Any) -> None:
+    """LLMレスポンスの usage を記録（記録の失敗で呼び出し元を失敗させない）"""
+    try:
+        get_usage_recorder().record(model, response)
+    except Exception as e:
+        logger.debug(f"使用量の記録に失敗: {e}")
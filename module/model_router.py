@@ -0,0 +1,327 @@
+"""
+LLM呼び出しのモデル振り分け（モデルカスケード）
+呼び出しごとに安価なシグナル（メッセージの重要度・長さ・処理ステップ・支援タイプ）からモデルの階層を選び、
+「ありがとう」「はい」のような軽いターンは小さく速いモデル、それ以外は大きいモデルで処理します。
+
+- 階層は small / large（モデル名は LLM_MODEL_SMALL / LLM_MODEL_LARGE、large の未設定時はクライアントのモデル）
+- シグナルは llm_context（step / importance / message_chars / support_type）から取得
+- LLM_ROUTE_STEP_OVERRIDES でステップごとに階層を固定（例: state_extract:small,reply:large、rolling_summary はデフォルトで small）
+- small での呼び出しが失敗した場合や応答が空の場合は large で再試行（エスカレーション）
+  （サーキットが open の場合と429は上流が同じため再試行しない）
+- ステップ・階層ごとの呼び出し数・レイテンシ・エスカレーション数を集計
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from module.circuit_breaker import CircuitOpenError
+from module.llm_context import get_llm_context
+from module.rate_pacer import is_rate_limit_error
+
+logger = logging.getLogger(__name__)
+
+TIER_SMALL = "small"
+TIER_LARGE = "large"
+# エスカレーションの順序
+TIER_ORDER: Tuple[str, ...] = (TIER_SMALL, TIER_LARGE)
+
+# 重要度（memory_manager.MessageImportance の値）
+IMPORTANCE_LOW = 2
+IMPORTANCE_HIGH = 4
+
+# 大きいモデルで応答する支援タイプ（視点転換・意思決定・道筋提示は推論の質が応答の価値を左右する）
+DEFAULT_LARGE_SUPPORT_TYPES = "視点転換,意思決定,道筋提示"
+
+# 階層を固定するステップのデフォルト（LLM_ROUTE_STEP_OVERRIDES で上書き可）
+DEFAULT_STEP_TIERS: Dict[str, str] = {
+    "rolling_summary": TIER_SMALL,   # 会話の累積要約（応答の外で実行し、要約の質より費用を優先）
+}
+
+
+def _parse_step_overrides(raw: str) -> Dict[str, str]:
+    """"state_extract:small,reply:large" 形式のステップ別設定をパース"""
+    overrides = {}
+    for item in raw.split(","):
+        if ":" not in item:
+            continue
+        step, tier = (part.strip() for part in item.split(":", 1))
+        if tier in TIER_ORDER:
+            overrides[step] = tier
+    return overrides
+
+
+@dataclass(frozen=True)
+class RouteDecision:
+    """振り分け結果"""
+    tier: str
+    model: str
+    reason: str
+    step: str
+
+
+@dataclass
+class TierStats:
+    """ステップ・階層ごとの呼び出し統計"""
+    calls: int = 0
+    errors: int = 0
+    escalations: int = 0              # この階層から上の階層に切り替えた回数
+    total_latency: float = 0.0
+    recent_latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=200))
+
+    def to_dict(self) -> Dict[str, Any]:
+        latencies = sorted(self.recent_latencies)
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "escalations": self.escalations,
+            "average_latency": self.total_latency / self.calls if self.calls else 0,
+            "p50_latency": latencies[len(latencies) // 2] if latencies else 0,
+            "p90_latency": latencies[int(len(latencies) * 0.9)] if latencies else 0,
+        }
+
+
+class ModelRouter:
+    """呼び出しごとにモデルの階層を選ぶルーター"""
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        small_model: Optional[str] = None,
+        large_model: Optional[str] = None,
+        step_overrides: Optional[Dict[str, str]] = None,
+        large_support_types: Optional[Set[str]] = None,
+        short_message_chars: Optional[int] = None,
+        long_message_chars: Optional[int] = None
+    ):
+        if enabled is None:
+            enabled = os.environ.get("ENABLE_LLM_MODEL_ROUTING", "true").lower() == "true"
+        if small_model is None:
+            small_model = os.environ.get("LLM_MODEL_SMALL", "gpt-4.1-mini")
+        if large_model is None:
+            large_model = os.environ.get("LLM_MODEL_LARGE", "") or None
+        if step_overrides is None:
+            step_overrides = {
+                **DEFAULT_STEP_TIERS,
+                **_parse_step_overrides(os.environ.get("LLM_ROUTE_STEP_OVERRIDES", "")),
+            }
+        if large_support_types is None:
+            raw = os.environ.get("LLM_ROUTE_LARGE_SUPPORT_TYPES", DEFAULT_LARGE_SUPPORT_TYPES)
+            large_support_types = {name.strip() for name in raw.split(",") if name.strip()}
+        if short_message_chars is None:
+            short_message_chars = int(os.environ.get("LLM_ROUTE_SHORT_MESSAGE_CHARS", "20"))
+        if long_message_chars is None:
+            long_message_chars = int(os.environ.get("LLM_ROUTE_LONG_MESSAGE_CHARS", "400"))
+
+        self.enabled = enabled
+        self.small_model = small_model
+        self.large_model = large_model
+        self.step_overrides = step_overrides
+        self.large_support_types = large_support_types
+        self.short_message_chars = short_message_chars
+        self.long_message_chars = long_message_chars
+
+        self._lock = threading.Lock()
+        self._stats: Dict[Tuple[str, str], TierStats] = {}
+        self._reasons: Dict[str, int] = {}
+
+    # ---------------------------------
+    # 振り分け
+    # ---------------------------------
+
+    def model_for(self, tier: str, default_model: str) -> str:
+        if tier == TIER_SMALL:
+            return self.small_model
+        return self.large_model or default_model
+
+    def route(self, messages: List[Dict[str, Any]], default_model: str) -> RouteDecision:
+        """
+        現在の llm_context とメッセージから階層を選ぶ
+
+        Args:
+            messages: LLMに渡すメッセージ（llm_context に message_chars がない場合は最後のユーザー発話の長さを使う）
+            default_model: クライアントのモデル（large の未設定時と無効時に使用）
+        """
+        ctx = get_llm_context()
+        step = ctx.step or "unspecified"
+        if not self.enabled:
+            return RouteDecision(TIER_LARGE, default_model, "disabled", step)
+
+        tier, reason = self._choose_tier(ctx, step, messages)
+        return RouteDecision(tier, self.model_for(tier, default_model), reason, step)
+
+    def _choose_tier(self, ctx: Any, step: str, messages: List[Dict[str, Any]]) -> Tuple[str, str]:
+        if step in self.step_overrides:
+            return self.step_overrides[step], "step_override"
+
+        importance = ctx.importance
+        if importance is not None and importance >= IMPORTANCE_HIGH:
+            return TIER_LARGE, "importance"
+        if ctx.support_type and ctx.support_type in self.large_support_types:
+            return TIER_LARGE, "support_type"
+
+        message_chars = ctx.message_chars
+        if message_chars is None:
+            message_chars = _last_user_message_chars(messages)
+        if message_chars > self.long_message_chars:
+            return TIER_LARGE, "long_message"
+        if importance is not None and importance <= IMPORTANCE_LOW:
+            return TIER_SMALL, "importance"
+        if message_chars <= self.short_message_chars:
+            return TIER_SMALL, "short_message"
+        return TIER_LARGE, "default"
+
+    def escalate(self, decision: RouteDecision, default_model: str, reason: str) -> Optional[RouteDecision]:
+        """1つ上の階層の振り分け結果（最上位ならNone）"""
+        index = TIER_ORDER.index(decision.tier)
+        if index + 1 >= len(TIER_ORDER):
+            return None
+        tier = TIER_ORDER[index + 1]
+        return RouteDecision(tier, self.model_for(tier, default_model), f"escalated:{reason}", decision.step)
+
+    # ---------------------------------
+    # 呼び出し
+    # ---------------------------------
+
+    async def run(
+        self,
+        decision: RouteDecision,
+        default_model: str,
+        call: Callable[[str], Awaitable[str]]
+    ) -> str:
+        """
+        振り分けたモデルで call を実行し、失敗・空の応答なら上の階層で再試行する
+
+        サーキットが open の場合と429（レートペーサーの再試行後も続くもの）は同じ上流のため再試行しない
+        """
+        while True:
+            start = time.perf_counter()
+            try:
+                content = await call(decision.model)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    # 上の階層に送っても同じアカウントのレート制限に当たるため、レートペーサーのクールダウンに任せる
+                    self.record(decision, time.perf_counter() - start, ok=False)
+                    raise
+                escalated = self._after_call(decision, default_model, time.perf_counter() - start, False, "error")
+                if escalated is None:
+                    raise
+                logger.warning(f"⚠️ {decision.model} の呼び出しに失敗、{escalated.model} で再試行: {e}")
+                decision = escalated
+                continue
+
+            ok = bool((content or "").strip())
+            escalated = self._after_call(decision, default_model, time.perf_counter() - start, ok, "empty")
+            if ok or escalated is None:
+                return content
+            logger.warning(f"⚠️ {decision.model} の応答が空のため {escalated.model} で再試行")
+            decision = escalated
+
+    def run_sync(self, decision: RouteDecision, default_model: str, call: Callable[[str], str]) -> str:
+        """run の同期版"""
+        while True:
+            start = time.perf_counter()
+            try:
+                content = call(decision.model)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    # 上の階層に送っても同じアカウントのレート制限に当たるため、レートペーサーのクールダウンに任せる
+                    self.record(decision, time.perf_counter() - start, ok=False)
+                    raise
+                escalated = self._after_call(decision, default_model, time.perf_counter() - start, False, "error")
+                if escalated is None:
+                    raise
+                logger.warning(f"⚠️ {decision.model} の呼び出しに失敗、{escalated.model} で再試行: {e}")
+                decision = escalated
+                continue
+
+            ok = bool((content or "").strip())
+            escalated = self._after_call(decision, default_model, time.perf_counter() - start, ok, "empty")
+            if ok or escalated is None:
+                return content
+            logger.warning(f"⚠️ {decision.model} の応答が空のため {escalated.model} で再試行")
+            decision = escalated
+
+    def _after_call(
+        self,
+        decision: RouteDecision,
+        default_model: str,
+        latency: float,
+        ok: bool,
+        failure: str
+    ) -> Optional[RouteDecision]:
+        # 呼び出しを記録し、失敗時はエスカレーション先を返す
+        escalated = None if ok else self.escalate(decision, default_model, failure)
+        self.record(decision, latency, ok=ok, escalated=escalated is not None)
+        return escalated
+
+    def record(self, decision: RouteDecision, latency: float, ok: bool = True, escalated: bool = False) -> None:
+        """呼び出し結果を記録（ストリーミングなど run を使わない呼び出しからも使う）"""
+        with self._lock:
+            key = (decision.step, decision.tier)
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = TierStats()
+            stats.calls += 1
+            stats.total_latency += latency
+            stats.recent_latencies.append(latency)
+            if not ok:
+                stats.errors += 1
+            if escalated:
+                stats.escalations += 1
+            self._reasons[decision.reason] = self._reasons.get(decision.reason, 0) + 1
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """ステップ・階層別の統計を取得"""
+        with self._lock:
+            by_step: Dict[str, Dict[str, Any]] = {}
+            tiers: Dict[str, int] = {}
+            for (step, tier), stats in self._stats.items():
+                by_step.setdefault(step, {})[tier] = stats.to_dict()
+                tiers[tier] = tiers.get(tier, 0) + stats.calls
+            return {
+                "enabled": self.enabled,
+                "models": {TIER_SMALL: self.small_model, TIER_LARGE: self.large_model or "default"},
+                "step_overrides": dict(self.step_overrides),
+                "calls_by_tier": tiers,
+                "reasons": dict(self._reasons),
+                "by_step": by_step,
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+            self._reasons.clear()
+
+
+def _last_user_message_chars(messages: List[Dict[str, Any]]) -> int:
+    for message in reversed(messages or []):
+        if message.get("role") == "user":
+            content = message.get("content", "")
+            return len(content) if isinstance(content, str) else 0
+    return 0
+
+
+# シングルトンインスタンスを管理
+_router_instance: Optional[ModelRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_model_router() -> ModelRouter:
+    """プロセス共通のモデルルーターを取得"""
+    global _router_instance
+
+    if _router_instance is None:
+        with _router_lock:
+            if _router_instance is None:
+                _router_instance = ModelRouter()
+
+    return _router_instance
@@ -0,0 +1,374 @@
+"""
+OpenAI呼び出しの共有レートペーサー
+アカウントのRPM（リクエスト/分）とTPM（トークン/分）をトークンバケットで管理し、
+上限を超えそうな呼び出しは429を受ける前にローカルで待機させます。
+
+ペーサーを通すクライアントはSDK内部のリトライを無効（max_retries=0）にしており、
+429は run_paced() / run_paced_sync() でクールダウンを設定したうえで、ペースをかけ直して1回だけ再試行します。
+
+同期呼び出し（スレッド）と非同期呼び出しの両方から同じインスタンスを利用できます。
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+# max_tokens未指定時の出力トークン見積もり
+DEFAULT_COMPLETION_ESTIMATE = 1000
+# 429時にRetry-Afterが得られない場合のクールダウン（秒）
+DEFAULT_RATE_LIMIT_COOLDOWN = 2.0
+# 429を受けた呼び出しをペースをかけ直して再試行する回数
+RATE_LIMIT_RETRIES = 1
+
+T = TypeVar("T")
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """上流の429（レート制限）エラーか"""
+    return getattr(error, "status_code", None) == 429
+
+
+def estimate_prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+    """
+    メッセージの入力トークン数を軽量に見積もる
+
+    日本語などの非ASCII文字は1文字≒1トークン、ASCIIは4文字≒1トークンとして数え、
+    メッセージごとの固定オーバーヘッドを加える（呼び出し後にusageで補正する）
+    """
+    total = 3
+    for message in messages or []:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            content = " ".join(
+                str(part.get("text", "")) if isinstance(part, dict) else str(part)
+                for part in content
+            )
+        content = str(content or "")
+        ascii_chars = sum(1 for ch in content if ord(ch) < 128)
+        total += (len(content) - ascii_chars) + ascii_chars // 4 + 4
+    return total
+
+
+@dataclass
+class PacerMetrics:
+    """ペーサーのメトリクス"""
+    total_requests: int = 0
+    delayed_requests: int = 0         # ローカルで待機させた呼び出し数
+    total_wait_time: float = 0.0
+    max_wait_time: float = 0.0
+    estimated_tokens: int = 0
+    actual_tokens: int = 0
+    rate_limited_responses: int = 0   # 上流から429を受けた回数
+    rate_limit_retries: int = 0       # 429後にペースをかけ直して再試行した回数
+    cancelled_reservations: int = 0
+
+
+class _TokenBucket:
+    """負の残高を許すトークンバケット（予約した順に待ち時間が決まる）"""
+
+    def __init__(self, capacity: float, per_minute: float):
+        self.capacity = float(capacity)
+        self.rate = float(per_minute) / 60.0
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """残高が0以上に戻るまでの秒数"""
+        if self.tokens >= 0 or self.rate <= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class PacerReservation:
+    """1回の呼び出しで予約したリクエスト枠とトークン枠"""
+    __slots__ = ("estimated_tokens", "wait_time", "settled")
+
+    def __init__(self, estimated_tokens: int, wait_time: float):
+        self.estimated_tokens = estimated_tokens
+        self.wait_time = wait_time
+        self.settled = False
+
+
+class PacerSlot:
+    """paced() で得られるスロット。レスポンスのusageを記録して見積もりを補正する"""
+    __slots__ = ("reservation", "actual_tokens")
+
+    def __init__(self, reservation: PacerReservation):
+        self.reservation = reservation
+        self.actual_tokens: Optional[int] = None
+
+    def record_usage(self, response: Any) -> None:
+        """Chat Completions / Responses API どちらのレスポンス（またはusage）も受け付ける"""
+        usage = getattr(response, "usage", response)
+        if usage is None:
+            return
+        total = getattr(usage, "total_tokens", None)
+        if total is None:
+            prompt = getattr(usage, "prompt_tokens", None) or getattr(usage, "input_tokens", 0) or 0
+            completion = getattr(usage, "completion_tokens", None) or getattr(usage, "output_tokens", 0) or 0
+            total = prompt + completion
+        if total:
+            self.actual_tokens = int(total)
+
+
+class RatePacer:
+    """
+    RPM/TPMトークンバケットによる共有ペーサー
+
+    呼び出し前に見積もりトークン数で枠を予約し（残高不足なら待機）、
+    呼び出し後に実際のusageとの差分をバケットに戻す。
+    """
+
+    def __init__(
+        self,
+        rpm_limit: Optional[int] = None,
+        tpm_limit: Optional[int] = None,
+        enabled: Optional[bool] = None
+    ):
+        if enabled is None:
+            enabled = os.environ.get("ENABLE_LLM_PACER", "true").lower() == "true"
+        self.enabled = enabled
+        self.rpm_limit = rpm_limit or int(os.environ.get("OPENAI_RPM_LIMIT", "500"))
+        self.tpm_limit = tpm_limit or int(os.environ.get("OPENAI_TPM_LIMIT", "30000"))
+
+        self._requests = _TokenBucket(self.rpm_limit, self.rpm_limit)
+        self._tokens = _TokenBucket(self.tpm_limit, self.tpm_limit)
+        self._cooldown_until = 0.0
+        self._lock = threading.Lock()
+        self.metrics = PacerMetrics()
+
+        logger.info(f"🚦 RatePacer初期化: enabled={self.enabled}, RPM={self.rpm_limit}, TPM={self.tpm_limit}")
+
+    # ---------------------------------
+    # 予約と精算
+    # ---------------------------------
+
+    def estimate(self, messages: List[Dict[str, Any]], max_tokens: Optional[int] = None) -> int:
+        """呼び出し1回分のTPM消費見積もり（入力見積もり＋出力上限）"""
+        completion = max_tokens if max_tokens is not None else DEFAULT_COMPLETION_ESTIMATE
+        return estimate_prompt_tokens(messages) + completion
+
+    def reserve(self, estimated_tokens: int) -> PacerReservation:
+        """枠を予約し、実行可能になるまでの待ち時間を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self._requests.refill(now)
+            self._tokens.refill(now)
+
+            self._requests.tokens -= 1
+            self._tokens.tokens -= estimated_tokens
+
+            wait = max(
+                self._requests.wait_time(),
+                self._tokens.wait_time(),
+                self._cooldown_until - now,
+                0.0
+            )
+
+            self.metrics.total_requests += 1
+            self.metrics.estimated_tokens += estimated_tokens
+            if wait > 0:
+                self.metrics.delayed_requests += 1
+                self.metrics.total_wait_time += wait
+                self.metrics.max_wait_time = max(self.metrics.max_wait_time, wait)
+
+        return PacerReservation(estimated_tokens, wait)
+
+    def settle(self, reservation: PacerReservation, actual_tokens: Optional[int]) -> None:
+        """実際の消費トークンで見積もりとの差分を補正"""
+        if reservation.settled:
+            return
+        reservation.settled = True
+        if actual_tokens is None:
+            return
+        with self._lock:
+            self._tokens.tokens += reservation.estimated_tokens - actual_tokens
+            self.metrics.actual_tokens += actual_tokens
+
+    def cancel(self, reservation: PacerReservation) -> None:
+        """呼び出し前にキャンセルされた予約を返却"""
+        if reservation.settled:
+            return
+        reservation.settled = True
+        with self._lock:
+            self._requests.tokens += 1
+            self._tokens.tokens += reservation.estimated_tokens
+            self.metrics.cancelled_reservations += 1
+
+    def note_rate_limited(self, retry_after: Optional[float] = None) -> None:
+        """上流の429を記録し、以降の呼び出しをクールダウンさせる"""
+        cooldown = retry_after if retry_after and retry_after > 0 else DEFAULT_RATE_LIMIT_COOLDOWN
+        with self._lock:
+            self._cooldown_until = max(self._cooldown_until, time.monotonic() + cooldown)
+            self.metrics.rate_limited_responses += 1
+        logger.warning(f"⚠️ OpenAIレート制限を検知: {cooldown:.1f}秒クールダウン")
+
+    # ---------------------------------
+    # 呼び出しラッパー
+    # ---------------------------------
+
+    @asynccontextmanager
+    async def paced(self, messages: List[Dict[str, Any]], max_tokens: Optional[int] = None):
+        """
+        非同期呼び出し用。枠が空くまで待機してからスロットを渡す
+
+        使い方:
+            async with pacer.paced(messages, max_tokens) as slot:
+                response = await client.chat.completions.create(...)
+                slot.record_usage(response)
+        """
+        if not self.enabled:
+            yield PacerSlot(PacerReservation(0, 0.0))
+            return
+
+        reservation = self.reserve(self.estimate(messages, max_tokens))
+        if reservation.wait_time > 0:
+            try:
+                await asyncio.sleep(reservation.wait_time)
+            except asyncio.CancelledError:
+                self.cancel(reservation)
+                raise
+
+        slot = PacerSlot(reservation)
+        try:
+            yield slot
+        except Exception as e:
+            self._handle_error(e)
+            raise
+        finally:
+            self.settle(reservation, slot.actual_tokens)
+
+    @contextmanager
+    def paced_sync(self, messages: List[Dict[str, Any]], max_tokens: Optional[int] = None):
+        """同期呼び出し用（ワーカースレッドからの呼び出しを想定）"""
+        if not self.enabled:
+            yield PacerSlot(PacerReservation(0, 0.0))
+            return
+
+        reservation = self.reserve(self.estimate(messages, max_tokens))
+        if reservation.wait_time > 0:
+            time.sleep(reservation.wait_time)
+
+        slot = PacerSlot(reservation)
+        try:
+            yield slot
+        except Exception as e:
+            self._handle_error(e)
+            raise
+        finally:
+            self.settle(reservation, slot.actual_tokens)
+
+    async def run_paced(
+        self,
+        messages: List[Dict[str, Any]],
+        max_tokens: Optional[int],
+        call: Callable[[PacerSlot], Awaitable[T]]
+    ) -> T:
+        """
+        paced() の中で call(slot) を実行する。429ならクールダウン後に枠を取り直して1回だけ再試行
+
+        使い方:
+            async def send(slot):
+                response = await client.chat.completions.create(...)
+                slot.record_usage(response)
+                return response
+            response = await pacer.run_paced(messages, max_tokens, send)
+        """
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                async with self.paced(messages, max_tokens) as slot:
+                    return await call(slot)
+            except Exception as e:
+                if attempt >= RATE_LIMIT_RETRIES or not self.should_retry(e):
+                    raise
+                logger.info("🔁 429のためクールダウン後に再試行します")
+
+    def run_paced_sync(
+        self,
+        messages: List[Dict[str, Any]],
+        max_tokens: Optional[int],
+        call: Callable[[PacerSlot], T]
+    ) -> T:
+        """run_paced の同期版（ワーカースレッドからの呼び出しを想定）"""
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            try:
+                with self.paced_sync(messages, max_tokens) as slot:
+                    return call(slot)
+            except Exception as e:
+                if attempt >= RATE_LIMIT_RETRIES or not self.should_retry(e):
+                    raise
+                logger.info("🔁 429のためクールダウン後に再試行します")
+
+    def should_retry(self, error: Exception) -> bool:
+        """429なら再試行回数を記録して True（クールダウンは paced() 側で設定済み）"""
+        if not is_rate_limit_error(error):
+            return False
+        with self._lock:
+            self.metrics.rate_limit_retries += 1
+        return True
+
+    def _handle_error(self, error: Exception) -> None:
+        """429エラーならRetry-Afterに従ってクールダウン"""
+        if not is_rate_limit_error(error):
+            return
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after", ""))
+            except (TypeError, ValueError):
+                retry_after = None
+        self.note_rate_limited(retry_after)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """ペーサーのメトリクスを取得"""
+        with self._lock:
+            now = time.monotonic()
+            self._requests.refill(now)
+            self._tokens.refill(now)
+            m = self.metrics
+            return {
+                "enabled": self.enabled,
+                "rpm_limit": self.rpm_limit,
+                "tpm_limit": self.tpm_limit,
+                "available_requests": round(self._requests.tokens, 2),
+                "available_tokens": round(self._tokens.tokens, 2),
+                "cooldown_remaining": max(0.0, self._cooldown_until - now),
+                "total_requests": m.total_requests,
+                "delayed_requests": m.delayed_requests,
+                "average_wait_time": m.total_wait_time / m.delayed_requests if m.delayed_requests else 0,
+                "max_wait_time": m.max_wait_time,
+                "estimated_tokens": m.estimated_tokens,
+                "actual_tokens": m.actual_tokens,
+                "rate_limited_responses": m.rate_limited_responses,
+                "rate_limit_retries": m.rate_limit_retries,
+                "cancelled_reservations": m.cancelled_reservations,
+            }
+
+
+# シングルトンインスタンスを管理
+_pacer_instance: Optional[RatePacer] = None
+_pacer_lock = threading.Lock()
+
+
+def get_rate_pacer() -> RatePacer:
+    """プロセス共通のレートペーサーを取得"""
+    global _pacer_instance
+
+    if _pacer_instance is None:
+        with _pacer_lock:
+            if _pacer_instance is None:
+                _pacer_instance = RatePacer()
+
+    return _pacer_instance
@@ -0,0 +1,270 @@
+"""
+LLM呼び出しの出力トークン予算
+処理ステップと支援タイプごとに max_tokens を決めます。初期値はステップごとの固定値で、直近の呼び出しの
+出力トークン数の分布（高いパーセンタイルに余裕を持たせた値）に合わせて自動で調整します。
+出力の長さは応答時間にほぼ比例するため、短い出力で足りるステップ（状態JSONなど）の上限を下げて待ち時間を抑えます。
+
+- 予算のキーは llm_context の (step, support_type)。呼び出し元が max_tokens を指定した場合はそれを優先
+- 予算で打ち切られた場合（finish_reason が "length"）は上限（LLM_TOKEN_BUDGET_MAX）で1回だけ再試行
+  （ストリーミングは送信済みのチャンクを取り消せないため記録のみ）
+- キーごとの打ち切り率・再試行数・現在の予算を集計
+"""
+
+import os
+import math
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from module.llm_context import get_llm_context
+
+logger = logging.getLogger(__name__)
+
+# 従来の固定値（未知のステップの初期値と、再試行時の上限のデフォルト）
+DEFAULT_MAX_TOKENS = 2000
+
+# ステップごとの初期値（観測値が min_samples 件たまるまで使う）
+DEFAULT_STEP_BUDGETS: Dict[str, int] = {
+    "state_extract": 800,    # 状態スナップショットのJSON
+    "state_update": 600,     # 差分更新のJSON
+    "support_type": 300,     # 支援タイプと理由のJSON
+    "plan": 1200,            # プロジェクト計画のJSON
+    "fused_turn": 1500,      # 状態・支援タイプ・応答をまとめたJSON
+    "reply": 1000,
+    "followups": 300,        # 応答と並行して生成するフォローアップ候補のJSON
+    "rolling_summary": 700,  # 会話の累積要約（SUMMARY_MAXTOKENS 以内に収める）
+}
+
+# 応答ステップの支援タイプごとの初期値
+DEFAULT_SUPPORT_TYPE_BUDGETS: Dict[str, int] = {
+    "理解深化": 600,         # 問いかけ中心の短い応答
+    "絞り込み": 700,
+    "行動活性化": 700,
+    "視点転換": 900,
+    "意思決定": 900,
+    "道筋提示": 1200,        # 手順を並べるため長め
+}
+
+
+def extract_completion(response: Any) -> Tuple[Optional[int], Optional[str]]:
+    """レスポンス（またはストリーミングの最後のチャンク）から (出力トークン数, finish_reason) を取り出す"""
+    usage = getattr(response, "usage", None)
+    completion_tokens = getattr(usage, "completion_tokens", None) if usage is not None else None
+    choices = getattr(response, "choices", None) or []
+    finish_reason = getattr(choices[0], "finish_reason", None) if choices else None
+    return completion_tokens, finish_reason
+
+
+@dataclass(frozen=True)
+class TokenBudget:
+    """1回の呼び出しの出力トークン予算"""
+    key: Tuple[str, str]
+    max_tokens: int
+    source: str                       # caller / default / observed / retry / disabled
+
+
+@dataclass
+class BudgetStats:
+    """キーごとの観測値と打ち切りの統計"""
+    calls: int = 0
+    truncated: int = 0                # 予算で打ち切られた呼び出し数（再試行を除く）
+    retries: int = 0
+    truncated_after_retry: int = 0
+    budget: Optional[int] = None      # 観測値から求めた予算（min_samples 件未満ならNone）
+    samples: Deque[int] = field(default_factory=lambda: deque(maxlen=500))
+
+
+class TokenBudgetPolicy:
+    """ステップ・支援タイプごとの出力トークン予算"""
+
+    def __init__(
+        self,
+        enabled: Optional[bool] = None,
+        percentile: Optional[float] = None,
+        headroom: Optional[float] = None,
+        min_samples: Optional[int] = None,
+        min_tokens: int = 64,
+        max_tokens: Optional[int] = None
+    ):
+        if enabled is None:
+            enabled = os.environ.get("ENABLE_LLM_TOKEN_BUDGET", "true").lower() == "true"
+        if percentile is None:
+            percentile = float(os.environ.get("LLM_TOKEN_BUDGET_PERCENTILE", "0.99"))
+        if headroom is None:
+            headroom = float(os.environ.get("LLM_TOKEN_BUDGET_HEADROOM", "1.2"))
+        if min_samples is None:
+            min_samples = int(os.environ.get("LLM_TOKEN_BUDGET_MIN_SAMPLES", "20"))
+        if max_tokens is None:
+            max_tokens = int(os.environ.get("LLM_TOKEN_BUDGET_MAX", str(DEFAULT_MAX_TOKENS)))
+
+        self.enabled = enabled
+        self.percentile = min(max(percentile, 0.5), 1.0)
+        self.headroom = max(1.0, headroom)
+        self.min_samples = max(1, min_samples)
+        self.min_tokens = min_tokens
+        self.max_tokens = max(min_tokens, max_tokens)
+
+        self._lock = threading.Lock()
+        self._stats: Dict[Tuple[str, str], BudgetStats] = {}
+
+    # ---------------------------------
+    # 予算
+    # ---------------------------------
+
+    def budget(self, requested: Optional[int] = None) -> TokenBudget:
+        """
+        現在の llm_context の予算を取得
+
+        Args:
+            requested: 呼び出し元が指定した max_tokens（指定時はそのまま使う）
+        """
+        ctx = get_llm_context()
+        key = (ctx.step or "unspecified", ctx.support_type or "")
+        if requested is not None:
+            return TokenBudget(key, requested, "caller")
+        if not self.enabled:
+            return TokenBudget(key, DEFAULT_MAX_TOKENS, "disabled")
+
+        with self._lock:
+            stats = self._stats.get(key)
+            observed = stats.budget if stats is not None else None
+        if observed is not None:
+            return TokenBudget(key, observed, "observed")
+        return TokenBudget(key, self._default_budget(key), "default")
+
+    def _default_budget(self, key: Tuple[str, str]) -> int:
+        step, support_type = key
+        if step == "reply" and support_type in DEFAULT_SUPPORT_TYPE_BUDGETS:
+            budget = DEFAULT_SUPPORT_TYPE_BUDGETS[support_type]
+        else:
+            budget = DEFAULT_STEP_BUDGETS.get(step, DEFAULT_MAX_TOKENS)
+        return min(max(budget, self.min_tokens), self.max_tokens)
+
+    def retry_budget(self, budget: TokenBudget) -> Optional[TokenBudget]:
+        """打ち切られた呼び出しの再試行用の予算（すでに上限ならNone）"""
+        if budget.source == "caller" or budget.max_tokens >= self.max_tokens:
+            return None
+        return TokenBudget(budget.key, self.max_tokens, "retry")
+
+    # ---------------------------------
+    # 観測
+    # ---------------------------------
+
+    def observe(self, budget: TokenBudget, response: Any) -> bool:
+        """呼び出し結果を記録し、予算で打ち切られたかを返す"""
+        return self.observe_completion(budget, *extract_completion(response))
+
+    def observe_completion(
+        self,
+        budget: TokenBudget,
+        completion_tokens: Optional[int],
+        finish_reason: Optional[str]
+    ) -> bool:
+        """出力トークン数と finish_reason を記録（ストリーミングはチャンクから集めた値で呼ぶ）"""
+        truncated = finish_reason == "length"
+        retry = budget.source == "retry"
+
+        with self._lock:
+            stats = self._stats.get(budget.key)
+            if stats is None:
+                stats = self._stats[budget.key] = BudgetStats()
+            if retry:
+                stats.retries += 1
+                stats.truncated_after_retry += int(truncated)
+            else:
+                stats.calls += 1
+                stats.truncated += int(truncated)
+            if completion_tokens is not None:
+                # 打ち切られた値は実際の長さより短いが、余裕を掛けるので次の予算は広がる
+                stats.samples.append(completion_tokens)
+                if len(stats.samples) >= self.min_samples:
+                    stats.budget = self._observed_budget(stats.samples)
+        return truncated
+
+    def _observed_budget(self, samples: Deque[int]) -> int:
+        ordered = sorted(samples)
+        value = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+        return min(max(math.ceil(value * self.headroom), self.min_tokens), self.max_tokens)
+
+    # ---------------------------------
+    # 呼び出し
+    # ---------------------------------
+
+    async def complete(self, budget: TokenBudget, call: Callable[[int], Awaitable[Any]]) -> Any:
+        """
+        予算で call を実行し、打ち切られたら上限の予算で1回だけ再試行する
+
+        Args:
+            call: max_tokens を受け取ってLLMのレスポンスを返す関数
+        """
+        response = await call(budget.max_tokens)
+        if self.observe(budget, response):
+            retry = self.retry_budget(budget)
+            if retry is not None:
+                logger.info(f"✂️ 出力が予算で打ち切られたため再試行: {budget.key} {budget.max_tokens} → {retry.max_tokens}")
+                response = await call(retry.max_tokens)
+                self.observe(retry, response)
+        return response
+
+    def complete_sync(self, budget: TokenBudget, call: Callable[[int], Any]) -> Any:
+        """complete の同期版"""
+        response = call(budget.max_tokens)
+        if self.observe(budget, response):
+            retry = self.retry_budget(budget)
+            if retry is not None:
+                logger.info(f"✂️ 出力が予算で打ち切られたため再試行: {budget.key} {budget.max_tokens} → {retry.max_tokens}")
+                response = call(retry.max_tokens)
+                self.observe(retry, response)
+        return response
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """キーごとの予算と打ち切り率を取得"""
+        with self._lock:
+            budgets = []
+            for (step, support_type), stats in self._stats.items():
+                samples = sorted(stats.samples)
+                budgets.append({
+                    "step": step,
+                    "support_type": support_type or None,
+                    "budget": stats.budget or self._default_budget((step, support_type)),
+                    "observed": stats.budget is not None,
+                    "calls": stats.calls,
+                    "truncation_rate": stats.truncated / stats.calls if stats.calls else 0,
+                    "retries": stats.retries,
+                    "truncated_after_retry": stats.truncated_after_retry,
+                    "p50_completion_tokens": samples[len(samples) // 2] if samples else None,
+                    "max_completion_tokens": samples[-1] if samples else None,
+                })
+            total_calls = sum(stats.calls for stats in self._stats.values())
+            total_truncated = sum(stats.truncated for stats in self._stats.values())
+            return {
+                "enabled": self.enabled,
+                "percentile": self.percentile,
+                "headroom": self.headroom,
+                "max_tokens": self.max_tokens,
+                "truncation_rate": total_truncated / total_calls if total_calls else 0,
+                "budgets": sorted(budgets, key=lambda row: (row["step"], row["support_type"] or "")),
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+
+# シングルトンインスタンスを管理
+_policy_instance: Optional[TokenBudgetPolicy] = None
+_policy_lock = threading.Lock()
+
+
+def get_token_budget_policy() -> TokenBudgetPolicy:
+    """プロセス共通の出力トークン予算を取得"""
+    global _policy_instance
+
+    if _policy_instance is None:
+        with _policy_lock:
+            if _policy_instance is None:
+                _policy_instance = TokenBudgetPolicy()
+
+    return _policy_instance
@@ -50,6 +50,22 @@ dev_system_prompt = """
 - 200字を超える場合は、約100字ごとに自然な段落で区切ってください。
 """
 
+# 会話の累積要約の更新用プロンプト（context_manager.ContextManager で使用）
+ROLLING_SUMMARY_PROMPT = """あなたは探究学習の対話記録係です。これまでの会話の要約に、その後の会話の内容を取り込んで要約を更新してください。
+
+これまでの要約:
+{previous_summary}
+
+その後の会話:
+{new_messages}
+
+注意:
+- 生徒の探究テーマ・問い・決めたこと・試したこと・困っていることを優先して残す
+- 挨拶や相づち、アシスタントの言い回しは残さない
+- 古い内容ほど短くまとめ、{max_chars}文字以内の箇条書きにする
+
+更新した要約のみを出力:"""
+
 # ===== 対話エージェント用プロンプト =====
 
 # 状態抽出用プロンプト
@@ -84,6 +100,26 @@ STATE_EXTRACT_PROMPT = """あなたは学習メンターAIです。学習者の
 
 出力は厳密なJSON形式のみ:"""
 
+# 状態の差分更新用プロンプト（前回の状態 + 新しいメッセージのみ）
+STATE_UPDATE_PROMPT = """あなたは学習メンターAIです。前回までの学習者の状態（StateSnapshot）と、その後に追加された会話から、現在の状態をJSONで生成してください。
+
+前回の状態:
+{previous_state}
+
+前回以降の会話:
+{new_messages}
+
+プロジェクト情報（参考）:
+{project_context}
+
+注意:
+- 新しい会話で変化した項目だけを更新し、それ以外は前回の状態を引き継ぐ
+- 解消したブロッカーや不確実性は削除する
+- 出力するフィールドは前回の状態と同じ（goal, purpose, time_horizon, last_action, blockers, uncertainties,
+  options_considered, resources, affect, progress_signal）
+
+出力は厳密なJSON形式のみ:"""
+
 # プロジェクト計画生成用プロンプト
 PLAN_GENERATION_PROMPT = """あなたは探究学習の専門家AIです。生徒のプロジェクト情報と状態を分析し、最適な学習計画を立ててください。
 
@@ -167,8 +203,10 @@ StateSnapshot:
 {{"support_type": "選択した支援タイプ", "reason": "選択理由（1-2文）", "confidence": 0.0-1.0}}"""
 
 # 応答生成用プロンプトテンプレート
-def generate_response_prompt(selected_acts, support_type, state, user_message):
-    """LLM応答生成用のプロンプトを動的に生成"""
+def generate_response_prompt(selected_acts, support_type, state, user_message, include_followups=True):
+    """LLM応答生成用のプロンプトを動的に生成（include_followups=False の場合はフォローアップ候補を別途生成するため応答文のみ）"""
+    followups_field = ''',
+    "followups": ["フォローアップ1", "フォローアップ2", "フォローアップ3"]''' if include_followups else ""
     return f"""あなたは探究学習のメンターAIです。
         
 選択された発話アクト: {selected_acts}
@@ -185,6 +223,68 @@ Socratic（問いかけ中心）なアプローチを優先し、必要最小限
 
 応答形式（JSON）:
 {{
-    "natural_reply": "自然な応答文",
-    "followups": ["フォローアップ1", "フォローアップ2", "フォローアップ3"]
-}}"""
\ No newline at end of file
+    "natural_reply": "自然な応答文"{followups_field}
+}}"""
+
+# フォローアップ候補生成用プロンプト（応答生成と並行して実行）
+def generate_followups_prompt(selected_acts, support_type, state, user_message):
+    """応答文を待たずに、状態と発話アクトからフォローアップ候補を生成するプロンプト"""
+    return f"""あなたは探究学習のメンターAIです。学習者が次に取れる行動や、次に投げかけられる短い発言の候補を3つ考えてください。
+
+選択された発話アクト: {selected_acts}
+支援タイプ: {support_type}
+学習者の状態:
+- 目標: {state.goal}
+- ブロッカー: {', '.join(state.blockers) if state.blockers else 'なし'}
+- 不確実性: {', '.join(state.uncertainties) if state.uncertainties else 'なし'}
+
+ユーザーのメッセージ: {user_message}
+
+各候補は学習者の立場で書いた20文字程度の短い文にしてください。
+
+出力形式（JSON）:
+{{"followups": ["フォローアップ1", "フォローアップ2", "フォローアップ3"]}}"""
+
+# 1回のLLM呼び出しで状態抽出・支援タイプ判定・発話アクト選択・応答生成を行うプロンプト（fusedモード）
+FUSED_TURN_PROMPT = """あなたは探究学習のメンターAIです。会話履歴と最新のメッセージから、次の4つを順に考え、1つのJSONで出力してください。
+
+1. state: 学習者の現在の状態（StateSnapshot）
+2. support_type: 最も適切な支援タイプ（候補から1つ）
+3. selected_acts: 応答で使う発話アクト（候補から1〜2個）
+4. natural_reply / followups: 選んだ支援タイプと発話アクトに沿った応答
+
+支援タイプの候補: {support_types}
+- ループ兆候が強い → 視点転換 または 絞り込み
+- 不確実性が核心 → 道筋提示 または 行動活性化
+- 行動ゼロ＆不安高 → 行動活性化
+- スコープ過大/選択肢過多 → 絞り込み または 意思決定
+
+発話アクトの候補: {speech_acts}
+（Clarify=理解を深める質問, Inform=情報提供, Probe=向き合うべき問い, Act=行動の提案,
+ Reframe=視点の再構築, Outline=道筋の整理, Decide=意思決定支援, Reflect=要約・整合チェック）
+
+会話履歴:
+{conversation}
+
+ユーザーのメッセージ: {user_message}
+
+注意:
+- 会話から読み取れない状態は適切なデフォルト値を使用
+- 応答はSocratic（問いかけ中心）なアプローチを優先し、必要最小限の情報提供に留める
+
+出力は厳密なJSON形式のみ:
+{{
+  "state": {{
+    "goal": "学習者の目標", "purpose": "学習の目的", "time_horizon": "今日/今週/今月など",
+    "blockers": [], "uncertainties": [], "options_considered": [],
+    "affect": {{"interest": 0-5, "anxiety": 0-5, "excitement": 0-5}},
+    "progress_signal": {{"actions_in_last_7_days": 数値, "novelty_ratio": 0.0-1.0, "looping_signals": [], "scope_breadth": 1-10}}
+  }},
+  "support_type": "支援タイプ",
+  "support_reason": "選択理由（1-2文）",
+  "confidence": 0.0-1.0,
+  "selected_acts": ["発話アクト"],
+  "act_reason": "アクトの選択理由",
+  "natural_reply": "自然な応答文",
+  "followups": ["フォローアップ1", "フォローアップ2", "フォローアップ3"]
+}}"""